@@ -93,7 +93,7 @@
 
 # import functions
 
-import numpy as np
+import argparse
 import pyodbc
 import socket
 import sys
@@ -103,17 +103,43 @@ from datetime import datetime
 import yaml
 import os
 import copy
-import re
-import pandas as pd
-from timezonefinder import TimezoneFinder
-from pytz import timezone, utc
+import pickle
+import queue
+import threading
+from zoneinfo import ZoneInfo
 import time
 #import GothamFunctions
 
 debug_status = 0
+shared_prefix_status = 1 # 1: run shared allocation stages once for baseline and pending tables until the first calculated transfer
+async_write_status = 1 # 1: database writes of the allocation loop run on a background writer thread while the next stage computes
+city_parallel_status = 0 # 1: inventory, harvest, and prior harvest allocations of each step run per city in a process pool
+city_parallel_validation_status = 0 # 1: also run the serial allocations of each step, compare, and keep the serial result on a mismatch
+city_parallel_worker_count = None # worker processes for city_parallel_status (None: CPU count)
+
+# spawned pool workers import this script as __mp_main__ and only need the function definitions
+is_main_process = __name__ != '__mp_main__'
+
+# command line options (unknown arguments, e.g. from a notebook kernel, are ignored)
+run_parser = argparse.ArgumentParser(description = 'CustomerAllocations')
+run_parser.add_argument('--watch', action = 'store_true', help = 'poll the inventory gate on one connection until inventory lands, then run')
+run_parser.add_argument('--watch-interval', type = float, default = 60, help = 'first wait between readiness polls (seconds)')
+run_parser.add_argument('--watch-max-interval', type = float, default = 600, help = 'longest wait between readiness polls (seconds)')
+run_parser.add_argument('--watch-until', default = None, help = 'stop watching at this local time (HH:MM)')
+run_parser.add_argument('--watch-trigger-file', default = None, help = 'local file touched by the inventory load to trigger an immediate poll')
+run_parser.add_argument('--resume', action = 'store_true', help = 'continue from the last completed allocation step of a failed run today')
+run_parser.add_argument('--checkpoint-dir', default = None, help = 'local folder for allocation checkpoints (defaults to allocation_checkpoint next to the script)')
+run_parser.add_argument('--parquet-dir', default = None, help = 'also write the allocation outputs as a Parquet dataset partitioned by load date, tier, and is_pending')
+(run_args, unknown_run_args) = run_parser.parse_known_args()
+
+# Parquet export of the fact table writes (None: SQL only)
+parquet_sink = None
+if run_args.parquet_dir is not None and is_main_process:
+    import GothamFunctions
+    parquet_sink = GothamFunctions.ParquetSink(run_args.parquet_dir)
 
 #CustomerInventoryAllocation_Facts
-def customerInventoryAllocation(forecast_date, inventory_out_LoL, demand_in_LoL, facilities_LoL,inv_transfers_LoL, tier_count):
+def customerInventoryAllocation(forecast_date, inventory_out_LoL, demand_in_LoL, facilities_LoL,inv_transfers_LoL, tier_count, facility_topology = None):
     '''
     #### Inputs:
     - forecast_date: date to compare to the demand allocation date
@@ -141,6 +167,7 @@ def customerInventoryAllocation(forecast_date, inventory_out_LoL, demand_in_LoL,
         6. List of enjoy-by-dates
         7. List of transfer quantites
     - tier_count: integer tier count for inventory allocation
+    - facility_topology: optional FacilityTopology of facilities_LoL shared by the run (computed here if None)
 
         
     #### Algorithm:
@@ -218,6 +245,8 @@ def customerInventoryAllocation(forecast_date, inventory_out_LoL, demand_in_LoL,
     # initialize facilities dimension
     fd_facility_id_list = facilities_LoL[0]
     fd_city_short_code_list = facilities_LoL[1]
+    if facility_topology is None:
+        facility_topology = FacilityTopology(facilities_LoL)
     
     #transfers
     tsf_ship_date_list = inv_transfers_LoL[0]
@@ -240,7 +269,7 @@ def customerInventoryAllocation(forecast_date, inventory_out_LoL, demand_in_LoL,
             tsf_enjoy_by_date = tsf_enjoy_by_date_list[tsf_idx]
             tsf_transfer_qty = tsf_transfer_qty_list[tsf_idx]
 
-            iaf_fid_indices = [i for i, x in enumerate(iaf_inventory_facility_id_list) if fd_city_short_code_list[fd_facility_id_list.index(x)] == fd_city_short_code_list[fd_facility_id_list.index(tsf_facility_id)]]        
+            iaf_fid_indices = [i for i, x in enumerate(iaf_inventory_facility_id_list) if facility_topology.sameCity(x, tsf_facility_id)]        
             iaf_pid_indices = [i for i, x in enumerate(iaf_product_id_list) if x == tsf_product_id]
             iaf_ebd_indices = [i for i, x in enumerate(iaf_enjoy_by_date_list) if x == tsf_enjoy_by_date]
 
@@ -292,7 +321,7 @@ def customerInventoryAllocation(forecast_date, inventory_out_LoL, demand_in_LoL,
             product_id_indices = [j for j, x in enumerate(iaf_product_id_list) if x == product_id]
             # inventory facility ID's matching demand_facility_id
             #inventory_facility_id_indices = [k for k, y in enumerate(cccif_facility_id_list) if y == demand_facility_id] 
-            inventory_facility_id_indices = [k for k, y in enumerate(iaf_inventory_facility_id_list) if fd_city_short_code_list[fd_facility_id_list.index(y)] == fd_city_short_code_list[fd_facility_id_list.index(demand_facility_id)]]
+            inventory_facility_id_indices = [k for k, y in enumerate(iaf_inventory_facility_id_list) if facility_topology.sameCity(y, demand_facility_id)]
  
             
             product_facility_indices = list(set(product_id_indices) & set(inventory_facility_id_indices))
@@ -456,7 +485,7 @@ def customerInventoryAllocation(forecast_date, inventory_out_LoL, demand_in_LoL,
     return (inventory_allocation_out_LoL, inventory_demand_out_LoL)
 
 
-def writeCustomerInventoryAllocation(forecast_date,inventory_allocation_out_LoL,tier_count, is_pending = 0):
+def writeCustomerInventoryAllocation(forecast_date,inventory_allocation_out_LoL,tier_count, is_pending = 0, cnxn = None):
     '''
     #### Inputs:
     - forecast_date: date of the forecast
@@ -470,10 +499,12 @@ def writeCustomerInventoryAllocation(forecast_date,inventory_allocation_out_LoL,
         7. List of end-of-day quantities cooresponding to each combination of greenhouse/product/enjoy-by-date
     - tier_count: integer tier count for inventory allocation
     - is_pending: integer boolean 1 for Pending table or 0 for baseline table
+    - cnxn: optional open connection (the connection of the background writer)
         
     #### Algorithm:
     - load inputs
     - loop through inventory allocation lists and insert entries into CustomerInventoryAllocation_Facts
+    - write the inserted rows to the Parquet dataset if --parquet-dir is set
     - return string indicating completion
     #### Output: string indicating completion
     '''
@@ -501,7 +532,10 @@ def writeCustomerInventoryAllocation(forecast_date,inventory_allocation_out_LoL,
 
 
 
-    cnxn = pyodbc.connect(CONNECTIONSTRING)   
+    # use the connection of the background writer if there is one
+    is_own_connection = cnxn is None
+    if is_own_connection:
+        cnxn = pyodbc.connect(CONNECTIONSTRING)
     cnxn_cursor = cnxn.cursor()
     
     sql = """
@@ -541,6 +575,8 @@ def writeCustomerInventoryAllocation(forecast_date,inventory_allocation_out_LoL,
         VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?);
         """ 
 
+    written_row_list = list()
+
     iaf_inventory_facility_id_list = inventory_allocation_out_LoL[0]
     iaf_product_id_list = inventory_allocation_out_LoL[1]
     iaf_enjoy_by_date_list = inventory_allocation_out_LoL[2]
@@ -572,7 +608,7 @@ def writeCustomerInventoryAllocation(forecast_date,inventory_allocation_out_LoL,
                               load_date,
                               to_date,
                               is_active)
-            cnxn_cursor.execute(sql, tuple_to_write)
+            written_row_list += [tuple_to_write]
             inventory_allocation_id += 1
         if type(allocated_qty) == list:
             for aq_idx in range(len(allocated_qty)):
@@ -591,21 +627,423 @@ def writeCustomerInventoryAllocation(forecast_date,inventory_allocation_out_LoL,
                                   load_date,
                                   to_date,
                                   is_active)
-                cnxn_cursor.execute(sql, tuple_to_write)
+                written_row_list += [tuple_to_write]
                 inventory_allocation_id += 1
 
                 
 
+    # one batch per table
+    if len(written_row_list) > 0:
+        cnxn_cursor.fast_executemany = True
+        cnxn_cursor.executemany(sql, written_row_list)
+
     cnxn.commit()
     cnxn_cursor.close()
-    cnxn.close()
+    if is_own_connection:
+        cnxn.close()
+
+    if parquet_sink is not None:
+        parquet_sink.write('CustomerInventoryAllocation_Facts', written_row_list, tier_count, is_pending)
     
     return 'CustomerInventoryAllocation_Facts for ' + str(forecast_date) + ' pau'
 
 
 
+class FacilityTopology:
+    '''
+    #### Inputs:
+        - facilities_LoL: greenhouse IDs, city short codes, and main cooler greenhouse IDs from Greenhouses_Dim
+          (MainCoolerGreenhouseID, None if the greenhouse is its own main cooler)
+        - location_name_list: optional greenhouse names aligned with facilities_LoL
+    #### Algorithm:
+    - precompute once per run, as arrays indexed by greenhouse ID
+        - greenhouse city short code
+        - main cooler greenhouse of the greenhouse city (demand, inventory, and harvest of a city are consolidated at its main cooler)
+    - a greenhouse without a main cooler greenhouse ID is its own main cooler, so a new greenhouse only needs a
+      Greenhouses_Dim row (with MainCoolerGreenhouseID set if it consolidates at another greenhouse)
+    - city short codes are stripped of CHAR padding
+
+    #### Output: O(1) lookups by greenhouse ID
+        - city(greenhouse_id): city short code (None if the greenhouse is not in Greenhouses_Dim)
+        - mainCooler(greenhouse_id): main cooler greenhouse ID (the greenhouse itself if it has none or is not in Greenhouses_Dim)
+        - locationName(greenhouse_id): greenhouse name (None if unknown)
+        - sameCity(greenhouse_id, other_greenhouse_id): boolean, both greenhouses are in the same known city
+    '''
+
+    def __init__(self, facilities_LoL, location_name_list = None):
+        fd_facility_id_list = facilities_LoL[0]
+        fd_city_short_code_list = facilities_LoL[1]
+        fd_main_cooler_id_list = facilities_LoL[2]
+
+        # first match per greenhouse ID wins (same as fd_facility_id_list.index)
+        fd_idx_dict = dict()
+        for fd_idx in range(len(fd_facility_id_list)):
+            fd_idx_dict.setdefault(int(fd_facility_id_list[fd_idx]), fd_idx)
+
+        array_length = max(fd_idx_dict.keys(), default = -1) + 1
+        self.city_array = np.full(array_length, None, dtype = object)
+        self.location_name_array = np.full(array_length, None, dtype = object)
+        self.main_cooler_array = np.arange(array_length, dtype = np.int64)
+        for (greenhouse_id, fd_idx) in fd_idx_dict.items():
+            city = fd_city_short_code_list[fd_idx]
+            if city is not None:
+                city = city.rstrip()
+            self.city_array[greenhouse_id] = city
+            if location_name_list is not None:
+                self.location_name_array[greenhouse_id] = location_name_list[fd_idx]
+            if fd_main_cooler_id_list[fd_idx] is not None:
+                self.main_cooler_array[greenhouse_id] = int(fd_main_cooler_id_list[fd_idx])
+
+    def __contains__(self, greenhouse_id):
+        return greenhouse_id is not None and 0 <= greenhouse_id < len(self.city_array) and self.city_array[greenhouse_id] is not None
+
+    def city(self, greenhouse_id):
+        if greenhouse_id not in self:
+            return None
+        return self.city_array[greenhouse_id]
+
+    def mainCooler(self, greenhouse_id):
+        if greenhouse_id not in self:
+            return greenhouse_id
+        return int(self.main_cooler_array[greenhouse_id])
+
+    def locationName(self, greenhouse_id):
+        if greenhouse_id not in self:
+            return None
+        return self.location_name_array[greenhouse_id]
+
+    def sameCity(self, greenhouse_id, other_greenhouse_id):
+        city = self.city(greenhouse_id)
+        return city is not None and city == self.city(other_greenhouse_id)
+
+
+class FacilityTimezones:
+    '''
+    #### Inputs:
+        - cache_path: optional local yaml table of IANA time zone names by "latitude,longitude" (defaults to facility_timezones.yml next to the script)
+    #### Algorithm:
+    - facility coordinates essentially never change, so each coordinate pair is resolved to a time zone name once and stored in the cache table
+    - timezonefinder (slow import and model load) is imported only when a coordinate pair is not in the cache table
+    - UTC offsets are computed from the cached time zone name with the standard library zoneinfo
+
+    #### Output:
+        - timezoneName(lat, lng): IANA time zone name of the coordinates
+        - utcOffsetHours(lat, lng, local_datetime = None): offset from UTC in hours at local_datetime (defaults to now), negative west of UTC
+        - save(): writes newly resolved coordinates back to the cache table
+    '''
+
+    cache_file_name = "facility_timezones.yml"
+
+    def __init__(self, cache_path = None):
+        if cache_path is None:
+            cache_path = os.path.join(sys.path[0], self.cache_file_name)
+        self.cache_path = cache_path
+        self.timezone_dict = dict()
+        self.timezone_finder = None
+        self.changed = 0
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as ymlfile:
+                self.timezone_dict = yaml.load(ymlfile, Loader=yaml.SafeLoader) or dict()
+
+    @staticmethod
+    def key(lat, lng):
+        return '{:.6f},{:.6f}'.format(float(lat), float(lng))
+
+    def timezoneName(self, lat, lng):
+        coordinates_key = self.key(lat, lng)
+        if coordinates_key not in self.timezone_dict:
+            if self.timezone_finder is None:
+                from timezonefinder import TimezoneFinder
+                self.timezone_finder = TimezoneFinder()
+            timezone_name = self.timezone_finder.certain_timezone_at(lng=float(lng), lat=float(lat))
+            if timezone_name is None:
+                raise ValueError('no time zone found for facility coordinates ' + coordinates_key)
+            self.timezone_dict[coordinates_key] = timezone_name
+            self.changed = 1
+        return self.timezone_dict[coordinates_key]
+
+    def utcOffsetHours(self, lat, lng, local_datetime = None):
+        if local_datetime is None:
+            local_datetime = datetime.now()
+        tz_target = ZoneInfo(self.timezoneName(lat, lng))
+        return local_datetime.replace(tzinfo=tz_target).utcoffset().total_seconds() / 3600
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as ymlfile:
+            yaml.safe_dump(self.timezone_dict, ymlfile, default_flow_style=False)
+        os.replace(tmp_path, self.cache_path)
+        self.changed = 0
+
+
+
+class AllocationTracker:
+    '''
+    #### Inputs:
+        - key_list: optional list of (date, crop ID, greenhouse ID) keys that have an allocation
+        - starting_ps_list: optional list of starting plant sites for each key
+        - allocated_ps_list: optional list of allocated plant sites for each key
+        - complete_key_list: optional list of keys that have been fully allocated
+    #### Algorithm:
+    - mid-allocation tracking of harvest plant sites by date/crop/greenhouse across all time and tier
+        - key_idx_dict maps each key to its position in the parallel lists for O(1) membership and updates
+        - complete_key_set holds the keys that have been fully allocated
+    - customerHarvestAllocation, priorHarvestAllocation, and calculateTransfers update the tracker in place
+    - writeAllocated persists the tracker from toArrays and readAllocated rebuilds it from Allocated_Facts
+
+    #### Output: AllocationTracker
+        - key(date, crop_id, greenhouse_id): tracking key
+        - allocated(key): allocated plant sites (0 if the key has no allocation)
+        - available(key): starting plant sites minus allocated plant sites (0 if the key has no allocation)
+        - add(key, plant_sites, starting_ps): add allocated plant sites, tracking the key with its starting plant sites if new
+        - subtract(key, plant_sites): remove allocated plant sites from a tracked key
+        - isComplete(key), complete(key): check and mark a key as fully allocated
+        - partition(partition_function), merge(tracker_list): split by greenhouse (e.g. by city) and merge back
+        - toDict(): order independent state for comparisons
+        - toArrays(): dict of arrays for persistence
+            1. date: allocated dates
+            2. crop_id: crop IDs
+            3. greenhouse_id: greenhouse IDs
+            4. starting_ps: starting plant sites
+            5. allocated_ps: allocated plant sites
+            6. is_complete: is complete boolean flags
+    '''
+
+    def __init__(self, key_list = None, starting_ps_list = None, allocated_ps_list = None, complete_key_list = None):
+        self.key_list = list()
+        self.starting_ps_list = list()
+        self.allocated_ps_list = list()
+        self.key_idx_dict = dict()
+        self.complete_key_set = set()
+
+        if key_list is not None:
+            for key_idx in range(len(key_list)):
+                self.add(key_list[key_idx], allocated_ps_list[key_idx], starting_ps_list[key_idx])
+        if complete_key_list is not None:
+            for key in complete_key_list:
+                self.complete(key)
+
+    @staticmethod
+    def key(date, crop_id, greenhouse_id):
+        # dates from the database may come back as datetimes
+        if isinstance(date, DT.datetime):
+            date = date.date()
+        return (date, int(crop_id), int(greenhouse_id))
+
+    def __contains__(self, key):
+        return key in self.key_idx_dict
+
+    def __len__(self):
+        return len(self.key_list)
+
+    def __eq__(self, other):
+        if not isinstance(other, AllocationTracker):
+            return NotImplemented
+        return (self.key_list == other.key_list
+                and self.starting_ps_list == other.starting_ps_list
+                and self.allocated_ps_list == other.allocated_ps_list
+                and self.complete_key_set == other.complete_key_set)
+
+    def allocated(self, key):
+        key_idx = self.key_idx_dict.get(key)
+        if key_idx is None:
+            return 0
+        return self.allocated_ps_list[key_idx]
+
+    def available(self, key):
+        key_idx = self.key_idx_dict.get(key)
+        if key_idx is None:
+            return 0
+        return self.starting_ps_list[key_idx] - self.allocated_ps_list[key_idx]
+
+    def add(self, key, plant_sites, starting_ps = 0):
+        key_idx = self.key_idx_dict.get(key)
+        if key_idx is None:
+            self.key_idx_dict[key] = len(self.key_list)
+            self.key_list += [key]
+            self.starting_ps_list += [starting_ps]
+            self.allocated_ps_list += [plant_sites]
+        else:
+            self.allocated_ps_list[key_idx] += plant_sites
+
+    def subtract(self, key, plant_sites):
+        self.allocated_ps_list[self.key_idx_dict[key]] -= plant_sites
+
+    def isComplete(self, key):
+        return key in self.complete_key_set
+
+    def complete(self, key):
+        self.complete_key_set.add(key)
+
+    def partition(self, partition_function):
+        # split by partition_function(greenhouse ID), e.g. greenhouse city: dictionary of AllocationTracker by partition
+        tracker_dict = dict()
+        for key_idx in range(len(self.key_list)):
+            key = self.key_list[key_idx]
+            tracker_dict.setdefault(partition_function(key[2]), AllocationTracker()).add(key, self.allocated_ps_list[key_idx], self.starting_ps_list[key_idx])
+        for key in self.complete_key_set:
+            tracker_dict.setdefault(partition_function(key[2]), AllocationTracker()).complete(key)
+        return tracker_dict
+
+    @classmethod
+    def merge(cls, tracker_list):
+        # union of trackers with disjoint keys, in list order
+        merged_tracker = cls()
+        for tracker in tracker_list:
+            for key_idx in range(len(tracker.key_list)):
+                merged_tracker.add(tracker.key_list[key_idx], tracker.allocated_ps_list[key_idx], tracker.starting_ps_list[key_idx])
+            merged_tracker.complete_key_set |= tracker.complete_key_set
+        return merged_tracker
+
+    def toDict(self):
+        # order independent state: key -> (starting plant sites, allocated plant sites, is complete)
+        tracker_dict = {key: (None, None, 1) for key in self.complete_key_set}
+        for key_idx in range(len(self.key_list)):
+            key = self.key_list[key_idx]
+            tracker_dict[key] = (self.starting_ps_list[key_idx], self.allocated_ps_list[key_idx], int(key in self.complete_key_set))
+        return tracker_dict
+
+    def toArrays(self):
+        return {'date': np.array([key[0] for key in self.key_list], dtype = 'datetime64[D]'),
+                'crop_id': np.array([key[1] for key in self.key_list], dtype = np.int64),
+                'greenhouse_id': np.array([key[2] for key in self.key_list], dtype = np.int64),
+                'starting_ps': np.array(self.starting_ps_list, dtype = np.int64),
+                'allocated_ps': np.array(self.allocated_ps_list, dtype = np.int64),
+                'is_complete': np.array([int(key in self.complete_key_set) for key in self.key_list], dtype = np.int64)}
+
+
+
+class HarvestCube:
+    '''
+    #### Inputs:
+        - harvest_in_LoL: harvest lists from HarvestForecastSeasonality_Facts (see customerHarvestAllocation)
+        - facilities_LoL: greenhouse IDs and city short codes
+        - facility_topology: optional FacilityTopology of facilities_LoL (computed here if None)
+    #### Algorithm:
+    - group the harvest rows once by (harvest date, crop ID, city) and by (harvest date, crop ID, greenhouse line ID)
+    - per group, keep NumPy arrays of
+        - row count and total expected plant sites
+        - whole and loose grams per plant site weighted by expected plant sites
+        - standard deviation of whole and loose grams per plant site across lines
+    - city groups are also kept over rows with positive expected plant sites only, with the sorted harvest dates per (crop ID, city)
+    - customerHarvestAllocation, priorHarvestAllocation, and writeHarvestUnallocated read a group in O(1)
+      instead of scanning the harvest lists for every allocation key
+
+    #### Output: stats tuples (None if the group has no harvest rows)
+        - cityStats(harvest_date, crop_id, city, positive = 0): city group, positive = 1 for positive expected plant sites only
+        - lineStats(harvest_date, crop_id, facility_line_id): greenhouse line group
+        - cityHarvestDates(crop_id, city, first_harvest_day, last_harvest_day): sorted harvest dates with positive expected plant sites
+        - city(greenhouse_id): city short code of a greenhouse
+        - stats tuple:
+            1. total expected plant sites (int)
+            2. mean whole grams per plant site weighted by expected plant sites, rounded to two decimals (0 if no plant sites)
+            3. mean loose grams per plant site weighted by expected plant sites, rounded to two decimals (0 if no plant sites)
+            4. standard deviation of whole grams per plant site, rounded to two decimals
+            5. standard deviation of loose grams per plant site, rounded to two decimals
+    '''
+
+    def __init__(self, harvest_in_LoL, facilities_LoL, facility_topology = None):
+        hfsf_harvest_date_list = harvest_in_LoL[0]
+        hfsf_facility_id_list = harvest_in_LoL[1]
+        hfsf_facility_line_id_list = harvest_in_LoL[2]
+        hfsf_crop_id_list = harvest_in_LoL[3]
+        hfsf_expected_plant_sites_list = harvest_in_LoL[4]
+        hfsf_avg_headweight_list = harvest_in_LoL[5]
+        hfsf_loose_grams_per_plant_site_list = harvest_in_LoL[6]
+
+        # city of each greenhouse
+        if facility_topology is None:
+            facility_topology = FacilityTopology(facilities_LoL)
+        self.facility_topology = facility_topology
+
+        # group index of every harvest row
+        self.city_key_idx_dict = dict()
+        self.line_key_idx_dict = dict()
+        hfsf_city_group_array = np.zeros(len(hfsf_harvest_date_list), dtype = np.int64)
+        hfsf_line_group_array = np.zeros(len(hfsf_harvest_date_list), dtype = np.int64)
+        for hfsf_idx in range(len(hfsf_harvest_date_list)):
+            city_key = (hfsf_harvest_date_list[hfsf_idx], hfsf_crop_id_list[hfsf_idx], self.facility_topology.city(hfsf_facility_id_list[hfsf_idx]))
+            line_key = (hfsf_harvest_date_list[hfsf_idx], hfsf_crop_id_list[hfsf_idx], hfsf_facility_line_id_list[hfsf_idx])
+            hfsf_city_group_array[hfsf_idx] = self.city_key_idx_dict.setdefault(city_key, len(self.city_key_idx_dict))
+            hfsf_line_group_array[hfsf_idx] = self.line_key_idx_dict.setdefault(line_key, len(self.line_key_idx_dict))
+
+        ps_array = np.array(hfsf_expected_plant_sites_list, dtype = float)
+        whole_gpps_array = np.array(hfsf_avg_headweight_list, dtype = float)
+        loose_gpps_array = np.array(hfsf_loose_grams_per_plant_site_list, dtype = float)
+        all_mask = np.ones(len(ps_array), dtype = bool)
+
+        self.city_stats_dict = self.groupStats(hfsf_city_group_array, len(self.city_key_idx_dict), ps_array, whole_gpps_array, loose_gpps_array, all_mask)
+        self.positive_city_stats_dict = self.groupStats(hfsf_city_group_array, len(self.city_key_idx_dict), ps_array, whole_gpps_array, loose_gpps_array, ps_array > 0)
+        self.line_stats_dict = self.groupStats(hfsf_line_group_array, len(self.line_key_idx_dict), ps_array, whole_gpps_array, loose_gpps_array, all_mask)
+
+        # harvest dates with positive expected plant sites by crop/city, sorted for range searches
+        self.city_harvest_dates_dict = dict()
+        for (harvest_date, crop_id, city), group_idx in self.city_key_idx_dict.items():
+            if self.positive_city_stats_dict['row_count'][group_idx] > 0:
+                self.city_harvest_dates_dict.setdefault((crop_id, city), []).append(harvest_date)
+        for harvest_dates_list in self.city_harvest_dates_dict.values():
+            harvest_dates_list.sort()
+
+    @staticmethod
+    def groupStats(group_array, group_count, ps_array, whole_gpps_array, loose_gpps_array, row_mask):
+        group_array = group_array[row_mask]
+        ps_array = ps_array[row_mask]
+        whole_gpps_array = whole_gpps_array[row_mask]
+        loose_gpps_array = loose_gpps_array[row_mask]
+
+        row_count_array = np.bincount(group_array, minlength = group_count)
+        total_ps_array = np.bincount(group_array, weights = ps_array, minlength = group_count)
+        has_ps_mask = total_ps_array != 0
+        has_rows_mask = row_count_array > 0
+
+        stats_dict = {'row_count': row_count_array, 'total_ps': total_ps_array}
+        for (gpps_str, gpps_array) in [('whole', whole_gpps_array), ('loose', loose_gpps_array)]:
+            # GPPS normalized by expected plant sites
+            numerator_array = np.bincount(group_array, weights = gpps_array * ps_array, minlength = group_count)
+            stats_dict['mean_' + gpps_str] = np.divide(numerator_array, total_ps_array, out = np.zeros(group_count), where = has_ps_mask)
+
+            # population standard deviation across the rows of the group (np.std)
+            row_mean_array = np.divide(np.bincount(group_array, weights = gpps_array, minlength = group_count), row_count_array,
+                                       out = np.zeros(group_count), where = has_rows_mask)
+            deviation_array = gpps_array - row_mean_array[group_array]
+            variance_array = np.divide(np.bincount(group_array, weights = deviation_array ** 2, minlength = group_count), row_count_array,
+                                       out = np.zeros(group_count), where = has_rows_mask)
+            stats_dict['std_' + gpps_str] = np.sqrt(variance_array)
+
+        return stats_dict
+
+    @staticmethod
+    def stats(stats_dict, group_idx):
+        if group_idx is None or stats_dict['row_count'][group_idx] == 0:
+            return None
+        return (int(stats_dict['total_ps'][group_idx]),
+                round(float(stats_dict['mean_whole'][group_idx]),2),
+                round(float(stats_dict['mean_loose'][group_idx]),2),
+                round(float(stats_dict['std_whole'][group_idx]),2),
+                round(float(stats_dict['std_loose'][group_idx]),2))
+
+    def city(self, greenhouse_id):
+        return self.facility_topology.city(greenhouse_id)
+
+    def cityStats(self, harvest_date, crop_id, city, positive = 0):
+        stats_dict = self.city_stats_dict
+        if positive == 1:
+            stats_dict = self.positive_city_stats_dict
+        return self.stats(stats_dict, self.city_key_idx_dict.get((harvest_date, crop_id, city)))
+
+    def lineStats(self, harvest_date, crop_id, facility_line_id):
+        return self.stats(self.line_stats_dict, self.line_key_idx_dict.get((harvest_date, crop_id, facility_line_id)))
+
+    def cityHarvestDates(self, crop_id, city, first_harvest_day, last_harvest_day):
+        harvest_dates_list = self.city_harvest_dates_dict.get((crop_id, city), [])
+        return [harvest_date for harvest_date in harvest_dates_list if harvest_date >= first_harvest_day and harvest_date <= last_harvest_day]
+
+
+
 #     #CustomerHarvestAllocation_Facts
-def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_out_LoL, facilities_LoL,allocated_crops_LoL, har_transfers_LoL, products_LoL, inventory_allocation_LoL, tier_count):
+def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_out_LoL, facilities_LoL,allocation_tracker, har_transfers_LoL, products_LoL, inventory_allocation_LoL, tier_count, harvest_cube = None, facility_topology = None, demand_order_list = None, transfer_order_list = None, row_order_dict = None):
     '''
     #### Inputs:
     - forecast_date: date of the forecast
@@ -628,11 +1066,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
     - facilities_LoL: list of two lists cooresponding to greenhouses dimension
         1. List of greenhouse IDs
         2. List of city abbreviations
-    - allocated_crops_LoL: list of three lists for mid-allocation tracking
-        1. List of date/crop/greenhouse key combinations that have an allocation
-        2. List of starting plant sites for each date/crop/greenhouse key combination
-        3. List of allocated plant sites for each date/crop/greenhouse key combination
-        4. List of date/crop/greenhouse key combinations that have been fully allocated
+    - allocation_tracker: AllocationTracker for mid-allocation tracking by date/crop/greenhouse (updated in place)
     - har_transfers_LoL: transfers information as a list of seven lists
         1. List of ship dates
         2. List of arrival dates
@@ -656,6 +1090,12 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
         6. List of allocated quantities cooresponding to each combination of greenhouse/product/enjoy-by-date/customer
         7. List of end-of-day quantities cooresponding to each combination of greenhouse/product/enjoy-by-date
     - tier_count: allocation tier for the harvest allocation from harvest city to customer  
+    - harvest_cube: optional HarvestCube of harvest_in_LoL computed once for the run (computed here if None)
+    - facility_topology: optional FacilityTopology of facilities_LoL shared by the run (computed here if None)
+    - demand_order_list: optional serial order of the inventory_demand_out_LoL rows (defaults to the row index)
+    - transfer_order_list: optional serial order of the har_transfers_LoL rows (defaults to the row index)
+    - row_order_dict: optional dictionary filled with the serial order key of every output row (CityPartitionPool merge)
+        - 'harvest_allocation_out_LoL', 'short_demand_out_LoL': (production priority, stage, order, order) by row
     
     #### Algorithm:
     - load inputs
@@ -685,7 +1125,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
         - after looping through all remaining demand for the production priority, allocate fully to the demand for each date/product/greenhouse in mid-allocation tracking lists
     - return output tuple
     
-    #### Output: (harvest_allocation_out_LoL,harvest_unallocated_out_LoL, short_demand_out_LoL)
+    #### Output: (harvest_allocation_out_LoL,allocation_tracker, short_demand_out_LoL)
     - harvest_allocation_out_LoL: list of twelve lists cooresponding to harvest allocations
         1. List of demand allocation dates
         2. List of demand dates
@@ -699,10 +1139,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
         10. List of allocated grams
         11. List of allocated quantities
         12. List of full packout boolean flags
-    - harvest_unallocated_out_LoL: list of three lists for mid-allocation tracking
-        1. List of date/crop/greenhouse key combinations that have an allocation
-        2. List of allocated plant sites for each date/crop/greenhouse key combination
-        3. List of date/crop/greenhouse key combinations that have been fully allocated
+    - allocation_tracker: AllocationTracker for mid-allocation tracking by date/crop/greenhouse
     - short_demand_out_LoL: list of seven lists cooresponding to short demand
         1. List of demand dates
         2. List of demand allocation dates
@@ -742,12 +1179,14 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
     # facilities dimension
     fd_facility_id_list = facilities_LoL[0]
     fd_city_short_code_list = facilities_LoL[1]
-    
-    # mid-allocation tracking lists
-    allocated_date_crop_facility_key_list = allocated_crops_LoL[0]
-    allocated_starting_ps_list = allocated_crops_LoL[1]
-    allocated_plant_sites_list = allocated_crops_LoL[2]
-    complete_crop_allocation_key_list = allocated_crops_LoL[3]
+
+    # greenhouse cities and main coolers
+    if facility_topology is None:
+        facility_topology = FacilityTopology(facilities_LoL)
+
+    # harvest totals and grams per plant site by date/crop/city
+    if harvest_cube is None:
+        harvest_cube = HarvestCube(harvest_in_LoL, facilities_LoL, facility_topology)
     
     #transfers
     tsf_ship_date_list = har_transfers_LoL[0]
@@ -759,11 +1198,11 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
     tsf_transfer_qty_list = har_transfers_LoL[6]
     
     # remaining inventory
-    iaf_inventory_facility_id_list = inventory_allocation_out_LoL[0]
-    iaf_product_id_list = inventory_allocation_out_LoL[1]
-    iaf_enjoy_by_date_list = inventory_allocation_out_LoL[2]
-    iaf_customer_id_list = inventory_allocation_out_LoL[3]
-    iaf_end_of_day_qty_list = inventory_allocation_out_LoL[6]
+    iaf_inventory_facility_id_list = inventory_allocation_LoL[0]
+    iaf_product_id_list = inventory_allocation_LoL[1]
+    iaf_enjoy_by_date_list = inventory_allocation_LoL[2]
+    iaf_customer_id_list = inventory_allocation_LoL[3]
+    iaf_end_of_day_qty_list = inventory_allocation_LoL[6]
 
     ri_key_list = list()
     ri_qty_list = list()
@@ -821,7 +1260,16 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
     new_sdf_production_priority_list = list()
     
     # list to track completed short demand allocations
-    sdf_idx_to_skip_list = list()
+    sdf_idx_to_skip_set = set()
+
+    # serial order key of every output row: the demand row (or planned transfer, or mid-allocation key) that emits it
+    if demand_order_list is None:
+        demand_order_list = list(range(len(sdf_demand_date_list)))
+    if transfer_order_list is None:
+        transfer_order_list = list(range(len(har_transfers_LoL[0])))
+    haf_order_list = list()
+    new_sdf_order_list = list()
+    allocated_customer_order_list = list()
 
     # get distinct production priorities
     production_priority_list = [1,2,3,4,5]
@@ -834,6 +1282,27 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
     # demand_date = distinct_demand_date_list[demand_date_idx]
     # demand_allocation_date = distinct_demand_allocation_date_list[demand_date_idx]
     demand_allocation_date_indices = [d for d, g in enumerate(sdf_demand_allocation_date_list) if g == forecast_date]
+
+    # product lookup
+    pd_idx_dict = dict()
+    for pd_idx in range(len(pd_product_id_list)):
+        pd_idx_dict.setdefault(pd_product_id_list[pd_idx], pd_idx)
+
+    # group-by stage: short demand indices by demand allocation date/city/production priority/crop
+    # the proportional shortage allocation reads its group here instead of rescanning the short demand lists
+    short_group_dict = dict()
+    for short_idx in range(len(sdf_demand_allocation_date_list)):
+        short_pd_idx = pd_idx_dict.get(sdf_product_id_list[short_idx])
+        if short_pd_idx is None:
+            continue
+        short_group_key = (sdf_demand_allocation_date_list[short_idx],
+                           facility_topology.city(sdf_demand_facility_id_list[short_idx]),
+                           sdf_production_priority_list[short_idx],
+                           pd_crop_id_list[short_pd_idx])
+        if short_group_key in short_group_dict:
+            short_group_dict[short_group_key] += [short_idx]
+        else:
+            short_group_dict[short_group_key] = [short_idx]
     
     
     ########################
@@ -865,64 +1334,28 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                 is_whole = pd_is_whole_list[pd_idx]
 
                 # keys for allocation tracking
-                allocated_date_crop_facility_key = str(harvest_date) + '_' + str(crop_id) + '_' + str(harvest_facility_id)
+                allocated_date_crop_facility_key = AllocationTracker.key(harvest_date, crop_id, harvest_facility_id)
                 allocated_date_product_facility_key = str(harvest_date) + '_' + str(product_id) + '_' + str(harvest_facility_id)
                 allocated_date_product_facility_customer_key = str(harvest_date) + '_' + str(product_id) + '_' + str(harvest_facility_id) + '_' + str(customer_id)
 
                 # checkpoint: we still can allocate for this date/crop/facility
-                if allocated_date_crop_facility_key not in complete_crop_allocation_key_list:
+                if not allocation_tracker.isComplete(allocated_date_crop_facility_key):
                     # get plant sites already allocated for the facility
-                    already_allocated_plant_sites = 0
-                    if allocated_date_crop_facility_key in allocated_date_crop_facility_key_list:
-                        already_allocated_plant_sites = allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(allocated_date_crop_facility_key)]
-
-                    # get other values from HarvestForecastSeasonality_Facts
-                    harvest_date_indices =  [i for i, x in enumerate(hfsf_harvest_date_list) if x == harvest_date]
-                    harvest_crop_id_indices =  [j for j, y in enumerate(hfsf_crop_id_list) if y == crop_id]
-                    harvest_facility_id_indices = [k for k, z in enumerate(hfsf_facility_id_list)
-                                                 if fd_city_short_code_list[fd_facility_id_list.index(z)]
-                                                    == fd_city_short_code_list[fd_facility_id_list.index(harvest_facility_id)]]
-                    harvest_date_crop_facility_indices = list(set(harvest_date_indices) & set(harvest_crop_id_indices) & set(harvest_facility_id_indices))
-                    #print(len(harvest_date_crop_facility_indices))
+                    already_allocated_plant_sites = allocation_tracker.allocated(allocated_date_crop_facility_key)
+
+                    # get other values from HarvestForecastSeasonality_Facts for the city of the harvest greenhouse
                     # multiple lines are potentially available to allocate for each crop
-                    # from the harvest forecast, determine if the short demand can be fulfilled or not
-                    harvest_facility_line_id_list = list()
-                    harvest_expected_plant_sites_list = list()
-                    harvest_avg_headweight_list = list()
-                    harvest_whole_gpps_list = list()
-                    harvest_loose_gpps_list = list()
-                    for hfsf_idx in harvest_date_crop_facility_indices:
-                        # get available lines
-                        harvest_facility_line_id_list += [hfsf_facility_line_id_list[hfsf_idx]]
-                        # get total plant sites
-                        harvest_expected_plant_sites_list += [hfsf_expected_plant_sites_list[hfsf_idx]]
-                        # get whole grams per plant site
-                        harvest_whole_gpps_list += [hfsf_avg_headweight_list[hfsf_idx]]
-                        harvest_loose_gpps_list += [hfsf_loose_grams_per_plant_site_list[hfsf_idx]]
-                    #print(allocated_date_crop_facility_key)
+                    harvest_city_stats = harvest_cube.cityStats(harvest_date, crop_id, harvest_cube.city(harvest_facility_id))
+
                     # checkpoint: there is available harvest
-                    if len(harvest_expected_plant_sites_list) > 0:
-
-                        # compute mean grams per plant site for the facility and round to two decimals
-                        #harvest_facility_mean_whole_gpps = round(float(np.mean(harvest_whole_gpps_list)),2)
-                        harvest_facility_std_whole_gpps = round(float(np.std(harvest_whole_gpps_list)),2)
-                        #harvest_facility_mean_loose_gpps = round(float(np.mean(harvest_loose_gpps_list)),2)
-                        harvest_facility_std_loose_gpps = round(float(np.std(harvest_loose_gpps_list)),2)
-
-                        # GPPS normalized by expected plant sites
-                        whole_numerator = 0
-                        loose_numerator = 0
-                        total_ps = 0
-                        for harvest_idx in range(len(harvest_whole_gpps_list)):
-                            whole_numerator += harvest_whole_gpps_list[harvest_idx] * harvest_expected_plant_sites_list[harvest_idx]
-                            loose_numerator += harvest_loose_gpps_list[harvest_idx] * harvest_expected_plant_sites_list[harvest_idx]
-                            total_ps += harvest_expected_plant_sites_list[harvest_idx]
-
-                        harvest_facility_mean_whole_gpps = 0
-                        harvest_facility_mean_loose_gpps = 0 
-                        if total_ps != 0:
-                            harvest_facility_mean_whole_gpps = round(float(whole_numerator/total_ps),2)
-                            harvest_facility_mean_loose_gpps = round(float(loose_numerator/total_ps),2)
+                    if harvest_city_stats is not None:
+
+                        # total plant sites, mean grams per plant site normalized by expected plant sites, and std for the city
+                        (harvest_facility_net_plant_sites,
+                         harvest_facility_mean_whole_gpps,
+                         harvest_facility_mean_loose_gpps,
+                         harvest_facility_std_whole_gpps,
+                         harvest_facility_std_loose_gpps) = harvest_city_stats
 
                         # choose conversion factor
                         harvest_facility_mean_gpps = harvest_facility_mean_loose_gpps 
@@ -934,10 +1367,6 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                         if harvest_facility_mean_gpps != 0:
                             net_plant_sites = int(np.ceil(float(transfer_qty * net_weight_grams / harvest_facility_mean_gpps)))
 
-                        # compute net plant sites for the facility
-                        harvest_facility_net_plant_sites = int(sum(harvest_expected_plant_sites_list))
-                        #print(harvest_expected_plant_sites_list)
-
                         # compute remaining plant sites for allocation considering the mid allocation checkpoint
                         harvest_facility_pre_plant_sites = harvest_facility_net_plant_sites - already_allocated_plant_sites
 
@@ -970,14 +1399,10 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                             haf_allocated_grams_list += [allocated_grams]
                             haf_allocated_qty_list += [allocated_qty]
                             haf_full_packout_list += [full_packout]
+                            haf_order_list += [(0, 0, transfer_order_list[tsf_idx], 0)]
 
                             # update the allocation_lists
-                            if allocated_date_crop_facility_key in allocated_date_crop_facility_key_list:
-                                allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(allocated_date_crop_facility_key)] += allocated_product_plant_sites
-                            if allocated_date_crop_facility_key not in allocated_date_crop_facility_key_list:
-                                allocated_date_crop_facility_key_list += [allocated_date_crop_facility_key]
-                                allocated_plant_sites_list += [allocated_product_plant_sites]
-                                allocated_starting_ps_list += [harvest_facility_net_plant_sites]
+                            allocation_tracker.add(allocated_date_crop_facility_key, allocated_product_plant_sites, harvest_facility_net_plant_sites)
 
                             if allocated_date_product_facility_key in allocated_date_product_facility_key_list:
                                 del allocated_gpps_list[allocated_date_product_facility_key_list.index(allocated_date_product_facility_key)]
@@ -994,8 +1419,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                             #complete_product_allocation_key_list += [allocated_date_product_facility_key]
                             #complete_customer_allocation_key_list += [allocated_date_product_facility_customer_key]
                             # mark allocation as complete
-                            if allocated_date_crop_facility_key not in complete_crop_allocation_key_list:
-                                complete_crop_allocation_key_list += [allocated_date_crop_facility_key]
+                            allocation_tracker.complete(allocated_date_crop_facility_key)
                             if allocated_date_product_facility_key not in complete_product_allocation_key_list:
                                 complete_product_allocation_key_list += [allocated_date_product_facility_key]
                             if allocated_date_product_facility_customer_key not in complete_customer_allocation_key_list:
@@ -1008,13 +1432,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                             # update the allocation lists
                             # add to mid-allocation tracker if they key exists
                             #print("yay")
-                            if allocated_date_crop_facility_key in allocated_date_crop_facility_key_list:
-                                allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(allocated_date_crop_facility_key)] += net_plant_sites
-                            # add to mid-allocation tracker if its a new key
-                            if allocated_date_crop_facility_key not in allocated_date_crop_facility_key_list:
-                                allocated_date_crop_facility_key_list += [allocated_date_crop_facility_key]
-                                allocated_plant_sites_list += [net_plant_sites]
-                                allocated_starting_ps_list += [harvest_facility_net_plant_sites]
+                            allocation_tracker.add(allocated_date_crop_facility_key, net_plant_sites, harvest_facility_net_plant_sites)
 
                             # write transfer to CustomerHarvestAllocation_Facts
                             full_packout = 0
@@ -1037,6 +1455,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                             haf_allocated_grams_list += [allocated_grams]
                             haf_allocated_qty_list += [allocated_qty]
                             haf_full_packout_list += [full_packout]
+                            haf_order_list += [(0, 0, transfer_order_list[tsf_idx], 0)]
                     else:
                         print('WARNING: no expected harvest for date_crop_facility: ', allocated_date_crop_facility_key)
 
@@ -1048,16 +1467,18 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
     # next loop through the production priorities
     for production_priority in production_priority_list:
         short_priority_indices = [c for c, f in enumerate(sdf_production_priority_list) if f == production_priority]
-        date_priority_indices = list(set(demand_allocation_date_indices) & set(short_priority_indices))
+        # in demand order, so a city partition of the demand allocates in the same order as the serial run
+        date_priority_indices = sorted(set(demand_allocation_date_indices) & set(short_priority_indices))
 
         # next loop through the date_priority indicies in the short demand
         dp_roll_key_list = list()
         dp_roll_qty_list = list()
         dp_roll_ps_list = list()
+        dp_roll_order_list = list()
         
         for sdf_idx in date_priority_indices:
             # checkpoint: we have not allocated this short demand yet
-            if sdf_idx not in sdf_idx_to_skip_list:
+            if sdf_idx not in sdf_idx_to_skip_set:
 
                 # get values from short demand
                 product_id = sdf_product_id_list[sdf_idx]
@@ -1080,85 +1501,42 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                     lead_time_in_days = int(pd_lead_time_in_days_list[pd_idx])
                     demand_allocation_date = demand_allocation_date - DT.timedelta(days=(lead_time_in_days))
                     
-#                 # consider demand from one facility ID per city short code
-                if demand_facility_id in [1,2,9]:
-                    demand_facility_id = 3 # set NYC1, NYC2, and NYC4 to NYC3
-#                 # set harvest facility ID to demand facility ID
-                if demand_facility_id == 4:
-                    demand_facility_id = 7 # set CHI1 to CHI2
+                # consider demand from one facility ID per city short code (e.g. NYC1, NYC2, and NYC4 to NYC3)
+                demand_facility_id = facility_topology.mainCooler(demand_facility_id)
                 
                 # set harvest facility ID to demand facility ID
                 harvest_facility_id = demand_facility_id
                 #harvest_city_short_code = fd_city_short_code_list[fd_facility_id_list.index(harvest_facility_id)]
                 
                 # create key for mid-allocation check
-                allocated_date_crop_facility_key = str(demand_allocation_date) + '_' + str(crop_id) + '_' + str(harvest_facility_id)
+                allocated_date_crop_facility_key = AllocationTracker.key(demand_allocation_date, crop_id, harvest_facility_id)
                 allocated_date_product_facility_key = str(demand_allocation_date) + '_' + str(product_id) + '_' + str(harvest_facility_id)
                 allocated_date_product_facility_customer_key = str(demand_allocation_date) + '_' + str(product_id) + '_' + str(harvest_facility_id) + '_' + str(customer_id)
-                # complete_crop_allocation_key_list contains date/crop/facility combinations that are already fully allocated
+                # allocation_tracker marks date/crop/facility combinations that are already fully allocated
                 
 
 
                 # get plant sites already allocated for the facility
-                already_allocated_plant_sites = 0
-
-                if allocated_date_crop_facility_key in allocated_date_crop_facility_key_list: 
-                    already_allocated_plant_sites = allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(allocated_date_crop_facility_key)]
-
-                # get other values from HarvestForecastSeasonality_Facts
-                harvest_date_indices =  [i for i, x in enumerate(hfsf_harvest_date_list) if x == demand_allocation_date]
-                harvest_crop_id_indices =  [j for j, y in enumerate(hfsf_crop_id_list) if y == crop_id]
-                #harvest_facility_id_indices = [k for k, z in enumerate(hfsf_facility_id_list) if z == harvest_facility_id]
-                harvest_facility_id_indices = [k for k, z in enumerate(hfsf_facility_id_list)
-                                            if fd_city_short_code_list[fd_facility_id_list.index(z)]
-                                               == fd_city_short_code_list[fd_facility_id_list.index(harvest_facility_id)]]
-                harvest_date_crop_facility_indices = list(set(harvest_date_indices) & set(harvest_crop_id_indices) & set(harvest_facility_id_indices))
-                #print(len(harvest_date_crop_facility_indices))
+                already_allocated_plant_sites = allocation_tracker.allocated(allocated_date_crop_facility_key)
+
+                # get other values from HarvestForecastSeasonality_Facts for the city of the harvest greenhouse
                 # multiple lines are potentially available to allocate for each crop
-                # from the harvest forecast, determine if the short demand can be fulfilled or not
-                harvest_facility_line_id_list = list()
-                harvest_expected_plant_sites_list = list()
-                harvest_avg_headweight_list = list()
-                harvest_whole_gpps_list = list()
-                harvest_loose_gpps_list = list()
-
-                for hfsf_idx in harvest_date_crop_facility_indices:
-                    # get available lines
-                    harvest_facility_line_id_list += [hfsf_facility_line_id_list[hfsf_idx]]
-                    # get total plant sites
-                    harvest_expected_plant_sites_list += [hfsf_expected_plant_sites_list[hfsf_idx]]
-                    # get whole grams per plant site
-                    harvest_whole_gpps_list += [hfsf_avg_headweight_list[hfsf_idx]]
-                    harvest_loose_gpps_list += [hfsf_loose_grams_per_plant_site_list[hfsf_idx]]
+                harvest_city_stats = harvest_cube.cityStats(demand_allocation_date, crop_id, harvest_cube.city(harvest_facility_id))
 
                 # no co-packers in DEN
                 if production_priority == 5 and demand_facility_id == 8:
-                    harvest_expected_plant_sites_list = list()
+                    harvest_city_stats = None
                 #print(allocated_date_crop_facility_key)
 
                 # checkpoint: there is available harvest
-                if len(harvest_expected_plant_sites_list) > 0:
+                if harvest_city_stats is not None:
                 
-                    # compute mean grams per plant site for the facility and round to two decimals
-                    #harvest_facility_mean_whole_gpps = round(float(np.mean(harvest_whole_gpps_list)),2)
-                    harvest_facility_std_whole_gpps = round(float(np.std(harvest_whole_gpps_list)),2)
-                    #harvest_facility_mean_loose_gpps = round(float(np.mean(harvest_loose_gpps_list)),2)
-                    harvest_facility_std_loose_gpps = round(float(np.std(harvest_loose_gpps_list)),2)
-
-                    # GPPS normalized by expected plant sites
-                    whole_numerator = 0
-                    loose_numerator = 0
-                    total_ps = 0
-                    for harvest_idx in range(len(harvest_whole_gpps_list)):
-                        whole_numerator += harvest_whole_gpps_list[harvest_idx] * harvest_expected_plant_sites_list[harvest_idx]
-                        loose_numerator += harvest_loose_gpps_list[harvest_idx] * harvest_expected_plant_sites_list[harvest_idx]
-                        total_ps += harvest_expected_plant_sites_list[harvest_idx]
-
-                    harvest_facility_mean_whole_gpps = 0
-                    harvest_facility_mean_loose_gpps = 0
-                    if total_ps != 0:
-                        harvest_facility_mean_whole_gpps = round(float(whole_numerator/total_ps),2)
-                        harvest_facility_mean_loose_gpps = round(float(loose_numerator/total_ps),2)
+                    # total plant sites, mean grams per plant site normalized by expected plant sites, and std for the city
+                    (harvest_facility_net_plant_sites,
+                     harvest_facility_mean_whole_gpps,
+                     harvest_facility_mean_loose_gpps,
+                     harvest_facility_std_whole_gpps,
+                     harvest_facility_std_loose_gpps) = harvest_city_stats
 
                     # choose conversion factor
                     harvest_facility_mean_gpps = harvest_facility_mean_loose_gpps 
@@ -1174,7 +1552,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
 
                             
                     # add to short demand if harvest is completely allocated (no harvest is available)
-                    if allocated_date_crop_facility_key in complete_crop_allocation_key_list:
+                    if allocation_tracker.isComplete(allocated_date_crop_facility_key):
                         if short_demand_qty > 0:
                             new_sdf_demand_date_list += [sdf_demand_date_list[sdf_idx]]
                             new_sdf_demand_allocation_date_list += [sdf_demand_allocation_date_list[sdf_idx]]
@@ -1183,17 +1561,14 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                             new_sdf_customer_id_list += [sdf_customer_id_list[sdf_idx]]
                             new_sdf_short_demand_qty_list += [sdf_short_demand_qty_list[sdf_idx]]
                             new_sdf_production_priority_list += [pd_production_priority_list[pd_product_id_list.index(sdf_product_id_list[sdf_idx])]]
+                            new_sdf_order_list += [(production_priority, 1, demand_order_list[sdf_idx], 0)]
 
                             
 
                                 
                                 
                     # checkpoint: we still need to allocate for this date/crop/facility
-                    if allocated_date_crop_facility_key not in complete_crop_allocation_key_list:
-
-                        # compute net plant sites for the facility
-                        harvest_facility_net_plant_sites = int(sum(harvest_expected_plant_sites_list))
-                        #print(harvest_expected_plant_sites_list)
+                    if not allocation_tracker.isComplete(allocated_date_crop_facility_key):
 
                         # compute remaining plant sites for allocation considering the mid allocation checkpoint
                         harvest_facility_pre_plant_sites = harvest_facility_net_plant_sites - already_allocated_plant_sites
@@ -1209,49 +1584,42 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                             # set full_packout to true
                             full_packout = 1
 
-                            # compute total short demand in the same product priority        
-                            short_date_indices =  [a for a, d in enumerate(sdf_demand_allocation_date_list) if d == sdf_demand_allocation_date]
-                            #short_facility_id_indices =  [b for b, e in enumerate(sdf_demand_facility_id_list) if e == demand_facility_id]
-                            short_facility_id_indices =  [b for b, e in enumerate(sdf_demand_facility_id_list)
-                                                 if fd_city_short_code_list[fd_facility_id_list.index(e)]
-                                                    == fd_city_short_code_list[fd_facility_id_list.index(demand_facility_id)]]
-                            short_date_facility_priority_indices = list(set(short_date_indices) & set(short_facility_id_indices) & set(short_priority_indices))
+                            # short demand of all products of the same date/crop/greenhouse/production priority from the group-by stage
+                            short_group_indices = short_group_dict[(sdf_demand_allocation_date, facility_topology.city(demand_facility_id), production_priority, crop_id)]
+                            short_group_pd_indices = [pd_idx_dict[sdf_product_id_list[short_idx]] for short_idx in short_group_indices]
+                            short_group_qty_array = np.array([sdf_short_demand_qty_list[short_idx] for short_idx in short_group_indices], dtype = float)
+                            short_group_roll_qty_array = np.array([sdf_roll_qty_list[short_idx] for short_idx in short_group_indices], dtype = float)
+                            short_group_net_weight_array = np.array([pd_net_weight_grams_list[pd_idx] for pd_idx in short_group_pd_indices], dtype = float)
+                            short_group_is_whole_array = np.array([pd_is_whole_list[pd_idx] for pd_idx in short_group_pd_indices])
+
+                            # choose conversion factor for every product in the group
+                            short_group_gpps_array = np.where(short_group_is_whole_array == 1, harvest_facility_mean_whole_gpps, harvest_facility_mean_loose_gpps)
+                            short_group_gpps_array = np.round(short_group_gpps_array.astype(float), 2)
+
+                            # compute net_plant_sites for the short demand and roll qty of every product in the group
+                            short_group_ps_array = np.ceil(np.divide(short_group_qty_array * short_group_net_weight_array, short_group_gpps_array,
+                                                                     out = np.zeros(len(short_group_indices)), where = short_group_gpps_array != 0))
+                            short_group_roll_ps_array = np.ceil(np.divide(short_group_roll_qty_array * short_group_net_weight_array, short_group_gpps_array,
+                                                                          out = np.zeros(len(short_group_indices)), where = short_group_gpps_array != 0))
 
                             # accumulate short_demand_plant_sites for all products of the same product priority
-                            short_demand_plant_sites = 0
-                            for short_idx in short_date_facility_priority_indices:
-                                product_id = sdf_product_id_list[short_idx]
-                                short_demand_qty = sdf_short_demand_qty_list[short_idx]
-                                s_roll_qty = sdf_roll_qty_list[short_idx]
-                                #####
-                                # get other values from Products_Dim
-                                pd_idx = pd_product_id_list.index(product_id)
-                                short_crop_id = pd_crop_id_list[pd_idx]
-
-                                if short_crop_id == crop_id:
-
-                                    net_weight_grams = pd_net_weight_grams_list[pd_idx]
-                                    is_whole = pd_is_whole_list[pd_idx]
-
-                                    # choose conversion factor
-                                    harvest_facility_mean_gpps = harvest_facility_mean_loose_gpps 
-                                    if is_whole == 1:
-                                        harvest_facility_mean_gpps = harvest_facility_mean_whole_gpps
-                                    # compute net_plant_sites for the short demand
-                                    net_plant_sites = int(np.ceil(float(short_demand_qty * net_weight_grams / harvest_facility_mean_gpps)))
-                                    short_demand_plant_sites += net_plant_sites
-                                    roll_net_plant_sites = int(np.ceil(float(s_roll_qty * net_weight_grams / harvest_facility_mean_gpps)))
-                                    # aggregate roll qty for date and priority
-                                    dp_roll_key = str(demand_facility_id) + '_' + str(product_id)
-                                    if roll_qty > 0:
-                                        if dp_roll_key in dp_roll_key_list:
-                                            dp_roll_qty_list[dp_roll_key_list.index(dp_roll_key)] += s_roll_qty
-                                            dp_roll_ps_list[dp_roll_key_list.index(dp_roll_key)] += roll_net_plant_sites
-                                        if dp_roll_key not in dp_roll_key_list:
-                                            dp_roll_key_list += [dp_roll_key]
-                                            dp_roll_qty_list += [s_roll_qty]
-                                            dp_roll_ps_list += [roll_net_plant_sites]
-                                            
+                            short_demand_plant_sites = int(short_group_ps_array.sum())
+
+                            # aggregate roll qty for date and priority
+                            if roll_qty > 0:
+                                for group_idx in range(len(short_group_indices)):
+                                    dp_roll_key = str(demand_facility_id) + '_' + str(sdf_product_id_list[short_group_indices[group_idx]])
+                                    s_roll_qty = sdf_roll_qty_list[short_group_indices[group_idx]]
+                                    roll_net_plant_sites = int(short_group_roll_ps_array[group_idx])
+                                    if dp_roll_key in dp_roll_key_list:
+                                        dp_roll_qty_list[dp_roll_key_list.index(dp_roll_key)] += s_roll_qty
+                                        dp_roll_ps_list[dp_roll_key_list.index(dp_roll_key)] += roll_net_plant_sites
+                                    if dp_roll_key not in dp_roll_key_list:
+                                        dp_roll_key_list += [dp_roll_key]
+                                        dp_roll_qty_list += [s_roll_qty]
+                                        dp_roll_ps_list += [roll_net_plant_sites]
+                                        dp_roll_order_list += [(1, demand_order_list[sdf_idx])]
+
                             # now that we have how many plant sites we are short across all products
                             # accumulate harvest_priority_plant_sites available for all products of the same priority
                             harvest_priority_plant_sites = harvest_facility_pre_plant_sites
@@ -1260,124 +1628,101 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                                 check_demand_allocation_date = DT.datetime.strptime(str(check_key.split("_")[0]), '%Y-%m-%d').date()
                                 check_product_id = int(check_key.split("_")[1])
                                 check_facility_id = int(check_key.split("_")[2])
-                                #check_city_short_code = check_key.split("_")[2]
-                                check_priority = pd_production_priority_list[pd_product_id_list.index(check_product_id)]
-                                check_crop_id = pd_crop_id_list[pd_product_id_list.index(check_product_id)]
-                                check_date_crop_facility_key = str(check_demand_allocation_date) + '_' + str(check_crop_id) + '_' + str(check_facility_id)
+                                check_priority = pd_production_priority_list[pd_idx_dict[check_product_id]]
+                                check_crop_id = pd_crop_id_list[pd_idx_dict[check_product_id]]
                                 if check_demand_allocation_date == demand_allocation_date and check_facility_id == harvest_facility_id and check_priority == production_priority and check_crop_id == crop_id:
-                                #if check_demand_allocation_date == demand_allocation_date and check_city_short_code == fd_city_short_code_list[fd_facility_id_list.index(harvest_facility_id)] and check_priority == production_priority and check_crop_id == crop_id:
                                     check_allocated_product_plant_sites = allocated_product_plant_sites_list[check_idx]
                                     # add the plant sites for the harvest_demand_ratio
                                     harvest_priority_plant_sites += check_allocated_product_plant_sites
                                     # subtract the plant sites from the overall allocation tracking list since the new value multiplied by harvest_demand_ratio will be added back
-                                    allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(check_date_crop_facility_key)] -= check_allocated_product_plant_sites
+                                    allocation_tracker.subtract(allocated_date_crop_facility_key, check_allocated_product_plant_sites)
 
 
-                            # compute harvest_demand_ratio (less than 1 in this case)
+                            # compute harvest_demand_ratio (less than 1 in this case) once for the group
                             harvest_demand_ratio = float(harvest_priority_plant_sites / short_demand_plant_sites)
-                            #harvest_demand_ratio = float(harvest_facility_pre_plant_sites / short_demand_plant_sites)
+
+                            # apply harvest_demand_ratio to every product of the group
+                            short_group_allocated_qty_array = np.floor(short_group_qty_array * harvest_demand_ratio)
+                            short_group_allocated_ps_array = np.ceil(np.divide(short_group_allocated_qty_array * short_group_net_weight_array, short_group_gpps_array,
+                                                                               out = np.zeros(len(short_group_indices)), where = short_group_gpps_array != 0))
 
                             # allocate to every product ID of the same product priority where shorts exist
-                            for short_idx in short_date_facility_priority_indices:
+                            for group_idx in range(len(short_group_indices)):
+                                short_idx = short_group_indices[group_idx]
                                 short_demand_date = sdf_demand_date_list[short_idx]
                                 product_id = sdf_product_id_list[short_idx]
                                 customer_id = sdf_customer_id_list[short_idx]
                                 short_demand_qty = sdf_short_demand_qty_list[short_idx]
-                                #####
-                                # get other values from Products_Dim
-                                pd_idx = pd_product_id_list.index(product_id)
-                                short_crop_id = pd_crop_id_list[pd_idx]
-
-                                if short_crop_id == crop_id:
-
-                                    net_weight_grams = pd_net_weight_grams_list[pd_idx]
-                                    is_whole = pd_is_whole_list[pd_idx]
-
-                                    s_allocated_date_product_facility_key = str(demand_allocation_date) + '_' + str(product_id) + '_' + str(harvest_facility_id)
-                                    s_allocated_date_product_facility_customer_key = str(demand_allocation_date) + '_' + str(product_id) + '_' + str(harvest_facility_id)+ '_' + str(customer_id)
-
-                                    # choose conversion factor
-                                    harvest_facility_mean_gpps = harvest_facility_mean_loose_gpps 
-                                    if is_whole == 1:
-                                        harvest_facility_mean_gpps = harvest_facility_mean_whole_gpps
-
-                                    # apply harvest_demand_ratio to allocated_qty
-                                    allocated_qty = int(np.floor(short_demand_qty * harvest_demand_ratio))
-
-                                    forecasted_gpps = round(float(harvest_facility_mean_gpps),2)
-                                    allocated_product_plant_sites = int(np.ceil(allocated_qty * net_weight_grams / forecasted_gpps))
-                                    allocated_grams = round(allocated_product_plant_sites * forecasted_gpps,2)
-
-                                    if allocated_qty > 0:
-                                        # write to lists for HarvestAllocation_Facts
-                                        haf_demand_allocation_date_list += [demand_allocation_date]
-                                        haf_demand_date_list += [short_demand_date]
-                                        haf_harvest_facility_id_list += [harvest_facility_id]
-                                        haf_demand_facility_id_list += [demand_facility_id]
-                                        haf_crop_id_list += [crop_id]
-                                        haf_product_id_list += [product_id]
-                                        haf_customer_id_list += [customer_id]
-                                        haf_forecasted_gpps_list += [forecasted_gpps]
-                                        haf_allocated_plant_sites_list += [allocated_product_plant_sites]
-                                        haf_allocated_grams_list += [allocated_grams]
-                                        haf_allocated_qty_list += [allocated_qty]
-                                        haf_full_packout_list += [full_packout]
-
-
-                                        # update the allocation_lists
-                                        if allocated_date_crop_facility_key in allocated_date_crop_facility_key_list:        
-                                            allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(allocated_date_crop_facility_key)] += allocated_product_plant_sites
-
-                                        if allocated_date_crop_facility_key not in allocated_date_crop_facility_key_list:
-                                            allocated_date_crop_facility_key_list += [allocated_date_crop_facility_key]
-                                            allocated_plant_sites_list += [allocated_product_plant_sites]
-                                            allocated_starting_ps_list += [harvest_facility_net_plant_sites]                          
-
-                                    if s_allocated_date_product_facility_key in allocated_date_product_facility_key_list:
-                                        del allocated_gpps_list[allocated_date_product_facility_key_list.index(s_allocated_date_product_facility_key)]
-                                        del allocated_qty_list[allocated_date_product_facility_key_list.index(s_allocated_date_product_facility_key)]
-                                        del allocated_product_plant_sites_list[allocated_date_product_facility_key_list.index(s_allocated_date_product_facility_key)]
-                                        del allocated_date_product_facility_key_list[allocated_date_product_facility_key_list.index(s_allocated_date_product_facility_key)]
-
-                                    # customer allocation
-                                    if s_allocated_date_product_facility_customer_key in allocated_date_product_facility_customer_key_list:
-                                        adpfc_key_idx = allocated_date_product_facility_customer_key_list.index(s_allocated_date_product_facility_customer_key)
-                                        del allocated_date_product_facility_customer_key_list[adpfc_key_idx]
-                                        del allocated_customer_gpps_list[adpfc_key_idx]
-                                        del allocated_customer_qty_list[adpfc_key_idx]
-                                        del allocated_customer_plant_sites_list[adpfc_key_idx]
-                                        del allocated_customer_roll_qty_list[adpfc_key_idx]
-                                        del allocated_customer_demand_date_list[adpfc_key_idx]
-                                        
-
-                                    # mark allocation as complete
-#                                     complete_crop_allocation_key_list += [allocated_date_crop_facility_key]
-#                                     complete_product_allocation_key_list += [allocated_date_product_facility_key]
-#                                     complete_customer_allocation_key_list += [allocated_date_product_facility_customer_key]
-                                    # mark allocation as complete
-                                    if allocated_date_crop_facility_key not in complete_crop_allocation_key_list:
-                                        complete_crop_allocation_key_list += [allocated_date_crop_facility_key]
-                                    if s_allocated_date_product_facility_key not in complete_product_allocation_key_list:
-                                        complete_product_allocation_key_list += [s_allocated_date_product_facility_key]
-                                    if s_allocated_date_product_facility_customer_key not in complete_customer_allocation_key_list:
-                                        complete_customer_allocation_key_list += [s_allocated_date_product_facility_customer_key]
-
-
-                                    # new short demand lists
-                                    new_short_demand_qty = short_demand_qty - allocated_qty
-
-                                    if new_short_demand_qty > 0:
-
-                                        new_sdf_demand_date_list += [short_demand_date]
-                                        new_sdf_demand_allocation_date_list += [demand_allocation_date]
-                                        new_sdf_demand_facility_id_list += [demand_facility_id]
-                                        new_sdf_product_id_list += [product_id]
-                                        new_sdf_customer_id_list += [customer_id]
-                                        new_sdf_short_demand_qty_list += [new_short_demand_qty]
-                                        new_sdf_production_priority_list += [pd_production_priority_list[pd_product_id_list.index(product_id)]]
-
-                                    # this short demand has now been allocated towards so add short idx to the list to skip
-                                    sdf_idx_to_skip_list += [short_idx]  
+
+                                s_allocated_date_product_facility_key = str(demand_allocation_date) + '_' + str(product_id) + '_' + str(harvest_facility_id)
+                                s_allocated_date_product_facility_customer_key = str(demand_allocation_date) + '_' + str(product_id) + '_' + str(harvest_facility_id)+ '_' + str(customer_id)
+
+                                allocated_qty = int(short_group_allocated_qty_array[group_idx])
+                                forecasted_gpps = float(short_group_gpps_array[group_idx])
+                                allocated_product_plant_sites = int(short_group_allocated_ps_array[group_idx])
+                                allocated_grams = round(allocated_product_plant_sites * forecasted_gpps,2)
+
+                                if allocated_qty > 0:
+                                    # write to lists for HarvestAllocation_Facts
+                                    haf_demand_allocation_date_list += [demand_allocation_date]
+                                    haf_demand_date_list += [short_demand_date]
+                                    haf_harvest_facility_id_list += [harvest_facility_id]
+                                    haf_demand_facility_id_list += [demand_facility_id]
+                                    haf_crop_id_list += [crop_id]
+                                    haf_product_id_list += [product_id]
+                                    haf_customer_id_list += [customer_id]
+                                    haf_forecasted_gpps_list += [forecasted_gpps]
+                                    haf_allocated_plant_sites_list += [allocated_product_plant_sites]
+                                    haf_allocated_grams_list += [allocated_grams]
+                                    haf_allocated_qty_list += [allocated_qty]
+                                    haf_full_packout_list += [full_packout]
+                                    haf_order_list += [(production_priority, 1, demand_order_list[sdf_idx], 0)]
+
+
+                                    # update the allocation_lists
+                                    allocation_tracker.add(allocated_date_crop_facility_key, allocated_product_plant_sites, harvest_facility_net_plant_sites)
+
+                                if s_allocated_date_product_facility_key in allocated_date_product_facility_key_list:
+                                    del allocated_gpps_list[allocated_date_product_facility_key_list.index(s_allocated_date_product_facility_key)]
+                                    del allocated_qty_list[allocated_date_product_facility_key_list.index(s_allocated_date_product_facility_key)]
+                                    del allocated_product_plant_sites_list[allocated_date_product_facility_key_list.index(s_allocated_date_product_facility_key)]
+                                    del allocated_date_product_facility_key_list[allocated_date_product_facility_key_list.index(s_allocated_date_product_facility_key)]
+
+                                # customer allocation
+                                if s_allocated_date_product_facility_customer_key in allocated_date_product_facility_customer_key_list:
+                                    adpfc_key_idx = allocated_date_product_facility_customer_key_list.index(s_allocated_date_product_facility_customer_key)
+                                    del allocated_date_product_facility_customer_key_list[adpfc_key_idx]
+                                    del allocated_customer_gpps_list[adpfc_key_idx]
+                                    del allocated_customer_qty_list[adpfc_key_idx]
+                                    del allocated_customer_plant_sites_list[adpfc_key_idx]
+                                    del allocated_customer_roll_qty_list[adpfc_key_idx]
+                                    del allocated_customer_demand_date_list[adpfc_key_idx]
+                                    del allocated_customer_order_list[adpfc_key_idx]
+
+                                # mark allocation as complete
+                                allocation_tracker.complete(allocated_date_crop_facility_key)
+                                if s_allocated_date_product_facility_key not in complete_product_allocation_key_list:
+                                    complete_product_allocation_key_list += [s_allocated_date_product_facility_key]
+                                if s_allocated_date_product_facility_customer_key not in complete_customer_allocation_key_list:
+                                    complete_customer_allocation_key_list += [s_allocated_date_product_facility_customer_key]
+
+
+                                # new short demand lists
+                                new_short_demand_qty = short_demand_qty - allocated_qty
+
+                                if new_short_demand_qty > 0:
+
+                                    new_sdf_demand_date_list += [short_demand_date]
+                                    new_sdf_demand_allocation_date_list += [demand_allocation_date]
+                                    new_sdf_demand_facility_id_list += [demand_facility_id]
+                                    new_sdf_product_id_list += [product_id]
+                                    new_sdf_customer_id_list += [customer_id]
+                                    new_sdf_short_demand_qty_list += [new_short_demand_qty]
+                                    new_sdf_production_priority_list += [pd_production_priority_list[pd_idx_dict[product_id]]]
+                                    new_sdf_order_list += [(production_priority, 1, demand_order_list[sdf_idx], 0)]
+
+                                # this short demand has now been allocated towards so add short idx to the set to skip
+                                sdf_idx_to_skip_set.add(short_idx)
                         
                         # next deal with what to do when we can successfully satisfy the demand
                         if harvest_facility_post_plant_sites >= 0 and net_plant_sites > 0:
@@ -1385,14 +1730,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                             # update the allocation lists
                             # add to mid-allocation tracker if they key exists
                             #print("yay")
-                            if allocated_date_crop_facility_key in allocated_date_crop_facility_key_list:
-                                allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(allocated_date_crop_facility_key)] += net_plant_sites
-
-                            # add to mid-allocation tracker if its a new key
-                            if allocated_date_crop_facility_key not in allocated_date_crop_facility_key_list:
-                                allocated_date_crop_facility_key_list += [allocated_date_crop_facility_key]
-                                allocated_plant_sites_list += [net_plant_sites]
-                                allocated_starting_ps_list += [harvest_facility_net_plant_sites]
+                            allocation_tracker.add(allocated_date_crop_facility_key, net_plant_sites, harvest_facility_net_plant_sites)
 
                             if allocated_date_product_facility_key in allocated_date_product_facility_key_list:
                                 allocated_qty_list[allocated_date_product_facility_key_list.index(allocated_date_product_facility_key)] += short_demand_qty
@@ -1416,9 +1754,10 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                                 allocated_customer_plant_sites_list += [[net_plant_sites]] 
                                 allocated_customer_roll_qty_list += [[roll_qty]]
                                 allocated_customer_demand_date_list += [[demand_date]]
+                                allocated_customer_order_list += [demand_order_list[sdf_idx]]
 
 
-                if len(harvest_expected_plant_sites_list) == 0:
+                if harvest_city_stats is None:
                     #if demand_allocation_date > load_date.date():
                         #print('no expected harvest for date_crop_facility: ', allocated_date_crop_facility_key)
                     nh_demand_qty = sdf_short_demand_qty_list[sdf_idx]
@@ -1432,6 +1771,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                         new_sdf_customer_id_list += [sdf_customer_id_list[sdf_idx]]
                         new_sdf_short_demand_qty_list += [nh_demand_qty]
                         new_sdf_production_priority_list += [pd_production_priority_list[pd_product_id_list.index(sdf_product_id_list[sdf_idx])]]
+                        new_sdf_order_list += [(production_priority, 1, demand_order_list[sdf_idx], 0)]
 
                             
         # after going through all short demand for the production priority
@@ -1486,6 +1826,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                     haf_allocated_grams_list += [allocated_grams]
                     haf_allocated_qty_list += [allocated_customer_qty]
                     haf_full_packout_list += [full_packout]
+                    haf_order_list += [(production_priority, 2, allocated_customer_order_list[allocated_idx], 0)]
 
                     # add rollover qty
 
@@ -1500,6 +1841,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                             dp_roll_key_list += [dp_roll_key]
                             dp_roll_qty_list += [roll_qty]
                             dp_roll_ps_list += [roll_net_plant_sites]
+                            dp_roll_order_list += [(2, allocated_customer_order_list[allocated_idx])]
                             
 
         
@@ -1508,6 +1850,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
         ha_roll_product_id_list = list() 
         ha_roll_ps_list  = list() 
         ha_roll_qty_list  = list() 
+        ha_roll_order_list = list()
         for dp_roll_idx in range(len(dp_roll_key_list)):
             dp_roll_key = dp_roll_key_list[dp_roll_idx]
             dp_facility_id = int(dp_roll_key.split('_')[0])
@@ -1526,7 +1869,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
             ha_roll_ps = dp_roll_ps - ri_ps
             ha_roll_qty = dp_roll_qty - ri_qty
             
-            ha_roll_key = str(demand_allocation_date) + '_' + str(dp_crop_id) + '_' + str(dp_facility_id)
+            ha_roll_key = AllocationTracker.key(demand_allocation_date, dp_crop_id, dp_facility_id)
             
             # build harvest allocation lists for rollover
             if ha_roll_ps > 0:
@@ -1540,6 +1883,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                     ha_roll_product_id_list += [[dp_product_id]]
                     ha_roll_ps_list += [[ha_roll_ps]]
                     ha_roll_qty_list += [[ha_roll_qty]]
+                    ha_roll_order_list += [(production_priority, 3) + dp_roll_order_list[dp_roll_idx]]
         
         # check aggregated demand and available harvest
         for ha_idx in range(len(ha_roll_key_list)):
@@ -1551,20 +1895,14 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
             ha_roll_ps_sum = sum(ha_roll_ps_sub_list)
 
 
-            roll_demand_allocation_date = DT.datetime.strptime(ha_roll_key.split('_')[0],"%Y-%m-%d").date()
-            roll_crop_id = int(ha_roll_key.split('_')[1])
-            roll_facility_id = int(ha_roll_key.split('_')[2])
+            (roll_demand_allocation_date, roll_crop_id, roll_facility_id) = ha_roll_key
 
             # set demand date as one day ahead of allocation for rollover qty
             roll_demand_date = roll_demand_allocation_date + DT.timedelta(days = 1)
             
             available_ps = 0
-            if ha_roll_key in allocated_date_crop_facility_key_list and ha_roll_key not in complete_crop_allocation_key_list:
-                ha_roll_allocated_idx = allocated_date_crop_facility_key_list.index(ha_roll_key)
-                
-                starting_ps = allocated_starting_ps_list[ha_roll_allocated_idx]
-
-                available_ps = starting_ps - allocated_plant_sites_list[ha_roll_allocated_idx]
+            if ha_roll_key in allocation_tracker and not allocation_tracker.isComplete(ha_roll_key):
+                available_ps = allocation_tracker.available(ha_roll_key)
 
             if available_ps > 0:
     
@@ -1594,10 +1932,9 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                     # update allocation tracking
                     full_packout = 0
                     if new_available_ps <= 0:
-                        complete_crop_allocation_key_list += [ha_roll_key]
+                        allocation_tracker.complete(ha_roll_key)
                         full_packout = 1
                         new_available_ps = 0
-                    #allocated_plant_sites_list[ha_roll_allocated_idx] = new_available_ps
                     
                     # write to lists for CustomerHarvestAllocation_Facts
                     if roll_qty > 0:
@@ -1613,9 +1950,10 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                         haf_allocated_grams_list += [roll_grams]
                         haf_allocated_qty_list += [roll_qty]
                         haf_full_packout_list += [full_packout]
+                        haf_order_list += [ha_roll_order_list[ha_idx]]
                     
                         # allocation tracking
-                        allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(ha_roll_key)] += roll_plant_sites
+                        allocation_tracker.add(ha_roll_key, roll_plant_sites)
                         
 
  
@@ -1629,6 +1967,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                         new_sdf_customer_id_list += [0]
                         new_sdf_short_demand_qty_list += [roll_short_demand_qty]
                         new_sdf_production_priority_list += [roll_prod_priority]
+                        new_sdf_order_list += [ha_roll_order_list[ha_idx]]
                         
             # update short demand when no plant sites are available
             if available_ps == 0:
@@ -1645,6 +1984,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                     new_sdf_customer_id_list += [0]
                     new_sdf_short_demand_qty_list += [roll_qty]
                     new_sdf_production_priority_list += [roll_prod_priority]
+                    new_sdf_order_list += [ha_roll_order_list[ha_idx]]
                 
 
 
@@ -1662,6 +2002,7 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
         allocated_customer_plant_sites_list = list()
         allocated_customer_roll_qty_list =list()
         allocated_customer_demand_date_list = list()
+        allocated_customer_order_list = list()
 
     # harvest allocation output
     harvest_allocation_out_LoL = [haf_demand_allocation_date_list,
@@ -1679,12 +2020,6 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
     
     
 
-    # harvest unallocated output
-    harvest_unallocated_out_LoL = [allocated_date_crop_facility_key_list,
-                                   allocated_starting_ps_list,
-                                   allocated_plant_sites_list,
-                                   complete_crop_allocation_key_list,
-                                  ]
 
     # initialize lists for new ShortDemand_Facts
     short_demand_out_LoL = [new_sdf_demand_date_list,
@@ -1695,11 +2030,15 @@ def customerHarvestAllocation(forecast_date, harvest_in_LoL, inventory_demand_ou
                             new_sdf_short_demand_qty_list,
                             new_sdf_production_priority_list]
     
-    return (harvest_allocation_out_LoL,harvest_unallocated_out_LoL, short_demand_out_LoL)
+    if row_order_dict is not None:
+        row_order_dict['harvest_allocation_out_LoL'] = haf_order_list
+        row_order_dict['short_demand_out_LoL'] = new_sdf_order_list
+
+    return (harvest_allocation_out_LoL,allocation_tracker, short_demand_out_LoL)
         
     
 
-def writeCustomerHarvestAllocation(forecast_allocation_date,harvest_allocation_out_LoL, tier_count, is_pending = 0):
+def writeCustomerHarvestAllocation(forecast_allocation_date,harvest_allocation_out_LoL, tier_count, is_pending = 0, cnxn = None):
     '''
     #### Inputs:
     - forecast_allocation_date: date of the forecast
@@ -1718,10 +2057,12 @@ def writeCustomerHarvestAllocation(forecast_allocation_date,harvest_allocation_o
         11. List of full packout boolean flags
     - tier_count: allocation tier for the harvest allocation from harvest city to customer
     - is_pending: integer boolean 1 for Pending table or 0 for baseline table
+    - cnxn: optional open connection (the connection of the background writer)
         
     #### Algorithm:
     - load inputs
     - loop through harvest allocation lists and insert entries into CustomerHarvestAllocation_Facts
+    - write the inserted rows to the Parquet dataset if --parquet-dir is set
     - return string indicating completion
     #### Output: string indicating completion
     '''
@@ -1749,7 +2090,10 @@ def writeCustomerHarvestAllocation(forecast_allocation_date,harvest_allocation_o
 
 
 
-    cnxn = pyodbc.connect(CONNECTIONSTRING)   
+    # use the connection of the background writer if there is one
+    is_own_connection = cnxn is None
+    if is_own_connection:
+        cnxn = pyodbc.connect(CONNECTIONSTRING)
     cnxn_cursor = cnxn.cursor()
     
     haf_demand_allocation_date_list = harvest_allocation_out_LoL[0]
@@ -1806,6 +2150,8 @@ def writeCustomerHarvestAllocation(forecast_allocation_date,harvest_allocation_o
         VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);
         """ 
 
+    written_row_list = list()
+
     for haf_idx in range(len(haf_demand_allocation_date_list)):
 
         # get values from the lists
@@ -1841,19 +2187,28 @@ def writeCustomerHarvestAllocation(forecast_allocation_date,harvest_allocation_o
                          load_date,
                          to_date,
                          is_active)
-        cnxn_cursor.execute(haf_sql, tuple_to_write)
+        written_row_list += [tuple_to_write]
         harvest_allocation_id += 1                            
 
+    # one batch per table
+    if len(written_row_list) > 0:
+        cnxn_cursor.fast_executemany = True
+        cnxn_cursor.executemany(haf_sql, written_row_list)
+
     cnxn.commit()
     cnxn_cursor.close()
-    cnxn.close()    
+    if is_own_connection:
+        cnxn.close()
+
+    if parquet_sink is not None:
+        parquet_sink.write('CustomerHarvestAllocation_Facts', written_row_list, tier_count, is_pending)
     
     return 'CustomerHarvestAllocation_Facts for ' + str(forecast_allocation_date) + ' pau'
 
 
 
 
-def writeHarvestUnallocated(harvest_in_LoL, harvest_unallocated_out_LoL, facilities_LoL, is_pending = 0):
+def writeHarvestUnallocated(harvest_in_LoL, allocation_tracker, facilities_LoL, is_pending = 0, harvest_cube = None, facility_topology = None, cnxn = None):
     '''
     #### Inputs:
     - harvest_in_LoL: list of seven lists cooresponding to harvest
@@ -1864,10 +2219,11 @@ def writeHarvestUnallocated(harvest_in_LoL, harvest_unallocated_out_LoL, facilit
         5. List of expected plant sites
         6. List of average headweights
         7. List of loose grams per plant site
-    - harvest_unallocated_out_LoL: list of three lists for mid-allocation tracking
-        1. List of date/crop/greenhouse key combinations that have an allocation
-        2. List of allocated plant sites for each date/crop/greenhouse key combination
+    - allocation_tracker: AllocationTracker for mid-allocation tracking by date/crop/greenhouse
     - is_pending: integer boolean 1 for Pending table or 0 for baseline table
+    - harvest_cube: optional HarvestCube of harvest_in_LoL computed once for the run (computed here if None)
+    - facility_topology: optional FacilityTopology of facilities_LoL shared by the run (computed here if None)
+    - cnxn: optional open connection (the connection of the background writer)
         
     #### Algorithm:
     - load inputs
@@ -1900,11 +2256,12 @@ def writeHarvestUnallocated(harvest_in_LoL, harvest_unallocated_out_LoL, facilit
                                 UID=%s;
                                 PWD=%s;""" % (uid, pwd) # use config.yml on local machine
 
-    cnxn = pyodbc.connect(CONNECTIONSTRING)   
+    # use the connection of the background writer if there is one
+    is_own_connection = cnxn is None
+    if is_own_connection:
+        cnxn = pyodbc.connect(CONNECTIONSTRING)
     cnxn_cursor = cnxn.cursor()
 
-    allocated_date_crop_facility_key_list = harvest_unallocated_out_LoL[0]
-    allocated_plant_sites_list = harvest_unallocated_out_LoL[2]
     
     # input lists from harvest
     hfsf_harvest_date_list = harvest_in_LoL[0]
@@ -1918,6 +2275,14 @@ def writeHarvestUnallocated(harvest_in_LoL, harvest_unallocated_out_LoL, facilit
     # facilities dimension
     fd_facility_id_list = facilities_LoL[0]
     fd_city_short_code_list = facilities_LoL[1]
+
+    # greenhouse cities and main coolers
+    if facility_topology is None:
+        facility_topology = FacilityTopology(facilities_LoL)
+
+    # harvest totals and grams per plant site by date/crop/city
+    if harvest_cube is None:
+        harvest_cube = HarvestCube(harvest_in_LoL, facilities_LoL, facility_topology)
     
 
     # initizlize index
@@ -1961,73 +2326,30 @@ def writeHarvestUnallocated(harvest_in_LoL, harvest_unallocated_out_LoL, facilit
         VALUES (?,?,?,?,?,?,?,?,?,?,?);
         """ 
 
-    for unallocated_key_idx in range(len(allocated_date_crop_facility_key_list)):
-        unallocated_key = allocated_date_crop_facility_key_list[unallocated_key_idx]
-        unallocated_date = DT.datetime.strptime(str(unallocated_key.split("_")[0]), '%Y-%m-%d').date()
-        unallocated_crop = int(unallocated_key.split("_")[1])
-        unallocated_facility = int(unallocated_key.split("_")[2])
+    written_row_list = list()
 
+    for unallocated_key in allocation_tracker.key_list:
+        (unallocated_date, unallocated_crop, unallocated_facility) = unallocated_key
 
-        # consider one facility ID per city short code
-        if unallocated_facility in [1,2,9]:
-            unallocated_facility = 3 # set NYC1, NYC2, and NYC4 to NYC3
-        # set harvest facility ID to demand facility ID
-        if unallocated_facility == 4:
-            unallocated_facility = 7 # set CHI1 to CHI2
 
+        # consider one facility ID per city short code (e.g. NYC1, NYC2, and NYC4 to NYC3)
+        unallocated_facility = facility_topology.mainCooler(unallocated_facility)
 
-        # get starting values from HarvestForecastSeasonality_Facts
-        harvest_date_indices =  [i for i, x in enumerate(hfsf_harvest_date_list) if x == unallocated_date]
-        harvest_crop_id_indices =  [j for j, y in enumerate(hfsf_crop_id_list) if y == unallocated_crop]
-        harvest_facility_id_indices = [k for k, z in enumerate(hfsf_facility_id_list)
-                                                 if fd_city_short_code_list[fd_facility_id_list.index(z)]
-                                                    == fd_city_short_code_list[fd_facility_id_list.index(unallocated_facility)]]
-        #harvest_facility_id_indices = [k for k, z in enumerate(hfsf_facility_id_list) if z == unallocated_facility]
-
-        harvest_date_crop_facility_indices = list(set(harvest_date_indices) & set(harvest_crop_id_indices) & set(harvest_facility_id_indices))
 
+        # get starting values from HarvestForecastSeasonality_Facts for the city of the greenhouse
         # multiple lines are potentially available to allocate for each crop
-        # from the harvest forecast, determine if the short demand can be fulfilled or not
-        harvest_facility_line_id_list = list()
-        harvest_expected_plant_sites_list = list()
-        harvest_avg_headweight_list = list()
-        harvest_whole_gpps_list = list()
-        harvest_loose_gpps_list = list()
-        for hfsf_idx in harvest_date_crop_facility_indices:
-            # get available lines
-            harvest_facility_line_id_list += [hfsf_facility_line_id_list[hfsf_idx]]
-            # get total plant sites
-            harvest_expected_plant_sites_list += [hfsf_expected_plant_sites_list[hfsf_idx]]
-            # get whole grams per plant site
-            harvest_whole_gpps_list += [hfsf_avg_headweight_list[hfsf_idx]]
-            harvest_loose_gpps_list += [hfsf_loose_grams_per_plant_site_list[hfsf_idx]]
+        harvest_city_stats = harvest_cube.cityStats(unallocated_date, unallocated_crop, harvest_cube.city(unallocated_facility))
 
         # checkpoint: there is available harvest
-        if len(harvest_expected_plant_sites_list) > 0:
-            # compute mean grams per plant site for the facility and round to two decimals
-            #harvest_facility_mean_whole_gpps = round(float(np.mean(harvest_whole_gpps_list)),2)
-            harvest_facility_std_whole_gpps = round(float(np.std(harvest_whole_gpps_list)),2)
-
-            #harvest_facility_mean_loose_gpps = round(float(np.mean(harvest_loose_gpps_list)),2)
-            harvest_facility_std_loose_gpps = round(float(np.std(harvest_loose_gpps_list)),2)
-
-            # GPPS normalized by expected plant sites
-            whole_numerator = 0
-            loose_numerator = 0
-            total_ps = 0
-            for harvest_idx in range(len(harvest_whole_gpps_list)):
-                whole_numerator += harvest_whole_gpps_list[harvest_idx] * harvest_expected_plant_sites_list[harvest_idx]
-                loose_numerator += harvest_loose_gpps_list[harvest_idx] * harvest_expected_plant_sites_list[harvest_idx]
-                total_ps += harvest_expected_plant_sites_list[harvest_idx]
-            
-            harvest_facility_mean_whole_gpps = 0
-            harvest_facility_mean_loose_gpps = 0
-            if total_ps != 0:
-                harvest_facility_mean_whole_gpps = round(float(whole_numerator/total_ps),2)
-                harvest_facility_mean_loose_gpps = round(float(loose_numerator/total_ps),2)
-            
-            key_total_plant_sites = int(sum(harvest_expected_plant_sites_list))
-            key_allocated_plant_sites = allocated_plant_sites_list[unallocated_key_idx]
+        if harvest_city_stats is not None:
+            # total plant sites, mean grams per plant site normalized by expected plant sites, and std for the city
+            (key_total_plant_sites,
+             harvest_facility_mean_whole_gpps,
+             harvest_facility_mean_loose_gpps,
+             harvest_facility_std_whole_gpps,
+             harvest_facility_std_loose_gpps) = harvest_city_stats
+
+            key_allocated_plant_sites = allocation_tracker.allocated(unallocated_key)
             key_unallocated_plant_sites = key_total_plant_sites - key_allocated_plant_sites
 
 
@@ -2069,7 +2391,7 @@ def writeHarvestUnallocated(harvest_in_LoL, harvest_unallocated_out_LoL, facilit
                   load_date,
                   to_date,
                   is_active)
-            cnxn_cursor.execute(huf_sql, tuple_to_write)
+            written_row_list += [tuple_to_write]
             harvest_unallocated_id += 1
 
     # add for date_crop_facility with no allocations
@@ -2088,14 +2410,10 @@ def writeHarvestUnallocated(harvest_in_LoL, harvest_unallocated_out_LoL, facilit
         hfsf_crop_id = hfsf_crop_id_list[hfsf_idx]
         hfsf_facility_id = hfsf_facility_id_list[hfsf_idx]
         
-        # consider one facility ID per city short code
-        if hfsf_facility_id in [1,2,9]:
-            hfsf_facility_id = 3 # set NYC1, NYC2, and NYC4 to NYC3
-        # set harvest facility ID to demand facility ID
-        if hfsf_facility_id == 4:
-            hfsf_facility_id = 7 # set CHI1 to CHI2
+        # consider one facility ID per city short code (e.g. NYC1, NYC2, and NYC4 to NYC3)
+        hfsf_facility_id = facility_topology.mainCooler(hfsf_facility_id)
 
-        hfsf_date_crop_facility_key = str(hfsf_harvest_date) + '_' + str(hfsf_crop_id) + '_' + str(hfsf_facility_id)
+        hfsf_date_crop_facility_key = AllocationTracker.key(hfsf_harvest_date, hfsf_crop_id, hfsf_facility_id)
 
         check_plant_sites = hfsf_expected_plant_sites_list[hfsf_idx]
         check_avg_headweight = hfsf_avg_headweight_list[hfsf_idx]
@@ -2104,7 +2422,7 @@ def writeHarvestUnallocated(harvest_in_LoL, harvest_unallocated_out_LoL, facilit
         check_whole_grams = round(check_avg_headweight * check_plant_sites,2)
         check_loose_grams = round(check_loose_gpps * check_plant_sites,2)
 
-        if hfsf_date_crop_facility_key not in allocated_date_crop_facility_key_list:
+        if hfsf_date_crop_facility_key not in allocation_tracker:
             # if we haven't allocated
             if hfsf_date_crop_facility_key in no_allocations_date_crop_facility_key_list:
                 # add plant sites, whole grams, and loose grams to no allocations lists
@@ -2159,18 +2477,24 @@ def writeHarvestUnallocated(harvest_in_LoL, harvest_unallocated_out_LoL, facilit
               load_date,
               to_date,
               is_active)
-        cnxn_cursor.execute(huf_sql, tuple_to_write)
+        written_row_list += [tuple_to_write]
         harvest_unallocated_id += 1
 
+    # one batch per table
+    if len(written_row_list) > 0:
+        cnxn_cursor.fast_executemany = True
+        cnxn_cursor.executemany(huf_sql, written_row_list)
+
     cnxn.commit()
     cnxn_cursor.close()
-    cnxn.close()
+    if is_own_connection:
+        cnxn.close()
     
     return 'HarvestUnallocated_Facts pau'
     
     
 
-def writeCustomerShortDemand(forecast_date, short_demand_out_LoL, is_pending = 0):
+def writeCustomerShortDemand(forecast_date, short_demand_out_LoL, is_pending = 0, tier_count = 0, cnxn = None):
     '''
     #### Inputs:
     - forecast_date: date of the forecast
@@ -2183,10 +2507,13 @@ def writeCustomerShortDemand(forecast_date, short_demand_out_LoL, is_pending = 0
         6. List of short demand quantities cooresponding to each combination of demand date/greenhouse/product
         7. List of production priorities cooresponding to each combination of demand date/greenhouse/product
     - is_pending: integer boolean 1 for Pending table or 0 for baseline table
+    - tier_count: integer tier count of the allocation step (Parquet partition only, CustomerShortDemand_Facts has no tier)
+    - cnxn: optional open connection (the connection of the background writer)
     
     #### Algorithm:
     - load inputs
     - loop through short demand lists and insert entries into CustomerShortDemand_Facts
+    - write the inserted rows to the Parquet dataset if --parquet-dir is set
     - return string indicating completion
     #### Output: string indicating completion
     '''
@@ -2211,7 +2538,10 @@ def writeCustomerShortDemand(forecast_date, short_demand_out_LoL, is_pending = 0
                                 UID=%s;
                                 PWD=%s;""" % (uid, pwd) # use config.yml on local machine
 
-    cnxn = pyodbc.connect(CONNECTIONSTRING)   
+    # use the connection of the background writer if there is one
+    is_own_connection = cnxn is None
+    if is_own_connection:
+        cnxn = pyodbc.connect(CONNECTIONSTRING)
     cnxn_cursor = cnxn.cursor()
 
     
@@ -2261,6 +2591,8 @@ def writeCustomerShortDemand(forecast_date, short_demand_out_LoL, is_pending = 0
         VALUES (?,?,?,?,?,?,?,?,?,?);
         """ 
 
+    written_row_list = list()
+
     # write new short demand for the day to ShortDemand_Facts
     for nsdf_idx in range(len(new_sdf_demand_date_list)):
         nsdf_demand_date = new_sdf_demand_date_list[nsdf_idx]
@@ -2284,17 +2616,71 @@ def writeCustomerShortDemand(forecast_date, short_demand_out_LoL, is_pending = 0
                                 to_date,
                                 is_active
                                 )
-            cnxn_cursor.execute(sdf_sql, tuple_to_write)
+            written_row_list += [tuple_to_write]
             short_demand_id += 1                
 
+    # one batch per table
+    if len(written_row_list) > 0:
+        cnxn_cursor.fast_executemany = True
+        cnxn_cursor.executemany(sdf_sql, written_row_list)
+
     cnxn.commit()
     cnxn_cursor.close()
-    cnxn.close()
+    if is_own_connection:
+        cnxn.close()
+
+    if parquet_sink is not None:
+        parquet_sink.write('CustomerShortDemand_Facts', written_row_list, tier_count, is_pending)
     
     return 'CustomerShortDemand_Facts for ' + str(forecast_date) + ' pau'
 
 
 
+def aggregateByKey(key_LoL, qty_list, net_negative = 0):
+    '''
+    #### Inputs:
+    - key_LoL: list of key lists, e.g. greenhouse IDs, product IDs, and enjoy-by-dates
+    - qty_list: list of quantities for each row of the key lists
+    - net_negative: integer boolean 1 to net negative quantities against the other quantities of the same key and drop keys with no remaining quantity
+
+    #### Algorithm:
+    - one pass over the rows with a dict from key tuple to output index (first-seen order)
+        - add the quantity of each row to the output quantity of its key
+    - if net_negative is 1, keep keys whose netted quantity is greater than 0 and warn for keys with outstanding negative quantity
+
+    #### Output: list of the distinct key lists followed by the list of aggregated quantities
+    '''
+    agg_key_idx_dict = dict()
+    agg_key_LoL = [list() for key_list in key_LoL]
+    agg_qty_list = list()
+
+    for row_idx in range(len(qty_list)):
+        row_key = tuple(key_list[row_idx] for key_list in key_LoL)
+        agg_idx = agg_key_idx_dict.get(row_key)
+        if agg_idx is None:
+            # the entry doesn't exist yet, so create it
+            agg_key_idx_dict[row_key] = len(agg_qty_list)
+            for key_idx in range(len(key_LoL)):
+                agg_key_LoL[key_idx] += [row_key[key_idx]]
+            agg_qty_list += [qty_list[row_idx]]
+        else:
+            # the entry exists, so update qty
+            agg_qty_list[agg_idx] += qty_list[row_idx]
+
+    if net_negative == 1:
+        keep_indices = list()
+        for agg_idx in range(len(agg_qty_list)):
+            if agg_qty_list[agg_idx] > 0:
+                keep_indices += [agg_idx]
+            if agg_qty_list[agg_idx] < 0:
+                print('Outstanding negative inventory: ' + str(-agg_qty_list[agg_idx]) + ' for ' + '_'.join([str(key_list[agg_idx]) for key_list in agg_key_LoL]))
+        agg_key_LoL = [[key_list[agg_idx] for agg_idx in keep_indices] for key_list in agg_key_LoL]
+        agg_qty_list = [agg_qty_list[agg_idx] for agg_idx in keep_indices]
+
+    return agg_key_LoL + [agg_qty_list]
+
+
+
 def inventoryRollover(evening_date, products_LoL, morning_date, is_pending = 0):
     '''
     #### Inputs:
@@ -2429,39 +2815,10 @@ def inventoryRollover(evening_date, products_LoL, morning_date, is_pending = 0):
 
 
     # compress inventory to one qty per combination of facility/product/enjoy-by-date
-    csi_facility_id_list = list()
-    csi_product_id_list = list()
-    csi_enjoy_by_date_list = list()
-    csi_qty_list = list()
-    csi_fpe_key_list = list()
-    
-    for si_idx in range(len(nn_inv_enjoy_by_date_list)):
-        si_facility_id = nn_inv_inventory_facility_id_list[si_idx]
-        si_product_id = nn_inv_product_id_list[si_idx]
-        si_enjoy_by_date = nn_inv_enjoy_by_date_list[si_idx]
-        
-        # check the facility/product/enjoy-by-date
-        fpe_key = str(si_facility_id) + '_' + str(si_product_id) + '_' + str(si_enjoy_by_date)
-        
-        si_qty = nn_inv_end_of_day_qty_list[si_idx]
-        
-        if fpe_key in csi_fpe_key_list:
-            # the entry exists, so update qty
-            csi_idx = csi_fpe_key_list.index(fpe_key)
-            csi_qty_list[csi_idx] += si_qty
-        if fpe_key not in csi_fpe_key_list:
-            # the entry doesn't exist yet, so create it
-            csi_facility_id_list += [si_facility_id]
-            csi_product_id_list += [si_product_id]
-            csi_enjoy_by_date_list += [si_enjoy_by_date]
-            csi_qty_list += [si_qty]
-            csi_fpe_key_list +=[fpe_key]
-    
-    # make output smooth_inv_LoL
-    new_inv_LoL = [csi_facility_id_list,
-                      csi_product_id_list,
-                      csi_enjoy_by_date_list,
-                      csi_qty_list]
+    new_inv_LoL = aggregateByKey([nn_inv_inventory_facility_id_list,
+                                  nn_inv_product_id_list,
+                                  nn_inv_enjoy_by_date_list],
+                                 nn_inv_end_of_day_qty_list)
     
     cnxn.commit()
     cnxn_cursor.close()
@@ -2542,39 +2899,10 @@ def smoothRollover(evening_date, inventory_LoL, roll_harvest_LoL, products_LoL,
 
 
     # compress smooth inventory to one qty per combination of facility/product/enjoy-by-date
-    csi_facility_id_list = list()
-    csi_product_id_list = list()
-    csi_enjoy_by_date_list = list()
-    csi_qty_list = list()
-    csi_fpe_key_list = list()
-    
-    for si_idx in range(len(smooth_inv_enjoy_by_date_list)):
-        si_facility_id = smooth_inv_inventory_facility_id_list[si_idx]
-        si_product_id = smooth_inv_product_id_list[si_idx]
-        si_enjoy_by_date = smooth_inv_enjoy_by_date_list[si_idx]
-        
-        # check the facility/product/enjoy-by-date
-        fpe_key = str(si_facility_id) + '_' + str(si_product_id) + '_' + str(si_enjoy_by_date)
-        
-        si_qty = smooth_inv_end_of_day_qty_list[si_idx]
-        
-        if fpe_key in csi_fpe_key_list:
-            # the entry exists, so update qty
-            csi_idx = csi_fpe_key_list.index(fpe_key)
-            csi_qty_list[csi_idx] += si_qty
-        if fpe_key not in csi_fpe_key_list:
-            # the entry doesn't exist yet, so create it
-            csi_facility_id_list += [si_facility_id]
-            csi_product_id_list += [si_product_id]
-            csi_enjoy_by_date_list += [si_enjoy_by_date]
-            csi_qty_list += [si_qty]
-            csi_fpe_key_list +=[fpe_key]
-    
-    # make output smooth_inv_LoL
-    smooth_inv_LoL = [csi_facility_id_list,
-                      csi_product_id_list,
-                      csi_enjoy_by_date_list,
-                      csi_qty_list]
+    smooth_inv_LoL = aggregateByKey([smooth_inv_inventory_facility_id_list,
+                                     smooth_inv_product_id_list,
+                                     smooth_inv_enjoy_by_date_list],
+                                    smooth_inv_end_of_day_qty_list)
     
     
     return smooth_inv_LoL
@@ -2583,7 +2911,30 @@ def smoothRollover(evening_date, inventory_LoL, roll_harvest_LoL, products_LoL,
 
 
 
-def inventoryForecast(forecast_date, inventory_LoL, products_LoL, transfers_LoL, tier_count):
+def transfersByArrivalDate(transfers_LoL):
+    '''
+    #### Inputs:
+    - transfers_LoL: transfers information as a list of lists (see inventoryForecast)
+
+    #### Algorithm:
+    - group transfer indices by arrival date once per run
+
+    #### Output: transfer_arrival_dict: dict of arrival date to list of transfer indices in transfer order
+    '''
+    tsf_arrival_date_list = transfers_LoL[1]
+
+    transfer_arrival_dict = dict()
+    for tsf_idx in range(len(tsf_arrival_date_list)):
+        tsf_arrival_date = tsf_arrival_date_list[tsf_idx]
+        if tsf_arrival_date in transfer_arrival_dict:
+            transfer_arrival_dict[tsf_arrival_date] += [tsf_idx]
+        else:
+            transfer_arrival_dict[tsf_arrival_date] = [tsf_idx]
+
+    return transfer_arrival_dict
+
+
+def inventoryForecast(forecast_date, inventory_LoL, products_LoL, transfers_LoL, tier_count, transfer_arrival_dict = None):
     '''
     #### Inputs:
     - forecast_date: date to compare to the stop sell date
@@ -2605,17 +2956,18 @@ def inventoryForecast(forecast_date, inventory_LoL, products_LoL, transfers_LoL,
         7. List of enjoy-by-dates
         8. List of transfer quantites
     - tier_count: allocation tier for the harvest allocation from harvest city to customer
+    - transfer_arrival_dict: optional transfer indices by arrival date from transfersByArrivalDate (computed here if None)
         
     #### Algorithm:
     - load inputs
     - initialize outputs
-    - looping through each inventory entry:
-        - compute stop sell date to compare to forecast date
-        - if stop sell date is greater than or equal to forecast date, add the entry to output inventory lists
-        - if stop sell date is less than forecast date, add entry to output stop sell lists
-    - looping through each transfer entry:
-        - if the inbound transfer arrival date is equal to the forecast date and there is greenhouse/product/enjoy-by-date is unique, add the entry to output inventory lists
-        - if the inbound transfer arrival date is equal to the forecast date and there is greenhouse/product/enjoy-by-date is not unique, add the transfer quantity to the output inventory quantity list
+    - for all inventory entries at once:
+        - join inventory to the product shelf life guarantee days array
+        - compute stop sell dates as datetime64 arithmetic and compare to forecast date
+        - split entries with a boolean mask: stop sell date greater than or equal to forecast date with positive quantity to output inventory lists, all others to output stop sell lists
+    - for each transfer arriving on the forecast date (from transfer_arrival_dict):
+        - if the greenhouse/product/enjoy-by-date is unique, add the entry to output inventory lists
+        - if the greenhouse/product/enjoy-by-date is not unique, add the transfer quantity to the output inventory quantity list
     - return the output tuple
     #### Output: (inventory_out_LoL, shelf_life_guarantee_out_LoL)
     - inventory_out_LoL: list of four lists containing expected inventory that is not expiring
@@ -2651,8 +3003,6 @@ def inventoryForecast(forecast_date, inventory_LoL, products_LoL, transfers_LoL,
     inv_out_product_id_list = list()
     inv_out_enjoy_by_date_list = list()
     inv_out_quantity_list = list()
-    
-    inv_out_facility_product_date_key_list = list()
 
     ss_out_facility_id_list = list()
     ss_out_product_id_list = list()
@@ -2660,63 +3010,56 @@ def inventoryForecast(forecast_date, inventory_LoL, products_LoL, transfers_LoL,
     ss_out_quantity_list = list()
     
     # read allocation results and make 1) inventory_LoL and 2) shelf_life_guarantee_LoL
-    for iaf_idx in range(len(iaf_inventory_facility_id_list)):
-
-        check_inventory_facility_id = iaf_inventory_facility_id_list[iaf_idx]
-        check_product_id = iaf_product_id_list[iaf_idx]                
-        check_enjoy_by_date = iaf_enjoy_by_date_list[iaf_idx]
-        check_end_of_day_qty = iaf_end_of_day_qty_list[iaf_idx]
-
-        # check enjoy_by_date with forecast_date
-        
-        check_shelf_life_guarantee_days = pd_shelf_life_guarantee_list[pd_product_id_list.index(check_product_id)]
-        shelf_life_guarantee_date = check_enjoy_by_date - DT.timedelta(days = check_shelf_life_guarantee_days)
-
-        if shelf_life_guarantee_date >= forecast_date and check_end_of_day_qty > 0:
-            inv_out_facility_id_list += [check_inventory_facility_id]
-            inv_out_product_id_list += [check_product_id]
-            inv_out_enjoy_by_date_list += [check_enjoy_by_date]
-            inv_out_quantity_list += [check_end_of_day_qty]
-            
-            inv_out_facility_product_date_key_list += str(check_inventory_facility_id) + '_' + str(check_product_id) + '_' + str(check_enjoy_by_date)
-        else:
-            ss_out_facility_id_list += [check_inventory_facility_id]
-            ss_out_product_id_list += [check_product_id]
-            ss_out_enjoy_by_date_list += [check_enjoy_by_date]
-            ss_out_quantity_list += [check_end_of_day_qty]
+    if len(iaf_inventory_facility_id_list) > 0:
+        # join inventory to product shelf life guarantee days
+        pd_product_id_array = np.array(pd_product_id_list)
+        pd_sort_indices = np.argsort(pd_product_id_array, kind = 'stable')
+        iaf_product_id_array = np.array(iaf_product_id_list)
+        iaf_pd_sorted_idx = np.searchsorted(pd_product_id_array[pd_sort_indices], iaf_product_id_array)
+        iaf_pd_sorted_idx = np.minimum(iaf_pd_sorted_idx, len(pd_sort_indices) - 1)
+        iaf_pd_idx = pd_sort_indices[iaf_pd_sorted_idx]
+        if not np.all(pd_product_id_array[iaf_pd_idx] == iaf_product_id_array):
+            raise ValueError('inventory product not in products: ' + str(iaf_product_id_array[pd_product_id_array[iaf_pd_idx] != iaf_product_id_array][0]))
+        iaf_shelf_life_guarantee_days_array = np.array(pd_shelf_life_guarantee_list, dtype = np.int64)[iaf_pd_idx]
+
+        # stop sell dates and boolean mask against the forecast date
+        iaf_enjoy_by_date_array = np.array(iaf_enjoy_by_date_list, dtype = 'datetime64[D]')
+        shelf_life_guarantee_date_array = iaf_enjoy_by_date_array - iaf_shelf_life_guarantee_days_array.astype('timedelta64[D]')
+        keep_mask = (shelf_life_guarantee_date_array >= np.datetime64(forecast_date, 'D')) & (np.array(iaf_end_of_day_qty_list, dtype = float) > 0)
+
+        keep_indices = np.flatnonzero(keep_mask)
+        ss_indices = np.flatnonzero(~keep_mask)
+
+        inv_out_facility_id_list = [iaf_inventory_facility_id_list[iaf_idx] for iaf_idx in keep_indices]
+        inv_out_product_id_list = [iaf_product_id_list[iaf_idx] for iaf_idx in keep_indices]
+        inv_out_enjoy_by_date_list = [iaf_enjoy_by_date_list[iaf_idx] for iaf_idx in keep_indices]
+        inv_out_quantity_list = [iaf_end_of_day_qty_list[iaf_idx] for iaf_idx in keep_indices]
+
+        ss_out_facility_id_list = [iaf_inventory_facility_id_list[iaf_idx] for iaf_idx in ss_indices]
+        ss_out_product_id_list = [iaf_product_id_list[iaf_idx] for iaf_idx in ss_indices]
+        ss_out_enjoy_by_date_list = [iaf_enjoy_by_date_list[iaf_idx] for iaf_idx in ss_indices]
+        ss_out_quantity_list = [iaf_end_of_day_qty_list[iaf_idx] for iaf_idx in ss_indices]
     
     
     # inbound transfers
     if tier_count == 1:
-        for tsf_idx in range(len(tsf_ship_date_list)):
-            tsf_arrival_date = tsf_arrival_date_list[tsf_idx]
-            if tsf_arrival_date == forecast_date:
-                # add inbound transfer to inventory of arrival facility
-                tsf_arrival_facility_id = tsf_arrival_facility_id_list[tsf_idx]
-                tsf_arrival_location_name = fd_location_name_list[fd_facility_id_list.index(tsf_arrival_facility_id)]
-                tsf_product_id = tsf_product_id_list[tsf_idx]
-                tsf_enjoy_by_date = tsf_enjoy_by_date_list[tsf_idx]
-                tsf_transfer_qty = tsf_transfer_qty_list[tsf_idx]
-
-                tsf_facility_product_date_key = str(tsf_arrival_facility_id)+ '_' + str(tsf_product_id) + '_' + str(tsf_enjoy_by_date)
-
-                if tsf_facility_product_date_key in inv_out_facility_product_date_key_list:
-                    inv_out_idx = inv_out_facility_product_date_key_list.index(tsf_facility_product_date_key)
-                    inv_out_quantity_list[inv_out_idx] += tsf_transfer_qty
-                if tsf_facility_product_date_key not in inv_out_facility_product_date_key_list:
-                    inv_out_facility_id_list += [tsf_arrival_facility_id]
-                    inv_out_enjoy_by_date_list += [tsf_enjoy_by_date]
-                    inv_out_product_id_list+= [tsf_product_id]
-                    inv_out_quantity_list += [tsf_transfer_qty]
-                    inv_out_facility_product_date_key_list += [tsf_facility_product_date_key]
-
-    inventory_out_LoL = [inv_out_facility_id_list, inv_out_product_id_list, inv_out_enjoy_by_date_list, inv_out_quantity_list]
+        if transfer_arrival_dict is None:
+            transfer_arrival_dict = transfersByArrivalDate(transfers_LoL)
+        for tsf_idx in transfer_arrival_dict.get(forecast_date, []):
+            # add inbound transfer to inventory of arrival facility
+            inv_out_facility_id_list += [tsf_arrival_facility_id_list[tsf_idx]]
+            inv_out_product_id_list += [tsf_product_id_list[tsf_idx]]
+            inv_out_enjoy_by_date_list += [tsf_enjoy_by_date_list[tsf_idx]]
+            inv_out_quantity_list += [tsf_transfer_qty_list[tsf_idx]]
+
+    # merge inbound transfers into inventory of the same greenhouse/product/enjoy-by-date
+    inventory_out_LoL = aggregateByKey([inv_out_facility_id_list, inv_out_product_id_list, inv_out_enjoy_by_date_list], inv_out_quantity_list)
     shelf_life_guarantee_out_LoL = [ss_out_facility_id_list,  ss_out_product_id_list, ss_out_enjoy_by_date_list, ss_out_quantity_list]
 
     return (inventory_out_LoL, shelf_life_guarantee_out_LoL)
 
     
-def writeStopSell(forecast_date,shelf_life_guarantee_LoL, is_pending = 0):
+def writeStopSell(forecast_date,shelf_life_guarantee_LoL, is_pending = 0, tier_count = 0, cnxn = None):
     '''
     #### Inputs:
     - inventory_date: date of the forecast of the stop sell inventory
@@ -2726,10 +3069,13 @@ def writeStopSell(forecast_date,shelf_life_guarantee_LoL, is_pending = 0):
         3. ss_out_product_id_list: list of product IDs
         4. ss_out_quantity_list: list of  stop sell quantities cooresponding to each combination of greenhouse/product/enjoy-by-date
     - is_pending: integer boolean 1 for Pending table or 0 for baseline table
+    - tier_count: integer tier count of the allocation step (Parquet partition only, StopSell_Facts has no tier)
+    - cnxn: optional open connection (the connection of the background writer)
     
     #### Algorithm:
     - load inputs
     - loop through stop sell lists and insert entries into StopSell_Facts
+    - write the inserted rows to the Parquet dataset if --parquet-dir is set
     - return string indicating completion
     #### Output: string indicating completion
     '''
@@ -2738,7 +3084,7 @@ def writeStopSell(forecast_date,shelf_life_guarantee_LoL, is_pending = 0):
     # connect to database
     HOSTNAME = socket.gethostname()
 
-    if HOSTNAME == 'hostname:
+    if HOSTNAME == 'hostname':
         CONNECTIONSTRING = """Driver={ODBC Driver 17 for SQL Server}; 
                                 Server=127.0.0.1,1443;
                                 Database=databasename;
@@ -2754,7 +3100,10 @@ def writeStopSell(forecast_date,shelf_life_guarantee_LoL, is_pending = 0):
                                 Database=databasename;
                                 UID=%s;
                                 PWD=%s;""" % (uid, pwd) # use config.yml on local machine
-    cnxn = pyodbc.connect(CONNECTIONSTRING)   
+    # use the connection of the background writer if there is one
+    is_own_connection = cnxn is None
+    if is_own_connection:
+        cnxn = pyodbc.connect(CONNECTIONSTRING)
     cnxn_cursor = cnxn.cursor()
 
     
@@ -2796,6 +3145,8 @@ def writeStopSell(forecast_date,shelf_life_guarantee_LoL, is_pending = 0):
         VALUES (?,?,?,?,?,?,?,?,?);
         """ 
 
+    written_row_list = list()
+
     # Stop sell
     ss_facility_id_list = shelf_life_guarantee_LoL[0]
     ss_product_id_list = shelf_life_guarantee_LoL[1]
@@ -2830,24 +3181,30 @@ def writeStopSell(forecast_date,shelf_life_guarantee_LoL, is_pending = 0):
                           to_date,
                           is_active)
         
-        cnxn_cursor.execute(sql, tuple_to_write)
+        written_row_list += [tuple_to_write]
         shelf_life_guarantee_id += 1
     
+    # one batch per table
+    if len(written_row_list) > 0:
+        cnxn_cursor.fast_executemany = True
+        cnxn_cursor.executemany(sql, written_row_list)
+
     cnxn.commit()
     cnxn_cursor.close()
-    cnxn.close()
+    if is_own_connection:
+        cnxn.close()
+
+    if parquet_sink is not None:
+        parquet_sink.write('StopSell_Facts', written_row_list, tier_count, is_pending)
 
     return 'StopSell_Facts for ' + str(forecast_date) + ' pau'
 
 
-def writeAllocated(allocated_crops_LoL, tier_count):
+def writeAllocated(allocation_tracker, tier_count, cnxn = None):
     """
     Write mid allocations to database
-    Input: allocated_crops_LoL: list of four lists tracking harvest allocation
-        1. Date_crop_facility list
-        2. Starting plant sites list
-        3. Allocated plant sites list
-        4. Completed crop allocation list
+    Input: allocation_tracker: AllocationTracker tracking harvest allocation by date/crop/facility
+           cnxn: optional open connection (the connection of the background writer)
     Algorithm:
         1. Change data capture
         2. Write allocated crops to Allocated_Facts
@@ -2874,7 +3231,10 @@ def writeAllocated(allocated_crops_LoL, tier_count):
                                 Database=databasename;
                                 UID=%s;
                                 PWD=%s;""" % (uid, pwd) # use config.yml on local machine
-    cnxn = pyodbc.connect(CONNECTIONSTRING)   
+    # use the connection of the background writer if there is one
+    is_own_connection = cnxn is None
+    if is_own_connection:
+        cnxn = pyodbc.connect(CONNECTIONSTRING)
     cnxn_cursor = cnxn.cursor()
     
     # CDC
@@ -2908,44 +3268,37 @@ def writeAllocated(allocated_crops_LoL, tier_count):
     VALUES (?,?,?,?,?,?,?,?,?,?,?);
     """ 
 
-    allocated_date_crop_facility_key_list = allocated_crops_LoL[0]
-    allocated_starting_ps_list = allocated_crops_LoL[1]
-    allocated_plant_sites_list = allocated_crops_LoL[2]
-    complete_crop_allocation_key_list = allocated_crops_LoL[3]
+    written_row_list = list()
 
-    for a_idx in range(len(allocated_date_crop_facility_key_list)):
-        date_crop_facility_key = allocated_date_crop_facility_key_list[a_idx]
-        starting_ps = allocated_starting_ps_list[a_idx]
-        allocated_ps = allocated_plant_sites_list[a_idx]
-        
-        is_complete = 0
-        if date_crop_facility_key in complete_crop_allocation_key_list:
-            is_complete = 1
-        
-        allocated_date = DT.datetime.strptime(str(date_crop_facility_key.split("_")[0]), '%Y-%m-%d').date()
-        allocated_crop_id = int(date_crop_facility_key.split("_")[1])
-        allocated_facility_id = int(date_crop_facility_key.split("_")[2])
+    allocated_arrays = allocation_tracker.toArrays()
 
+    for a_idx in range(len(allocation_tracker)):
         tuple_to_write = (
             allocated_id,
-            allocated_date,
-            allocated_crop_id,
-            allocated_facility_id,
+            allocated_arrays['date'][a_idx].item(),
+            int(allocated_arrays['crop_id'][a_idx]),
+            int(allocated_arrays['greenhouse_id'][a_idx]),
             tier_count,
-            starting_ps,
-            allocated_ps,
-            is_complete,
+            int(allocated_arrays['starting_ps'][a_idx]),
+            int(allocated_arrays['allocated_ps'][a_idx]),
+            int(allocated_arrays['is_complete'][a_idx]),
             load_date,
             to_date,
             is_active
         )
         #print(tuple_to_write)
-        cnxn_cursor.execute(sql, tuple_to_write)
+        written_row_list += [tuple_to_write]
         allocated_id += 1
     
+    # one batch per table
+    if len(written_row_list) > 0:
+        cnxn_cursor.fast_executemany = True
+        cnxn_cursor.executemany(sql, written_row_list)
+
     cnxn.commit()
     cnxn_cursor.close()
-    cnxn.close()
+    if is_own_connection:
+        cnxn.close()
 
     return 'Allocated_Facts pau'
 
@@ -2958,11 +3311,7 @@ def readAllocated():
     #### Algorithm:
     - read Allocated_Facts active entries
     
-    #### Output: allocated_crops_LoL: list of four lists for allocation tracking
-        1. Date_crop_facility list
-        2. Starting plant sites list
-        3. Allocated plant sites list
-        4. Completed crop allocation list
+    #### Output: allocation_tracker: AllocationTracker for allocation tracking by date/crop/greenhouse
     '''
     
         
@@ -2989,10 +3338,7 @@ def readAllocated():
     cnxn = pyodbc.connect(CONNECTIONSTRING)   
     cnxn_cursor = cnxn.cursor()
 
-    allocated_date_crop_facility_key_list = list()
-    allocated_starting_ps_list = list()
-    allocated_plant_sites_list = list()
-    complete_crop_allocation_key_list = list()
+    allocation_tracker = AllocationTracker()
     
     sql = """ SELECT AllocatedDate, CropID, GreenhouseID, StartingPlantSites, AllocatedPlantSites, IsComplete
                 FROM Allocated_Facts
@@ -3007,15 +3353,13 @@ def readAllocated():
         a_crop_id = row[1]
         a_facility_id = row[2]
         
-        a_key = str(a_date) + '_' + str(a_crop_id) + '_' + str(a_facility_id)
+        a_key = AllocationTracker.key(a_date, a_crop_id, a_facility_id)
         
-        allocated_date_crop_facility_key_list += [a_key]
-        allocated_starting_ps_list += [row[3]]
-        allocated_plant_sites_list += [row[4]]
+        allocation_tracker.add(a_key, row[4], row[3])
         
         a_is_complete = row[5]
         if a_is_complete == 1:
-            complete_crop_allocation_key_list += [a_key]
+            allocation_tracker.complete(a_key)
         
     while row is not None:
         row = cnxn_cursor.fetchone()
@@ -3024,29 +3368,164 @@ def readAllocated():
             a_crop_id = row[1]
             a_facility_id = row[2]
 
-            a_key = str(a_date) + '_' + str(a_crop_id) + '_' + str(a_facility_id)
+            a_key = AllocationTracker.key(a_date, a_crop_id, a_facility_id)
 
-            allocated_date_crop_facility_key_list += [a_key]
-            allocated_starting_ps_list += [row[3]]
-            allocated_plant_sites_list += [row[4]]
+            allocation_tracker.add(a_key, row[4], row[3])
 
             a_is_complete = row[5]
             if a_is_complete == 1:
-                complete_crop_allocation_key_list += [a_key]
+                allocation_tracker.complete(a_key)
  
-    # make output smooth_inv_LoL
-    allocated_crops_LoL = [allocated_date_crop_facility_key_list,
-                            allocated_starting_ps_list,
-                            allocated_plant_sites_list,
-                            complete_crop_allocation_key_list]
-    
     cnxn.commit()
     cnxn_cursor.close()
     cnxn.close()
     
-    return allocated_crops_LoL
+    return allocation_tracker
+
+class RouteCalendar:
+    '''
+    #### Inputs:
+        - transfer_constraints_LoL: transfer constraints (see calculateTransfers)
+        - calendar_LoL: calendar information (see calculateTransfers)
+        - demand_allocation_date_list: demand allocation dates of the run
+    #### Algorithm:
+    - precompute once per run, for each demand allocation date, the transfer constraints that deliver on that date
+        - active routes and extra shelf days by demand allocation date day of week (Mon is 0)
+        - ship day, arrival day, and next arrival day of the same ship/arrival greenhouse route from the calendar
+    - calculateTransfers looks up the routes instead of searching the transfer constraints and calendar
+
+    #### Output: route tuples
+        - routes(demand_allocation_date): list of route tuples in transfer constraint order
+        - lookup(ship_greenhouse_id, arrival_greenhouse_id, demand_allocation_date): list of route tuples for the route
+        - route tuple:
+            1. transfer constraint index
+            2. ship greenhouse ID
+            3. arrival greenhouse ID
+            4. ship day
+            5. arrival day
+            6. next arrival day of the same route (None if past the end of the calendar)
+            7. pack lead time days
+            8. ship duration days
+            9. max pallet capacity
+            10. gfoods transfer boolean flag
+    '''
+
+    # transfer constraint indices that deliver on each demand allocation date day of week (see calculateTransfers)
+    active_tcf_idx_dict = {0: [1,4,6,8,10,12],
+                           1: [1,2,6,8,10,12],
+                           2: [1,2,5,8,10,12],
+                           3: [0,3,5,7,9,11],
+                           4: [0,3,6,7,9,11]}
+
+    # additional days on the shelf before the demand allocation date: (transfer constraint index, day of week): days
+    extra_shelf_days_dict = {(0,4): 1,  # 13 pvd to nyc Wed when its Fri
+                             (1,0): 2,  # 1 pvd to nyc Fri when its Mon
+                             (1,1): 3,  # 4 pvd to nyc Fri when its Tues
+                             (1,2): 4,  # 7 pvd to nyc Fri when its Wed
+                             (2,2): 1,  # 8 bal to nyc Mon when its Wed
+                             (3,4): 1,  # 14 bal to nyc Wed when its Fri
+                             (4,0): 2,  # 2 bal to nyc Fri when its Mon
+                             (5,3): 1,  # 12 chi to den Mon when its Thurs
+                             (6,0): 3,  # 3 chi to den Wed when its Mon
+                             (6,1): 4,  # 6 chi to den Wed when its Tues
+                             (7,4): 1,  # 28
+                             (8,0): 2,  # 16
+                             (8,1): 3,  # 19
+                             (8,2): 4,  # 22
+                             (9,4): 1,  # 29
+                             (10,0): 2, # 17
+                             (10,1): 3, # 20
+                             (10,2): 4, # 23
+                             (11,4): 1, # 30
+                             (12,0): 2, # 18
+                             (12,1): 3, # 21
+                             (12,2): 4} # 24
+
+    def __init__(self, transfer_constraints_LoL, calendar_LoL, demand_allocation_date_list):
+
+        tcf_ship_greenhouse_id_list = transfer_constraints_LoL[0]
+        tcf_arrival_greenhouse_id_list = transfer_constraints_LoL[1]
+        tcf_ship_day_of_week_list = transfer_constraints_LoL[2]
+        tcf_pack_lead_time_days_list = transfer_constraints_LoL[3]
+        tcf_ship_duration_days_list = transfer_constraints_LoL[4]
+        tcf_max_pallet_capacity_list = transfer_constraints_LoL[5]
+        tcf_gfoods_transfer_list = transfer_constraints_LoL[6]
+
+        cald_date_day_list = calendar_LoL[0]
+        cald_year_week_dow_list = calendar_LoL[4]
+
+        # calendar day of week by date
+        cald_dow_dict = dict()
+        for cald_idx in range(len(cald_date_day_list)):
+            cald_dow_dict[cald_date_day_list[cald_idx]] = int(cald_year_week_dow_list[cald_idx].split('_')[2])
+
+        # ship days of week for each ship/arrival greenhouse route
+        route_ship_dow_dict = dict()
+        for tcf_idx in range(len(tcf_ship_greenhouse_id_list)):
+            route_key = (tcf_ship_greenhouse_id_list[tcf_idx], tcf_arrival_greenhouse_id_list[tcf_idx])
+            if route_key in route_ship_dow_dict:
+                route_ship_dow_dict[route_key].add(tcf_ship_day_of_week_list[tcf_idx])
+            else:
+                route_ship_dow_dict[route_key] = {tcf_ship_day_of_week_list[tcf_idx]}
+
+        self.date_route_dict = dict()
+        self.route_dict = dict()
+
+        for demand_allocation_date in demand_allocation_date_list:
+            dad_dow = demand_allocation_date.weekday()
+            date_route_list = list()
+            for tcf_idx in self.active_tcf_idx_dict.get(dad_dow, []):
+                if tcf_idx >= len(tcf_ship_greenhouse_id_list):
+                    continue
+
+                ship_greenhouse_id = tcf_ship_greenhouse_id_list[tcf_idx]
+                arrival_greenhouse_id = tcf_arrival_greenhouse_id_list[tcf_idx]
+                ship_duration_days = tcf_ship_duration_days_list[tcf_idx]
+
+                # infer ship day based on demand_allocation_date
+                extra_shelf_days = self.extra_shelf_days_dict.get((tcf_idx, dad_dow), 0)
+                ship_day = demand_allocation_date - DT.timedelta(days = ship_duration_days + extra_shelf_days)
+                arrival_day = ship_day + DT.timedelta(days = ship_duration_days)
+
+                # next ship day of the same route within the following week
+                next_arrival_day = None
+                route_ship_dow_set = route_ship_dow_dict[(ship_greenhouse_id, arrival_greenhouse_id)]
+                for day_count in range(1, 8):
+                    next_ship_day = ship_day + DT.timedelta(days = day_count)
+                    if next_ship_day not in cald_dow_dict:
+                        break
+                    if cald_dow_dict[next_ship_day] in route_ship_dow_set:
+                        next_arrival_day = next_ship_day + DT.timedelta(days = ship_duration_days)
+                        break
+
+                route = (tcf_idx,
+                         ship_greenhouse_id,
+                         arrival_greenhouse_id,
+                         ship_day,
+                         arrival_day,
+                         next_arrival_day,
+                         tcf_pack_lead_time_days_list[tcf_idx],
+                         ship_duration_days,
+                         tcf_max_pallet_capacity_list[tcf_idx],
+                         tcf_gfoods_transfer_list[tcf_idx])
+
+                date_route_list += [route]
+                route_key = (ship_greenhouse_id, arrival_greenhouse_id, demand_allocation_date)
+                if route_key in self.route_dict:
+                    self.route_dict[route_key] += [route]
+                else:
+                    self.route_dict[route_key] = [route]
+
+            self.date_route_dict[demand_allocation_date] = date_route_list
+
+    def routes(self, demand_allocation_date):
+        return self.date_route_dict.get(demand_allocation_date, [])
+
+    def lookup(self, ship_greenhouse_id, arrival_greenhouse_id, demand_allocation_date):
+        return self.route_dict.get((ship_greenhouse_id, arrival_greenhouse_id, demand_allocation_date), [])
 
-def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL, facilities_LoL, allocated_crops_LoL, products_LoL, transfer_constraints_LoL, calendar_LoL, calc_transfers_LoL, inventory_allocation_out_LoL):
+
+def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL, facilities_LoL, allocation_tracker, products_LoL, transfer_constraints_LoL, calendar_LoL, calc_transfers_LoL, inventory_allocation_out_LoL, route_calendar = None, harvest_cube = None):
     '''
     #### Inputs:
         - demand_allocation_date: date of the short demand allocation in main loop
@@ -3069,7 +3548,7 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
         - facilities_LoL: greenhouses dimension
             1. List of greenhouse IDs
             2. List of city abbreviations
-        - allocated_crops_LoL:  mid-allocation tracking
+        - allocation_tracker:  AllocationTracker for mid-allocation tracking (updated in place)
             1. List of date/crop/greenhouse key combinations that have an allocation
             2. List of starting plant sites for each date/crop/greenhouse key combination
             3. List of allocated plant sites for each date/crop/greenhouse key combination
@@ -3117,9 +3596,11 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
             5. List of start-of-day quantities cooresponding to each combination of greenhouse/product/enjoy-by-date
             6. List of allocated quantities cooresponding to each combination of greenhouse/product/enjoy-by-date/customer
             7. List of end-of-day quantities cooresponding to each combination of greenhouse/product/enjoy-by-date
+        11. route_calendar: RouteCalendar precomputed for the run (built from transfer constraints and calendar if None)
+        12. harvest_cube: HarvestCube of harvest_in_LoL computed once for the run (computed here if None)
     #### Algorithm:
     - initialize inputs
-    - loop through transfer constraints for the demand allocation date
+    - loop through RouteCalendar routes for the demand allocation date
         - check for initial truck capacity
         - organize demand into nested dictionaries 
         - inventory calculated transfers for GFOODS products
@@ -3148,7 +3629,7 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
             9. List of allocated grams
             10. List of allocated quantities
             11. List of full packout boolean flags
-        - allocated_crops_out_LoL: mid-allocation tracking
+        - allocation_tracker: AllocationTracker for mid-allocation tracking
             1. List of date/crop/greenhouse key combinations that have an allocation
             2. List of starting plant sites for each date/crop/greenhouse key combination
             3. List of allocated plant sites for each date/crop/greenhouse key combination
@@ -3186,12 +3667,6 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
     hfsf_avg_headweight_list = harvest_in_LoL[5]
     hfsf_loose_grams_per_plant_site_list = harvest_in_LoL[6]
     
-    # allocated crops
-    allocated_date_crop_facility_key_list = allocated_crops_LoL[0]
-    allocated_starting_ps_list = allocated_crops_LoL[1]
-    allocated_plant_sites_list = allocated_crops_LoL[2]
-    complete_crop_allocation_key_list = allocated_crops_LoL[3]
-    
 
     # input lists from demand
     sdf_demand_date_list = short_demand_LoL[0]
@@ -3212,6 +3687,19 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
             ct_sdf_key_list += [ct_sdf_key]
             ct_qty_list += [ct_qty]
         
+    # parse each short demand key once for the route loop
+    # ct_sdf_row_dict[ct_sdf_key] = (demand date, greenhouse ID, product ID, customer ID, crop ID, production priority)
+    ct_sdf_row_dict = dict()
+    for ct_sdf_key in ct_sdf_key_list:
+        sdf_product_id = int(ct_sdf_key.split('_')[2])
+        pd_idx = products_LoL[0].index(sdf_product_id)
+        ct_sdf_row_dict[ct_sdf_key] = (DT.datetime.strptime(ct_sdf_key.split('_')[0],"%Y-%m-%d").date(),
+                                       int(ct_sdf_key.split('_')[1]),
+                                       sdf_product_id,
+                                       int(ct_sdf_key.split('_')[3]),
+                                       products_LoL[2][pd_idx],
+                                       pd_production_priority_list[pd_idx])
+
     
     # product dimension
     pd_product_id_list = products_LoL[0]
@@ -3227,6 +3715,10 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
     fd_facility_id_list = facilities_LoL[0]
     fd_city_short_code_list = facilities_LoL[1]
 
+    # harvest totals and grams per plant site by date/crop/city
+    if harvest_cube is None:
+        harvest_cube = HarvestCube(harvest_in_LoL, facilities_LoL)
+
     # read transfer constraints
     tcf_ship_greenhouse_id_list = transfer_constraints_LoL[0]
     tcf_arrival_greenhouse_id_list = transfer_constraints_LoL[1]
@@ -3392,12 +3884,12 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
     ######################
     
     
-    # for the constraint indices cooresponding to shipments
-    for tcf_idx in range(len(tcf_ship_greenhouse_id_list)):
-    #for tcf_idx in [0]:
-        # determine if the demand allocation date is between the arrival date and next arrival date
-        
-    
+    # precomputed transfer routes (ship day, arrival day, constraints) for the demand allocation date
+    if route_calendar is None:
+        route_calendar = RouteCalendar(transfer_constraints_LoL, calendar_LoL, [demand_allocation_date])
+
+    # for the routes delivering on the demand allocation date (see RouteCalendar)
+    for route in route_calendar.routes(demand_allocation_date):
         #checkpoint: demand_allocation date matches transfer constraint
         
         # NYC gets shipments on Tuesday (from BAL only), Thursday, and Saturday
@@ -3447,79 +3939,14 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
 #             29. receive in BAL from NYC previous Thurs (9)
 #             30. recieve in DEN from CHI previous Thurs (11)
             
-        # python datetime .weekday() starts with Mon as 0, whereas Calendars_dim DayOfWeek starts at 1
-        dad_dow = demand_allocation_date.weekday() # note python datetime .weekday() starts with Mon as 0, whereas Calendars_dim DayOfWeek starts at 1
-        if len(ct_sdf_key_list) > 0 and ((dad_dow == 0 and tcf_idx in [1,4,6,8,10,12]) or (dad_dow == 1 and tcf_idx in [1,2,6, 8,10,12]) or (dad_dow == 2 and tcf_idx in [1,2,5, 8,10,12]) or (dad_dow == 3 and tcf_idx in [0,3,5,7,9,11]) or (dad_dow == 4 and tcf_idx in [0,3,6,7,9,11])):
-        
-            #print(demand_allocation_date, tcf_idx)
-
-            # transfer constraints
-            arrival_greenhouse_id = tcf_arrival_greenhouse_id_list[tcf_idx]
-            ship_greenhouse_id = tcf_ship_greenhouse_id_list[tcf_idx]
-            ship_dow = tcf_ship_day_of_week_list[tcf_idx]
-            pack_lead_time_days = tcf_pack_lead_time_days_list[tcf_idx]
-            ship_duration_days = tcf_ship_duration_days_list[tcf_idx]
-            max_pallet_capacity = tcf_max_pallet_capacity_list[tcf_idx]
-            gfoods_transfer = tcf_gfoods_transfer_list[tcf_idx]
-
-            # infer ship day based on demand_allocation_date
-            
-            # 5, 9, 10, 11, 15 demand allocation date matches arrival date
-            ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days)
-            
-            # modify ship day when we need to keep it on the shelf for one or more additional days
-            if tcf_idx == 0 and dad_dow == 4: # 13 pvd to nyc Wed when its Fri
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 1)
-            if tcf_idx == 1 and dad_dow == 0: # 1 pvd to nyc Fri when its Mon
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 2)   
-            if tcf_idx == 1 and dad_dow == 1: # 4 pvd to nyc Fri when its Tues
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 3)
-            if tcf_idx == 1 and dad_dow == 2: # 7 pvd to nyc Fri when its Wed
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 4)   
-            if tcf_idx == 2 and dad_dow == 2: # 8 bal to nyc Mon when its Wed
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 1)
-            if tcf_idx == 3 and dad_dow == 4: # 14 bal to nyc Wed when its Fri
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 1)
-            if tcf_idx == 4 and dad_dow == 0: # 2 bal to nyc Fri when its Mon
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 2)
-            if tcf_idx == 5 and dad_dow == 3: # 12 chi to den Mon when its Thurs
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 1)
-            if tcf_idx == 6 and dad_dow == 0: # 3 chi to den Wed when its Mon
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 3)
-            if tcf_idx == 6 and dad_dow == 1: # 6 chi to den Wed when its Tues
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 4)
-
-            if tcf_idx == 7 and dad_dow == 4: # 28
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 1)
-            if tcf_idx == 8 and dad_dow == 0: # 16
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 2)  
-            if tcf_idx == 8 and dad_dow == 1: # 19
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 3)
-            if tcf_idx == 8 and dad_dow == 2: # 22
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 4) 
-            if tcf_idx == 9 and dad_dow == 4: # 29
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 1)
-            if tcf_idx == 10 and dad_dow == 0: # 17
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 2)  
-            if tcf_idx == 10 and dad_dow == 1: # 20
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 3)
-            if tcf_idx == 10 and dad_dow == 2: # 23
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 4)
-            if tcf_idx == 11 and dad_dow == 4: # 30
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 1)
-            if tcf_idx == 12 and dad_dow == 0: # 18
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 2)  
-            if tcf_idx == 12 and dad_dow == 1: # 21
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 3)
-            if tcf_idx == 12 and dad_dow == 2: # 24
-                ship_day = demand_allocation_date -  DT.timedelta(days = ship_duration_days + 4)                
-                
-                
+        if len(ct_sdf_key_list) > 0:
+
+            # transfer constraints and ship day inferred from demand_allocation_date
+            (tcf_idx, ship_greenhouse_id, arrival_greenhouse_id, ship_day, arrival_day, next_arrival_day, pack_lead_time_days, ship_duration_days, max_pallet_capacity, gfoods_transfer) = route
+
             # checkpoint: ship date is greater than the first date in the harvest forecast
             if ship_day > initial_date:
-                
 
-                arrival_day = ship_day + DT.timedelta(days = ship_duration_days)
                 # get short demand in arrival facility between arrival day and next arrival day
 
 
@@ -3552,15 +3979,9 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
 
                 for ct_idx in range(len(ct_sdf_key_list)):
                     ct_key = ct_sdf_key_list[ct_idx]
-                    sdf_demand_date = DT.datetime.strptime(ct_key.split('_')[0],"%Y-%m-%d").date()
-                    sdf_greenhouse_id = int(ct_key.split('_')[1])
-                    sdf_product_id = int(ct_key.split('_')[2])
-                    sdf_customer_id = int(ct_key.split('_')[3])
+                    (sdf_demand_date, sdf_greenhouse_id, sdf_product_id, sdf_customer_id, sdf_crop_id, sdf_production_priority) = ct_sdf_row_dict[ct_key]
                     sdf_short_demand_qty = ct_qty_list[ct_idx]
 
-                    sdf_crop_id = pd_crop_id_list[pd_product_id_list.index(sdf_product_id)]
-                    sdf_production_priority = pd_production_priority_list[pd_product_id_list.index(sdf_product_id)]
-
                     if sdf_short_demand_qty != None and sdf_customer_id != 0 and sdf_greenhouse_id == arrival_greenhouse_id:
 
                         if sdf_production_priority in demand_dict.keys():
@@ -3834,46 +4255,10 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
                                         # get harvest for the crop in the ship greenhouse
                                         transfer_harvest_date_list = list()
 
-                                        harvest_date_indices =  [i for i, x in enumerate(hfsf_harvest_date_list) if x >= first_harvest_day and x<= last_harvest_day]
-                                        harvest_crop_id_indices =  [j for j, y in enumerate(hfsf_crop_id_list) if y == crop_id]
-                                        harvest_facility_id_indices = [k for k, z in enumerate(hfsf_facility_id_list)
-                                                                     if fd_city_short_code_list[fd_facility_id_list.index(z)]
-                                                                        == fd_city_short_code_list[fd_facility_id_list.index(ship_greenhouse_id)]]
-                                        harvest_date_crop_facility_indices = list(set(harvest_date_indices) & set(harvest_crop_id_indices) & set(harvest_facility_id_indices))
-
-                                        all_harvest_expected_plant_sites_list = list()
-                                        all_harvest_whole_gpps_list = list()
-                                        all_harvest_loose_gpps_list = list()
-
-                                        # organize harvest by date
-                                        distinct_harvest_date_list = list()
-
-                                        for hfsf_idx in harvest_date_crop_facility_indices:
-
-                                            hfsf_harvest_date = hfsf_harvest_date_list[hfsf_idx]
-                                            hfsf_expected_plant_sites = hfsf_expected_plant_sites_list[hfsf_idx]
-                                            if hfsf_harvest_date in distinct_harvest_date_list and hfsf_expected_plant_sites > 0:
-
-                                                harvest_idx = distinct_harvest_date_list.index(hfsf_harvest_date)
-                                                # get total plant sites, whole grams per plant site, and loose grams per plant site
-                                                all_harvest_expected_plant_sites_list[harvest_idx] += [hfsf_expected_plant_sites]
-                                                all_harvest_whole_gpps_list[harvest_idx] += [hfsf_avg_headweight_list[hfsf_idx]]
-                                                all_harvest_loose_gpps_list[harvest_idx] += [hfsf_loose_grams_per_plant_site_list[hfsf_idx]]
-
-
-                                            if hfsf_harvest_date not in distinct_harvest_date_list and hfsf_expected_plant_sites > 0:
-                                                distinct_harvest_date_list += [hfsf_harvest_date]
-                                                # get total plant sites, whole grams per plant site, and loose grams per plant site
-                                                all_harvest_expected_plant_sites_list += [[hfsf_expected_plant_sites]]
-                                                all_harvest_whole_gpps_list += [[hfsf_avg_headweight_list[hfsf_idx]]]
-                                                all_harvest_loose_gpps_list += [[hfsf_loose_grams_per_plant_site_list[hfsf_idx]]]
-
-
-                                        # sort harvest by date
-                                        sorted_harvest_date_list = list(np.sort(distinct_harvest_date_list))
-                                        sorted_harvest_expected_plant_sites_list = list([x for _,x in sorted(zip(distinct_harvest_date_list,all_harvest_expected_plant_sites_list))])
-                                        sorted_harvest_whole_gpps_list = list([y for _,y in sorted(zip(distinct_harvest_date_list,all_harvest_whole_gpps_list))])
-                                        sorted_harvest_loose_gpps_list = list([y for _,y in sorted(zip(distinct_harvest_date_list,all_harvest_loose_gpps_list))])
+                                        # harvest dates with positive expected plant sites for the crop in the city of the greenhouse, sorted by date
+                                        harvest_city = harvest_cube.city(ship_greenhouse_id)
+                                        sorted_harvest_date_list = harvest_cube.cityHarvestDates(crop_id, harvest_city, first_harvest_day, last_harvest_day)
+                                        sorted_harvest_stats_list = [harvest_cube.cityStats(harvest_date, crop_id, harvest_city, 1) for harvest_date in sorted_harvest_date_list]
 
 
                                         # attempt allocation in reverse chronological order
@@ -3886,49 +4271,30 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
 
                                             if check_skip_key in skip_key_list:
                                                 del sorted_harvest_date_list[-1]
-                                                del sorted_harvest_expected_plant_sites_list[-1]
-                                                del sorted_harvest_whole_gpps_list[-1]
-                                                del sorted_harvest_loose_gpps_list[-1]
+                                                del sorted_harvest_stats_list[-1]
                                             if check_skip_key not in skip_key_list:
 
 
-                                                allocated_date_crop_facility_key = str(harvest_date) + '_' + str(crop_id) + '_' + str(ship_greenhouse_id)
+                                                allocated_date_crop_facility_key = AllocationTracker.key(harvest_date, crop_id, ship_greenhouse_id)
 
                                                 # remove from lists if harvest is completely allocated (no harvest is available)
-                                                if allocated_date_crop_facility_key in complete_crop_allocation_key_list:
+                                                if allocation_tracker.isComplete(allocated_date_crop_facility_key):
                                                     del sorted_harvest_date_list[-1]
-                                                    del sorted_harvest_expected_plant_sites_list[-1]
-                                                    del sorted_harvest_whole_gpps_list[-1]
-                                                    del sorted_harvest_loose_gpps_list[-1]
+                                                    del sorted_harvest_stats_list[-1]
 
                                                 # checkpoint: harvest is available
 
-                                                if allocated_date_crop_facility_key not in complete_crop_allocation_key_list:
+                                                if not allocation_tracker.isComplete(allocated_date_crop_facility_key):
 
                                                     # get plant sites already allocated for the facility on the harvest date
-                                                    already_allocated_plant_sites = 0
-                                                    if allocated_date_crop_facility_key in allocated_date_crop_facility_key_list: 
-                                                        already_allocated_plant_sites = allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(allocated_date_crop_facility_key)]
-
-                                                    # available harvest closes to ship day
-                                                    harvest_expected_plant_sites_list = sorted_harvest_expected_plant_sites_list[-1]
-                                                    harvest_whole_gpps_list = sorted_harvest_whole_gpps_list[-1]
-                                                    harvest_loose_gpps_list = sorted_harvest_loose_gpps_list[-1]
-
-                                                    # GPPS normalized by expected plant sites
-                                                    whole_numerator = 0
-                                                    loose_numerator = 0
-                                                    total_ps = 0
-                                                    for harvest_idx in range(len(harvest_whole_gpps_list)):
-                                                        whole_numerator += harvest_whole_gpps_list[harvest_idx] * harvest_expected_plant_sites_list[harvest_idx]
-                                                        loose_numerator += harvest_loose_gpps_list[harvest_idx] * harvest_expected_plant_sites_list[harvest_idx]
-                                                        total_ps += harvest_expected_plant_sites_list[harvest_idx]
-
-                                                    harvest_facility_mean_whole_gpps = 0
-                                                    harvest_facility_mean_loose_gpps = 0
-                                                    if total_ps != 0:
-                                                        harvest_facility_mean_whole_gpps = round(float(whole_numerator/total_ps),2)
-                                                        harvest_facility_mean_loose_gpps = round(float(loose_numerator/total_ps),2)
+                                                    already_allocated_plant_sites = allocation_tracker.allocated(allocated_date_crop_facility_key)
+
+                                                    # available harvest closes to ship day: total plant sites and mean grams per plant site normalized by expected plant sites
+                                                    (harvest_facility_net_plant_sites,
+                                                     harvest_facility_mean_whole_gpps,
+                                                     harvest_facility_mean_loose_gpps,
+                                                     harvest_facility_std_whole_gpps,
+                                                     harvest_facility_std_loose_gpps) = sorted_harvest_stats_list[-1]
 
                                                     # choose conversion factor
                                                     harvest_facility_mean_gpps = harvest_facility_mean_loose_gpps 
@@ -3942,9 +4308,6 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
                                                     if harvest_facility_mean_gpps != 0:
                                                         net_plant_sites = int(np.ceil(float(short_demand_qty * net_weight_grams / harvest_facility_mean_gpps)))
 
-                                                    # compute net plant sites for the facility
-                                                    harvest_facility_net_plant_sites = int(sum(harvest_expected_plant_sites_list))
-
                                                     # compute remaining plant sites for allocation considering the mid allocation checkpoint
                                                     harvest_facility_pre_plant_sites = harvest_facility_net_plant_sites - already_allocated_plant_sites
 
@@ -3957,9 +4320,7 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
                                                         #print('oh no short on ', crop_id, ship_greenhouse_id, harvest_date, demand_allocation_date)
                                                         # update harvest allocation lists
                                                         del sorted_harvest_date_list[-1]
-                                                        del sorted_harvest_expected_plant_sites_list[-1]
-                                                        del sorted_harvest_whole_gpps_list[-1]
-                                                        del sorted_harvest_loose_gpps_list[-1]
+                                                        del sorted_harvest_stats_list[-1]
 
                                                         # set full_packout to true
                                                         full_packout = 1
@@ -3992,14 +4353,14 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
                                                             check_product_id = int(check_key.split("_")[1])
                                                             check_facility_id = int(check_key.split("_")[2])
                                                             check_crop_id = pd_crop_id_list[pd_product_id_list.index(check_product_id)]
-                                                            check_date_crop_facility_key = str(check_harvest_date) + '_' + str(check_crop_id) + '_' + str(check_facility_id)
+                                                            check_date_crop_facility_key = AllocationTracker.key(check_harvest_date, check_crop_id, check_facility_id)
                                                             if check_harvest_date == harvest_date and check_facility_id == ship_greenhouse_id and check_crop_id == crop_id:
                                                             #if check_demand_allocation_date == demand_allocation_date and check_city_short_code == fd_city_short_code_list[fd_facility_id_list.index(harvest_facility_id)] and check_priority == production_priority and check_crop_id == crop_id:
                                                                 check_allocated_product_plant_sites = allocated_product_plant_sites_list[check_idx]
                                                                 # add the plant sites for the harvest_demand_ratio
                                                                 harvest_priority_plant_sites += check_allocated_product_plant_sites
                                                                 # subtract the plant sites from the overall allocation tracking list since the new value multiplied by harvest_demand_ratio will be added back
-                                                                allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(check_date_crop_facility_key)] -= check_allocated_product_plant_sites
+                                                                allocation_tracker.subtract(check_date_crop_facility_key, check_allocated_product_plant_sites)
 
 
                                                         # compute harvest_demand_ratio (less than 1 in this case)
@@ -4046,13 +4407,7 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
                                                                         haf_full_packout_list += [full_packout]
 
                                                                         # update the allocation_lists
-                                                                        if allocated_date_crop_facility_key in allocated_date_crop_facility_key_list:        
-                                                                            allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(allocated_date_crop_facility_key)] += allocated_product_plant_sites
-
-                                                                        if allocated_date_crop_facility_key not in allocated_date_crop_facility_key_list:
-                                                                            allocated_date_crop_facility_key_list += [allocated_date_crop_facility_key]
-                                                                            allocated_plant_sites_list += [allocated_product_plant_sites]
-                                                                            allocated_starting_ps_list += [harvest_facility_net_plant_sites]                          
+                                                                        allocation_tracker.add(allocated_date_crop_facility_key, allocated_product_plant_sites, harvest_facility_net_plant_sites)
 
                                                                         # compute pallets
                                                                         pd_idx = pd_product_id_list.index(s_product_id)
@@ -4099,8 +4454,7 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
                                                                         del allocated_customer_demand_date_list[adpfc_key_idx]
 
                                                                     # mark allocation as complete
-                                                                    if allocated_date_crop_facility_key not in complete_crop_allocation_key_list:
-                                                                        complete_crop_allocation_key_list += [allocated_date_crop_facility_key]
+                                                                    allocation_tracker.complete(allocated_date_crop_facility_key)
                                                                     if s_allocated_date_product_facility_key not in complete_product_allocation_key_list:
                                                                         complete_product_allocation_key_list += [s_allocated_date_product_facility_key]
                                                                     if s_allocated_date_product_facility_customer_key not in complete_customer_allocation_key_list:
@@ -4145,14 +4499,7 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
                                                         # yay! we have enough plant sites to cover the demand (so far)
                                                         # update the allocation lists
 
-                                                        if allocated_date_crop_facility_key in allocated_date_crop_facility_key_list:
-                                                            allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(allocated_date_crop_facility_key)] += net_plant_sites
-
-                                                        # add to mid-allocation tracker if its a new key
-                                                        if allocated_date_crop_facility_key not in allocated_date_crop_facility_key_list:
-                                                            allocated_date_crop_facility_key_list += [allocated_date_crop_facility_key]
-                                                            allocated_plant_sites_list += [net_plant_sites]
-                                                            allocated_starting_ps_list += [harvest_facility_net_plant_sites]
+                                                        allocation_tracker.add(allocated_date_crop_facility_key, net_plant_sites, harvest_facility_net_plant_sites)
 
                                                         # create key for mid-allocation check
                                                         allocated_date_product_facility_key = str(harvest_date) + '_' + str(product_id) + '_' + str(ship_greenhouse_id)
@@ -4304,12 +4651,6 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
         haf_allocated_qty_list,
         haf_full_packout_list]  
     
-    # allocated crops output
-    allocated_crops_out_LoL = [allocated_date_crop_facility_key_list,
-        allocated_starting_ps_list,
-        allocated_plant_sites_list,
-        complete_crop_allocation_key_list]
-    
     # short demand
     ct_sdf_demand_date_list = list()
     ct_sdf_demand_allocation_date_list= list()
@@ -4346,13 +4687,13 @@ def calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_LoL,
         calc_transfer_pallets_list,
         calc_truck_count_list]
     
-    transfer_tuple = (inventory_allocation_transfers_LoL, harvest_allocation_transfers_LoL, allocated_crops_out_LoL, short_demand_out_LoL, new_calc_transfers_LoL)
+    transfer_tuple = (inventory_allocation_transfers_LoL, harvest_allocation_transfers_LoL, allocation_tracker, short_demand_out_LoL, new_calc_transfers_LoL)
     
    # print('sl:', len(ct_sdf_short_demand_qty_list))
     return transfer_tuple
 
 
-def writeCalculatedTransfers(calc_transfers_LoL):
+def writeCalculatedTransfers(calc_transfers_LoL, cnxn = None):
     '''
     #### Inputs:
     - calc_transfers_LoL
@@ -4366,6 +4707,7 @@ def writeCalculatedTransfers(calc_transfers_LoL):
         8. List of transfer quantiites
         9. List of transfer pallets
         10. List of truck counts
+    - cnxn: optional open connection (the connection of the background writer)
     #### Algorithm:
         - load inputs
         - write to CalculatedTransfers_Facts
@@ -4394,7 +4736,10 @@ def writeCalculatedTransfers(calc_transfers_LoL):
                                 Database=databasename;
                                 UID=%s;
                                 PWD=%s;""" % (uid, pwd) # use config.yml on local machine
-    cnxn = pyodbc.connect(CONNECTIONSTRING)   
+    # use the connection of the background writer if there is one
+    is_own_connection = cnxn is None
+    if is_own_connection:
+        cnxn = pyodbc.connect(CONNECTIONSTRING)
     cnxn_cursor = cnxn.cursor()
 
     
@@ -4418,6 +4763,8 @@ def writeCalculatedTransfers(calc_transfers_LoL):
     VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);
     """ 
 
+    written_row_list = list()
+
     # write calculated transfers
     calc_ship_date_list = calc_transfers_LoL[0]
     calc_arrival_date_list  = calc_transfers_LoL[1]
@@ -4451,17 +4798,23 @@ def writeCalculatedTransfers(calc_transfers_LoL):
                         to_date,
                         is_active)
         
-        cnxn_cursor.execute(sql, tuple_to_write)
+        written_row_list += [tuple_to_write]
         calc_transfers_id += 1
     
+    # one batch per table
+    if len(written_row_list) > 0:
+        cnxn_cursor.fast_executemany = True
+        cnxn_cursor.executemany(sql, written_row_list)
+
     cnxn.commit()
     cnxn_cursor.close()
-    cnxn.close()
+    if is_own_connection:
+        cnxn.close()
     
     
     return 'CalculatedTransfers_Facts pau'
 
-def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_LoL, facilities_LoL, allocated_crops_LoL, products_LoL):
+def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_LoL, facilities_LoL, allocation_tracker, products_LoL, harvest_cube = None):
     '''
     #### Inputs:
         - demand_allocation_date: date of the short demand allocation in main loop
@@ -4484,7 +4837,7 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
         - facilities_LoL: greenhouses dimension
             1. List of greenhouse IDs
             2. List of city abbreviations
-        - allocated_crops_LoL:  mid-allocation tracking
+        - allocation_tracker:  AllocationTracker for mid-allocation tracking (updated in place)
             1. List of date/crop/greenhouse key combinations that have an allocation
             2. List of starting plant sites for each date/crop/greenhouse key combination
             3. List of allocated plant sites for each date/crop/greenhouse key combination
@@ -4505,6 +4858,7 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
             3. List of week of year
             4. List of year week
             5. List of day of week
+        - harvest_cube: optional HarvestCube of harvest_in_LoL computed once for the run (computed here if None)
     #### Algorithm:
     - initialize inputs
     - for the demand allocation date
@@ -4527,7 +4881,7 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
             9. List of allocated grams
             10. List of allocated quantities
             11. List of full packout boolean flags
-        - allocated_crops_out_LoL: mid-allocation tracking
+        - allocation_tracker: AllocationTracker for mid-allocation tracking
             1. List of date/crop/greenhouse key combinations that have an allocation
             2. List of starting plant sites for each date/crop/greenhouse key combination
             3. List of allocated plant sites for each date/crop/greenhouse key combination
@@ -4554,12 +4908,6 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
     hfsf_avg_headweight_list = harvest_in_LoL[5]
     hfsf_loose_grams_per_plant_site_list = harvest_in_LoL[6]
     
-    # allocated crops
-    allocated_date_crop_facility_key_list = allocated_crops_LoL[0]
-    allocated_starting_ps_list = allocated_crops_LoL[1]
-    allocated_plant_sites_list = allocated_crops_LoL[2]
-    complete_crop_allocation_key_list = allocated_crops_LoL[3]
-    
 
     # input lists from demand
     sdf_demand_date_list = short_demand_LoL[0]
@@ -4595,6 +4943,10 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
     fd_facility_id_list = facilities_LoL[0]
     fd_city_short_code_list = facilities_LoL[1]
 
+    # harvest totals and grams per plant site by date/crop/city
+    if harvest_cube is None:
+        harvest_cube = HarvestCube(harvest_in_LoL, facilities_LoL)
+
     
     # initialize harvest allocation lists for transfers
     # lists for CustomerHarvestAllocation_Facts
@@ -4707,46 +5059,10 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
                             # get harvest for the crop in the ship greenhouse
                             transfer_harvest_date_list = list()
 
-                            harvest_date_indices =  [i for i, x in enumerate(hfsf_harvest_date_list) if x >= first_harvest_day and x<= last_harvest_day]
-                            harvest_crop_id_indices =  [j for j, y in enumerate(hfsf_crop_id_list) if y == crop_id]
-                            harvest_facility_id_indices = [k for k, z in enumerate(hfsf_facility_id_list)
-                                                         if fd_city_short_code_list[fd_facility_id_list.index(z)]
-                                                            == fd_city_short_code_list[fd_facility_id_list.index(greenhouse_id)]]
-                            harvest_date_crop_facility_indices = list(set(harvest_date_indices) & set(harvest_crop_id_indices) & set(harvest_facility_id_indices))
-
-                            all_harvest_expected_plant_sites_list = list()
-                            all_harvest_whole_gpps_list = list()
-                            all_harvest_loose_gpps_list = list()
-
-                            # organize harvest by date
-                            distinct_harvest_date_list = list()
-
-                            for hfsf_idx in harvest_date_crop_facility_indices:
-
-                                hfsf_harvest_date = hfsf_harvest_date_list[hfsf_idx]
-                                hfsf_expected_plant_sites = hfsf_expected_plant_sites_list[hfsf_idx]
-                                if hfsf_harvest_date in distinct_harvest_date_list and hfsf_expected_plant_sites > 0:
-
-                                    harvest_idx = distinct_harvest_date_list.index(hfsf_harvest_date)
-                                    # get total plant sites, whole grams per plant site, and loose grams per plant site
-                                    all_harvest_expected_plant_sites_list[harvest_idx] += [hfsf_expected_plant_sites]
-                                    all_harvest_whole_gpps_list[harvest_idx] += [hfsf_avg_headweight_list[hfsf_idx]]
-                                    all_harvest_loose_gpps_list[harvest_idx] += [hfsf_loose_grams_per_plant_site_list[hfsf_idx]]
-
-
-                                if hfsf_harvest_date not in distinct_harvest_date_list and hfsf_expected_plant_sites > 0:
-                                    distinct_harvest_date_list += [hfsf_harvest_date]
-                                    # get total plant sites, whole grams per plant site, and loose grams per plant site
-                                    all_harvest_expected_plant_sites_list += [[hfsf_expected_plant_sites]]
-                                    all_harvest_whole_gpps_list += [[hfsf_avg_headweight_list[hfsf_idx]]]
-                                    all_harvest_loose_gpps_list += [[hfsf_loose_grams_per_plant_site_list[hfsf_idx]]]
-
-
-                            # sort harvest by date
-                            sorted_harvest_date_list = list(np.sort(distinct_harvest_date_list))
-                            sorted_harvest_expected_plant_sites_list = list([x for _,x in sorted(zip(distinct_harvest_date_list,all_harvest_expected_plant_sites_list))])
-                            sorted_harvest_whole_gpps_list = list([y for _,y in sorted(zip(distinct_harvest_date_list,all_harvest_whole_gpps_list))])
-                            sorted_harvest_loose_gpps_list = list([y for _,y in sorted(zip(distinct_harvest_date_list,all_harvest_loose_gpps_list))])
+                            # harvest dates with positive expected plant sites for the crop in the city of the greenhouse, sorted by date
+                            harvest_city = harvest_cube.city(greenhouse_id)
+                            sorted_harvest_date_list = harvest_cube.cityHarvestDates(crop_id, harvest_city, first_harvest_day, last_harvest_day)
+                            sorted_harvest_stats_list = [harvest_cube.cityStats(harvest_date, crop_id, harvest_city, 1) for harvest_date in sorted_harvest_date_list]
 
 
                             # attempt allocation in reverse chronological order
@@ -4759,49 +5075,30 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
 
                                 if check_skip_key in skip_key_list:
                                     del sorted_harvest_date_list[-1]
-                                    del sorted_harvest_expected_plant_sites_list[-1]
-                                    del sorted_harvest_whole_gpps_list[-1]
-                                    del sorted_harvest_loose_gpps_list[-1]
+                                    del sorted_harvest_stats_list[-1]
                                 if check_skip_key not in skip_key_list:
 
 
-                                    allocated_date_crop_facility_key = str(harvest_date) + '_' + str(crop_id) + '_' + str(greenhouse_id)
+                                    allocated_date_crop_facility_key = AllocationTracker.key(harvest_date, crop_id, greenhouse_id)
 
                                     # remove from lists if harvest is completely allocated (no harvest is available)
-                                    if allocated_date_crop_facility_key in complete_crop_allocation_key_list:
+                                    if allocation_tracker.isComplete(allocated_date_crop_facility_key):
                                         del sorted_harvest_date_list[-1]
-                                        del sorted_harvest_expected_plant_sites_list[-1]
-                                        del sorted_harvest_whole_gpps_list[-1]
-                                        del sorted_harvest_loose_gpps_list[-1]
+                                        del sorted_harvest_stats_list[-1]
 
                                     # checkpoint: harvest is available
 
-                                    if allocated_date_crop_facility_key not in complete_crop_allocation_key_list:
+                                    if not allocation_tracker.isComplete(allocated_date_crop_facility_key):
 
                                         # get plant sites already allocated for the facility on the harvest date
-                                        already_allocated_plant_sites = 0
-                                        if allocated_date_crop_facility_key in allocated_date_crop_facility_key_list: 
-                                            already_allocated_plant_sites = allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(allocated_date_crop_facility_key)]
-
-                                        # available harvest closes to ship day
-                                        harvest_expected_plant_sites_list = sorted_harvest_expected_plant_sites_list[-1]
-                                        harvest_whole_gpps_list = sorted_harvest_whole_gpps_list[-1]
-                                        harvest_loose_gpps_list = sorted_harvest_loose_gpps_list[-1]
-
-                                        # GPPS normalized by expected plant sites
-                                        whole_numerator = 0
-                                        loose_numerator = 0
-                                        total_ps = 0
-                                        for harvest_idx in range(len(harvest_whole_gpps_list)):
-                                            whole_numerator += harvest_whole_gpps_list[harvest_idx] * harvest_expected_plant_sites_list[harvest_idx]
-                                            loose_numerator += harvest_loose_gpps_list[harvest_idx] * harvest_expected_plant_sites_list[harvest_idx]
-                                            total_ps += harvest_expected_plant_sites_list[harvest_idx]
-
-                                        harvest_facility_mean_whole_gpps = 0
-                                        harvest_facility_mean_loose_gpps = 0
-                                        if total_ps != 0:
-                                            harvest_facility_mean_whole_gpps = round(float(whole_numerator/total_ps),2)
-                                            harvest_facility_mean_loose_gpps = round(float(loose_numerator/total_ps),2)
+                                        already_allocated_plant_sites = allocation_tracker.allocated(allocated_date_crop_facility_key)
+
+                                        # available harvest closes to ship day: total plant sites and mean grams per plant site normalized by expected plant sites
+                                        (harvest_facility_net_plant_sites,
+                                         harvest_facility_mean_whole_gpps,
+                                         harvest_facility_mean_loose_gpps,
+                                         harvest_facility_std_whole_gpps,
+                                         harvest_facility_std_loose_gpps) = sorted_harvest_stats_list[-1]
 
                                         # choose conversion factor
                                         harvest_facility_mean_gpps = harvest_facility_mean_loose_gpps 
@@ -4815,9 +5112,6 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
                                         if harvest_facility_mean_gpps != 0:
                                             net_plant_sites = int(np.ceil(float(short_demand_qty * net_weight_grams / harvest_facility_mean_gpps)))
 
-                                        # compute net plant sites for the facility
-                                        harvest_facility_net_plant_sites = int(sum(harvest_expected_plant_sites_list))
-
                                         # compute remaining plant sites for allocation considering the mid allocation checkpoint
                                         harvest_facility_pre_plant_sites = harvest_facility_net_plant_sites - already_allocated_plant_sites
 
@@ -4830,9 +5124,7 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
                                             #print('oh no short on ', crop_id, ship_greenhouse_id, harvest_date, demand_allocation_date)
                                             # update harvest allocation lists
                                             del sorted_harvest_date_list[-1]
-                                            del sorted_harvest_expected_plant_sites_list[-1]
-                                            del sorted_harvest_whole_gpps_list[-1]
-                                            del sorted_harvest_loose_gpps_list[-1]
+                                            del sorted_harvest_stats_list[-1]
 
                                             # set full_packout to true
                                             full_packout = 1
@@ -4865,14 +5157,14 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
                                                 check_product_id = int(check_key.split("_")[1])
                                                 check_facility_id = int(check_key.split("_")[2])
                                                 check_crop_id = pd_crop_id_list[pd_product_id_list.index(check_product_id)]
-                                                check_date_crop_facility_key = str(check_harvest_date) + '_' + str(check_crop_id) + '_' + str(check_facility_id)
+                                                check_date_crop_facility_key = AllocationTracker.key(check_harvest_date, check_crop_id, check_facility_id)
                                                 if check_harvest_date == harvest_date and check_facility_id == greenhouse_id and check_crop_id == crop_id:
                                                 #if check_demand_allocation_date == demand_allocation_date and check_city_short_code == fd_city_short_code_list[fd_facility_id_list.index(harvest_facility_id)] and check_priority == production_priority and check_crop_id == crop_id:
                                                     check_allocated_product_plant_sites = allocated_product_plant_sites_list[check_idx]
                                                     # add the plant sites for the harvest_demand_ratio
                                                     harvest_priority_plant_sites += check_allocated_product_plant_sites
                                                     # subtract the plant sites from the overall allocation tracking list since the new value multiplied by harvest_demand_ratio will be added back
-                                                    allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(check_date_crop_facility_key)] -= check_allocated_product_plant_sites
+                                                    allocation_tracker.subtract(check_date_crop_facility_key, check_allocated_product_plant_sites)
 
 
                                             # compute harvest_demand_ratio (less than 1 in this case)
@@ -4919,13 +5211,7 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
                                                             haf_full_packout_list += [full_packout]
 
                                                             # update the allocation_lists
-                                                            if allocated_date_crop_facility_key in allocated_date_crop_facility_key_list:        
-                                                                allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(allocated_date_crop_facility_key)] += allocated_product_plant_sites
-
-                                                            if allocated_date_crop_facility_key not in allocated_date_crop_facility_key_list:
-                                                                allocated_date_crop_facility_key_list += [allocated_date_crop_facility_key]
-                                                                allocated_plant_sites_list += [allocated_product_plant_sites]
-                                                                allocated_starting_ps_list += [harvest_facility_net_plant_sites]                          
+                                                            allocation_tracker.add(allocated_date_crop_facility_key, allocated_product_plant_sites, harvest_facility_net_plant_sites)
 
                                                         if s_allocated_date_product_facility_key in allocated_date_product_facility_key_list:
                                                             del allocated_gpps_list[allocated_date_product_facility_key_list.index(s_allocated_date_product_facility_key)]
@@ -4943,8 +5229,7 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
                                                             del allocated_customer_demand_date_list[adpfc_key_idx]
 
                                                         # mark allocation as complete
-                                                        if allocated_date_crop_facility_key not in complete_crop_allocation_key_list:
-                                                            complete_crop_allocation_key_list += [allocated_date_crop_facility_key]
+                                                        allocation_tracker.complete(allocated_date_crop_facility_key)
                                                         if s_allocated_date_product_facility_key not in complete_product_allocation_key_list:
                                                             complete_product_allocation_key_list += [s_allocated_date_product_facility_key]
                                                         if s_allocated_date_product_facility_customer_key not in complete_customer_allocation_key_list:
@@ -4983,14 +5268,7 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
                                             # yay! we have enough plant sites to cover the demand (so far)
                                             # update the allocation lists
 
-                                            if allocated_date_crop_facility_key in allocated_date_crop_facility_key_list:
-                                                allocated_plant_sites_list[allocated_date_crop_facility_key_list.index(allocated_date_crop_facility_key)] += net_plant_sites
-
-                                            # add to mid-allocation tracker if its a new key
-                                            if allocated_date_crop_facility_key not in allocated_date_crop_facility_key_list:
-                                                allocated_date_crop_facility_key_list += [allocated_date_crop_facility_key]
-                                                allocated_plant_sites_list += [net_plant_sites]
-                                                allocated_starting_ps_list += [harvest_facility_net_plant_sites]
+                                            allocation_tracker.add(allocated_date_crop_facility_key, net_plant_sites, harvest_facility_net_plant_sites)
 
                                             # create key for mid-allocation check
                                             allocated_date_product_facility_key = str(harvest_date) + '_' + str(product_id) + '_' + str(greenhouse_id)
@@ -5101,12 +5379,6 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
         haf_allocated_qty_list,
         haf_full_packout_list]  
     
-    # allocated crops output
-    allocated_crops_out_LoL = [allocated_date_crop_facility_key_list,
-        allocated_starting_ps_list,
-        allocated_plant_sites_list,
-        complete_crop_allocation_key_list]
-    
     # short demand
     ct_sdf_demand_date_list = list()
     ct_sdf_demand_allocation_date_list= list()
@@ -5132,67 +5404,597 @@ def priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_
         ct_sdf_short_demand_qty_list] 
 
     
-    prior_harvest_tuple = (harvest_allocation_prior_LoL, allocated_crops_out_LoL, short_demand_out_LoL)
+    prior_harvest_tuple = (harvest_allocation_prior_LoL, allocation_tracker, short_demand_out_LoL)
     
    # print('sl:', len(ct_sdf_short_demand_qty_list))
     return prior_harvest_tuple    
 
-print('functions loaded')
-
-
-# In[2]:
 
+#InventoryStatus_Lov / Inventory_Facts readiness gate
+def inventoryReadiness(cnxn_cursor):
+    '''
+    #### Inputs:
+    - cnxn_cursor: open cursor to the data warehouse
+    #### Algorithm:
+    - one combined query for the inventory gate
+        1. number of InventoryStatus_Lov rows written today (allocations already run today)
+        2. current CoolerInventoryDate in Inventory_Facts
+        3. last InventoryStatusID in InventoryStatus_Lov
+
+    #### Output: tuple
+        - run_status: 1 if allocations were already run today with actual inventory, else 0
+        - inventory_date: current cooler inventory date (None if Inventory_Facts has no current records)
+        - inventory_status_id: last InventoryStatusID (0 if InventoryStatus_Lov is empty)
+    '''
+    sql = """
+    SELECT
+        (SELECT COUNT(*) FROM InventoryStatus_Lov WHERE CONVERT(Date,InventoryLoadDate) = CONVERT(Date,GETDATE())),
+        (SELECT MAX(CoolerInventoryDate) FROM Inventory_Facts WHERE CurrentRecord = 1),
+        (SELECT MAX(InventoryStatusID) FROM InventoryStatus_Lov)
+    """
+    cnxn_cursor.execute(sql)
+    row = cnxn_cursor.fetchone()
 
-#start timer for execution
-start_time = time.time()
+    run_status = 0
+    if row[0] > 0:
+        # run_status = 1 if the inventory has already been loaded and allocations were done already
+        run_status = 1
+    inventory_date = row[1]
+    inventory_status_id = 0
+    if row[2] is not None:
+        inventory_status_id = row[2]
 
+    return (run_status, inventory_date, inventory_status_id)
 
-if debug_status == 0:
-    ## Check inventory for an actual count today
 
-    HOSTNAME = socket.gethostname()
+def waitForInventory(connection_string, watch_status = 0, poll_seconds = 60, max_poll_seconds = 600, watch_until = None, trigger_path = None):
+    '''
+    #### Inputs:
+    - connection_string: ODBC connection string of the data warehouse
+    - watch_status: 0 to check the gate once, 1 to keep polling until the gate opens or watch_until passes
+    - poll_seconds: first wait between polls (seconds)
+    - max_poll_seconds: longest wait between polls, the wait doubles after every closed poll up to this value
+    - watch_until: datetime to stop watching (None to watch until the gate opens)
+    - trigger_path: optional local file, touching it (e.g. from the inventory load job) wakes the watcher for an immediate poll
+    #### Algorithm:
+    - one persistent connection, inventoryReadiness on every poll (committed so no locks are held between polls)
+    - gate opens when the current cooler inventory date is today and allocations have not been run today
+    - when the gate opens, record the run in InventoryStatus_Lov on the same connection
+    - a dropped connection is reopened on the next poll
+
+    #### Output: tuple
+        - check_for_new_inventory: 1 if actual inventory for today is loaded
+        - run_status: 1 if allocations were already run today
+    '''
+    cnxn = None
+    check_for_new_inventory = 0
+    run_status = 0
 
-    if HOSTNAME == 'hostname':
-        CONNECTIONSTRING = """Driver={ODBC Driver 17 for SQL Server}; 
-                                Server=127.0.0.1,1443;
-                                Database=databasename;
-                                trusted_connection=yes""" # use windows auth on DB01
+    while True:
+        try:
+            if cnxn is None:
+                cnxn = pyodbc.connect(connection_string)
+            cnxn_cursor = cnxn.cursor()
+            (run_status, inventory_date, inventory_status_id) = inventoryReadiness(cnxn_cursor)
+            cnxn.commit()
+            cnxn_cursor.close()
+        except pyodbc.Error as e:
+            if watch_status == 0:
+                raise
+            print('readiness poll failed, reconnecting:', e)
+            if cnxn is not None:
+                try:
+                    cnxn.close()
+                except pyodbc.Error:
+                    pass
+            cnxn = None
+            inventory_date = None
+
+        check_today_datetime = DT.datetime.now()
+        check_today_date = check_today_datetime.date()
+
+        if cnxn is not None and (run_status == 1 or check_today_date == inventory_date):
+            break
+        if watch_status == 0 or (watch_until is not None and check_today_datetime >= watch_until):
+            break
+
+        # back off until the next poll, waking early if the trigger file is touched
+        print('no new inventory, next poll in ' + str(int(poll_seconds)) + ' s')
+        trigger_mtime = None
+        if trigger_path is not None and os.path.exists(trigger_path):
+            trigger_mtime = os.path.getmtime(trigger_path)
+        sleep_deadline = time.time() + poll_seconds
+        while time.time() < sleep_deadline:
+            time.sleep(min(5, max(0, sleep_deadline - time.time())))
+            if trigger_path is not None and os.path.exists(trigger_path) and os.path.getmtime(trigger_path) != trigger_mtime:
+                print('inventory trigger file touched')
+                break
+        poll_seconds = min(poll_seconds * 2, max_poll_seconds)
+
+    if cnxn is not None and check_today_date == inventory_date:
+        check_for_new_inventory = 1
+        print('actual inventory loaded')
+        if run_status == 0:
+            # this is the first run with actual inventory: write datetime to InventoryStatus_Lov
+            cnxn_cursor = cnxn.cursor()
+            sql = """
+            INSERT INTO InventoryStatus_Lov
+            VALUES (?,?);
+            """
+            tuple_to_write = (inventory_status_id + 1, check_today_datetime)
+            cnxn_cursor.execute(sql, tuple_to_write)
+            cnxn.commit()
+            cnxn_cursor.close()
     else:
-        with open(os.path.join(sys.path[0], "config.yml"), 'r') as ymlfile:
-            cfg = yaml.load(ymlfile, Loader=yaml.SafeLoader)
-        uid = cfg['databasename']['uid']
-        pwd = cfg['databasename']['pwd']
+        print('no new inventory')
 
-        CONNECTIONSTRING = """Driver={ODBC Driver 17 for SQL Server};
-                                Server=127.0.0.1,1443;
-                                Database=databasename;
-                                UID=%s;
-                                PWD=%s;""" % (uid, pwd) # use config.yml on local machine
+    if cnxn is not None:
+        cnxn.close()
 
-    cnxn = pyodbc.connect(CONNECTIONSTRING)   
-    cnxn_cursor = cnxn.cursor()
+    return (check_for_new_inventory, run_status)
 
 
-    # check if data has been refreshed with actual inventory in the past
+class AllocationCheckpoint:
+    '''
+    #### Inputs:
+        - checkpoint_dir: optional local folder for the checkpoint files (defaults to allocation_checkpoint next to the script)
+    #### Algorithm:
+    - the run inputs of the allocation loop (loaded data and precomputed lookups) are pickled once, after the data load and
+      change data capture, so a resumed run skips both
+    - after every completed (tier, date) allocation step the loop state is pickled
+        - phase ('baseline' or 'pending') and next step index
+        - branch state (demand allocation date, roll harvest), pending fork, calculated transfers
+        - active allocation tracker (restored to Allocated_Facts on resume)
+        - last ID of every output table and the last Parquet part file (--parquet-dir)
+    - checkpoints are only valid on the day they were written
+    - on resume, rows written after the last completed step (a partially written step) are deleted by ID, and the Parquet
+      export continues the partition of the failed run without the part files written after that step
+
+    #### Output:
+        - saveInputs(input_dict), loadInputs(): run inputs (None if there is no checkpoint from today)
+        - saveStep(step_dict), loadStep(): loop state of the last completed step (None if there is none from today)
+        - lastIDs(connection_string, cnxn = None): dictionary of last ID by output table
+        - rollback(connection_string, last_id_dict): deletes rows after the last IDs
+        - clear(): removes the checkpoint files after a completed run
+    '''
 
-    sql = "SELECT InventoryLoadDate FROM InventoryStatus_Lov WHERE CONVERT(Date,InventoryLoadDate) = CONVERT(Date,GETDATE())"
-    cnxn_cursor.execute(sql) 
-    row = cnxn_cursor.fetchone()
-    run_status = 0
-    if row is not None:
-        # run_status = 1 if the inventory has already been loaded and allocations were done already 
-        run_status = 1
+    input_file_name = 'allocation_inputs.pkl'
+    step_file_name = 'allocation_step.pkl'
+
+    # output tables of the allocation loop (ID column is the table base name + 'ID'), Allocated_Facts is restored by writeAllocated
+    output_table_list = ['CustomerInventoryAllocation',
+                         'CustomerHarvestAllocation',
+                         'CustomerShortDemand',
+                         'StopSell',
+                         'HarvestUnallocated',
+                         'CalculatedTransfers',
+                         'CustomerInventoryAllocationPending',
+                         'CustomerHarvestAllocationPending',
+                         'CustomerShortDemandPending',
+                         'StopSellPending',
+                         'HarvestUnallocatedPending']
+
+    def __init__(self, checkpoint_dir = None):
+        if checkpoint_dir is None:
+            checkpoint_dir = os.path.join(sys.path[0], 'allocation_checkpoint')
+        self.checkpoint_dir = checkpoint_dir
+
+    def path(self, file_name):
+        return os.path.join(self.checkpoint_dir, file_name)
+
+    def save(self, file_name, value_dict):
+        os.makedirs(self.checkpoint_dir, exist_ok = True)
+        value_dict = dict(value_dict)
+        value_dict['run_date'] = DT.date.today()
+        tmp_path = self.path(file_name) + '.tmp'
+        with open(tmp_path, 'wb') as pklfile:
+            pickle.dump(value_dict, pklfile, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path(file_name))
+
+    def load(self, file_name):
+        if not os.path.exists(self.path(file_name)):
+            return None
+        with open(self.path(file_name), 'rb') as pklfile:
+            value_dict = pickle.load(pklfile)
+        if value_dict.pop('run_date', None) != DT.date.today():
+            return None
+        return value_dict
+
+    def saveInputs(self, input_dict):
+        # a new run starts without step state
+        if os.path.exists(self.path(self.step_file_name)):
+            os.remove(self.path(self.step_file_name))
+        self.save(self.input_file_name, input_dict)
+
+    def loadInputs(self):
+        return self.load(self.input_file_name)
+
+    def saveStep(self, step_dict):
+        self.save(self.step_file_name, step_dict)
+
+    def loadStep(self):
+        return self.load(self.step_file_name)
+
+    def lastIDs(self, connection_string, cnxn = None):
+        # cnxn: optional open connection (the connection of the background writer)
+        is_own_connection = cnxn is None
+        if is_own_connection:
+            cnxn = pyodbc.connect(connection_string)
+        cnxn_cursor = cnxn.cursor()
+        sql = "SELECT " + ",\n".join("(SELECT ISNULL(MAX(" + table + "ID), 0) FROM " + table + "_Facts)" for table in self.output_table_list)
+        cnxn_cursor.execute(sql)
+        row = cnxn_cursor.fetchone()
+        cnxn.commit()
+        cnxn_cursor.close()
+        if is_own_connection:
+            cnxn.close()
+        return dict(zip(self.output_table_list, row))
+
+    def rollback(self, connection_string, last_id_dict):
+        cnxn = pyodbc.connect(connection_string)
+        cnxn_cursor = cnxn.cursor()
+        deleted_row_count = 0
+        for table in self.output_table_list:
+            cnxn_cursor.execute("DELETE FROM " + table + "_Facts WHERE " + table + "ID > ?", last_id_dict[table])
+            deleted_row_count += max(cnxn_cursor.rowcount, 0)
+        cnxn.commit()
+        cnxn_cursor.close()
+        cnxn.close()
+        return deleted_row_count
+
+    def clear(self):
+        for file_name in [self.step_file_name, self.input_file_name]:
+            if os.path.exists(self.path(file_name)):
+                os.remove(self.path(file_name))
+
+
+class BackgroundWriter:
+    '''
+    #### Inputs:
+        - connection_string: database of the writes, the writer opens one connection and keeps it until close
+        - max_pending: bound of the write queue, submit blocks while this many writes are waiting (back-pressure)
+        - async_status: 1 to run writes on the writer thread, 0 to run them inline on the calling thread (serial loop)
+    #### Algorithm:
+    - one writer thread runs the submitted write functions (writeCustomerInventoryAllocation, writeAllocated, ...) in
+      submission order, so the writes to every table keep the order of the serial loop
+    - the write functions are called with the connection of the writer (cnxn keyword) instead of opening their own, and
+      insert the rows of each table with one executemany
+    - the main thread continues with the next compute stage while the writer thread waits on the database
+    - flush() blocks until every submitted write is committed: the allocation loop flushes before it reads its own writes
+      back (inventoryRollover, readAllocated); checkpoints are submitted as writes so they are saved after the writes of
+      their step without draining the queue
+    - the first write error stops further writes and is re-raised on the main thread at the next submit or flush
+
+    #### Output:
+        - submit(write_function, *args, **kwargs)
+        - flush()
+        - close(): flush, stop the writer thread, and close the connection
+    '''
+
+    def __init__(self, connection_string, max_pending = 4, async_status = 1):
+        self.connection_string = connection_string
+        self.async_status = async_status
+        self.cnxn = None
+        self.error = None
+        self.write_queue = None
+        self.thread = None
+        if async_status == 1:
+            self.write_queue = queue.Queue(maxsize = max_pending)
+            self.thread = threading.Thread(target = self.run, name = 'BackgroundWriter', daemon = True)
+            self.thread.start()
+
+    def connection(self):
+        # opened on the thread that runs the writes (pyodbc connections are not shared between threads)
+        if self.cnxn is None:
+            self.cnxn = pyodbc.connect(self.connection_string)
+        return self.cnxn
+
+    def closeConnection(self):
+        if self.cnxn is not None:
+            self.cnxn.close()
+            self.cnxn = None
+
+    def run(self):
+        try:
+            while True:
+                task = self.write_queue.get()
+                try:
+                    if task is None:
+                        return
+                    if self.error is None:
+                        (write_function, args, kwargs) = task
+                        write_function(*args, cnxn = self.connection(), **kwargs)
+                except BaseException as e:
+                    # keep draining the queue so submit and flush never block on a failed writer
+                    self.error = e
+                finally:
+                    self.write_queue.task_done()
+        finally:
+            self.closeConnection()
+
+    def raiseError(self):
+        if self.error is not None:
+            raise RuntimeError('background write failed') from self.error
+
+    def submit(self, write_function, *args, **kwargs):
+        if self.async_status == 0:
+            return write_function(*args, cnxn = self.connection(), **kwargs)
+        self.raiseError()
+        self.write_queue.put((write_function, args, kwargs))
+
+    def flush(self):
+        if self.async_status == 0:
+            return
+        self.write_queue.join()
+        self.raiseError()
+
+    def close(self):
+        if self.async_status == 0:
+            self.closeConnection()
+            return
+        if self.thread is None:
+            return
+        self.write_queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.raiseError()
+
+
+#allocation stages of one step that stay within the demand city
+def cityAllocationStages(demand_allocation_date, tier_count, inventory_out_LoL, demand_in_LoL, allocation_tracker, inv_transfers_LoL, har_transfers_LoL, facilities_LoL, harvest_in_LoL, products_LoL, harvest_cube = None, facility_topology = None,
+                         demand_order_list = None, transfer_order_list = None, row_order_dict = None):
+    '''
+    #### Inputs:
+    - demand_allocation_date, tier_count: allocation step
+    - inventory_out_LoL: starting inventory of the step (see customerInventoryAllocation)
+    - demand_in_LoL: customer tier and time demand of the step (see customerInventoryAllocation)
+    - allocation_tracker: AllocationTracker at the start of the step (updated in place)
+    - inv_transfers_LoL, har_transfers_LoL, facilities_LoL, harvest_in_LoL, products_LoL, harvest_cube, facility_topology: see customerHarvestAllocation
+    - demand_order_list, transfer_order_list: optional row indices of demand_in_LoL and har_transfers_LoL in the serial run (city partitions)
+    - row_order_dict: optional dictionary filled with the serial order key of every harvest allocation, prior harvest allocation,
+      and short demand output row (by stage output name)
+    #### Algorithm: stages that only draw on inventory and harvest of the demand city (and the ship city of planned transfers)
+        b. Inventory to Customer Allocation
+        c. Harvest to Customer Allocation
+        d. Prior Day Harvest to Customer Allocation
+    - called once with all cities (serial) or once per city partition by CityPartitionPool
+    - sorting the rows of all city partitions by the order keys gives the rows of the serial run in the serial order
+
+    #### Output: (inventory_allocation_out_LoL, harvest_allocation_out_LoL, harvest_allocation_prior_LoL, allocation_tracker_out2, short_demand_out2_LoL)
+    '''
+    # customerInventoryAllocation
+    (inventory_allocation_out_LoL, inventory_demand_out_LoL) = customerInventoryAllocation(demand_allocation_date, inventory_out_LoL, demand_in_LoL, facilities_LoL, inv_transfers_LoL, tier_count, facility_topology)
+
+    inventory_demand_order_list = None
+    harvest_order_dict = None
+    if row_order_dict is not None:
+        inventory_demand_order_list = inventoryDemandOrder(demand_allocation_date, demand_in_LoL, demand_order_list, inventory_demand_out_LoL)
+        harvest_order_dict = dict()
+
+    #customerHarvestAllocation
+    (harvest_allocation_out_LoL,allocation_tracker_out, short_demand_out_LoL) = customerHarvestAllocation(demand_allocation_date, harvest_in_LoL, inventory_demand_out_LoL, facilities_LoL, allocation_tracker, har_transfers_LoL, products_LoL, inventory_allocation_out_LoL, tier_count, harvest_cube, facility_topology,
+                                                                                                          inventory_demand_order_list, transfer_order_list, harvest_order_dict)
+
+    # prior day harvest allocation
+    (harvest_allocation_prior_LoL,allocation_tracker_out2, short_demand_out2_LoL) = priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_out_LoL, facilities_LoL, allocation_tracker_out, products_LoL, harvest_cube)
+
+    if row_order_dict is not None:
+        (prior_order_list, short_demand_order2_list) = priorHarvestOrder(short_demand_out_LoL, harvest_order_dict['short_demand_out_LoL'], harvest_allocation_prior_LoL, short_demand_out2_LoL)
+        row_order_dict['harvest_allocation_out_LoL'] = harvest_order_dict['harvest_allocation_out_LoL']
+        row_order_dict['harvest_allocation_prior_LoL'] = prior_order_list
+        row_order_dict['short_demand_out2_LoL'] = short_demand_order2_list
+
+    return (inventory_allocation_out_LoL, harvest_allocation_out_LoL, harvest_allocation_prior_LoL, allocation_tracker_out2, short_demand_out2_LoL)
+
+
+def inventoryDemandOrder(demand_allocation_date, demand_in_LoL, demand_order_list, inventory_demand_out_LoL):
+    # customerInventoryAllocation compresses the demand of the date by demand date/greenhouse/product/customer in order of
+    # first appearance: each remaining demand row takes the serial order of its first demand row
+    first_order_dict = dict()
+    for df_idx in range(len(demand_in_LoL[0])):
+        if demand_in_LoL[1][df_idx] == demand_allocation_date:
+            df_key = str(demand_in_LoL[0][df_idx]) + '_' + str(demand_in_LoL[2][df_idx]) + '_' + str(demand_in_LoL[3][df_idx]) + '_' + str(demand_in_LoL[4][df_idx])
+            first_order_dict.setdefault(df_key, demand_order_list[df_idx])
+    return [first_order_dict[str(inventory_demand_out_LoL[0][sdf_idx]) + '_' + str(inventory_demand_out_LoL[2][sdf_idx]) + '_' + str(inventory_demand_out_LoL[3][sdf_idx]) + '_' + str(inventory_demand_out_LoL[4][sdf_idx])]
+            for sdf_idx in range(len(inventory_demand_out_LoL[0]))]
+
+
+def priorHarvestOrder(short_demand_LoL, short_order_list, harvest_allocation_prior_LoL, short_demand_out2_LoL):
+    # priorHarvestAllocation compresses the short demand by demand date/greenhouse/product/customer in order of first appearance
+    # and allocates greenhouse by greenhouse in order of the first customer short demand of the greenhouse
+    def shortKey(LoL, sdf_idx):
+        return LoL[0][sdf_idx].strftime("%Y-%m-%d") + '_' + str(LoL[2][sdf_idx]) + '_' + str(LoL[3][sdf_idx]) + '_' + str(LoL[4][sdf_idx])
+
+    first_order_dict = dict()
+    greenhouse_order_dict = dict()
+    for sdf_idx in range(len(short_demand_LoL[0])):
+        sdf_key = shortKey(short_demand_LoL, sdf_idx)
+        if sdf_key not in first_order_dict:
+            first_order_dict[sdf_key] = short_order_list[sdf_idx]
+            if short_demand_LoL[5][sdf_idx] != None and int(short_demand_LoL[4][sdf_idx]) != 0:
+                greenhouse_order_dict.setdefault(int(short_demand_LoL[2][sdf_idx]), short_order_list[sdf_idx])
+    short_demand_order2_list = [first_order_dict[shortKey(short_demand_out2_LoL, sdf_idx)] for sdf_idx in range(len(short_demand_out2_LoL[0]))]
+    prior_order_list = [greenhouse_order_dict[int(greenhouse_id)] for greenhouse_id in harvest_allocation_prior_LoL[2]]
+
+    return (prior_order_list, short_demand_order2_list)
+
+
+# run inputs of a city partition worker process, set once per process by cityWorkerInit
+city_worker_state = None
+
+def cityWorkerInit(state_dict):
+    # spawned workers import this script without running the load cells: restore the run inputs the allocation functions read
+    global city_worker_state, np, pd_product_id_list, pd_production_priority_list
+    import numpy as np
+    city_worker_state = state_dict
+    pd_product_id_list = state_dict['pd_product_id_list']
+    pd_production_priority_list = state_dict['pd_production_priority_list']
+
+
+def cityWorkerRun(city, demand_allocation_date, tier_count, inventory_out_LoL, demand_in_LoL, allocation_tracker, demand_order_list):
+    state_dict = city_worker_state
+    row_order_dict = dict()
+    city_stage_tuple = cityAllocationStages(demand_allocation_date, tier_count, inventory_out_LoL, demand_in_LoL, allocation_tracker,
+                                            state_dict['inv_transfers_dict'].get(city, state_dict['empty_transfers_LoL']),
+                                            state_dict['har_transfers_dict'].get(city, state_dict['empty_transfers_LoL']),
+                                            state_dict['facilities_LoL'], state_dict['harvest_in_LoL'], state_dict['products_LoL'],
+                                            state_dict['harvest_cube'], state_dict['facility_topology'],
+                                            demand_order_list, state_dict['har_transfers_order_dict'].get(city, []), row_order_dict)
+    return (city_stage_tuple, row_order_dict)
+
+
+class CityPartitionPool:
+    '''
+    #### Inputs:
+        - facility_topology: FacilityTopology of the run (city of every greenhouse)
+        - facilities_LoL, harvest_in_LoL, products_LoL, harvest_cube: run inputs shared by every city
+        - inv_transfers_LoL, har_transfers_LoL: planned transfers, partitioned by ship greenhouse city
+        - pd_product_id_list, pd_production_priority_list: product priorities read by the allocation functions
+        - worker_count: optional number of worker processes (defaults to the CPU count)
+    #### Algorithm:
+    - within a step, inventory allocation only draws inventory of the demand city, harvest allocation is matched to the harvest
+      of the demand city (main cooler), and planned transfers draw on the ship city, so cityAllocationStages is independent by city
+    - run inputs are sent to the worker processes once (pool initializer); each step sends only the city partitions of
+        - starting inventory (by inventory greenhouse city)
+        - tier and time demand (by demand greenhouse city)
+        - AllocationTracker (by tracked greenhouse city)
+    - merge (deterministic): inventory allocation rows are put back in starting inventory order, harvest allocation, prior
+      harvest allocation, and short demand rows are sorted by the serial order keys of cityAllocationStages (demand and planned
+      transfer rows are tagged with their index in the step inputs), trackers are merged by city short code
+    - validate compares a merged result with the serial result: the row lists exactly (in order, calculateTransfers reads the
+      short demand rows greedily), the tracker by key
+
+    #### Output:
+        - run(demand_allocation_date, tier_count, inventory_out_LoL, demand_in_LoL, allocation_tracker): cityAllocationStages output tuple
+        - validate(city_stage_tuple, serial_stage_tuple): list of stage output names that differ (empty if the results match)
+        - close(): stops the worker processes
+    '''
+
+    stage_output_name_list = ['inventory_allocation_out_LoL', 'harvest_allocation_out_LoL', 'harvest_allocation_prior_LoL', 'allocation_tracker_out2', 'short_demand_out2_LoL']
+
+    def __init__(self, facility_topology, facilities_LoL, harvest_in_LoL, products_LoL, harvest_cube, inv_transfers_LoL, har_transfers_LoL,
+                 pd_product_id_list, pd_production_priority_list, worker_count = None):
+        from concurrent.futures import ProcessPoolExecutor
+        self.facility_topology = facility_topology
+        state_dict = {'facilities_LoL': facilities_LoL,
+                      'harvest_in_LoL': harvest_in_LoL,
+                      'products_LoL': products_LoL,
+                      'harvest_cube': harvest_cube,
+                      'facility_topology': facility_topology,
+                      'inv_transfers_dict': self.partitionRows(inv_transfers_LoL, 2),
+                      'har_transfers_dict': self.partitionRows(har_transfers_LoL, 2),
+                      'har_transfers_order_dict': self.partitionIndices(har_transfers_LoL, 2),
+                      'empty_transfers_LoL': [list() for column in inv_transfers_LoL],
+                      'pd_product_id_list': pd_product_id_list,
+                      'pd_production_priority_list': pd_production_priority_list}
+        self.transfer_city_set = set(state_dict['inv_transfers_dict'].keys()) | set(state_dict['har_transfers_dict'].keys())
+        self.executor = ProcessPoolExecutor(max_workers = worker_count, initializer = cityWorkerInit, initargs = (state_dict,))
+
+    @staticmethod
+    def cityOrder(city):
+        # greenhouses without a city sort last
+        return (city is None, city or '')
+
+    def partitionIndices(self, LoL, facility_column):
+        city_idx_dict = dict()
+        for row_idx in range(len(LoL[facility_column])):
+            city = self.facility_topology.city(LoL[facility_column][row_idx])
+            city_idx_dict.setdefault(city, []).append(row_idx)
+        return city_idx_dict
+
+    @staticmethod
+    def rows(LoL, row_idx_list):
+        return [[column[row_idx] for row_idx in row_idx_list] for column in LoL]
+
+    def partitionRows(self, LoL, facility_column):
+        return {city: self.rows(LoL, row_idx_list) for (city, row_idx_list) in self.partitionIndices(LoL, facility_column).items()}
+
+    def run(self, demand_allocation_date, tier_count, inventory_out_LoL, demand_in_LoL, allocation_tracker):
+        inventory_idx_dict = self.partitionIndices(inventory_out_LoL, 0)
+        demand_idx_dict = self.partitionIndices(demand_in_LoL, 2)
+        tracker_dict = allocation_tracker.partition(self.facility_topology.city)
+
+        city_list = sorted(set(inventory_idx_dict) | set(demand_idx_dict) | set(tracker_dict) | self.transfer_city_set, key = self.cityOrder)
+
+        future_list = list()
+        for city in city_list:
+            future_list += [self.executor.submit(cityWorkerRun, city, demand_allocation_date, tier_count,
+                                                 self.rows(inventory_out_LoL, inventory_idx_dict.get(city, [])),
+                                                 self.rows(demand_in_LoL, demand_idx_dict.get(city, [])),
+                                                 tracker_dict.get(city, AllocationTracker()),
+                                                 demand_idx_dict.get(city, []))]
+        city_result_list = [future.result() for future in future_list]
+        city_stage_tuple_list = [city_stage_tuple for (city_stage_tuple, row_order_dict) in city_result_list]
+
+        # inventory allocation rows back in starting inventory order
+        inventory_row_count = len(inventory_out_LoL[0])
+        inventory_allocation_out_LoL = None
+        for city_idx in range(len(city_list)):
+            city_inventory_allocation_LoL = city_stage_tuple_list[city_idx][0]
+            if inventory_allocation_out_LoL is None:
+                inventory_allocation_out_LoL = [[None] * inventory_row_count for column in city_inventory_allocation_LoL]
+            row_idx_list = inventory_idx_dict.get(city_list[city_idx], [])
+            for column_idx in range(len(city_inventory_allocation_LoL)):
+                for part_idx in range(len(row_idx_list)):
+                    inventory_allocation_out_LoL[column_idx][row_idx_list[part_idx]] = city_inventory_allocation_LoL[column_idx][part_idx]
+
+        # harvest allocation, prior harvest allocation, and short demand rows in serial order
+        # (stable sort: rows with the same order key come from one city, in the order of the city partition)
+        merged_LoL_list = list()
+        for output_idx in [1, 2, 4]:
+            output_name = self.stage_output_name_list[output_idx]
+            order_row_list = list()
+            for (city_stage_tuple, row_order_dict) in city_result_list:
+                order_row_list += list(zip(row_order_dict[output_name], zip(*city_stage_tuple[output_idx])))
+            order_row_list.sort(key = lambda order_row: order_row[0])
+            merged_LoL = [[row[column_idx] for (order, row) in order_row_list] for column_idx in range(len(city_stage_tuple_list[0][output_idx]))]
+            merged_LoL_list += [merged_LoL]
+
+        allocation_tracker_out2 = AllocationTracker.merge([city_stage_tuple[3] for city_stage_tuple in city_stage_tuple_list])
+
+        return (inventory_allocation_out_LoL, merged_LoL_list[0], merged_LoL_list[1], allocation_tracker_out2, merged_LoL_list[2])
+
+    def validate(self, city_stage_tuple, serial_stage_tuple):
+        mismatch_list = list()
+        for output_idx in [0, 1, 2, 4]:
+            if city_stage_tuple[output_idx] != serial_stage_tuple[output_idx]:
+                mismatch_list += [self.stage_output_name_list[output_idx]]
+        if city_stage_tuple[3].toDict() != serial_stage_tuple[3].toDict():
+            mismatch_list += [self.stage_output_name_list[3]]
+        return mismatch_list
+
+    def close(self):
+        self.executor.shutdown()
+
+print('functions loaded')
 
-    cnxn.commit()
-    cnxn_cursor.close()
-    cnxn.close()
-    ###########################################################################################
 
-    # check inventory date
+# In[2]:
+
+
+#start timer for execution
+start_time = time.time()
+
+# checkpoint of the tier x date allocation loop, --resume skips the inventory gate, data load, and change data capture
+allocation_checkpoint = AllocationCheckpoint(run_args.checkpoint_dir)
+resume_inputs = None
+if run_args.resume and is_main_process:
+    resume_inputs = allocation_checkpoint.loadInputs()
+    if resume_inputs is None:
+        print('no allocation checkpoint from today, starting a new run')
+
+allocation_run_status = 0
+
+if is_main_process and debug_status == 0 and resume_inputs is None:
+    ## Check inventory for an actual count today
+    # --watch keeps one connection open and polls the combined readiness query with backoff until inventory lands,
+    # then continues to the allocation run in this process (instead of the scheduler relaunching the script)
+
+    HOSTNAME = socket.gethostname()
 
     if HOSTNAME == 'hostname':
         CONNECTIONSTRING = """Driver={ODBC Driver 17 for SQL Server}; 
-                                Server=127.0.0.1;
+                                Server=127.0.0.1,1443;
                                 Database=databasename;
                                 trusted_connection=yes""" # use windows auth on DB01
     else:
@@ -5202,100 +6004,28 @@ if debug_status == 0:
         pwd = cfg['databasename']['pwd']
 
         CONNECTIONSTRING = """Driver={ODBC Driver 17 for SQL Server};
-                                Server=127.0.0.1;
+                                Server=127.0.0.1,1443;
                                 Database=databasename;
                                 UID=%s;
                                 PWD=%s;""" % (uid, pwd) # use config.yml on local machine
-    cnxn = pyodbc.connect(CONNECTIONSTRING) 
-    cnxn_cursor = cnxn.cursor()
-    sql = "SELECT DISTINCT CoolerInventoryDate FROM Inventory_Facts WHERE CurrentRecord = 1"
-    cnxn_cursor.execute(sql) 
-    row = cnxn_cursor.fetchone()
-    inventory_date = row[0]
 
-    cnxn.commit()
-    cnxn_cursor.close()
-    cnxn.close()
+    watch_until = None
+    if run_args.watch_until is not None:
+        watch_until = DT.datetime.combine(DT.date.today(), DT.datetime.strptime(run_args.watch_until, "%H:%M").time())
 
-    ###################
-    check_today_datetime = DT.datetime.now()
-    check_today_date = check_today_datetime.date()
-
-    check_for_new_inventory = 0
-    if check_today_date == inventory_date:
-        check_for_new_inventory = 1
-        print('actual inventory loaded')
-        if run_status == 0:
-            # this is the first run with actual inventory
-            if HOSTNAME == 'hostname':
-                CONNECTIONSTRING = """Driver={ODBC Driver 17 for SQL Server}; 
-                                        Server=127.0.0.1,1443;
-                                        Database=databasename;
-                                        trusted_connection=yes""" # use windows auth on DB01
-            else:
-                with open(os.path.join(sys.path[0], "config.yml"), 'r') as ymlfile:
-                    cfg = yaml.load(ymlfile, Loader=yaml.SafeLoader)
-                uid = cfg['databasename']['uid']
-                pwd = cfg['databasename']['pwd']
-
-                CONNECTIONSTRING = """Driver={ODBC Driver 17 for SQL Server};
-                                        Server=127.0.0.1,1443;
-                                        Database=databasename;
-                                        UID=%s;
-                                        PWD=%s;""" % (uid, pwd) # use config.yml on local machine
-            cnxn = pyodbc.connect(CONNECTIONSTRING) 
-            cnxn_cursor = cnxn.cursor()
-            sql = "SELECT MAX(InventoryStatusID) FROM InventoryStatus_Lov;"
-            cnxn_cursor.execute(sql) 
-            row = cnxn_cursor.fetchone()
-            cnxn.commit()
-            cnxn_cursor.close()
-            cnxn.close()
-            inventory_status_id = 0
-            if row is not None:
-                if row[0] is not None:
-                    inventory_status_id = row[0]
-            inventory_status_id += 1
-            # write datetime to InventoryStatus_Lov
-            if HOSTNAME == 'hostname':
-                CONNECTIONSTRING = """Driver={ODBC Driver 17 for SQL Server}; 
-                                        Server=127.0.0.1,1443;
-                                        Database=databasename;
-                                        trusted_connection=yes""" # use windows auth on DB01
-            else:
-                with open(os.path.join(sys.path[0], "config.yml"), 'r') as ymlfile:
-                    cfg = yaml.load(ymlfile, Loader=yaml.SafeLoader)
-                uid = cfg['databasename']['uid']
-                pwd = cfg['databasename']['pwd']
-
-                CONNECTIONSTRING = """Driver={ODBC Driver 17 for SQL Server};
-                                        Server=127.0.0.1,1443;
-                                        Database=databasename;
-                                        UID=%s;
-                                        PWD=%s;""" % (uid, pwd) # use config.yml on local machine
-            cnxn = pyodbc.connect(CONNECTIONSTRING) 
-            cnxn_cursor = cnxn.cursor()
-            sql = """
-            INSERT INTO InventoryStatus_Lov
-            VALUES (?,?);
-            """ 
-            # write to database
-            tuple_to_write = (inventory_status_id, check_today_datetime)
-            cnxn_cursor.execute(sql, tuple_to_write)
-            cnxn.commit()
-            cnxn_cursor.close()
-            cnxn.close()
-
-
-    else:
-        print('no new inventory')
+    (check_for_new_inventory, run_status) = waitForInventory(CONNECTIONSTRING, int(run_args.watch), run_args.watch_interval,
+                                                             run_args.watch_max_interval, watch_until, run_args.watch_trigger_file)
 
 
 # In[5]:
 
 
 
-if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
+if is_main_process and resume_inputs is None and (debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0)):
+
+    # numpy is only needed once the inventory gate is open (the functions above reference np at call time)
+    import numpy as np
+    import GothamFunctions
 
     # load data
     HOSTNAME = socket.gethostname()
@@ -5324,20 +6054,24 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
     ###########################################################################################
 
     # DIMENSIONS
+    # slow changing dimensions are read from the local snapshot unless the TTL expired or the row count/checksum changed
+    # (own snapshot folder: the forecast jobs pull Crop_Dim and Customers_Dim with other columns)
+    dimension_cache_dir = os.path.join(sys.path[0], 'dimension_cache_allocations')
+    dimension_cache = GothamFunctions.DimensionCache(cnxn_cursor, dimension_cache_dir)
 
     # pull from Crop_Dim
     crd_crop_id_list = list()
     crd_sage_crop_code_list = list()
     sql = "SELECT CropID, SageCropCode FROM Crop_Dim ORDER BY CropID"
-    cnxn_cursor.execute(sql) 
-    row = cnxn_cursor.fetchone()
+    dim_row_iter = iter(dimension_cache.rows('Crop_Dim', sql))
+    row = next(dim_row_iter, None)
 
     crd_crop_id_list += [row[0]]
     crd_sage_crop_code_list += [row[1]]
 
 
     while row is not None:
-        row = cnxn_cursor.fetchone()
+        row = next(dim_row_iter, None)
         if row is not None:
             crd_crop_id_list += [row[0]]
             crd_sage_crop_code_list += [row[1]]
@@ -5350,48 +6084,43 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
     fd_city_short_code_list = list()
     fd_latitude_list = list()
     fd_longitude_list = list()
+    fd_main_cooler_id_list = list()
 
     sql = """
     SELECT GreenhouseID,
     GreenhouseName,
     CityAbbreviation,
     Latitude,
-    Longitude
+    Longitude,
+    MainCoolerGreenhouseID
     FROM
     Greenhouses_Dim
     """
-    cnxn_cursor.execute(sql) 
-    row = cnxn_cursor.fetchone()
+    dim_row_iter = iter(dimension_cache.rows('Greenhouses_Dim', sql))
+    row = next(dim_row_iter, None)
 
     fd_facility_id_list += [row[0]]
     fd_location_name_list += [row[1].rstrip()]
-    fd_city_short_code_list += [row[2]]
+    fd_city_short_code_list += [row[2].rstrip()]
     fd_latitude_list += [row[3]]
     fd_longitude_list += [row[4]]
+    fd_main_cooler_id_list += [row[5]]
 
     while row is not None:
-        row = cnxn_cursor.fetchone()
+        row = next(dim_row_iter, None)
         if row is not None:
             fd_facility_id_list += [row[0]]
             fd_location_name_list += [row[1].rstrip()]
-            fd_city_short_code_list += [row[2]]
+            fd_city_short_code_list += [row[2].rstrip()]
             fd_latitude_list += [row[3]]
             fd_longitude_list += [row[4]]
+            fd_main_cooler_id_list += [row[5]]
 
-    # for each location find the timezone based on latitude and longitude
-    def get_offset(*, lat, lng):
-        """
-        returns a location's time zone offset from UTC in hours.
-        """
-
-        today = datetime.now()
-        tz_target = timezone(tf.certain_timezone_at(lng=lng, lat=lat))
-        # ATTENTION: tz_target could be None! handle error case
-        today_target = tz_target.localize(today)
-        today_utc = utc.localize(today)
-        return (today_utc - today_target).total_seconds() / 3600
+    # greenhouse cities and main coolers, shared by the inventory load and all allocation functions
+    facility_topology = FacilityTopology([fd_facility_id_list, fd_city_short_code_list, fd_main_cooler_id_list], fd_location_name_list)
 
-    tf = TimezoneFinder()
+    # for each location find the timezone based on latitude and longitude (cached locally, timezonefinder only for unseen coordinates)
+    facility_timezones = FacilityTimezones()
 
     # build list of last order call hours relative to east coast time
     fd_last_call_time_list = list()
@@ -5402,21 +6131,23 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
         fd_lat = fd_latitude_list[fd_idx]
         fd_lng = fd_longitude_list[fd_idx]
 
-        hour_offset = get_offset(**{"lat": fd_lat, "lng": fd_lng})
+        hour_offset = facility_timezones.utcOffsetHours(fd_lat, fd_lng)
         fd_last_call_time_list += [int(last_order_utc_hour - hour_offset)]
 
+    facility_timezones.save()
+
     # pull from Greenhouseline_Lov
     fld_facility_line_id_list = list()
     fld_facility_line_list = list()
     sql = "SELECT GreenhouseLineID, GreenhouseLine FROM GreenhouseLine_LOV"
-    cnxn_cursor.execute(sql) 
-    row = cnxn_cursor.fetchone()
+    dim_row_iter = iter(dimension_cache.rows('GreenhouseLine_LOV', sql))
+    row = next(dim_row_iter, None)
 
     fld_facility_line_id_list += [row[0]]
     fld_facility_line_list += [row[1]]
 
     while row is not None:
-        row = cnxn_cursor.fetchone()
+        row = next(dim_row_iter, None)
         if row is not None:
             fld_facility_line_id_list += [row[0]]
             fld_facility_line_list += [row[1]]  
@@ -5428,8 +6159,8 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
     cud_service_factor_list = list()
 
     sql = "SELECT CustomersID, SageCustomerID,ServiceFactor FROM Customers_Dim"
-    cnxn_cursor.execute(sql) 
-    row = cnxn_cursor.fetchone()
+    dim_row_iter = iter(dimension_cache.rows('Customers_Dim', sql))
+    row = next(dim_row_iter, None)
 
     cud_customers_id_list += [row[0]]
     cud_sage_customer_id_list += [row[1].rstrip()]
@@ -5441,7 +6172,7 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
     cud_service_factor_list += [cud_service_factor]
 
     while row is not None:
-        row = cnxn_cursor.fetchone()
+        row = next(dim_row_iter, None)
         if row is not None:
             cud_customers_id_list += [row[0]]
             cud_sage_customer_id_list += [row[1].rstrip()]
@@ -5538,8 +6269,8 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
         ORDER BY ProductID
     """
 
-    cnxn_cursor.execute(sql)
-    row = cnxn_cursor.fetchone()
+    dim_row_iter = iter(dimension_cache.rows('Products_Dim', sql))
+    row = next(dim_row_iter, None)
 
     pd_product_id_list += [row[0]]
 
@@ -5594,7 +6325,7 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
 
 
     while row is not None:  
-        row = cnxn_cursor.fetchone()
+        row = next(dim_row_iter, None)
         if row is not None:
             pd_product_id_list += [row[0]]
 
@@ -5709,13 +6440,10 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
     if row is not None:
         inv_facility_name = row[0].rstrip()    
         inv_facility_id = fd_facility_id_list[fd_location_name_list.index(str(row[0].rstrip()))]
-        # consider one inventory per city
-        if inv_facility_id in [1,2,9]:
-            inv_facility_id = 3 # set NYC1, NYC2, and NYC4 to NYC3
-            inv_facility_name = ['NYC3']
-        if inv_facility_id == 4:
-            inv_facility_id = 7 # set CHI1 to CHI2
-            inv_facility_name = ['CHI2']
+        # consider one inventory per city (e.g. NYC1, NYC2, and NYC4 to NYC3)
+        if facility_topology.mainCooler(inv_facility_id) != inv_facility_id:
+            inv_facility_id = facility_topology.mainCooler(inv_facility_id)
+            inv_facility_name = [facility_topology.locationName(inv_facility_id)]
 
         if_inventory_facility_name_list += [inv_facility_name]
         if_product_id_list += [row[1]]
@@ -5731,13 +6459,10 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
         if row is not None:
             inv_facility_name = row[0].rstrip()    
             inv_facility_id = fd_facility_id_list[fd_location_name_list.index(str(row[0].rstrip()))]
-            # consider one inventory per city
-            if inv_facility_id in [1,2,9]:
-                inv_facility_id = 3 # set NYC1, NYC2, and NYC4 to NYC3
-                inv_facility_name = ['NYC3']
-            if inv_facility_id == 4:
-                inv_facility_id = 7 # set CHI1 to CHI2
-                inv_facility_name = ['CHI2']
+            # consider one inventory per city (e.g. NYC1, NYC2, and NYC4 to NYC3)
+            if facility_topology.mainCooler(inv_facility_id) != inv_facility_id:
+                inv_facility_id = facility_topology.mainCooler(inv_facility_id)
+                inv_facility_name = [facility_topology.locationName(inv_facility_id)]
 
             if_inventory_facility_name_list += [inv_facility_name]
             if_product_id_list += [row[1]]
@@ -5764,8 +6489,8 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
     sql = """
     SELECT DateDay, YearNumber, WeekOfYear FROM Calendars_Dim
     """
-    cnxn_cursor.execute(sql) 
-    row = cnxn_cursor.fetchone()
+    dim_row_iter = iter(dimension_cache.rows('Calendars_Dim', sql))
+    row = next(dim_row_iter, None)
 
     cald_date_day_list  += [row[0]]
     cald_year_number_list  += [row[1]]
@@ -5775,7 +6500,7 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
 
 
     while row is not None:
-        row = cnxn_cursor.fetchone()
+        row = next(dim_row_iter, None)
         if row is not None:
             cald_date_day_list  += [row[0]]
             cald_year_number_list  += [row[1]]
@@ -5822,6 +6547,7 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
 
     cnxn = pyodbc.connect(CONNECTIONSTRING)   
     cnxn_cursor = cnxn.cursor()
+    dimension_cache = GothamFunctions.DimensionCache(cnxn_cursor, dimension_cache_dir)
 
 
     #CustomerFillGoal_Dim
@@ -5838,8 +6564,8 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
     FROM CustomerFillGoal_Dim
     WHERE IsActive = 1
     """
-    cnxn_cursor.execute(sql) 
-    row = cnxn_cursor.fetchone()
+    dim_row_iter = iter(dimension_cache.rows('CustomerFillGoal_Dim', sql))
+    row = next(dim_row_iter, None)
 
     cfgd_product_id_list += [row[0]]
     cfgd_customers_id_list += [row[1]]
@@ -5850,7 +6576,7 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
     cfgd_key_list += [str(row[0]) + '_' + str(row[1]) + '_' + str(row[2]) + '_' + str(row[3])]
 
     while row is not None:
-        row = cnxn_cursor.fetchone()
+        row = next(dim_row_iter, None)
         if row is not None:
             cfgd_product_id_list += [row[0]]
             cfgd_customers_id_list += [row[1]]
@@ -6203,94 +6929,12 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
     # date today
     date_today = DT.datetime.now().date()
 
-    # Clean inventory
-    cif_facility_id_list = list()
-    cif_enjoy_by_date_list = list()
-    cif_product_id_list = list()
-    cif_quantity_list = list()
-    cif_facility_product_date_key_list = list()
-
-    for if_idx in range(len(if_facility_id_list)):
-        if if_idx in range(len(if_facility_id_list)):
-
-            check_facility_id = if_facility_id_list[if_idx]
-            check_enjoy_by_date = if_enjoy_by_date_list[if_idx]
-            check_product_id = if_product_id_list[if_idx]
-            check_quantity = if_quantity_list[if_idx]
-            check_facility_product_date_key = if_facility_product_date_key_list[if_idx]
-
-
-            if check_quantity > 0:
-                # the entry is valid if Quantity is greater than 0
-                cif_facility_id_list += [check_facility_id]
-                cif_enjoy_by_date_list += [check_enjoy_by_date]
-                cif_product_id_list += [check_product_id]
-                cif_quantity_list += [check_quantity]
-
-                cif_facility_product_date_key_list += [check_facility_product_date_key]
-
-            else:
-                # handle negative entries
-                outstanding_quantity = check_quantity
-
-                while outstanding_quantity < 0:
-
-                    # check before the entry
-                    if check_facility_product_date_key in cif_facility_product_date_key_list:
-                        previous_idx = cif_facility_product_date_key_list.index(check_facility_product_date_key)
-                        old_val = cif_quantity_list[previous_idx]
-                        new_val = old_val + outstanding_quantity # subtract outstanding quantity from existing entry
-                        if new_val == 0:
-                            # remove the record from the clean inventory
-                            del cif_facility_id_list[previous_idx]
-                            del cif_enjoy_by_date_list[previous_idx]
-                            del cif_product_id_list[previous_idx]
-                            del cif_quantity_list[previous_idx]
-                            del cif_facility_product_date_key_list[previous_idx]
-                            outstanding_quantity = 0
-                        if new_val > 0:
-                            # update the record in cif
-                            cif_quantity_list[previous_idx] = new_val
-                            outstanding_quantity = 0
-                        if new_val < 0:   
-                            # remove the record from the clean inventory continue searching
-                            del cif_facility_id_list[previous_idx]
-                            del cif_enjoy_by_date_list[previous_idx]
-                            del cif_product_id_list[previous_idx]
-                            del cif_quantity_list[previous_idx]
-                            del cif_facility_product_date_key_list[previous_idx]                               
-                            outstanding_quantity = new_val
-
-                    # check after the entry
-                    post_facility_product_date_key_list = if_facility_product_date_key_list[if_idx+1:]
-                    if check_facility_product_date_key in post_facility_product_date_key_list:
-                        post_idx = post_facility_product_date_key_list.index(check_facility_product_date_key)
-                        post_idx_if = post_idx + if_idx + 1
-                        old_val = if_quantity_list[post_idx_if]
-                        new_val = old_val + outstanding_quantity
-                        if new_val == 0:
-                            # remove the record from the inventory facts lists
-                            del if_facility_id_list[post_idx_if]
-                            del if_product_id_list[post_idx_if]
-                            del if_enjoy_by_date_list[post_idx_if]
-                            del if_quantity_list[post_idx_if]
-                            del if_facility_product_date_key_list[post_idx_if]   
-                            outstanding_quantity = 0
-                        if new_val > 0:
-                            # update the record in inventory facts qty list
-                            if_quantity_list[post_idx_if] = new_val
-                            outstanding_quantity = 0
-                        if new_val < 0:             
-                            # remove the record from the inventory facts lists and continue searching
-                            del if_facility_id_list[post_idx_if]
-                            del if_product_id_list[post_idx_if]
-                            del if_enjoy_by_date_list[post_idx_if]
-                            del if_quantity_list[post_idx_if]
-                            del if_facility_product_date_key_list[post_idx_if] 
-                            outstanding_quantity = new_val
-                    else:
-                        print('Outstanding negative inventory: ' + str(-outstanding_quantity) + ' for ' + check_facility_product_date_key)
-                        outstanding_quantity = 0
+    # Clean inventory (cif): one qty per greenhouse/product/enjoy-by-date
+    # negative entries are netted against the other entries of the same greenhouse/product/enjoy-by-date
+    (cif_facility_id_list,
+     cif_product_id_list,
+     cif_enjoy_by_date_list,
+     cif_quantity_list) = aggregateByKey([if_facility_id_list, if_product_id_list, if_enjoy_by_date_list], if_quantity_list, 1)
 
 
     ##########
@@ -6366,13 +7010,13 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
     ssf_enjoy_by_date_list = list()
     ssf_product_id_list = list()
     ssf_quantity_list = list()
+    stop_sell_row_list = list()
 
     # Clean clean inventory (ccif) after removing stop sell products
     ccif_facility_id_list = list()
     ccif_enjoy_by_date_list = list()
     ccif_product_id_list = list()
     ccif_quantity_list = list()
-    ccif_facility_product_date_key_list = list()
 
 
     for cif_idx in range(len(cif_facility_id_list)):
@@ -6381,7 +7025,6 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
         check_enjoy_by_date = cif_enjoy_by_date_list[cif_idx]
         check_product_id = cif_product_id_list[cif_idx]
         check_quantity = cif_quantity_list[cif_idx]
-        check_facility_product_date_key = cif_facility_product_date_key_list[cif_idx]
 
         check_shelf_life_guarantee_days = pd_shelf_life_guarantee_list[pd_product_id_list.index(check_product_id)]
         shelf_life_guarantee_date = check_enjoy_by_date - DT.timedelta(days = check_shelf_life_guarantee_days)
@@ -6390,51 +7033,21 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
             ccif_enjoy_by_date_list += [check_enjoy_by_date]
             ccif_product_id_list += [check_product_id]
             ccif_quantity_list += [check_quantity]
-            ccif_facility_product_date_key_list += [check_facility_product_date_key]
         else:
             # write to StopSell_Facts if we can no longer sell the inventory item
             tuple_to_write = (shelf_life_guarantee_id, date_today, check_facility_id, check_product_id, check_enjoy_by_date, check_quantity,load_date,to_date,is_active,check_facility_id)
             cnxn_cursor.execute(sql, tuple_to_write)
+            stop_sell_row_list += [tuple_to_write]
             shelf_life_guarantee_id += 1
 
     cnxn.commit()
     cnxn_cursor.close()
     cnxn.close()
 
-    #print(date_today, 'StopSell_Facts done')
-
-
-    # aggregate inventory lists by facility_product_date key
-    # Compressed clean clean inventory facts (cccif) after aggregating 
-    cccif_facility_id_list = list()
-    cccif_enjoy_by_date_list = list()
-    cccif_product_id_list = list()
-    cccif_quantity_list = list()
-    cccif_facility_product_date_key_list = list()
-
-    for ccif_idx in range(len(ccif_facility_id_list)):
-        # check entry in clean clean inventory facts
-        check_facility_id = ccif_facility_id_list[ccif_idx]
-        check_enjoy_by_date = ccif_enjoy_by_date_list[ccif_idx]
-        check_product_id = ccif_product_id_list[ccif_idx]
-        check_quantity = ccif_quantity_list[ccif_idx]
-        check_facility_product_date_key = ccif_facility_product_date_key_list[ccif_idx]
-
-
-        if check_facility_product_date_key in cccif_facility_product_date_key_list:
-            # add check entry to the existing entry in compressed inventory lists
-            # index in new list
-            cccif_idx = cccif_facility_product_date_key_list.index(check_facility_product_date_key)
-            cccif_quantity_list[cccif_idx] += check_quantity
-
-        if check_facility_product_date_key not in cccif_facility_product_date_key_list:
-            # add check entry to new entry in compressed inventory lists
-            cccif_facility_id_list += [check_facility_id]
-            cccif_enjoy_by_date_list += [check_enjoy_by_date]
-            cccif_product_id_list+= [check_product_id]
-            cccif_quantity_list += [check_quantity]
-            cccif_facility_product_date_key_list += [check_facility_product_date_key]
+    if parquet_sink is not None:
+        parquet_sink.write('StopSell_Facts', stop_sell_row_list)
 
+    #print(date_today, 'StopSell_Facts done')
 
 
     # inbound transfers
@@ -6442,23 +7055,17 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
         tsf_arrival_date = tsf_arrival_date_list[tsf_idx]
         if tsf_arrival_date == date_today:
             # add inbound transfer to inventory of arrival facility
-            tsf_arrival_facility_id = tsf_arrival_facility_id_list[tsf_idx]
-            tsf_arrival_location_name = fd_location_name_list[fd_facility_id_list.index(tsf_arrival_facility_id)]
-            tsf_product_id = tsf_product_id_list[tsf_idx]
-            tsf_enjoy_by_date = tsf_enjoy_by_date_list[tsf_idx]
-            tsf_transfer_qty = tsf_transfer_qty_list[tsf_idx]
-
-            tsf_facility_product_date_key = tsf_arrival_location_name + '_' + str(tsf_product_id) + '_' + str(tsf_enjoy_by_date)
+            ccif_facility_id_list += [tsf_arrival_facility_id_list[tsf_idx]]
+            ccif_enjoy_by_date_list += [tsf_enjoy_by_date_list[tsf_idx]]
+            ccif_product_id_list += [tsf_product_id_list[tsf_idx]]
+            ccif_quantity_list += [tsf_transfer_qty_list[tsf_idx]]
 
-            if tsf_facility_product_date_key in cccif_facility_product_date_key_list:
-                cccif_idx = cccif_facility_product_date_key_list.index(tsf_facility_product_date_key)
-                cccif_quantity_list[cccif_idx] += tsf_transfer_qty
-            if tsf_facility_product_date_key not in cccif_facility_product_date_key_list:
-                cccif_facility_id_list += [tsf_arrival_facility_id]
-                cccif_enjoy_by_date_list += [tsf_enjoy_by_date]
-                cccif_product_id_list+= [tsf_product_id]
-                cccif_quantity_list += [tsf_transfer_qty]
-                cccif_facility_product_date_key_list += [tsf_facility_product_date_key]
+    # aggregate inventory lists by facility_product_date key
+    # Compressed clean clean inventory facts (cccif) after aggregating and adding inbound transfers
+    (cccif_facility_id_list,
+     cccif_product_id_list,
+     cccif_enjoy_by_date_list,
+     cccif_quantity_list) = aggregateByKey([ccif_facility_id_list, ccif_product_id_list, ccif_enjoy_by_date_list], ccif_quantity_list)
 
     #print(date_today, 'inbound transfers done')
 
@@ -6746,11 +7353,7 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
     ######################################################################################
     # these lists will track the delta of harvest lists through the allocation process
 
-    # allocation tracking: crop level across all time and tier
-    allocated_date_crop_facility_key_list = list()
-    allocated_plant_sites_list = list()
-    complete_crop_allocation_key_list = list()
-    allocated_starting_ps_list = list()
+    # allocation tracking: crop level across all time and tier (AllocationTracker)
 
     # allocation_tracking: product level
     allocated_date_product_facility_key_list = list()
@@ -6803,7 +7406,7 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
     #initialize lists for HarvestUnallocated_Facts
 
 
-    allocated_crops_in_LoL =  [allocated_date_crop_facility_key_list, allocated_starting_ps_list, allocated_plant_sites_list, complete_crop_allocation_key_list]
+    allocation_tracker_in = AllocationTracker()
 
     # initialize transfers
     transfers_LoL = [tsf_ship_date_list,
@@ -6833,7 +7436,7 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
 
 
     # initialize facilities
-    facilities_LoL = [fd_facility_id_list, fd_city_short_code_list]
+    facilities_LoL = [fd_facility_id_list, fd_city_short_code_list, fd_main_cooler_id_list]
 
     # initialize lists for short demand
     new_sdf_demand_date_list = list()
@@ -6870,261 +7473,6 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
 #     if debug_status == 1:
 #         distinct_demand_allocation_date_list = distinct_demand_allocation_date_list[0:5]
 
-    # initialize first date 
-    demand_allocation_date = distinct_demand_allocation_date_list[0] 
-
-
-    # main loop
-    # 1. customer tier
-    # 2. time
-    # order for each tier-timestep combination
-    #    a. Inventory Rollover
-    #    b. Inventory to Customer Allocation
-    #    c. Harvest to Customer Allocation
-    #    d. Prior Day Harvest to Customer Allocation (to do)
-
-
-
-
-
-    tier_count = 0
-    final_tier = (len(sorted_distinct_fill_goal_list) * 2) - 1
-    # first pass allocations up to fill goal %
-    # 1. customer tier
-    for fill_goal in sorted_distinct_fill_goal_list:
-        # customer tier indices for demand
-        tier_indices = [i for i, x in enumerate(df_fill_goal_list) if x == fill_goal]
-
-
-        ####
-        tier_count += 1
-        print('Tier ', tier_count, 'fill goal:', fill_goal, "- %s seconds-" % (time.time() - start_time))
-        # 2. time - loop dates starting from the next demand allocation date
-        for demand_allocation_date_idx in range(len(distinct_demand_allocation_date_list)):
-
-            # set last allocation date
-            last_allocation_date = demand_allocation_date
-            # set demand allocation date
-            demand_allocation_date = distinct_demand_allocation_date_list[demand_allocation_date_idx]
-
-            time_indices = [i for i, x in enumerate(df_demand_allocation_date_list) if x == demand_allocation_date]
-            tier_time_indices = list(set(tier_indices) & set(time_indices))
-
-
-            # create list of list for customer tier and time demand
-
-            if demand_allocation_date != distinct_demand_allocation_date_list[0]:
-                last_tier_time_demand_in_LoL = tier_time_demand_in_LoL
-
-
-            tier_time_demand_in_LoL = [[demand_in_LoL[0][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[1][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[2][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[3][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[4][idx] for idx in tier_time_indices],
-                                        [int(round((demand_in_LoL[5][idx] - demand_in_LoL[6][idx] - demand_in_LoL[7][idx]) * fill_goal)) + int(round(demand_in_LoL[6][idx]*fill_goal)) + int(round(demand_in_LoL[7][idx]*fill_goal)) for idx in tier_time_indices],
-                                        [int(round(demand_in_LoL[6][idx]*fill_goal)) for idx in tier_time_indices],
-                                        [int(round(demand_in_LoL[7][idx]*fill_goal)) for idx in tier_time_indices]
-                                      ]
-
-            # inventory for Day 1 Tier 1
-            if demand_allocation_date == distinct_demand_allocation_date_list[0] and tier_count == 1:
-                # Compressed clean clean inventory facts (cccif) after aggregating
-                inventory_out_LoL = starting_inventory_in
-
-
-            # inventory rollover Tier 2+ Day 1 or Day 2+
-            if (demand_allocation_date == distinct_demand_allocation_date_list[0] and tier_count > 1) or demand_allocation_date != distinct_demand_allocation_date_list[0]:
-
-                inventory_in_date = last_allocation_date    
-                inventory_in_LoL = inventoryRollover(inventory_in_date,products_LoL, demand_allocation_date)
-
-                # inventory rollover from smooth quantities from last allocation date
-
-                inventory_in_LoL = smoothRollover(last_allocation_date, inventory_in_LoL, roll_harvest_LoL, products_LoL, demand_allocation_date)
-
-                # stop sell and add transfers in
-                (inventory_out_LoL, shelf_life_guarantee_out_LoL) = inventoryForecast(demand_allocation_date, inventory_in_LoL, products_LoL, transfers_LoL, tier_count)
-
-                allocated_crops_in_LoL = readAllocated()
-
-
-
-            # customerInventoryAllocation
-            (inventory_allocation_out_LoL, inventory_demand_out_LoL) = customerInventoryAllocation(demand_allocation_date, inventory_out_LoL, tier_time_demand_in_LoL, facilities_LoL, inv_transfers_LoL,tier_count)
-
-            # writeCustomerInventoryAllocation
-            inventory_allocation_str = writeCustomerInventoryAllocation(demand_allocation_date,inventory_allocation_out_LoL, tier_count)
-            #print(inventory_allocation_str)
-
-            #customerHarvestAllocation
-            (harvest_allocation_out_LoL,allocated_crops_out_LoL, short_demand_out_LoL) = customerHarvestAllocation(demand_allocation_date, harvest_in_LoL, inventory_demand_out_LoL, facilities_LoL, allocated_crops_in_LoL, har_transfers_LoL, products_LoL, inventory_allocation_out_LoL, tier_count)
-            #print(len(short_demand_out_LoL[0]))
-            
-
-            # create list of list for roll harvest
-            haf_customer_id_list = harvest_allocation_out_LoL[6]
-
-            roll_indices = [i for i, x in enumerate(haf_customer_id_list) if x == 0]
-            roll_harvest_LoL = [[harvest_allocation_out_LoL[2][idx] for idx in roll_indices],
-                                [harvest_allocation_out_LoL[5][idx] for idx in roll_indices],
-                                [harvest_allocation_out_LoL[10][idx] for idx in roll_indices]]
-
-            # writeCustomerHarvestAllocation
-            harvest_allocation_str = writeCustomerHarvestAllocation(demand_allocation_date,harvest_allocation_out_LoL, tier_count)
-            #print(harvest_allocation_str) 
-            
-            # prior day harvest allocation
-            (harvest_allocation_prior_LoL,allocated_crops_out2_LoL, short_demand_out2_LoL) = priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_out_LoL, facilities_LoL, allocated_crops_out_LoL, products_LoL)
-            harvest_allocation_str = writeCustomerHarvestAllocation(demand_allocation_date,harvest_allocation_prior_LoL, tier_count)
-
-            # track mid-allocation harvest
-            write_allocated_str = writeAllocated(allocated_crops_out2_LoL, tier_count)
-
-            #writecustomerShortDemand
-            short_demand_str = writeCustomerShortDemand(demand_allocation_date, short_demand_out2_LoL)
-            #print(short_demand_str)
-
-            ###
-
-    # second pass allocations of remaining demand (100% - fill goal %)
-    for fill_goal in sorted_distinct_fill_goal_list[1:]:
-
-        tier_indices = [i for i, x in enumerate(df_fill_goal_list) if x == fill_goal]
-        ####
-        tier_count += 1
-        print('Tier ', tier_count, 'fill goal:', fill_goal, 'second pass fill goal:', round(float(1- fill_goal),2), "- %s seconds-" % (time.time() - start_time))
-
-        # 2. time - loop dates starting from the next demand allocation date
-        for demand_allocation_date_idx in range(len(distinct_demand_allocation_date_list)):
-
-            # set last allocation date
-            last_allocation_date = demand_allocation_date
-            # set demand allocation date
-            demand_allocation_date = distinct_demand_allocation_date_list[demand_allocation_date_idx]
-
-            time_indices = [i for i, x in enumerate(df_demand_allocation_date_list) if x == demand_allocation_date]
-            tier_time_indices = list(set(tier_indices) & set(time_indices))
-
-            # create list of list for customer tier and time demand
-
-            if demand_allocation_date != distinct_demand_allocation_date_list[0]:
-                last_tier_time_demand_in_LoL = tier_time_demand_in_LoL
-
-            tier_time_demand_in_LoL = [[demand_in_LoL[0][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[1][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[2][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[3][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[4][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[5][idx] - int(round((demand_in_LoL[5][idx] - demand_in_LoL[6][idx] - demand_in_LoL[7][idx]) * fill_goal)) - int(round(demand_in_LoL[6][idx]*fill_goal)) - int(round(demand_in_LoL[7][idx]*fill_goal)) for idx in tier_time_indices],
-                                        [demand_in_LoL[6][idx] - int(round(demand_in_LoL[6][idx]*fill_goal)) for idx in tier_time_indices],
-                                        [demand_in_LoL[7][idx] - int(round(demand_in_LoL[7][idx]*fill_goal)) for idx in tier_time_indices]
-                                      ]
-
-            inventory_in_date = last_allocation_date    
-
-            inventory_in_LoL = inventoryRollover(inventory_in_date,products_LoL, demand_allocation_date)
-
-            # inventory rollover from smooth quantities from last allocation date
-            inventory_in_LoL = smoothRollover(last_allocation_date, inventory_in_LoL, roll_harvest_LoL, products_LoL, demand_allocation_date)
-
-            # stop sell and add transfers in
-            (inventory_out_LoL, shelf_life_guarantee_out_LoL) = inventoryForecast(demand_allocation_date, inventory_in_LoL, products_LoL, transfers_LoL, tier_count)
-
-            # write stop sell on final tier Day 2+
-            if tier_count == final_tier and demand_allocation_date != distinct_demand_allocation_date_list[0]: 
-                shelf_life_guarantee_str = writeStopSell(demand_allocation_date,shelf_life_guarantee_out_LoL)
-            #print(shelf_life_guarantee_str)
-
-            allocated_crops_in_LoL = readAllocated()
-
-            # customerInventoryAllocation
-            (inventory_allocation_out_LoL, inventory_demand_out_LoL) = customerInventoryAllocation(demand_allocation_date, inventory_out_LoL, tier_time_demand_in_LoL, facilities_LoL,inv_transfers_LoL,tier_count)
-
-            # writeCustomerInventoryAllocation
-            inventory_allocation_str = writeCustomerInventoryAllocation(demand_allocation_date,inventory_allocation_out_LoL, tier_count)
-            #print(inventory_allocation_str)
-
-            #customerHarvestAllocation
-            (harvest_allocation_out_LoL,allocated_crops_out_LoL, short_demand_out_LoL) = customerHarvestAllocation(demand_allocation_date, harvest_in_LoL, inventory_demand_out_LoL, facilities_LoL, allocated_crops_in_LoL, har_transfers_LoL, products_LoL, inventory_allocation_out_LoL, tier_count)
-
-            # create list of list for roll harvest
-            haf_customer_id_list = harvest_allocation_out_LoL[6]
-
-            roll_indices = [i for i, x in enumerate(haf_customer_id_list) if x == 0]
-            roll_harvest_LoL = [[harvest_allocation_out_LoL[2][idx] for idx in roll_indices],
-                                [harvest_allocation_out_LoL[5][idx] for idx in roll_indices],
-                                [harvest_allocation_out_LoL[10][idx] for idx in roll_indices]]
-
-            # writeCustomerHarvestAllocation
-            harvest_allocation_str = writeCustomerHarvestAllocation(demand_allocation_date,harvest_allocation_out_LoL,tier_count)
-            #print(harvest_allocation_str)
-            
-            # prior day harvest allocation
-            (harvest_allocation_prior_LoL,allocated_crops_out2_LoL, short_demand_out2_LoL) = priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_out_LoL, facilities_LoL, allocated_crops_out_LoL, products_LoL)
-            harvest_allocation_str = writeCustomerHarvestAllocation(demand_allocation_date,harvest_allocation_prior_LoL, tier_count)
-
-            # track mid-allocation harvest
-            write_allocated_str = writeAllocated(allocated_crops_out2_LoL, tier_count)
-
-
-            #writecustomerShortDemand
-            short_demand_str = writeCustomerShortDemand(demand_allocation_date, short_demand_out2_LoL)
-            #print(short_demand_str)
-
-#             ###
-
-
-    #HarvestUnallocated_Facts
-
-
-    allocated_crops_in_LoL = readAllocated()
-    harvest_unallocated_str = writeHarvestUnallocated(harvest_in_LoL, allocated_crops_in_LoL, facilities_LoL)
-    #print(harvest_unallocated_str)
-
-
-
-    ###### Calculated Transfers
-    
-    
-        ######################################################################################
- 
-
-    # allocation tracking: crop level across all time and tier
-    allocated_date_crop_facility_key_list = list()
-    allocated_plant_sites_list = list()
-    complete_crop_allocation_key_list = list()
-    allocated_starting_ps_list = list()
-
-    # allocation_tracking: product level
-    allocated_date_product_facility_key_list = list()
-    allocated_gpps_list = list()
-    allocated_qty_list = list()
-    allocated_product_plant_sites_list = list()
-    complete_product_allocation_key_list = list()
-
-    # allocation tracking: customer level
-    complete_customer_allocation_key_list = list()
-
-    # initialize allocation tracking
-
-    #initialize lists for HarvestUnallocatedPending_Facts
-
-    allocated_crops_in_LoL =  [allocated_date_crop_facility_key_list, allocated_starting_ps_list, allocated_plant_sites_list, complete_crop_allocation_key_list]
-
-
-    # initialize lists for short demand
-    new_sdf_demand_date_list = list()
-    new_sdf_demand_allocation_date_list = list()
-    new_sdf_demand_facility_id_list = list()
-    new_sdf_product_id_list = list()
-    new_sdf_customer_id_list = list()
-    new_sdf_short_demand_qty_list = list()
-    new_sdf_production_priority_list = list()
-
-    sdf_idx_to_skip_list = list()
-
-
     calendar_LoL = [cald_date_day_list,
             cald_year_number_list,
             cald_week_of_year_list,
@@ -7139,6 +7487,15 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
             tcf_ship_duration_days_list,
             tcf_max_pallet_capacity_list,
             tcf_gfoods_transfer_list]
+
+    # transfer routes for every demand allocation date, computed once for the pending branch
+    route_calendar = RouteCalendar(transfer_constraints_LoL, calendar_LoL, distinct_demand_allocation_date_list)
+
+    # scheduled transfers by arrival date, computed once for inventoryForecast
+    transfer_arrival_dict = transfersByArrivalDate(transfers_LoL)
+
+    # harvest totals and grams per plant site by date/crop/city, computed once for the harvest allocations
+    harvest_cube = HarvestCube(harvest_in_LoL, facilities_LoL, facility_topology)
     
     # initialize lists for calculated transfers
     calc_ship_date_list = list()
@@ -7166,56 +7523,124 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
         calc_transfer_pallets_list,
         calc_truck_count_list
         ]
-    
-    # initialize first date 
-    demand_allocation_date = distinct_demand_allocation_date_list[0] 
 
-    # write output to pending tables
-    is_pending = 1
+    # demand indices by customer tier (fill goal %) and by demand allocation date
+    tier_indices_dict = dict()
+    for df_idx in range(len(df_fill_goal_list)):
+        if df_fill_goal_list[df_idx] in tier_indices_dict:
+            tier_indices_dict[df_fill_goal_list[df_idx]] += [df_idx]
+        else:
+            tier_indices_dict[df_fill_goal_list[df_idx]] = [df_idx]
 
-    # main loop for calculated transfers
-    # 1. customer tier
-    # 2. time
-    # order for each tier-timestep combination
-    #    a. Inventory Rollover
-    #    b. Inventory to Customer Allocation
-    #    c. Harvest to Customer Allocation
-    #    d. Prior Day Harvest to Customer Allocation
-    #    e. Harvest to Customer Calculated Transfers
+    time_indices_dict = dict()
+    for df_idx in range(len(df_demand_allocation_date_list)):
+        if df_demand_allocation_date_list[df_idx] in time_indices_dict:
+            time_indices_dict[df_demand_allocation_date_list[df_idx]] += [df_idx]
+        else:
+            time_indices_dict[df_demand_allocation_date_list[df_idx]] = [df_idx]
 
+    # run inputs of the allocation loop and the functions it calls
+    run_input_name_list = ['calendar_LoL', 'demand_in_LoL', 'distinct_demand_allocation_date_list', 'facilities_LoL', 'facility_topology',
+                           'har_transfers_LoL', 'harvest_cube', 'harvest_in_LoL', 'inv_transfers_LoL', 'products_LoL', 'route_calendar',
+                           'sorted_distinct_fill_goal_list', 'starting_inventory_in', 'tier_indices_dict', 'time_indices_dict',
+                           'transfer_arrival_dict', 'transfer_constraints_LoL', 'transfers_LoL', 'calc_transfers_LoL',
+                           'date_today', 'pd_product_id_list', 'pd_lead_time_in_days_list', 'pd_production_priority_list', 'parquet_load_date']
+    # a resumed run keeps writing to the Parquet partition of this run
+    parquet_load_date = None
+    if parquet_sink is not None:
+        parquet_load_date = parquet_sink.load_date
+    run_input_dict = {name: globals()[name] for name in run_input_name_list}
+    allocation_checkpoint.saveInputs(run_input_dict)
 
+    allocation_run_status = 1
 
 
-    tier_count = 0
-    final_tier = (len(sorted_distinct_fill_goal_list) * 2) - 1
-    # first pass allocations up to fill goal %
-    # 1. customer tier
-    for fill_goal in sorted_distinct_fill_goal_list:
-        # customer tier indices for demand
-        tier_indices = [i for i, x in enumerate(df_fill_goal_list) if x == fill_goal]
+# In[6]:
 
 
-        ####
+if resume_inputs is not None:
+    # restore the run inputs of the failed run
+    import numpy as np
+    globals().update(resume_inputs)
+    allocation_run_status = 1
+
+    # continue the Parquet partition of the failed run
+    if parquet_sink is not None and resume_inputs.get('parquet_load_date') is not None:
+        parquet_sink = GothamFunctions.ParquetSink(run_args.parquet_dir, resume_inputs['parquet_load_date'])
+
+if allocation_run_status == 1:
+
+    # connect to database for checkpoints (last IDs of the output tables)
+    HOSTNAME = socket.gethostname()
+
+    if HOSTNAME == 'hostname':
+        CONNECTIONSTRING = """Driver={ODBC Driver 17 for SQL Server}; 
+                                Server=127.0.0.1,1443;
+                                Database=databasename;
+                                trusted_connection=yes""" # use windows auth on DB01
+    else:
+        with open(os.path.join(sys.path[0], "config.yml"), 'r') as ymlfile:
+            cfg = yaml.load(ymlfile, Loader=yaml.SafeLoader)
+    #    uid = cfg['databasename']['uid']
+        uid = 'sa'
+        pwd = cfg['databasename']['pwd'][:-3]
+        CONNECTIONSTRING = """Driver={ODBC Driver 17 for SQL Server};
+                                Server=hostname\MSSQLSERVER1;
+                                Database=databasename;
+                                UID=%s;
+                                PWD=%s;""" % (uid, pwd) # use config.yml on local machine
+
+    # allocation steps (tier_count, fill_goal, is_second_pass, demand_allocation_date_idx)
+    # 1. customer tier: first pass allocations up to fill goal %, then second pass allocations of remaining demand (100% - fill goal %)
+    # 2. time: demand allocation dates
+    allocation_step_list = list()
+    tier_count = 0
+    for fill_goal in sorted_distinct_fill_goal_list:
+        tier_count += 1
+        for demand_allocation_date_idx in range(len(distinct_demand_allocation_date_list)):
+            allocation_step_list += [(tier_count, fill_goal, 0, demand_allocation_date_idx)]
+    for fill_goal in sorted_distinct_fill_goal_list[1:]:
         tier_count += 1
-        print('Tier ', tier_count, 'fill goal:', fill_goal, "- %s seconds-" % (time.time() - start_time))
-        # 2. time - loop dates starting from the next demand allocation date
         for demand_allocation_date_idx in range(len(distinct_demand_allocation_date_list)):
+            allocation_step_list += [(tier_count, fill_goal, 1, demand_allocation_date_idx)]
 
-            # set last allocation date
-            last_allocation_date = demand_allocation_date
-            # set demand allocation date
-            demand_allocation_date = distinct_demand_allocation_date_list[demand_allocation_date_idx]
+    final_tier = (len(sorted_distinct_fill_goal_list) * 2) - 1
+
+
+    def sharedAllocationStages(allocation_step, branch_state, is_pending):
+        '''
+        #### Inputs:
+            - allocation_step: (tier_count, fill_goal, is_second_pass, demand_allocation_date_idx)
+            - branch_state: demand allocation date and roll harvest of the previous step of the branch
+            - is_pending: 0 reads baseline tables, 1 reads pending tables
 
-            time_indices = [i for i, x in enumerate(df_demand_allocation_date_list) if x == demand_allocation_date]
-            tier_time_indices = list(set(tier_indices) & set(time_indices))
+        #### Algorithm: stages shared by the baseline and pending allocations
+            a. Inventory Rollover
+            b. Inventory to Customer Allocation
+            c. Harvest to Customer Allocation
+            d. Prior Day Harvest to Customer Allocation
+            (b-d in cityAllocationStages, per city in city_pool if city_parallel_status == 1)
 
+        #### Output: stage_dict of stage outputs for the allocation step
+        '''
+        (tier_count, fill_goal, is_second_pass, demand_allocation_date_idx) = allocation_step
 
-            # create list of list for customer tier and time demand
+        if demand_allocation_date_idx == 0:
+            if is_second_pass == 0:
+                print('Tier ', tier_count, 'fill goal:', fill_goal, "- %s seconds-" % (time.time() - start_time))
+            else:
+                print('Tier ', tier_count, 'fill goal:', fill_goal, 'second pass fill goal:', round(float(1- fill_goal),2), "- %s seconds-" % (time.time() - start_time))
 
-            if demand_allocation_date != distinct_demand_allocation_date_list[0]:
-                last_tier_time_demand_in_LoL = tier_time_demand_in_LoL
+        # set last allocation date and demand allocation date
+        last_allocation_date = branch_state['demand_allocation_date']
+        demand_allocation_date = distinct_demand_allocation_date_list[demand_allocation_date_idx]
 
+        tier_indices = tier_indices_dict.get(fill_goal, [])
+        time_indices = time_indices_dict.get(demand_allocation_date, [])
+        tier_time_indices = list(set(tier_indices) & set(time_indices))
 
+        # create list of list for customer tier and time demand
+        if is_second_pass == 0:
             tier_time_demand_in_LoL = [[demand_in_LoL[0][idx] for idx in tier_time_indices],
                                         [demand_in_LoL[1][idx] for idx in tier_time_indices],
                                         [demand_in_LoL[2][idx] for idx in tier_time_indices],
@@ -7225,173 +7650,289 @@ if debug_status == 1 or (check_for_new_inventory == 1 and run_status == 0):
                                         [int(round(demand_in_LoL[6][idx]*fill_goal)) for idx in tier_time_indices],
                                         [int(round(demand_in_LoL[7][idx]*fill_goal)) for idx in tier_time_indices]
                                       ]
+        else:
+            tier_time_demand_in_LoL = [[demand_in_LoL[0][idx] for idx in tier_time_indices],
+                                        [demand_in_LoL[1][idx] for idx in tier_time_indices],
+                                        [demand_in_LoL[2][idx] for idx in tier_time_indices],
+                                        [demand_in_LoL[3][idx] for idx in tier_time_indices],
+                                        [demand_in_LoL[4][idx] for idx in tier_time_indices],
+                                        [demand_in_LoL[5][idx] - int(round((demand_in_LoL[5][idx] - demand_in_LoL[6][idx] - demand_in_LoL[7][idx]) * fill_goal)) - int(round(demand_in_LoL[6][idx]*fill_goal)) - int(round(demand_in_LoL[7][idx]*fill_goal)) for idx in tier_time_indices],
+                                        [demand_in_LoL[6][idx] - int(round(demand_in_LoL[6][idx]*fill_goal)) for idx in tier_time_indices],
+                                        [demand_in_LoL[7][idx] - int(round(demand_in_LoL[7][idx]*fill_goal)) for idx in tier_time_indices]
+                                      ]
 
-            # inventory for Day 1 Tier 1
-            if demand_allocation_date == distinct_demand_allocation_date_list[0] and tier_count == 1:
-                # Compressed clean clean inventory facts (cccif) after aggregating
-                inventory_out_LoL = starting_inventory_in
+        shelf_life_guarantee_out_LoL = None
+        if demand_allocation_date_idx == 0 and tier_count == 1:
+            # inventory for Day 1 Tier 1: compressed clean clean inventory facts (cccif) after aggregating
+            inventory_out_LoL = starting_inventory_in
+            allocation_tracker_in = AllocationTracker()
+        else:
+            # inventory rollover Tier 2+ Day 1 or Day 2+ reads the writes of the previous step
+            background_writer.flush()
+            inventory_in_LoL = inventoryRollover(last_allocation_date, products_LoL, demand_allocation_date, is_pending)
 
+            # inventory rollover from smooth quantities from last allocation date
+            inventory_in_LoL = smoothRollover(last_allocation_date, inventory_in_LoL, branch_state['roll_harvest_LoL'], products_LoL, demand_allocation_date)
 
-            # inventory rollover Tier 2+ Day 1 or Day 2+
-            if (demand_allocation_date == distinct_demand_allocation_date_list[0] and tier_count > 1) or demand_allocation_date != distinct_demand_allocation_date_list[0]:
+            # stop sell and add transfers in
+            (inventory_out_LoL, shelf_life_guarantee_out_LoL) = inventoryForecast(demand_allocation_date, inventory_in_LoL, products_LoL, transfers_LoL, tier_count, transfer_arrival_dict)
 
-                inventory_in_date = last_allocation_date    
-                inventory_in_LoL = inventoryRollover(inventory_in_date,products_LoL, demand_allocation_date, is_pending)
-                #inventory_in_LoL = inventoryRolloverPending(inventory_in_date,products_LoL, demand_allocation_date)
+            allocation_tracker_in = readAllocated()
 
-                inventory_in_LoL = smoothRollover(last_allocation_date, inventory_in_LoL, roll_harvest_LoL, products_LoL, demand_allocation_date)
+        # inventory, harvest, and prior day harvest allocation (per city in the process pool if city_parallel_status == 1)
+        if city_pool is None:
+            stage_tuple = cityAllocationStages(demand_allocation_date, tier_count, inventory_out_LoL, tier_time_demand_in_LoL, allocation_tracker_in, inv_transfers_LoL, har_transfers_LoL, facilities_LoL, harvest_in_LoL, products_LoL, harvest_cube, facility_topology)
+        else:
+            stage_tuple = city_pool.run(demand_allocation_date, tier_count, inventory_out_LoL, tier_time_demand_in_LoL, allocation_tracker_in)
+            if city_parallel_validation_status == 1:
+                serial_stage_tuple = cityAllocationStages(demand_allocation_date, tier_count, inventory_out_LoL, tier_time_demand_in_LoL, allocation_tracker_in, inv_transfers_LoL, har_transfers_LoL, facilities_LoL, harvest_in_LoL, products_LoL, harvest_cube, facility_topology)
+                mismatch_list = city_pool.validate(stage_tuple, serial_stage_tuple)
+                if len(mismatch_list) > 0:
+                    print('WARNING: city parallel allocation differs from serial for', demand_allocation_date, 'tier', tier_count, ':', mismatch_list)
+                    stage_tuple = serial_stage_tuple
 
-                # stop sell and add transfers in
-                (inventory_out_LoL, shelf_life_guarantee_out_LoL) = inventoryForecast(demand_allocation_date, inventory_in_LoL, products_LoL, transfers_LoL, tier_count)
+        (inventory_allocation_out_LoL, harvest_allocation_out_LoL, harvest_allocation_prior_LoL, allocation_tracker_out2, short_demand_out2_LoL) = stage_tuple
 
-                allocated_crops_in_LoL = readAllocated()
+        # create list of list for roll harvest
+        haf_customer_id_list = harvest_allocation_out_LoL[6]
 
-            # customerInventoryAllocation
-            (inventory_allocation_out_LoL, inventory_demand_out_LoL) = customerInventoryAllocation(demand_allocation_date, inventory_out_LoL, tier_time_demand_in_LoL, facilities_LoL,inv_transfers_LoL,tier_count)
+        roll_indices = [i for i, x in enumerate(haf_customer_id_list) if x == 0]
+        roll_harvest_LoL = [[harvest_allocation_out_LoL[2][idx] for idx in roll_indices],
+                            [harvest_allocation_out_LoL[5][idx] for idx in roll_indices],
+                            [harvest_allocation_out_LoL[10][idx] for idx in roll_indices]]
 
-            # writeCustomerInventoryAllocation
-            inventory_allocation_str = writeCustomerInventoryAllocation(demand_allocation_date,inventory_allocation_out_LoL, tier_count, is_pending)
-            #print(inventory_allocation_str)
+        stage_dict = {'allocation_step': allocation_step,
+                      'demand_allocation_date': demand_allocation_date,
+                      'shelf_life_guarantee_out_LoL': shelf_life_guarantee_out_LoL,
+                      'inventory_allocation_out_LoL': inventory_allocation_out_LoL,
+                      'harvest_allocation_out_LoL': harvest_allocation_out_LoL,
+                      'roll_harvest_LoL': roll_harvest_LoL,
+                      'harvest_allocation_prior_LoL': harvest_allocation_prior_LoL,
+                      'allocation_tracker_out2': allocation_tracker_out2,
+                      'short_demand_out2_LoL': short_demand_out2_LoL}
 
-            #customerHarvestAllocation
-            (harvest_allocation_out_LoL,allocated_crops_out_LoL, short_demand_out_LoL) = customerHarvestAllocation(demand_allocation_date, harvest_in_LoL, inventory_demand_out_LoL, facilities_LoL, allocated_crops_in_LoL, har_transfers_LoL, products_LoL, inventory_allocation_out_LoL, tier_count)
+        return stage_dict
 
-            # create list of list for roll harvest
-            haf_customer_id_list = harvest_allocation_out_LoL[6]
 
-            roll_indices = [i for i, x in enumerate(haf_customer_id_list) if x == 0]
-            roll_harvest_LoL = [[harvest_allocation_out_LoL[2][idx] for idx in roll_indices],
-                                [harvest_allocation_out_LoL[5][idx] for idx in roll_indices],
-                                [harvest_allocation_out_LoL[10][idx] for idx in roll_indices]]
+    def writeSharedStages(stage_dict, is_pending):
+        # write the shared stage outputs to the baseline (is_pending = 0) or pending (is_pending = 1) tables
+        (tier_count, fill_goal, is_second_pass, demand_allocation_date_idx) = stage_dict['allocation_step']
+        demand_allocation_date = stage_dict['demand_allocation_date']
 
-            # writeCustomerHarvestAllocation
-            harvest_allocation_str = writeCustomerHarvestAllocation(demand_allocation_date,harvest_allocation_out_LoL, tier_count, is_pending)
-            #print(harvest_allocation_str)    
-            #print(len(short_demand_out_LoL[0]))
-            
-            # prior day harvest allocation
-            (harvest_allocation_prior_LoL,allocated_crops_out2_LoL, short_demand_out2_LoL) = priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_out_LoL, facilities_LoL, allocated_crops_out_LoL, products_LoL)
-            harvest_allocation_str = writeCustomerHarvestAllocation(demand_allocation_date,harvest_allocation_prior_LoL, tier_count, is_pending)
+        # write stop sell on final tier Day 2+
+        if is_second_pass == 1 and tier_count == final_tier and demand_allocation_date_idx != 0:
+            background_writer.submit(writeStopSell, demand_allocation_date, stage_dict['shelf_life_guarantee_out_LoL'], is_pending, tier_count)
 
+        background_writer.submit(writeCustomerInventoryAllocation, demand_allocation_date, stage_dict['inventory_allocation_out_LoL'], tier_count, is_pending)
+        background_writer.submit(writeCustomerHarvestAllocation, demand_allocation_date, stage_dict['harvest_allocation_out_LoL'], tier_count, is_pending)
+        background_writer.submit(writeCustomerHarvestAllocation, demand_allocation_date, stage_dict['harvest_allocation_prior_LoL'], tier_count, is_pending)
 
-            # calculated transfers
-            (inventory_allocation_transfers_LoL,harvest_allocation_transfers_LoL, allocated_crops_out3_LoL, short_demand_out3_LoL,calc_transfers_LoL) = calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_out2_LoL, facilities_LoL, allocated_crops_out2_LoL, products_LoL, transfer_constraints_LoL, calendar_LoL, calc_transfers_LoL, inventory_allocation_out_LoL)
-            inventory_allocation_str = writeCustomerInventoryAllocation(demand_allocation_date,inventory_allocation_transfers_LoL, tier_count, is_pending)
-            harvest_allocation_str = writeCustomerHarvestAllocation(demand_allocation_date,harvest_allocation_transfers_LoL, tier_count, is_pending)
-            
 
-            # track mid-allocation harvest
-            write_allocated_str = writeAllocated(allocated_crops_out3_LoL, tier_count)
-            
-            #writecustomerShortDemand
-            short_demand_str = writeCustomerShortDemand(demand_allocation_date, short_demand_out3_LoL, is_pending)
-            #print(short_demand_str)
+    def pendingTransferStage(stage_dict, calc_transfers_LoL):
+        '''
+        #### Inputs: stage_dict from sharedAllocationStages and the calculated transfers so far
 
-            ###
+        #### Algorithm:
+            e. Harvest to Customer Calculated Transfers on copies of the shared stage tracking lists, written to the pending tables
 
-    # second pass allocations of remaining demand (100% - fill goal %)
-    for fill_goal in sorted_distinct_fill_goal_list[1:]:
+        #### Output: (allocation_tracker_out3, is_transfer_step)
+            - allocation_tracker_out3: AllocationTracker after calculated transfers (not written)
+            - is_transfer_step: True if the transfers changed the state the next step reads (fork point of the pending branch)
+        '''
+        (tier_count, fill_goal, is_second_pass, demand_allocation_date_idx) = stage_dict['allocation_step']
+        demand_allocation_date = stage_dict['demand_allocation_date']
+        calc_transfers_count = len(calc_transfers_LoL[0])
 
-        tier_indices = [i for i, x in enumerate(df_fill_goal_list) if x == fill_goal]
-        ####
-        tier_count += 1
-        print('Tier ', tier_count, 'fill goal:', fill_goal, 'second pass fill goal:', round(float(1- fill_goal),2), "- %s seconds-" % (time.time() - start_time))
+        # calculated transfers
+        (inventory_allocation_transfers_LoL,harvest_allocation_transfers_LoL, allocation_tracker_out3, short_demand_out3_LoL,calc_transfers_LoL) = calculateTransfers(demand_allocation_date, harvest_in_LoL, copy.deepcopy(stage_dict['short_demand_out2_LoL']), facilities_LoL, copy.deepcopy(stage_dict['allocation_tracker_out2']), products_LoL, transfer_constraints_LoL, calendar_LoL, calc_transfers_LoL, stage_dict['inventory_allocation_out_LoL'], route_calendar, harvest_cube)
+        background_writer.submit(writeCustomerInventoryAllocation, demand_allocation_date,inventory_allocation_transfers_LoL, tier_count, 1)
+        background_writer.submit(writeCustomerHarvestAllocation, demand_allocation_date,harvest_allocation_transfers_LoL, tier_count, 1)
 
-        # 2. time - loop dates starting from the next demand allocation date
-        for demand_allocation_date_idx in range(len(distinct_demand_allocation_date_list)):
-
-            # set last allocation date
-            last_allocation_date = demand_allocation_date
-            # set demand allocation date
-            demand_allocation_date = distinct_demand_allocation_date_list[demand_allocation_date_idx]
-
-            time_indices = [i for i, x in enumerate(df_demand_allocation_date_list) if x == demand_allocation_date]
-            tier_time_indices = list(set(tier_indices) & set(time_indices))
+        #writecustomerShortDemand
+        background_writer.submit(writeCustomerShortDemand, demand_allocation_date, short_demand_out3_LoL, 1, tier_count)
 
-            # create list of list for customer tier and time demand
+        is_transfer_step = (len(calc_transfers_LoL[0]) != calc_transfers_count
+                            or len(harvest_allocation_transfers_LoL[0]) > 0
+                            or allocation_tracker_out3 != stage_dict['allocation_tracker_out2'])
 
-            if demand_allocation_date != distinct_demand_allocation_date_list[0]:
-                last_tier_time_demand_in_LoL = tier_time_demand_in_LoL
+        return (allocation_tracker_out3, is_transfer_step)
 
-            tier_time_demand_in_LoL = [[demand_in_LoL[0][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[1][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[2][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[3][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[4][idx] for idx in tier_time_indices],
-                                        [demand_in_LoL[5][idx] - int(round((demand_in_LoL[5][idx] - demand_in_LoL[6][idx] - demand_in_LoL[7][idx]) * fill_goal)) - int(round(demand_in_LoL[6][idx]*fill_goal)) - int(round(demand_in_LoL[7][idx]*fill_goal)) for idx in tier_time_indices],
-                                        [demand_in_LoL[6][idx] - int(round(demand_in_LoL[6][idx]*fill_goal)) for idx in tier_time_indices],
-                                        [demand_in_LoL[7][idx] - int(round(demand_in_LoL[7][idx]*fill_goal)) for idx in tier_time_indices]
-                                      ]
 
-            inventory_in_date = last_allocation_date    
+    # main loop
+    # for each tier-timestep combination
+    #    a-d. shared stages (sharedAllocationStages), written to the baseline tables
+    #    e. Harvest to Customer Calculated Transfers (pendingTransferStage), written to the pending tables
+    #
+    # shared_prefix_status == 1: the shared stages run once per step for both the baseline and pending tables until the first
+    # step where calculated transfers change the state (fork point). The pending branch is snapshotted there and resumed from
+    # the fork point after the baseline finishes. shared_prefix_status == 0 runs the baseline and pending passes one after the other.
+
+    # database writes of the loop overlap with the next compute stage
+    background_writer = BackgroundWriter(CONNECTIONSTRING, async_status = async_write_status)
+
+    # per-city process pool for the inventory, harvest, and prior harvest allocations of each step
+    city_pool = None
+    if city_parallel_status == 1:
+        city_pool = CityPartitionPool(facility_topology, facilities_LoL, harvest_in_LoL, products_LoL, harvest_cube, inv_transfers_LoL, har_transfers_LoL,
+                                      pd_product_id_list, pd_production_priority_list, city_parallel_worker_count)
+
+    baseline_state = {'demand_allocation_date': distinct_demand_allocation_date_list[0], 'roll_harvest_LoL': None}
+    pending_fork = None
+    pending_state = None
+    is_shared = shared_prefix_status == 1
+
+    # checkpoint after every completed step: --resume continues with the next step
+    def saveStep(step_dict, cnxn = None):
+        # runs on the writer thread after the writes of the step, so the last IDs include every write of the step
+        step_dict['last_id_dict'] = allocation_checkpoint.lastIDs(CONNECTIONSTRING, cnxn)
+        step_dict['parquet_part_sequence'] = parquet_sink.part_sequence if parquet_sink is not None else 0
+        allocation_checkpoint.saveStep(step_dict)
+
+    def checkpointStep(phase, next_step_idx, allocation_tracker, allocated_tier_count):
+        # copy of the loop state, the next step updates calc_transfers_LoL in place while the writer saves
+        step_dict = copy.deepcopy({'phase': phase,
+                                   'next_step_idx': next_step_idx,
+                                   'baseline_state': baseline_state,
+                                   'pending_state': pending_state,
+                                   'pending_fork': pending_fork,
+                                   'is_shared': is_shared,
+                                   'calc_transfers_LoL': calc_transfers_LoL,
+                                   'allocation_tracker': allocation_tracker,
+                                   'allocated_tier_count': allocated_tier_count})
+        background_writer.submit(saveStep, step_dict)
+
+    resume_step = None
+    if resume_inputs is not None:
+        resume_step = allocation_checkpoint.loadStep()
+
+    checkpoint_phase = 'baseline'
+    baseline_first_step_idx = 0
+    if resume_step is None:
+        # first step: record the last IDs after change data capture
+        checkpointStep(checkpoint_phase, 0, None, 0)
+    else:
+        # delete the rows of the partially written step and restore the mid-allocation harvest of the last completed step
+        checkpoint_phase = resume_step['phase']
+        deleted_row_count = allocation_checkpoint.rollback(CONNECTIONSTRING, resume_step['last_id_dict'])
+        if parquet_sink is not None:
+            # part files written after the last completed step
+            deleted_part_count = parquet_sink.rollback(resume_step.get('parquet_part_sequence', 0))
+            print(deleted_part_count, 'partially written Parquet part files deleted')
+        baseline_state = resume_step['baseline_state']
+        pending_state = resume_step['pending_state']
+        pending_fork = resume_step['pending_fork']
+        is_shared = resume_step['is_shared']
+        calc_transfers_LoL = resume_step['calc_transfers_LoL']
+        if resume_step['allocation_tracker'] is not None:
+            write_allocated_str = writeAllocated(resume_step['allocation_tracker'], resume_step['allocated_tier_count'])
+        baseline_first_step_idx = len(allocation_step_list)
+        if checkpoint_phase == 'baseline':
+            baseline_first_step_idx = resume_step['next_step_idx']
+        print('Resuming', checkpoint_phase, 'allocation at step', resume_step['next_step_idx'], 'of', len(allocation_step_list), '-', deleted_row_count, 'partially written rows deleted')
+
+    for step_idx in range(baseline_first_step_idx, len(allocation_step_list)):
+        allocation_step = allocation_step_list[step_idx]
+        stage_dict = sharedAllocationStages(allocation_step, baseline_state, 0)
+
+        writeSharedStages(stage_dict, 0)
+        if is_shared:
+            writeSharedStages(stage_dict, 1)
+
+        # track mid-allocation harvest
+        background_writer.submit(writeAllocated, stage_dict['allocation_tracker_out2'], allocation_step[0])
+
+        #writecustomerShortDemand
+        background_writer.submit(writeCustomerShortDemand, stage_dict['demand_allocation_date'], stage_dict['short_demand_out2_LoL'], 0, allocation_step[0])
+
+        if is_shared:
+            (allocation_tracker_out3, is_transfer_step) = pendingTransferStage(stage_dict, calc_transfers_LoL)
+            if is_transfer_step:
+                # fork point: snapshot the pending branch and continue the baseline alone
+                pending_fork = {'step_idx': step_idx + 1,
+                                'tier_count': allocation_step[0],
+                                'demand_allocation_date': stage_dict['demand_allocation_date'],
+                                'roll_harvest_LoL': stage_dict['roll_harvest_LoL'],
+                                'allocation_tracker_out3': allocation_tracker_out3}
+                is_shared = False
+                print('Pending fork point:', stage_dict['demand_allocation_date'], 'tier', allocation_step[0])
+
+        baseline_state = {'demand_allocation_date': stage_dict['demand_allocation_date'], 'roll_harvest_LoL': stage_dict['roll_harvest_LoL']}
+
+        checkpointStep(checkpoint_phase, step_idx + 1, stage_dict['allocation_tracker_out2'], allocation_step[0])
 
-            inventory_in_LoL = inventoryRollover(inventory_in_date,products_LoL, demand_allocation_date, is_pending)
 
-            # inventory rollover from smooth quantities from last allocation date
-            inventory_in_LoL = smoothRollover(last_allocation_date, inventory_in_LoL, roll_harvest_LoL, products_LoL, demand_allocation_date)
+    ###### Calculated Transfers
 
-            # stop sell and add transfers in
-            (inventory_out_LoL, shelf_life_guarantee_out_LoL) = inventoryForecast(demand_allocation_date, inventory_in_LoL, products_LoL, transfers_LoL, tier_count)
+    # write output to pending tables
+    is_pending = 1
 
-            # write stop sell on final tier Day 2+
-            if tier_count == final_tier and demand_allocation_date != distinct_demand_allocation_date_list[0]: 
-                shelf_life_guarantee_str = writeStopSell(demand_allocation_date,shelf_life_guarantee_out_LoL, is_pending)
-            #print(shelf_life_guarantee_str)
+    pending_first_step_idx = len(allocation_step_list)
+    if checkpoint_phase == 'baseline':
 
-            allocated_crops_in_LoL = readAllocated()
+        #HarvestUnallocated_Facts
 
-            # customerInventoryAllocation
-            (inventory_allocation_out_LoL, inventory_demand_out_LoL) = customerInventoryAllocation(demand_allocation_date, inventory_out_LoL, tier_time_demand_in_LoL, facilities_LoL,inv_transfers_LoL,tier_count)
+        background_writer.flush()
+        allocation_tracker_in = readAllocated()
+        background_writer.submit(writeHarvestUnallocated, harvest_in_LoL, allocation_tracker_in, facilities_LoL, harvest_cube = harvest_cube, facility_topology = facility_topology)
+        #print(harvest_unallocated_str)
 
-            # writeCustomerInventoryAllocation
-            inventory_allocation_str = writeCustomerInventoryAllocation(demand_allocation_date,inventory_allocation_out_LoL, tier_count, is_pending)
-            #print(inventory_allocation_str)
+        if shared_prefix_status == 0:
+            # pending branch from the first step
+            pending_fork = {'step_idx': 0,
+                            'tier_count': 1,
+                            'demand_allocation_date': distinct_demand_allocation_date_list[0],
+                            'roll_harvest_LoL': None,
+                            'allocation_tracker_out3': None}
 
-            #customerHarvestAllocation
-            (harvest_allocation_out_LoL,allocated_crops_out_LoL, short_demand_out_LoL) = customerHarvestAllocation(demand_allocation_date, harvest_in_LoL, inventory_demand_out_LoL, facilities_LoL, allocated_crops_in_LoL, har_transfers_LoL, products_LoL, inventory_allocation_out_LoL, tier_count)
+        pending_tracker = None
+        if pending_fork is not None:
+            # restore the pending branch mid-allocation harvest at the fork point
+            pending_tracker = pending_fork['allocation_tracker_out3']
+            if pending_tracker is not None:
+                background_writer.submit(writeAllocated, pending_tracker, pending_fork['tier_count'])
 
-            # create list of list for roll harvest
-            haf_customer_id_list = harvest_allocation_out_LoL[6]
+            pending_state = {'demand_allocation_date': pending_fork['demand_allocation_date'], 'roll_harvest_LoL': pending_fork['roll_harvest_LoL']}
+            pending_first_step_idx = pending_fork['step_idx']
 
-            roll_indices = [i for i, x in enumerate(haf_customer_id_list) if x == 0]
-            roll_harvest_LoL = [[harvest_allocation_out_LoL[2][idx] for idx in roll_indices],
-                                [harvest_allocation_out_LoL[5][idx] for idx in roll_indices],
-                                [harvest_allocation_out_LoL[10][idx] for idx in roll_indices]]
+        checkpoint_phase = 'pending'
+        checkpointStep(checkpoint_phase, pending_first_step_idx, pending_tracker, pending_fork['tier_count'] if pending_fork is not None else 0)
 
-            # writeCustomerHarvestAllocation
-            harvest_allocation_str = writeCustomerHarvestAllocation(demand_allocation_date,harvest_allocation_out_LoL,tier_count, is_pending)
-            #print(harvest_allocation_str)
+    elif checkpoint_phase == 'pending':
+        pending_first_step_idx = resume_step['next_step_idx']
 
-            # prior day harvest allocation
-            (harvest_allocation_prior_LoL,allocated_crops_out2_LoL, short_demand_out2_LoL) = priorHarvestAllocation(demand_allocation_date, harvest_in_LoL, short_demand_out_LoL, facilities_LoL, allocated_crops_out_LoL, products_LoL)
-            harvest_allocation_str = writeCustomerHarvestAllocation(demand_allocation_date,harvest_allocation_prior_LoL, tier_count, is_pending)
+    for step_idx in range(pending_first_step_idx, len(allocation_step_list)):
+        allocation_step = allocation_step_list[step_idx]
+        stage_dict = sharedAllocationStages(allocation_step, pending_state, is_pending)
+        writeSharedStages(stage_dict, is_pending)
 
+        (allocation_tracker_out3, is_transfer_step) = pendingTransferStage(stage_dict, calc_transfers_LoL)
 
-            # calculated transfers
-            (inventory_allocation_transfers_LoL,harvest_allocation_transfers_LoL, allocated_crops_out3_LoL, short_demand_out3_LoL,calc_transfers_LoL) = calculateTransfers(demand_allocation_date, harvest_in_LoL, short_demand_out2_LoL, facilities_LoL, allocated_crops_out2_LoL, products_LoL, transfer_constraints_LoL, calendar_LoL, calc_transfers_LoL, inventory_allocation_out_LoL)
-            inventory_allocation_str = writeCustomerInventoryAllocation(demand_allocation_date,inventory_allocation_transfers_LoL, tier_count, is_pending)
-            harvest_allocation_str = writeCustomerHarvestAllocation(demand_allocation_date,harvest_allocation_transfers_LoL, tier_count, is_pending)
-            
-            # track mid-allocation harvest
-            write_allocated_str = writeAllocated(allocated_crops_out3_LoL, tier_count)
+        # track mid-allocation harvest
+        background_writer.submit(writeAllocated, allocation_tracker_out3, allocation_step[0])
 
-            short_demand_str = writeCustomerShortDemand(demand_allocation_date, short_demand_out3_LoL, is_pending)
-            #print(short_demand_str)
+        pending_state = {'demand_allocation_date': stage_dict['demand_allocation_date'], 'roll_harvest_LoL': stage_dict['roll_harvest_LoL']}
 
-            ###
+        checkpointStep(checkpoint_phase, step_idx + 1, allocation_tracker_out3, allocation_step[0])
 
 
     #HarvestUnallocated_Facts
 
-    allocated_crops_in_LoL = readAllocated()
-    harvest_unallocated_str = writeHarvestUnallocated(harvest_in_LoL, allocated_crops_in_LoL, facilities_LoL, is_pending)
+    background_writer.flush()
+    allocation_tracker_in = readAllocated()
+    background_writer.submit(writeHarvestUnallocated, harvest_in_LoL, allocation_tracker_in, facilities_LoL, is_pending, harvest_cube, facility_topology)
     #print(harvest_unallocated_str)
     
     # CalculatedTransfers_Facts
     
-    calc_transfer_str = writeCalculatedTransfers(calc_transfers_LoL)
+    background_writer.submit(writeCalculatedTransfers, calc_transfers_LoL)
 
-    
+    # wait for the last writes before the run is complete
+    background_writer.close()
+    if city_pool is not None:
+        city_pool.close()
+
+    # completed run, nothing to resume
+    allocation_checkpoint.clear()
     
     print('pau')
 
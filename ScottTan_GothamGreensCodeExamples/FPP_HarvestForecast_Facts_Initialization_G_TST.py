@@ -44,18 +44,19 @@
 #         ToDate DATETIME: to date in HarvestForecast_Facts
 #         IsActive INT: active tag in HarvestForecast_Facts
 
-import numpy as np
+import argparse
 import pyodbc
 import datetime as DT
 from datetime import date
 from datetime import datetime
 import yaml
-import os
-import copy
-import re
-import pandas as pd
 import GothamFunctions
 
+# command line options (unknown arguments, e.g. from a notebook kernel, are ignored)
+run_parser = argparse.ArgumentParser(description = 'HarvestForecast_Facts')
+run_parser.add_argument('--parquet-dir', default = None, help = 'also write the HarvestForecast_Facts rows as a Parquet dataset partitioned by load date')
+(run_args, unknown_run_args) = run_parser.parse_known_args()
+
 print('functions loaded')
 
 
@@ -81,7 +82,8 @@ cnxn_cursor = cnxn.cursor()
 ###########################################################################################
 
 # DIMENSIONS
-        
+# slow changing dimensions are read from the local snapshot unless the TTL expired or the row count/checksum changed
+dimension_cache = GothamFunctions.DimensionCache(cnxn_cursor)
             
 # pull from Crop_Dim
 crop_id_list = list()
@@ -89,59 +91,34 @@ sage_crop_code_list = list()
 crop_description_list = list()
 default_generic_item_number_list = list()
 sql = "SELECT CropID, SageCropCode, CropDescription, DefaultGenericItemNumber FROM Crop_Dim ORDER BY CropID"
-cnxn_cursor.execute(sql) 
-row = cnxn_cursor.fetchone()
 
-crop_id_list += [row[0]]
-sage_crop_code_list += [row[1]]
-crop_description_list += [row[2]]
-default_generic_item_number_list += [row[3]]
-
-while row is not None:
-    row = cnxn_cursor.fetchone()
-    if row is not None:
-        crop_id_list += [row[0]]
-        sage_crop_code_list += [row[1]]
-        crop_description_list += [row[2]]
-        default_generic_item_number_list += [row[3]]
+for row in dimension_cache.rows('Crop_Dim', sql):
+    crop_id_list += [row[0]]
+    sage_crop_code_list += [row[1]]
+    crop_description_list += [row[2]]
+    default_generic_item_number_list += [row[3]]
 
 # pull from Facilities_Dim
 facility_list = list()
 location_name_list = list()
 region_list = list()
 sql = "SELECT FacilityID, LocationName,Region FROM Facilities_Dim"
-cnxn_cursor.execute(sql) 
-row = cnxn_cursor.fetchone()
 
-facility_list += [row[0]]
-location_name_str = row[1].rstrip()
-location_name_list += [location_name_str]
-region_list += [row[2]]
-
-while row is not None:
-    row = cnxn_cursor.fetchone()
-    if row is not None:
-        facility_list += [row[0]]        
-        location_name_str = row[1].rstrip()
-        location_name_list += [location_name_str]     
-        region_list += [row[2]]    
+for row in dimension_cache.rows('Facilities_Dim', sql):
+    facility_list += [row[0]]        
+    location_name_str = row[1].rstrip()
+    location_name_list += [location_name_str]     
+    region_list += [row[2]]    
         
 
 # pull from FacilityLine_Dim
 fld_facility_line_id_list = list()
 fld_facility_line_list = list()
 sql = "SELECT FacilityLineID, FacilityLine FROM FacilityLine_Dim"
-cnxn_cursor.execute(sql) 
-row = cnxn_cursor.fetchone()
 
-fld_facility_line_id_list += [row[0]]
-fld_facility_line_list += [row[1]]
-
-while row is not None:
-    row = cnxn_cursor.fetchone()
-    if row is not None:
-        fld_facility_line_id_list += [row[0]]
-        fld_facility_line_list += [row[1]]  
+for row in dimension_cache.rows('FacilityLine_Dim', sql):
+    fld_facility_line_id_list += [row[0]]
+    fld_facility_line_list += [row[1]]  
 
 
 print('Crop_Dim, Facilities_Dim, FacilityLine_Dim loaded')   
@@ -727,6 +704,12 @@ load_date_to_write = DT.datetime.now()
 to_date_to_write = DT.datetime.strptime('2099-12-31 00:00:00.000000', '%Y-%m-%d %H:%M:%S.%f')
 is_active_to_write = 1
 
+# facility, city, and national fallback tables for missing entries (updated when a '0000_00' entry is appended)
+avg_headweight_table = GothamFunctions.cropAveragesTable(avg_headweight_dict)
+pspc_table = GothamFunctions.cropAveragesTable(pspc_dict)
+
+# new rows for the Parquet export
+parquet_row_list = list()
 
 # loop through expected plant sites and write new entries
 for date_tomorrow_idx in range(len(list(expected_ps_dict.keys()))-1):
@@ -802,8 +785,8 @@ for date_tomorrow_idx in range(len(list(expected_ps_dict.keys()))-1):
                 loose_spatial_precision_to_write = 0
             # compute at lower spatial precision if expected biomass is zero
             if expected_whole_grams_to_write == 0:
-                # use cropAverages to compute predictions for any missing entries
-                crop_averages_list = GothamFunctions.cropAverages(avg_headweight_dict,active_line,ps_active_line_crop_id_list[idx])
+                # use the cropAverages fallback table to compute predictions for any missing entries
+                crop_averages_list = GothamFunctions.cropAveragesLookup(avg_headweight_table,active_line,ps_active_line_crop_id_list[idx])
                 idx_to_try = 0
                 while idx_to_try < 3 and expected_whole_grams_to_write == 0:
                     conversion_factor = crop_averages_list[idx_to_try]
@@ -820,22 +803,7 @@ for date_tomorrow_idx in range(len(list(expected_ps_dict.keys()))-1):
                         # add entry to avg_headweight_dict
                         # new_avg_headweight_dict[facility_line_to_write] = {crop_id_to_write:{'0000_00':conversion_factor}}
                         
-                        avg_headweight_value = conversion_factor
-                        facility_line = facility_line_to_write
-                        crop_id = crop_id_to_write
-                        year_week = '0000_00'
-                        if facility_line in avg_headweight_dict.keys():
-                            facility_line_dictionary_value = avg_headweight_dict[facility_line]
-                            if crop_id in facility_line_dictionary_value.keys():
-                                crop_id_dictionary_value = avg_headweight_dict[facility_line][crop_id]
-                                if year_week in crop_id_dictionary_value.keys():
-                                    avg_headweight_dict[facility_line][crop_id][year_week] += [avg_headweight_value]
-                                else:
-                                    avg_headweight_dict[facility_line][crop_id][year_week] = [avg_headweight_value]
-                            else:
-                                avg_headweight_dict[facility_line][crop_id] = {year_week:[avg_headweight_value]}
-                        else:
-                            avg_headweight_dict[facility_line] = {crop_id:{year_week:[avg_headweight_value]}}
+                        GothamFunctions.cropAveragesAppend(avg_headweight_table, avg_headweight_dict, facility_line_to_write, crop_id_to_write, conversion_factor)
                         
                         # add value to expected_whole_plant_biomass_dict
                         # new_expected_whole_plant_biomass_dict[date_tomorrow][facility_line_to_write] = {crop_id_to_write:[expected_whole_grams_to_write]}
@@ -859,7 +827,7 @@ for date_tomorrow_idx in range(len(list(expected_ps_dict.keys()))-1):
                         idx_to_try = 3
                     idx_to_try += 1
             if expected_loose_grams_to_write == 0:
-                crop_averages_list = GothamFunctions.cropAverages(pspc_dict,active_line,ps_active_line_crop_id_list[idx])
+                crop_averages_list = GothamFunctions.cropAveragesLookup(pspc_table,active_line,ps_active_line_crop_id_list[idx])
                 idx_to_try = 0
                 while idx_to_try < 3 and expected_loose_grams_to_write == 0:
                     conversion_factor = crop_averages_list[idx_to_try]
@@ -879,22 +847,7 @@ for date_tomorrow_idx in range(len(list(expected_ps_dict.keys()))-1):
                         loose_spatial_precision_to_write = idx_to_try+1
                         # add entry to pspc_dict
                         #new_pspc_dict[facility_line_to_write] = {crop_id_to_write:{'0000_00':conversion_factor}}
-                        pspc_value = conversion_factor
-                        facility_line = facility_line_to_write
-                        crop_id = crop_id_to_write
-                        year_week = '0000_00'
-                        if facility_line in pspc_dict.keys():
-                            facility_line_dictionary_value = pspc_dict[facility_line]
-                            if crop_id in facility_line_dictionary_value.keys():
-                                crop_id_dictionary_value = pspc_dict[facility_line][crop_id]
-                                if year_week in crop_id_dictionary_value.keys():
-                                    pspc_dict[facility_line][crop_id][year_week] += [pspc_value]
-                                else:
-                                    pspc_dict[facility_line][crop_id][year_week] = [pspc_value]
-                            else:
-                                pspc_dict[facility_line][crop_id] = {year_week:[pspc_value]}
-                        else:
-                            pspc_dict[facility_line] = {crop_id:{year_week:[pspc_value]}}
+                        GothamFunctions.cropAveragesAppend(pspc_table, pspc_dict, facility_line_to_write, crop_id_to_write, conversion_factor)
                         
                         #new_expected_loose_plant_biomass_dict[date_tomorrow][facility_line_to_write] = {crop_id_to_write:[expected_loose_grams_to_write]}                                            
                         total_expected_grams = expected_loose_grams_to_write
@@ -954,6 +907,7 @@ for date_tomorrow_idx in range(len(list(expected_ps_dict.keys()))-1):
             VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);
             """ 
             cnxn_cursor.execute(sql, tuple_to_write)
+            parquet_row_list += [tuple_to_write]
             #print(tuple_to_write)
             harvest_forecast_id_to_write += 1
             
@@ -961,6 +915,10 @@ cnxn.commit()
 cnxn_cursor.close()
 cnxn.close()
 
+# one partition per load, LoadDate matches the rows in HarvestForecast_Facts
+if run_args.parquet_dir is not None:
+    GothamFunctions.ParquetSink(run_args.parquet_dir, load_date_to_write).write('HarvestForecast_Facts', parquet_row_list)
+
                     
 print('HarvestForecast_Facts done')                    
 
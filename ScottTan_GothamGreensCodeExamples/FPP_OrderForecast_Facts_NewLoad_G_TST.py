@@ -35,6 +35,7 @@
 #         ToDate DATETIME: to date in OrderForecast_Facts
 #         IsActive INT: active tag in OrderForecast_Facts
 
+import argparse
 import numpy as np
 import pyodbc
 import socket
@@ -44,12 +45,14 @@ from datetime import date
 from datetime import datetime
 import yaml
 import os
-import copy
-import re
-import pandas as pd
 
 import GothamFunctions
 
+# command line options (unknown arguments, e.g. from a notebook kernel, are ignored)
+run_parser = argparse.ArgumentParser(description = 'OrderForecast_Facts')
+run_parser.add_argument('--parquet-dir', default = None, help = 'also write the new OrderForecast_Facts rows as a Parquet dataset partitioned by load date')
+(run_args, unknown_run_args) = run_parser.parse_known_args()
+
 print('functions loaded')
 
 
@@ -83,70 +86,21 @@ cnxn_cursor = cnxn.cursor()
 ###########################################################################################
 
 # DIMENSIONS
+# slow changing dimensions are read from the local snapshot unless the TTL expired or the row count/checksum changed
+dimension_cache = GothamFunctions.DimensionCache(cnxn_cursor)
 
 # pull SageProducts_Dim
-spd_item_no_list = list()
-spd_eaches_per_unit_list = list()
-spd_product_name_list = list()
-spd_packed_weight_conversion_grams_list = list()
-spd_item_id_list = list()
-
+# eaches per unit, packed weight conversion (default and 12/6 head BTHDBBY overrides) and item ids are derived once in the catalog
 sql_orders = "SELECT ItemNo, ChildEachesPerUnit, ParentEachesPerUnit,ProductName, PackedWeightConversionGrams, ItemID FROM SageProductsDim"
 #sql_orders = "SELECT ItemNo, ChildEachesPerUnit, ParentEachesPerUnit,ProductName, PackedWeightConversionGrams FROM SageProductsDim WHERE Active = 1 AND IsInvoiced = 1 AND PackedWeightConversionGrams IS NOT NULL"
-cnxn_cursor.execute(sql_orders)
-row = cnxn_cursor.fetchone()
 
-spd_item_no_list += [row[0].rstrip()]
-
-eaches_per_unit = 1
-if row[1] != '':
-    eaches_per_unit = row[1]
-if row[2] != '':
-    eaches_per_unit = row[2]
-spd_eaches_per_unit_list+=[eaches_per_unit]
-spd_product_name_list += [row[3]]
-if row[4] is None:
-    spd_packed_weight_conversion_grams_to_add = 1530.88 # conversion factor for leafy greens retail set as default
-    if row[0].rstrip()[3:10] == 'BTHDBBY':
-        spd_packed_weight_conversion_grams_to_add = 12 # placeholder value of 12 whole heads
-        if row[0].rstrip()[-1] == '6':
-            spd_packed_weight_conversion_grams_to_add = 6    
-if row[4] is not None:
-    spd_packed_weight_conversion_grams_to_add = row[4]
-    if row[0].rstrip()[3:10] == 'BTHDBBY':
-        spd_packed_weight_conversion_grams_to_add = 12 
-        if row[0].rstrip()[-1] == '6':
-            spd_packed_weight_conversion_grams_to_add = 6
-            
-spd_packed_weight_conversion_grams_list += [spd_packed_weight_conversion_grams_to_add]
-spd_item_id_list += [row[5]]
-
-while row is not None:  
-    row = cnxn_cursor.fetchone()
-    if row is not None:
-        spd_item_no_list += [row[0].rstrip()]
-        #spd_sku_type_short_name_list += [row[1].rstrip()]
-        eaches_per_unit = 1
-        if row[1] != '':
-            eaches_per_unit = row[1]
-        if row[2] != '':
-            eaches_per_unit = row[2]
-        spd_eaches_per_unit_list+=[eaches_per_unit]
-        spd_product_name_list += [row[3]]
-        if row[4] is None:
-            spd_packed_weight_conversion_grams_to_add = 1530.88 # conversion factor for leafy greens retail set as default
-            if row[0].rstrip()[3:10] == 'BTHDBBY':
-                spd_packed_weight_conversion_grams_to_add = 12 
-                if row[0].rstrip()[-1] == '6':
-                    spd_packed_weight_conversion_grams_to_add = 6    
-        if row[4] is not None:
-            spd_packed_weight_conversion_grams_to_add = row[4]
-            if row[0].rstrip()[3:10] == 'BTHDBBY':
-                spd_packed_weight_conversion_grams_to_add = 12 
-                if row[0].rstrip()[-1] == '6':
-                    spd_packed_weight_conversion_grams_to_add = 6
-        spd_packed_weight_conversion_grams_list += [spd_packed_weight_conversion_grams_to_add]
-        spd_item_id_list += [row[5]]
+product_catalog = GothamFunctions.ProductCatalog.fromRows(dimension_cache.rows('SageProductsDim', sql_orders))
+
+spd_item_no_list = product_catalog.item_no_list
+spd_eaches_per_unit_list = product_catalog.eaches_per_unit_list
+spd_product_name_list = product_catalog.product_name_list
+spd_packed_weight_conversion_grams_list = product_catalog.packed_weight_conversion_grams_list
+spd_item_id_list = product_catalog.item_id_list
         
 
 # pull Facilities_Dim
@@ -154,21 +108,12 @@ facility_id_list = list()
 location_code_list = list()
 region_list = list()
 sql = "SELECT FacilityID, LocationName,Region FROM Facilities_Dim"
-cnxn_cursor.execute(sql) 
-row = cnxn_cursor.fetchone()
-
-facility_id_list += [row[0]]
-location_code_str = row[1].rstrip()
-location_code_list += [location_code_str]
-region_list += [row[2]]
 
-while row is not None:
-    row = cnxn_cursor.fetchone()
-    if row is not None:
-        facility_id_list += [row[0]]
-        location_code_str = row[1].rstrip()
-        location_code_list += [location_code_str]
-        region_list += [row[2]]    
+for row in dimension_cache.rows('Facilities_Dim', sql):
+    facility_id_list += [row[0]]
+    location_code_str = row[1].rstrip()
+    location_code_list += [location_code_str]
+    region_list += [row[2]]    
         
 
 # pull Customers_Dim
@@ -176,17 +121,10 @@ customers_id_list = list()
 sage_customer_id_list = list()
 
 sql = "SELECT CustomersID, SageCustomerID FROM Customers_Dim"
-cnxn_cursor.execute(sql) 
-row = cnxn_cursor.fetchone()
-
-customers_id_list += [row[0]]
-sage_customer_id_list += [row[1].rstrip()]
 
-while row is not None:
-    row = cnxn_cursor.fetchone()
-    if row is not None:
-        customers_id_list += [row[0]]
-        sage_customer_id_list += [row[1].rstrip()]        
+for row in dimension_cache.rows('Customers_Dim', sql):
+    customers_id_list += [row[0]]
+    sage_customer_id_list += [row[1].rstrip()]        
 
 print('SageProducts_Dim, Facilities_Dim, Customers_Dim loaded')   
 
@@ -214,6 +152,13 @@ allocation_classes_str_list = ["SageProducts_Dim.OrderType = 'Food Service' AND
                                "SageProducts_Dim.OrderType = 'Retail' AND (SageProducts_Dim.ProductTypeDesc = 'Sauces' OR SageProducts_Dim.ProductTypeDesc = 'Dressings & Dips' OR SageProducts_Dim.ProductTypeDesc = 'Prepared Foods')",
                                "SageProducts_Dim.OrderType = 'Retail' AND SageProducts_Dim.SkuTypeShortName = 'Ugly Greens'"]
 
+# allocation class as a CASE expression so each fact table is pulled in one scan
+# rows matching no allocation class are dropped server-side (first matching class wins)
+allocation_class_case_str = "CASE"
+for allocation_class_idx in range(len(allocation_classes_str_list)):
+    allocation_class_case_str += " WHEN " + allocation_classes_str_list[allocation_class_idx] + " THEN " + str(allocation_class_idx + 1)
+allocation_class_case_str += " END"
+
 # pull all upcoming orders in the next 6 weeks from LiveSales_Facts
 lsd_date_list = list()
 lsd_item_no_list = list()
@@ -223,33 +168,19 @@ lsd_location_code_list = list()
 lsd_order_number_list = list()
 lsd_allocation_class_list = list()
 
-allocation_class = 1
-for allocation_class_str in allocation_classes_str_list:
-    sql_orders = "SELECT LiveSales_Facts.OrderDate,SageProducts_Dim.ItemNo, OriginalQty, Customers_Dim.SageCustomerID, SageLocations_Dim.LocationName, OpenOrders_Dim.OrderNumber FROM LiveSales_Facts INNER JOIN SageLocations_Dim ON LiveSales_Facts.FacilityID = SageLocations_Dim.ID INNER JOIN SageProducts_Dim ON LiveSales_Facts.ItemID = SageProducts_Dim.ItemID INNER JOIN Customers_Dim ON LiveSales_Facts.CustomersID = Customers_Dim.CustomersID INNER JOIN OpenOrders_Dim ON LiveSales_Facts.OpenOrderID = OpenOrders_Dim.OpenOrderID WHERE (LiveSales_Facts.OrderDate BETWEEN GETDATE() AND DATEADD(WEEK,6,GETDATE())) AND SageProducts_Dim.ItemNo LIKE 'FNG%' AND CurrentRecord = 1 AND " + allocation_class_str + " ORDER BY LiveSales_Facts.OrderDate"
-    cnxn_cursor.execute(sql_orders) 
-    row = cnxn_cursor.fetchone()
+sql_orders = "SELECT OrderDate, ItemNo, OriginalQty, SageCustomerID, LocationName, OrderNumber, AllocationClass FROM (SELECT LiveSales_Facts.OrderDate,SageProducts_Dim.ItemNo, OriginalQty, Customers_Dim.SageCustomerID, SageLocations_Dim.LocationName, OpenOrders_Dim.OrderNumber, " + allocation_class_case_str + " AS AllocationClass FROM LiveSales_Facts INNER JOIN SageLocations_Dim ON LiveSales_Facts.FacilityID = SageLocations_Dim.ID INNER JOIN SageProducts_Dim ON LiveSales_Facts.ItemID = SageProducts_Dim.ItemID INNER JOIN Customers_Dim ON LiveSales_Facts.CustomersID = Customers_Dim.CustomersID INNER JOIN OpenOrders_Dim ON LiveSales_Facts.OpenOrderID = OpenOrders_Dim.OpenOrderID WHERE (LiveSales_Facts.OrderDate BETWEEN GETDATE() AND DATEADD(WEEK,6,GETDATE())) AND SageProducts_Dim.ItemNo LIKE 'FNG%' AND CurrentRecord = 1) AS ls WHERE AllocationClass IS NOT NULL ORDER BY AllocationClass, OrderDate"
+cnxn_cursor.execute(sql_orders) 
+row = cnxn_cursor.fetchone()
 
-    if row is not None:
-        lsd_date_list += [row[0]]
-        lsd_item_no_list += [row[1].rstrip()]
-        lsd_original_qty_list += [row[2]]
-        lsd_sage_customer_id_list += [row[3].rstrip()]
-        lsd_location_code_list +=[row[4].rstrip()]
-        lsd_order_number_list += [row[5].rstrip()]
-        lsd_allocation_class_list += [allocation_class]
-    
-    while row is not None:
-        row = cnxn_cursor.fetchone()
-        if row is not None:
-            lsd_date_list += [row[0]]
-            lsd_item_no_list += [row[1].rstrip()]
-            lsd_original_qty_list += [row[2]]
-            lsd_sage_customer_id_list += [row[3].rstrip()]
-            lsd_location_code_list +=[row[4].rstrip()]
-            lsd_order_number_list += [row[5].rstrip()]
-            lsd_allocation_class_list += [allocation_class]
-    
-    allocation_class += 1
+while row is not None:
+    lsd_date_list += [row[0]]
+    lsd_item_no_list += [row[1].rstrip()]
+    lsd_original_qty_list += [row[2]]
+    lsd_sage_customer_id_list += [row[3].rstrip()]
+    lsd_location_code_list +=[row[4].rstrip()]
+    lsd_order_number_list += [row[5].rstrip()]
+    lsd_allocation_class_list += [int(row[6])]
+    row = cnxn_cursor.fetchone()
     
     
 print('LiveSales_Facts loaded')
@@ -262,32 +193,19 @@ fs_sage_customer_id_list = list()
 fs_location_code_list = list()
 fs_allocation_class_list = list()
 
-allocation_class = 1
-for allocation_class_str in allocation_classes_str_list:
-
-    sql_orders = "SELECT OrderDate, SageProducts_Dim.ItemNo, OriginalQty, Customers_Dim.SageCustomerID, SageLocations_Dim.LocationCode FROM InvoicedSales_Facts INNER JOIN SageLocations_Dim ON InvoicedSales_Facts.FacilityID = SageLocations_Dim.ID INNER JOIN SageProducts_Dim ON InvoicedSales_Facts.ItemID = SageProducts_Dim.ItemID INNER JOIN Customers_Dim ON InvoicedSales_Facts.CustomersID = Customers_Dim.CustomersID WHERE CurrentRecord = 1 AND SageLocations_Dim.LocationName IS NOT NULL AND InvoicedSales_Facts.OrderDate BETWEEN DATEADD(WEEK,-6,GETDATE()) AND GETDATE() AND SageProducts_Dim.ItemNo LIKE 'FNG%' AND "+ allocation_class_str + " ORDER BY InvoicedSales_Facts.OrderDate"
+sql_orders = "SELECT OrderDate, ItemNo, OriginalQty, SageCustomerID, LocationCode, AllocationClass FROM (SELECT InvoicedSales_Facts.OrderDate, SageProducts_Dim.ItemNo, OriginalQty, Customers_Dim.SageCustomerID, SageLocations_Dim.LocationCode, " + allocation_class_case_str + " AS AllocationClass FROM InvoicedSales_Facts INNER JOIN SageLocations_Dim ON InvoicedSales_Facts.FacilityID = SageLocations_Dim.ID INNER JOIN SageProducts_Dim ON InvoicedSales_Facts.ItemID = SageProducts_Dim.ItemID INNER JOIN Customers_Dim ON InvoicedSales_Facts.CustomersID = Customers_Dim.CustomersID WHERE CurrentRecord = 1 AND SageLocations_Dim.LocationName IS NOT NULL AND InvoicedSales_Facts.OrderDate BETWEEN DATEADD(WEEK,-6,GETDATE()) AND GETDATE() AND SageProducts_Dim.ItemNo LIKE 'FNG%') AS fs WHERE AllocationClass IS NOT NULL ORDER BY AllocationClass, OrderDate"
 
-    cnxn_cursor.execute(sql_orders) 
-    row = cnxn_cursor.fetchone()
+cnxn_cursor.execute(sql_orders) 
+row = cnxn_cursor.fetchone()
 
+while row is not None:
     fs_order_date_list += [row[0]]
     fs_item_no_list += [row[1].rstrip()]
     fs_original_qty_list += [row[2]]
     fs_sage_customer_id_list += [row[3].rstrip()]
     fs_location_code_list +=[row[4].rstrip()]
-    fs_allocation_class_list += [allocation_class]
-    
-    while row is not None:
-        row = cnxn_cursor.fetchone()
-        if row is not None:
-            fs_order_date_list += [row[0]]
-            fs_item_no_list += [row[1].rstrip()]
-            fs_original_qty_list += [row[2]]
-            fs_sage_customer_id_list += [row[3].rstrip()]
-            fs_location_code_list +=[row[4].rstrip()]        
-            fs_allocation_class_list += [allocation_class]
-    
-    allocation_class += 1
+    fs_allocation_class_list += [int(row[5])]
+    row = cnxn_cursor.fetchone()
     
 print('InvoicedSales_Facts loaded')
 
@@ -425,6 +343,27 @@ lsd_list_of_lists = [lsd_date_list, lsd_item_no_list, lsd_original_qty_list, lsd
 fs_list_of_lists = [fs_order_date_list, fs_item_no_list, fs_original_qty_list, fs_sage_customer_id_list, fs_location_code_list, fs_allocation_class_list]
 
 
+# foreign key lookups built once (first match wins, same as list.index)
+facility_id_dict = {}
+for fd_idx in range(len(location_code_list)):
+    facility_id_dict.setdefault(location_code_list[fd_idx], facility_id_list[fd_idx])
+customers_id_dict = {}
+for cd_idx in range(len(sage_customer_id_list)):
+    customers_id_dict.setdefault(sage_customer_id_list[cd_idx], customers_id_list[cd_idx])
+spd_item_id_array = np.array(spd_item_id_list, dtype = object)
+
+# days between the allocation date and the order date by weekday (Monday = 0): Monday orders allocate Friday, Sunday orders allocate Friday
+days_before_allocation_array = np.array([3,1,1,1,1,1,2], dtype = 'timedelta64[D]')
+
+sql_write = """
+INSERT INTO OrderForecast_Facts
+VALUES (?,?,?,?,?,?,?,?,?,?,?,?);
+""" 
+cnxn_cursor.fast_executemany = True
+
+# new rows for the Parquet export
+parquet_row_list = list()
+
 for a in [1,2,3,4,5,6,7,8]:
 
     allocation_class = a
@@ -436,47 +375,51 @@ for a in [1,2,3,4,5,6,7,8]:
     std_expected_orders_dict = c_tuple[2]
     live_orders_dict = c_tuple[3]
 
-
-    sql_write = """
-    INSERT INTO OrderForecast_Facts
-    VALUES (?,?,?,?,?,?,?,?,?,?,?,?);
-    """ 
-
-    # write expected_orders_dict to OrderForecast_Facts
-    for order_date in expected_orders_dict.keys():
-        order_date_to_write = order_date.date()
-        weekday = order_date_to_write.weekday()
-        days_before_allocation = 1
-        if order_date_to_write.weekday() == 0:
-            days_before_allocation = 3
-        if order_date_to_write.weekday() == 6:
-            days_before_allocation = 2
-
-        order_allocation_date_to_write = order_date_to_write - DT.timedelta(days = days_before_allocation)
-
-        for location_name in expected_orders_dict[order_date].keys():
-            city = location_name
-            facility_id_to_write = facility_id_list[location_code_list.index(location_name)]
-            for sage_customer_id in expected_orders_dict[order_date][city].keys():
-                dc = sage_customer_id
-                customers_id_to_write = customers_id_list[sage_customer_id_list.index(sage_customer_id)]
-                for crop_id in expected_orders_dict[order_date][city][dc].keys():
-                    for item_number in expected_orders_dict[order_date][city][dc][crop_id].keys():
-                        item_id_to_write = spd_item_id_list[spd_item_no_list.index(item_number)]
-                        expected_order_qty_to_write = int(np.ceil(expected_orders_dict[order_date][city][dc][crop_id][item_number]))
-                        std_expected_order_qty_to_write = round(std_expected_orders_dict[order_date][city][dc][crop_id][item_number],2)
-                        live_order_qty_to_write = int(live_orders_dict[order_date][city][dc][crop_id][item_number])
-                        if expected_order_qty_to_write > 0:
-                            tuple_to_insert = (order_forecast_id_to_write, order_date_to_write, facility_id_to_write, customers_id_to_write, item_id_to_write, expected_order_qty_to_write, std_expected_order_qty_to_write, live_order_qty_to_write, order_allocation_date_to_write, load_date_to_write, to_date_to_write, is_active_to_write)
-                            # write to database
-                            cnxn_cursor.execute(sql_write, tuple_to_insert)
-                            order_forecast_id_to_write += 1
+    # flatten expected_orders_dict into columns and keep rows with a positive expected order
+    [of_order_date_list, of_location_name_list, of_sage_customer_id_list, of_crop_id_list, of_item_number_list,
+     of_expected_list, of_std_expected_list, of_live_list] = GothamFunctions.flattenOrderForecast(expected_orders_dict, std_expected_orders_dict, live_orders_dict)
+
+    of_expected_qty_array = np.ceil(np.array(of_expected_list, dtype = np.float64)).astype(np.int64)
+    of_keep_idx = np.flatnonzero(of_expected_qty_array > 0)
+    if len(of_keep_idx) == 0:
+        continue
+
+    of_order_date_array = np.array([of_order_date_list[of_idx] for of_idx in of_keep_idx], dtype = 'datetime64[D]')
+    of_weekday_array = (of_order_date_array.astype(np.int64) + 3) % 7 # 1970-01-01 is a Thursday
+    of_allocation_date_array = of_order_date_array - days_before_allocation_array[of_weekday_array]
+
+    of_facility_id_list = [facility_id_dict[of_location_name_list[of_idx]] for of_idx in of_keep_idx]
+    of_customers_id_list = [customers_id_dict[of_sage_customer_id_list[of_idx]] for of_idx in of_keep_idx]
+    of_spd_idx_array = product_catalog.indexArray([of_item_number_list[of_idx] for of_idx in of_keep_idx])
+    if (of_spd_idx_array < 0).any():
+        missing_item_number_list = sorted(set(of_item_number_list[of_keep_idx[of_idx]] for of_idx in np.flatnonzero(of_spd_idx_array < 0)))
+        raise ValueError('item numbers not in SageProductsDim: ' + str(missing_item_number_list))
+    of_item_id_list = spd_item_id_array[of_spd_idx_array].tolist()
+
+    of_std_expected_array = np.round(np.array(of_std_expected_list, dtype = np.float64)[of_keep_idx], 2)
+    of_live_array = np.array(of_live_list, dtype = np.float64)[of_keep_idx].astype(np.int64)
+    of_order_forecast_id_array = order_forecast_id_to_write + np.arange(len(of_keep_idx))
+    order_forecast_id_to_write += len(of_keep_idx)
+
+    # write to database in one batch per allocation class
+    tuple_to_insert_list = list(zip(of_order_forecast_id_array.tolist(), of_order_date_array.tolist(), of_facility_id_list, of_customers_id_list, of_item_id_list,
+                                    of_expected_qty_array[of_keep_idx].tolist(), of_std_expected_array.tolist(), of_live_array.tolist(), of_allocation_date_array.tolist(),
+                                    [load_date_to_write] * len(of_keep_idx), [to_date_to_write] * len(of_keep_idx), [is_active_to_write] * len(of_keep_idx)))
+    cnxn_cursor.executemany(sql_write, tuple_to_insert_list)
+    parquet_row_list += tuple_to_insert_list
                             
 
 cnxn.commit()
 cnxn_cursor.close()
 cnxn.close()
-                            
+
+# one partition per load, LoadDate matches the rows in OrderForecast_Facts
+if run_args.parquet_dir is not None:
+    GothamFunctions.ParquetSink(run_args.parquet_dir, load_date_to_write).write('OrderForecast_Facts', parquet_row_list)
+
+
+        
+print('Data is loaded and ready!')
 
 
 # In[2]:
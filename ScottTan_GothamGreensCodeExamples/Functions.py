@@ -13,6 +13,14 @@
 # Load all Gotham custom functions
 
 import numpy as np
+from collections import deque
+from collections.abc import Mapping
+from datetime import date, datetime
+import decimal
+import json
+import os
+import threading
+import time
 
 def cropAverages(source_dict,target_facility_line,target_crop_id):
     
@@ -74,6 +82,103 @@ def cropAverages(source_dict,target_facility_line,target_crop_id):
 
     return [facility_avg_val,city_avg_val,nation_avg_val]
 
+
+def cropAveragesTable(source_dict):
+
+#     goal: precompute the facility, city, and national fallback table used by cropAveragesLookup so that each fallback
+#           is a dictionary lookup instead of a scan of source_dict (same values as cropAverages)
+
+#     input: yield metric dictionary
+#     source_dict: dictionary containing avg plant sites per clam or average headweights (pspc_dict or avg_headweight_dict)
+
+#     output: fallback table dictionary
+#         1. table['line'][(facility_line, crop_id)] = mean of the last year_week values for the facility line and crop
+#         2. table['members'][(level, key, crop_id)] = facility lines in the facility/city/nation group, in source_dict order
+#         3. table['avg'][(level, key, crop_id)] = cached group average, filled on lookup and cleared by cropAveragesUpdate
+
+    table = {'line':{}, 'members':{}, 'avg':{}}
+    for facility_line in source_dict.keys():
+        for crop_id in source_dict[facility_line].keys():
+            cropAveragesUpdate(table, source_dict, facility_line, crop_id)
+
+    return table
+
+
+def cropAveragesGroups(facility_line, crop_id):
+
+#     goal: facility, city, and national group keys of a facility line and crop id in a cropAveragesTable
+
+#     input: facility line ('NYC2_4') and crop id (int)
+
+#     output: list of three group keys [(level, key, crop_id)]
+
+    return [('facility', facility_line.split('_')[0], crop_id),
+            ('city', facility_line[0:3], crop_id),
+            ('nation', '', crop_id)]
+
+
+def cropAveragesUpdate(table, source_dict, facility_line, crop_id):
+
+#     goal: invalidation hook for a cropAveragesTable after source_dict[facility_line][crop_id] changes
+
+#     input: fallback table, yield metric dictionary, facility line and crop id that changed
+
+#     output: None (table is updated in place and the cached facility, city, and national averages are cleared)
+
+    year_week_dict = source_dict[facility_line][crop_id]
+    line_key = (facility_line, crop_id)
+    if line_key not in table['line']:
+        for group_key in cropAveragesGroups(facility_line, crop_id):
+            if group_key in table['members']:
+                table['members'][group_key] += [facility_line]
+            else:
+                table['members'][group_key] = [facility_line]
+    table['line'][line_key] = np.mean(year_week_dict[next(reversed(year_week_dict))])
+
+    for group_key in cropAveragesGroups(facility_line, crop_id):
+        table['avg'].pop(group_key, None)
+
+
+def cropAveragesLookup(table, target_facility_line, target_crop_id):
+
+#     goal: facility, city, and national yield metrics for a target facility line and crop id from a cropAveragesTable
+
+#     input: fallback table, target facility line, and target crop
+
+#     output: list of three average yield metrics (floats), nan if no facility line matches (same as cropAverages)
+#         1. facility average headweight/plant sites per clam (float)
+#         2. city average headweight/plant sites per clam (float)
+#         3. national average headweight/plant sites per clam (float)
+
+    avg_val_list = []
+    for group_key in cropAveragesGroups(target_facility_line, target_crop_id):
+        if group_key not in table['avg']:
+            member_list = table['members'].get(group_key, [])
+            table['avg'][group_key] = np.mean([table['line'][(facility_line, target_crop_id)] for facility_line in member_list])
+        avg_val_list += [table['avg'][group_key]]
+
+    return avg_val_list
+
+
+def cropAveragesAppend(table, source_dict, facility_line, crop_id, value, year_week = '0000_00'):
+
+#     goal: append a fallback value to source_dict[facility_line][crop_id][year_week] and update the fallback table
+
+#     input: fallback table, yield metric dictionary, facility line, crop id, value to append, and year week ('0000_00')
+
+#     output: None (source_dict and table are updated in place)
+
+    if facility_line not in source_dict:
+        source_dict[facility_line] = {}
+    if crop_id not in source_dict[facility_line]:
+        source_dict[facility_line][crop_id] = {}
+    if year_week in source_dict[facility_line][crop_id]:
+        source_dict[facility_line][crop_id][year_week] += [value]
+    else:
+        source_dict[facility_line][crop_id][year_week] = [value]
+
+    cropAveragesUpdate(table, source_dict, facility_line, crop_id)
+
 ##########################################
 
 
@@ -409,6 +514,43 @@ def orderForecast(allocation_class, lsd_list_of_lists, fs_list_of_lists, order_f
     return tuple_to_return
 
 
+def flattenOrderForecast(expected_orders_dict, std_expected_orders_dict, live_orders_dict):
+
+    # goal: flatten the nested order forecast dictionaries from orderForecast into aligned columns in one pass
+
+    # input: dictionaries from orderForecast
+    # expected_orders_dict[order_date][location_name][sage_customer_id][crop_id][item_number] = expected order qty
+    # std_expected_orders_dict, live_orders_dict: same keys as expected_orders_dict
+
+    # output: list of 8 lists in dictionary order
+    #     1. order date (datetime)
+    #     2. location name (string)
+    #     3. sage customer id (string)
+    #     4. crop id (int)
+    #     5. item number (string)
+    #     6. expected order qty (float)
+    #     7. std of expected order qty (float)
+    #     8. live order qty (float)
+
+    column_LoL = [[] for col_idx in range(8)]
+    for order_date, order_date_dict in expected_orders_dict.items():
+        for location_name, location_dict in order_date_dict.items():
+            for sage_customer_id, customer_dict in location_dict.items():
+                for crop_id, crop_dict in customer_dict.items():
+                    std_crop_dict = std_expected_orders_dict[order_date][location_name][sage_customer_id][crop_id]
+                    live_crop_dict = live_orders_dict[order_date][location_name][sage_customer_id][crop_id]
+                    for item_number, expected_order_qty in crop_dict.items():
+                        column_LoL[0] += [order_date]
+                        column_LoL[1] += [location_name]
+                        column_LoL[2] += [sage_customer_id]
+                        column_LoL[3] += [crop_id]
+                        column_LoL[4] += [item_number]
+                        column_LoL[5] += [expected_order_qty]
+                        column_LoL[6] += [std_crop_dict[item_number]]
+                        column_LoL[7] += [live_crop_dict[item_number]]
+
+    return column_LoL
+
 def actualOrderInventoryAllocation(inventory_lists, actual_orders_lists, allocation_date):
     
     # goal: allocate items in the inventory to live orders
@@ -878,7 +1020,129 @@ def lastMatchingValue(a,b):
     
     return match_idx
                                     
-def harvestAllocation(new_order_lists,expected_harvest_dict_list, sort_metric_dict_list, allocation_class, allocation_date):
+class ProductCatalog:
+
+    # goal: SageProducts_Dim lookup tables built once (eaches per unit, packed weight conversion, item id) so callers
+    #       resolve an item number with a dictionary lookup instead of spd_item_no_list.index(...) per row
+
+    # input:
+    # item_no_list: list of item numbers (rstripped strings)
+    # packed_weight_conversion_grams_list: list of packed weight conversions with the default and BTHDBBY overrides applied
+    # eaches_per_unit_list, product_name_list, item_id_list: optional lists aligned with item_no_list
+
+    # state:
+    #   item_no_idx_dict[item_no] = index into the lists (first occurrence, same as list.index)
+    #   item_id_idx_dict[item_id] = index into the lists
+
+    # output: dictionary/array lookups by item number and by item id (None when the item is not in SageProducts_Dim)
+
+    default_packed_weight_conversion_grams = 1530.88 # conversion factor for leafy greens retail set as default
+
+    def __init__(self, item_no_list, packed_weight_conversion_grams_list, eaches_per_unit_list = None, product_name_list = None, item_id_list = None):
+
+        self.item_no_list = item_no_list
+        self.packed_weight_conversion_grams_list = packed_weight_conversion_grams_list
+        self.eaches_per_unit_list = eaches_per_unit_list if eaches_per_unit_list is not None else [1] * len(item_no_list)
+        self.product_name_list = product_name_list if product_name_list is not None else [None] * len(item_no_list)
+        self.item_id_list = item_id_list if item_id_list is not None else [None] * len(item_no_list)
+
+        self.item_no_idx_dict = {}
+        self.item_id_idx_dict = {}
+        for spd_idx in range(len(item_no_list)):
+            self.item_no_idx_dict.setdefault(item_no_list[spd_idx], spd_idx)
+            if self.item_id_list[spd_idx] is not None:
+                self.item_id_idx_dict.setdefault(self.item_id_list[spd_idx], spd_idx)
+
+    @classmethod
+    def fromRows(cls, row_list):
+
+        # goal: build the catalog from SageProducts_Dim rows
+        # input: rows of (ItemNo, ChildEachesPerUnit, ParentEachesPerUnit, ProductName, PackedWeightConversionGrams, ItemID)
+
+        item_no_list = []
+        eaches_per_unit_list = []
+        product_name_list = []
+        packed_weight_conversion_grams_list = []
+        item_id_list = []
+        for row in row_list:
+            item_no = row[0].rstrip()
+            item_no_list += [item_no]
+            eaches_per_unit_list += [cls.eachesPerUnit(row[1], row[2])]
+            product_name_list += [row[3]]
+            packed_weight_conversion_grams_list += [cls.packedWeightConversionGrams(item_no, row[4])]
+            item_id_list += [row[5]]
+
+        return cls(item_no_list, packed_weight_conversion_grams_list, eaches_per_unit_list, product_name_list, item_id_list)
+
+    @staticmethod
+    def eachesPerUnit(child_eaches_per_unit, parent_eaches_per_unit):
+        # output: eaches per unit, the parent value overrides the child value and the default is 1
+        eaches_per_unit = 1
+        if child_eaches_per_unit != '':
+            eaches_per_unit = child_eaches_per_unit
+        if parent_eaches_per_unit != '':
+            eaches_per_unit = parent_eaches_per_unit
+        return eaches_per_unit
+
+    @classmethod
+    def packedWeightConversionGrams(cls, item_no, packed_weight_conversion_grams):
+        # output: packed weight conversion in grams, baby butterhead (BTHDBBY) is counted in whole heads, 12 or 6 for 6 head packs
+        if item_no[3:10] == 'BTHDBBY':
+            if item_no[-1] == '6':
+                return 6
+            return 12 # placeholder value of 12 whole heads
+        if packed_weight_conversion_grams is None:
+            return cls.default_packed_weight_conversion_grams
+        return packed_weight_conversion_grams
+
+    def __contains__(self, item_no):
+        return item_no in self.item_no_idx_dict
+
+    def __len__(self):
+        return len(self.item_no_list)
+
+    def index(self, item_no):
+        # output: index of the item number in the catalog lists, None if missing
+        return self.item_no_idx_dict.get(item_no)
+
+    def packedWeight(self, item_no):
+        # output: packed weight conversion in grams for the item number, None if missing
+        spd_idx = self.item_no_idx_dict.get(item_no)
+        if spd_idx is None:
+            return None
+        return self.packed_weight_conversion_grams_list[spd_idx]
+
+    def eaches(self, item_no):
+        # output: eaches per unit for the item number, None if missing
+        spd_idx = self.item_no_idx_dict.get(item_no)
+        if spd_idx is None:
+            return None
+        return self.eaches_per_unit_list[spd_idx]
+
+    def itemID(self, item_no):
+        # output: SageProducts_Dim item id for the item number, None if missing
+        spd_idx = self.item_no_idx_dict.get(item_no)
+        if spd_idx is None:
+            return None
+        return self.item_id_list[spd_idx]
+
+    def itemNo(self, item_id):
+        # output: item number for the SageProducts_Dim item id, None if missing
+        spd_idx = self.item_id_idx_dict.get(item_id)
+        if spd_idx is None:
+            return None
+        return self.item_no_list[spd_idx]
+
+    def indexArray(self, item_no_list):
+        # output: numpy array of catalog indices for a list of item numbers, -1 where the item is missing
+        return np.array([self.item_no_idx_dict.get(item_no, -1) for item_no in item_no_list], dtype = np.int64)
+
+    def packedWeightArray(self, item_no_list, default = 1):
+        # output: numpy array of packed weight conversions for a list of item numbers, default where the item is missing
+        packed_weight_array = np.asarray(self.packed_weight_conversion_grams_list + [default], dtype = np.float64)
+        return packed_weight_array[self.indexArray(item_no_list)]
+
+def harvestAllocation(new_order_lists,expected_harvest_dict_list, sort_metric_dict_list, allocation_class, allocation_date, product_catalog = None):
     
     # goal: compute crop allocations from each line to fulfill orders
     
@@ -898,6 +1162,7 @@ def harvestAllocation(new_order_lists,expected_harvest_dict_list, sort_metric_di
             # 2. pspc_dict[facility_line][crop_id][year_week] = [pspc1, pspc2,...]
         # 4. allocation_class: int (1-6) cooresponding to allocation class        
         # 5. allocation_date: datetime cooresponding to allocation date
+        # 6. product_catalog: ProductCatalog of SageProducts_Dim (optional, built from the notebook's spd lists if None)
     
     # output: list of three lists: 1) harvest allocation for harvestAllocation_V, 2) remaining plant sites, and 3) remaining orders
     # 1) all_tuple_to_insert_list: list of tuples of harvest allocations
@@ -918,6 +1183,9 @@ def harvestAllocation(new_order_lists,expected_harvest_dict_list, sort_metric_di
         # 5. new_order_number_list (list of strings)
     
     date_tomorrow = allocation_date
+
+    if product_catalog is None:
+        product_catalog = ProductCatalog(spd_item_no_list, spd_packed_weight_conversion_grams_list)
     
     all_tuple_to_insert_list = list()
 
@@ -979,11 +1247,11 @@ def harvestAllocation(new_order_lists,expected_harvest_dict_list, sort_metric_di
 
         city_sort_metrics = []
         city_facility_lines = []
-        if item_no not in spd_item_no_list:
+        conversion_factor = product_catalog.packedWeight(item_no)
+        if conversion_factor is None:
             print(item_no + 'not in SageProductsDim')
-        conversion_factor = 1 # let expected_order_packed_weight = original_qty if no conversion_factor exists
-        if item_no in spd_item_no_list:
-            conversion_factor = float(spd_packed_weight_conversion_grams_list[spd_item_no_list.index(item_no)])
+            conversion_factor = 1 # let expected_order_packed_weight = original_qty if no conversion_factor exists
+        conversion_factor = float(conversion_factor)
         
         expected_order_packed_weight = float(original_qty * conversion_factor)
 
@@ -1128,7 +1396,7 @@ def harvestAllocation(new_order_lists,expected_harvest_dict_list, sort_metric_di
 
 
 
-def harvestAllocationFromGMED(new_order_lists,expected_harvest_dict_list, sort_metric_dict_list, allocation_class, allocation_date):
+def harvestAllocationFromGMED(new_order_lists,expected_harvest_dict_list, sort_metric_dict_list, allocation_class, allocation_date, product_catalog = None):
     
     
     # goal: compute crop allocations from GMED lines to fulfill orders for allocation class 1-4
@@ -1149,6 +1417,7 @@ def harvestAllocationFromGMED(new_order_lists,expected_harvest_dict_list, sort_m
             # 2. pspc_dict[facility_line][crop_id][year_week] = [pspc1, pspc2,...]
         # 4. allocation_class: int (1-6) cooresponding to allocation class        
         # 5. allocation_date: datetime cooresponding to allocation date
+        # 6. product_catalog: ProductCatalog of SageProducts_Dim (optional, built from the notebook's spd lists if None)
     
     # output: list of three lists: 1) harvest allocation for harvestAllocation_V, 2) remaining plant sites, and 3) remaining orders
     # 1) all_tuple_to_insert_list: list of tuples of harvest allocations
@@ -1185,6 +1454,9 @@ def harvestAllocationFromGMED(new_order_lists,expected_harvest_dict_list, sort_m
 
     date_tomorrow = allocation_date
 
+    if product_catalog is None:
+        product_catalog = ProductCatalog(spd_item_no_list, spd_packed_weight_conversion_grams_list)
+
     if allocation_class == 1:    
         expected_harvest_dict = expected_whole_plant_biomass_dict
         sort_metric_dict = avg_headweight_dict
@@ -1229,11 +1501,11 @@ def harvestAllocationFromGMED(new_order_lists,expected_harvest_dict_list, sort_m
         city_sort_metrics = []
         city_facility_lines = []
         
-        if item_no not in spd_item_no_list:
+        conversion_factor = product_catalog.packedWeight(item_no)
+        if conversion_factor is None:
             print(item_no + 'not in SageProductsDim')
-        conversion_factor = 1 # let expected_order_packed_weight = original_qty if no conversion_factor exists
-        if item_no in spd_item_no_list:
-            conversion_factor = float(spd_packed_weight_conversion_grams_list[spd_item_no_list.index(item_no)])
+            conversion_factor = 1 # let expected_order_packed_weight = original_qty if no conversion_factor exists
+        conversion_factor = float(conversion_factor)
         
         expected_order_packed_weight = float(original_qty * conversion_factor)
 
@@ -1397,7 +1669,7 @@ def harvestAllocationFromGMED(new_order_lists,expected_harvest_dict_list, sort_m
 
 
 
-def harvestAllocationToGMED(new_order_lists,expected_harvest_dict_list, sort_metric_dict_list, allocation_class, allocation_date):
+def harvestAllocationToGMED(new_order_lists,expected_harvest_dict_list, sort_metric_dict_list, allocation_class, allocation_date, product_catalog = None):
     
     # goal: compute crop allocations to GMED to fulfill orders for allocation class 5
     
@@ -1417,6 +1689,7 @@ def harvestAllocationToGMED(new_order_lists,expected_harvest_dict_list, sort_met
             # 2. pspc_dict[facility_line][crop_id][year_week] = [pspc1, pspc2,...]
         # 4. allocation_class: int (1-6) cooresponding to allocation class        
         # 5. allocation_date: datetime cooresponding to allocation date
+        # 6. product_catalog: ProductCatalog of SageProducts_Dim (optional, built from the notebook's spd lists if None)
     
     # output: list of three lists: 1) harvest allocation for harvestAllocation_V, 2) remaining plant sites, and 3) remaining orders
     # 1) all_tuple_to_insert_list: list of tuples of harvest allocations
@@ -1452,6 +1725,9 @@ def harvestAllocationToGMED(new_order_lists,expected_harvest_dict_list, sort_met
 
     date_tomorrow = allocation_date
 
+    if product_catalog is None:
+        product_catalog = ProductCatalog(spd_item_no_list, spd_packed_weight_conversion_grams_list)
+
     if allocation_class == 1:    
         expected_harvest_dict = expected_whole_plant_biomass_dict
         sort_metric_dict = avg_headweight_dict
@@ -1496,11 +1772,11 @@ def harvestAllocationToGMED(new_order_lists,expected_harvest_dict_list, sort_met
         city_sort_metrics = []
         city_facility_lines = []
         
-        if item_no not in spd_item_no_list:
+        conversion_factor = product_catalog.packedWeight(item_no)
+        if conversion_factor is None:
             print(item_no + 'not in SageProductsDim')
-        conversion_factor = 1 # let expected_order_packed_weight = original_qty if no conversion_factor exists
-        if item_no in spd_item_no_list:
-            conversion_factor = float(spd_packed_weight_conversion_grams_list[spd_item_no_list.index(item_no)])
+            conversion_factor = 1 # let expected_order_packed_weight = original_qty if no conversion_factor exists
+        conversion_factor = float(conversion_factor)
         
         expected_order_packed_weight = float(original_qty * conversion_factor)
 
@@ -1989,7 +2265,154 @@ def isListEmpty(inList):
         return all( map(isListEmpty, inList) )
     return False # Not a list
 
-def remainingHarvest(new_expected_harvest_dict_list, allocation_date):
+def harvestArray(new_expected_harvest_dict_list, allocation_date, key_list = None):
+
+    # goal: array form of the expected harvest for an allocation date
+
+    # input: list of three dictionaries corresponding to the expected harvest (see remainingHarvest), the allocation date,
+    #        and an optional key_list of (facility_line, crop_id) (defaults to the plant site keys for the allocation date)
+
+    # output: [key_list, harvest_array]
+        # 1. key_list: list of (facility_line, crop_id) tuples, row order of harvest_array
+        # 2. harvest_array[key_idx] = [expected plant sites, expected whole grams, expected loose grams] (float array, shape (len(key_list), 3))
+
+    date_dict_list = [new_expected_harvest_dict.get(allocation_date, {}) for new_expected_harvest_dict in new_expected_harvest_dict_list]
+
+    if key_list is None:
+        key_list = [(facility_line, crop_id) for facility_line in date_dict_list[0].keys() for crop_id in date_dict_list[0][facility_line].keys()]
+
+    harvest_array = np.zeros((len(key_list), 3))
+    for dict_idx in range(3):
+        date_dict = date_dict_list[dict_idx]
+        harvest_array[:, dict_idx] = [date_dict.get(facility_line, {}).get(crop_id, 0) for (facility_line, crop_id) in key_list]
+
+    return [key_list, harvest_array]
+
+
+class HarvestDictView(Mapping):
+
+    # goal: read only nested dictionary view of one column of a harvest array, built on first access
+    # view[facility_line][crop_id] = value
+
+    def __init__(self, key_list, value_array):
+        self.key_list = key_list
+        self.value_array = value_array
+        self.view_dict = None
+
+    def materialize(self):
+        if self.view_dict is None:
+            self.view_dict = {}
+            for key_idx in range(len(self.key_list)):
+                (facility_line, crop_id) = self.key_list[key_idx]
+                if facility_line not in self.view_dict:
+                    self.view_dict[facility_line] = {}
+                self.view_dict[facility_line][crop_id] = self.value_array[key_idx].item()
+        return self.view_dict
+
+    def __getitem__(self, facility_line):
+        return self.materialize()[facility_line]
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __repr__(self):
+        return repr(self.materialize())
+
+
+def remainingHarvestArray(harvest_array, allocation_array = None):
+
+    # goal: remaining harvest after allocation in one vectorized step
+
+    # input: harvest_array from harvestArray (any leading shape, e.g. (keys, 3) or (dates, keys, 3)) and an allocation array
+    #        of the same shape (plant sites, whole grams, loose grams allocated), or None if nothing is allocated
+
+    # output: remaining_array = max(harvest_array - allocation_array, 0)
+
+    if allocation_array is None:
+        return np.maximum(harvest_array, 0)
+
+    return np.maximum(harvest_array - allocation_array, 0)
+
+
+def remainingHarvestArrays(new_expected_harvest_dict_list, allocation_date, allocation_array = None, avg_headweight_table = None, pspc_table = None):
+
+    # goal: compute remaining harvest in array form
+
+    # input: same as remainingHarvest, plus
+        # allocation_array: optional array aligned with the plant site keys of the allocation date (see harvestArray)
+        #                   of allocated [plant sites, whole grams, loose grams], subtracted and clamped at zero
+
+    # output: [key_list, remaining_array, spatial_precision_array, view_list]
+        # 1. key_list: list of (facility_line, crop_id) tuples, row order of the arrays
+        # 2. remaining_array[key_idx] = [plant sites, whole grams, loose grams]
+        # 3. spatial_precision_array[key_idx] = [whole spatial precision, loose spatial precision] (0 line, 1 facility, 2 city, 3 nation, 4 none)
+        # 4. view_list: lazy nested dictionary views [plant_site_dict, whole_dict, loose_dict] of remaining_array for the allocation date
+        #    view[facility_line][crop_id] = value
+
+    expected_whole_plant_biomass_dict = new_expected_harvest_dict_list[1]
+    expected_loose_plant_biomass_dict = new_expected_harvest_dict_list[2]
+
+    if avg_headweight_table is None:
+        avg_headweight_table = cropAveragesTable(avg_headweight_dict)
+    if pspc_table is None:
+        pspc_table = cropAveragesTable(pspc_dict)
+
+    [key_list, harvest_array] = harvestArray(new_expected_harvest_dict_list, allocation_date)
+
+    # lines with a line level biomass forecast have spatial precision 0
+    date_whole_dict = expected_whole_plant_biomass_dict.get(allocation_date, {})
+    date_loose_dict = expected_loose_plant_biomass_dict.get(allocation_date, {})
+    spatial_precision_array = np.full((len(key_list), 2), 4)
+    spatial_precision_array[:, 0] = [0 if crop_id in date_whole_dict.get(facility_line, {}) else 4 for (facility_line, crop_id) in key_list]
+    spatial_precision_array[:, 1] = [0 if crop_id in date_loose_dict.get(facility_line, {}) else 4 for (facility_line, crop_id) in key_list]
+
+    # compute at lower spatial precision if expected biomass is zero
+    for (col_idx, source_dict, source_table, biomass_dict) in ((1, avg_headweight_dict, avg_headweight_table, expected_whole_plant_biomass_dict),
+                                                               (2, pspc_dict, pspc_table, expected_loose_plant_biomass_dict)):
+        for key_idx in np.flatnonzero(harvest_array[:, col_idx] == 0):
+            (facility_line, crop_id) = key_list[key_idx]
+            crop_averages_list = cropAveragesLookup(source_table, facility_line, crop_id)
+            for idx_to_try in range(3):
+                conversion_factor = crop_averages_list[idx_to_try]
+                if conversion_factor != conversion_factor or conversion_factor == 0:
+                    continue
+                if col_idx == 1:
+                    expected_grams = harvest_array[key_idx, 0] * float(conversion_factor)
+                else:
+                    g_per_clam = 128
+                    if crop_id == 1:
+                        g_per_clam = 114 # arugula
+                    if crop_id == 3:
+                        g_per_clam = 35.4 # basil
+                    expected_grams = harvest_array[key_idx, 0] * float(1/conversion_factor) * g_per_clam
+                # the first non-zero factor is used even if the plant sites (and so the grams) are zero
+                harvest_array[key_idx, col_idx] = expected_grams
+                spatial_precision_array[key_idx, col_idx-1] = idx_to_try+1
+
+                # add entry to avg_headweight_dict/pspc_dict
+                cropAveragesAppend(source_table, source_dict, facility_line, crop_id, conversion_factor)
+
+                # add value to expected_whole_plant_biomass_dict/expected_loose_plant_biomass_dict
+                if allocation_date not in biomass_dict:
+                    biomass_dict[allocation_date] = {}
+                if facility_line not in biomass_dict[allocation_date]:
+                    biomass_dict[allocation_date][facility_line] = {}
+                if crop_id in biomass_dict[allocation_date][facility_line]:
+                    biomass_dict[allocation_date][facility_line][crop_id] += expected_grams
+                else:
+                    biomass_dict[allocation_date][facility_line][crop_id] = expected_grams
+                break
+
+    remaining_array = remainingHarvestArray(harvest_array, allocation_array)
+    view_list = [HarvestDictView(key_list, remaining_array[:, col_idx]) for col_idx in range(3)]
+
+    return [key_list, remaining_array, spatial_precision_array, view_list]
+
+
+def remainingHarvest(new_expected_harvest_dict_list, allocation_date, avg_headweight_table = None, pspc_table = None, allocation_array = None):
 
     # goal: compute remaining harvest
     
@@ -1999,6 +2422,8 @@ def remainingHarvest(new_expected_harvest_dict_list, allocation_date):
             # 2. expected_whole_plant_biomass_trail_dict[harvest_date][facility_line][crop_id] = expected_whole_plant_biomass (g)
             # 3. expected_loose_plant_biomass_trail_dict[harvest_date][facility_line][crop_id] = expected_loose_plant_biomass (g)
         # 2. allocation_date (datetime)
+        # 3. avg_headweight_table, pspc_table: optional cropAveragesTable fallback tables (built from the global dictionaries if None)
+        # 4. allocation_array: optional allocated [plant sites, whole grams, loose grams] per key (see remainingHarvestArrays)
     # output: all_tuple_to_insert_list- list of tuples of remaining harvest
         # 1. harvest date (datetime)
         # 2. facility id (int)
@@ -2007,181 +2432,19 @@ def remainingHarvest(new_expected_harvest_dict_list, allocation_date):
         # 5. expected plant sites (int)
         # 6. expected whole grams (float)
         # 7. expected loose grams (float)
-        
-    all_tuple_to_insert_list = []
-    
-    expected_ps_dict = new_expected_harvest_dict_list[0]
-    expected_whole_plant_biomass_dict = new_expected_harvest_dict_list[1]
-    expected_loose_plant_biomass_dict = new_expected_harvest_dict_list[2]
-    
-    date_tomorrow = allocation_date
 
-    harvest_date_to_write = date_tomorrow
-    ps_active_lines = list(expected_ps_dict[date_tomorrow].keys())
-    for active_line in ps_active_lines:
-        facility_line_to_write = active_line
-        location_name_to_write = active_line.split('_')[0]
-        facility_id_to_write = facility_list[location_name_list.index(active_line.split('_')[0])]
-        city_to_write = facility_line_to_write[0:3]
-        line_to_write = int(active_line.split('_')[1])
-        ps_active_line_crop_id_list = list(expected_ps_dict[date_tomorrow][active_line].keys())
-        active_line_expected_ps_list = list(expected_ps_dict[date_tomorrow][active_line].values())
-        region_to_write = region_list[location_name_list.index(active_line.split('_')[0])]
-        if date_tomorrow in list(expected_whole_plant_biomass_dict.keys()):
-            if active_line in list(expected_whole_plant_biomass_dict[date_tomorrow].keys()):
-                whole_active_line_crop_id_list = list(expected_whole_plant_biomass_dict[date_tomorrow][active_line].keys())
-                active_line_expected_whole_biomass_list = list(expected_whole_plant_biomass_dict[date_tomorrow][active_line].values())
-            else:
-                whole_active_line_crop_id_list = list(expected_ps_dict[date_tomorrow][active_line].keys())
-                active_line_expected_whole_biomass_list = [0] * len(list(expected_ps_dict[date_tomorrow][active_line].values()))
-        else:
-            whole_active_line_crop_id_list = list(expected_ps_dict[date_tomorrow][active_line].keys())
-            active_line_expected_whole_biomass_list = [0] * len(list(expected_ps_dict[date_tomorrow][active_line].values()))
+    [key_list, remaining_array, spatial_precision_array, view_list] = remainingHarvestArrays(new_expected_harvest_dict_list, allocation_date, allocation_array, avg_headweight_table, pspc_table)
 
-        if date_tomorrow in list(expected_loose_plant_biomass_dict.keys()):
-            if active_line in list(expected_loose_plant_biomass_dict[date_tomorrow].keys()):
-                loose_active_line_crop_id_list = list(expected_loose_plant_biomass_dict[date_tomorrow][active_line].keys())                
-                active_line_expected_loose_biomass_list = list(expected_loose_plant_biomass_dict[date_tomorrow][active_line].values())
-            else:
-                loose_active_line_crop_id_list = [0] * len(list(expected_ps_dict[date_tomorrow][active_line].keys()))  
-                active_line_expected_loose_biomass_list = [0] * len(list(expected_ps_dict[date_tomorrow][active_line].values()))
-        else:
-            loose_active_line_crop_id_list = [0] * len(list(expected_ps_dict[date_tomorrow][active_line].keys()))
-            active_line_expected_loose_biomass_list = [0] * len(list(expected_ps_dict[date_tomorrow][active_line].values()))
-
-        line_tuple = (harvest_date_to_write, facility_id_to_write, line_to_write)
-        for idx in range(len(ps_active_line_crop_id_list)):
-            crop_id_to_write = ps_active_line_crop_id_list[idx]
-            sage_crop_code_to_write = sage_crop_code_list[crop_id_list.index(crop_id_to_write)]
-            expected_plant_sites_to_write = active_line_expected_ps_list[idx]
-            expected_whole_grams_to_write = 0
-            expected_loose_grams_to_write = 0
-            whole_spatial_precision_to_write = 4
-            loose_spatial_precision_to_write = 4
-            if crop_id_to_write in whole_active_line_crop_id_list:
-                whole_idx = whole_active_line_crop_id_list.index(crop_id_to_write)
-                expected_whole_grams_to_write = active_line_expected_whole_biomass_list[whole_idx]
-                whole_spatial_precision_to_write = 0
-            if crop_id_to_write in loose_active_line_crop_id_list:            
-                loose_idx = loose_active_line_crop_id_list.index(crop_id_to_write)
-                expected_loose_grams_to_write = active_line_expected_loose_biomass_list[loose_idx]
-                loose_spatial_precision_to_write = 0
-            # compute at lower spatial precision if expected biomass is zero
-            if expected_whole_grams_to_write == 0:
-                crop_averages_list = cropAverages(avg_headweight_dict,active_line,ps_active_line_crop_id_list[idx])
-                idx_to_try = 0
-                while idx_to_try < 3 and expected_whole_grams_to_write == 0:
-                    conversion_factor = crop_averages_list[idx_to_try]
-                    #print(type(expected_whole_grams_to_write))
-                    if conversion_factor != conversion_factor:
-                        expected_whole_grams_to_write = 0
-                        conversion_factor = 0
-                    #print(expected_whole_grams_to_write)
-                    if conversion_factor != 0:
-                        expected_whole_grams_to_write = expected_plant_sites_to_write * float(conversion_factor)
-                        #print(expected_whole_grams_to_write)
-                        whole_spatial_precision_to_write = idx_to_try+1
-                        # add entry to avg_headweight_dict
-                        #new_avg_headweight_dict[facility_line_to_write] = {crop_id_to_write:{'0000_00':conversion_factor}}
-
-                        avg_headweight_value = conversion_factor
-                        facility_line = facility_line_to_write
-                        crop_id = crop_id_to_write
-                        year_week = '0000_00'
-                        if facility_line in avg_headweight_dict.keys():
-                            facility_line_dictionary_value = avg_headweight_dict[facility_line]
-                            if crop_id in facility_line_dictionary_value.keys():
-                                crop_id_dictionary_value = avg_headweight_dict[facility_line][crop_id]
-                                if year_week in crop_id_dictionary_value.keys():
-                                    avg_headweight_dict[facility_line][crop_id][year_week] += [avg_headweight_value]
-                                else:
-                                    avg_headweight_dict[facility_line][crop_id][year_week] = [avg_headweight_value]
-                            else:
-                                avg_headweight_dict[facility_line][crop_id] = {year_week:[avg_headweight_value]}
-                        else:
-                            avg_headweight_dict[facility_line] = {crop_id:{year_week:[avg_headweight_value]}}
-
-                        # add value to expected_whole_plant_biomass_dict
-                        # new_expected_whole_plant_biomass_dict[date_tomorrow][facility_line_to_write] = {crop_id_to_write:[expected_whole_grams_to_write]}
-                        total_expected_grams = expected_whole_grams_to_write
-                        harvest_date = date_tomorrow
-                        facility_line = facility_line_to_write
-                        crop_id = crop_id_to_write
-                        if harvest_date in expected_whole_plant_biomass_dict.keys():
-                            harvest_date_dictionary_value = expected_whole_plant_biomass_dict[harvest_date]
-                            if facility_line in harvest_date_dictionary_value.keys():
-                                facility_line_dictionary_value = expected_whole_plant_biomass_dict[harvest_date][facility_line]
-                                if crop_id in facility_line_dictionary_value.keys():
-                                    expected_whole_plant_biomass_dict[harvest_date][facility_line][crop_id] += total_expected_grams
-                                else:
-                                    expected_whole_plant_biomass_dict[harvest_date][facility_line][crop_id] = total_expected_grams
-                            else:
-                                expected_whole_plant_biomass_dict[harvest_date][facility_line] = {crop_id:total_expected_grams}
-                        else:
-                            expected_whole_plant_biomass_dict[harvest_date] = {facility_line:{crop_id:total_expected_grams}}
-
-                        idx_to_try = 3
-                    idx_to_try += 1
-            if expected_loose_grams_to_write == 0:
-                crop_averages_list = cropAverages(pspc_dict,active_line,ps_active_line_crop_id_list[idx])
-                idx_to_try = 0
-                while idx_to_try < 3 and expected_loose_grams_to_write == 0:
-                    conversion_factor = crop_averages_list[idx_to_try]
-                    if conversion_factor != conversion_factor:
-                        expected_loose_grams_to_write = 0
-                        conversion_factor = 0
-                    #print(expected_loose_grams_to_write)
-                    if conversion_factor != 0:
-                        g_per_clam = 128
-                        if crop_id_to_write == 1:
-                            g_per_clam = 114 # arugula
-                        if crop_id_to_write == 3:
-                            g_per_clam = 35.4 # basil
-                        expected_loose_grams_to_write = expected_plant_sites_to_write * float(1/conversion_factor) * g_per_clam
-                        #print(expected_loose_grams_to_write)
-                        loose_spatial_precision_to_write = idx_to_try+1
-                        # add entry to pspc_dict
-                        #new_pspc_dict[facility_line_to_write] = {crop_id_to_write:{'0000_00':conversion_factor}}
-                        pspc_value = conversion_factor
-                        facility_line = facility_line_to_write
-                        crop_id = crop_id_to_write
-                        year_week = '0000_00'
-                        if facility_line in pspc_dict.keys():
-                            facility_line_dictionary_value = pspc_dict[facility_line]
-                            if crop_id in facility_line_dictionary_value.keys():
-                                crop_id_dictionary_value = pspc_dict[facility_line][crop_id]
-                                if year_week in crop_id_dictionary_value.keys():
-                                    pspc_dict[facility_line][crop_id][year_week] += [pspc_value]
-                                else:
-                                    pspc_dict[facility_line][crop_id][year_week] = [pspc_value]
-                            else:
-                                pspc_dict[facility_line][crop_id] = {year_week:[pspc_value]}
-                        else:
-                            pspc_dict[facility_line] = {crop_id:{year_week:[pspc_value]}}
-
-                        #new_expected_loose_plant_biomass_dict[date_tomorrow][facility_line_to_write] = {crop_id_to_write:[expected_loose_grams_to_write]}                                            
-                        total_expected_grams = expected_loose_grams_to_write
-                        harvest_date = date_tomorrow
-                        facility_line = facility_line_to_write
-                        crop_id = crop_id_to_write
-                        if harvest_date in expected_loose_plant_biomass_dict.keys():
-                            harvest_date_dictionary_value = expected_loose_plant_biomass_dict[harvest_date]
-                            if facility_line in harvest_date_dictionary_value.keys():
-                                facility_line_dictionary_value = expected_loose_plant_biomass_dict[harvest_date][facility_line]
-                                if crop_id in facility_line_dictionary_value.keys():
-                                    expected_loose_plant_biomass_dict[harvest_date][facility_line][crop_id] += total_expected_grams
-                                else:
-                                    expected_loose_plant_biomass_dict[harvest_date][facility_line][crop_id] = total_expected_grams
-                            else:
-                                expected_loose_plant_biomass_dict[harvest_date][facility_line] = {crop_id:total_expected_grams}
-                        else:
-                            expected_loose_plant_biomass_dict[harvest_date] = {facility_line:{crop_id:total_expected_grams}}                      
-                        idx_to_try = 3
-                    idx_to_try += 1
+    all_tuple_to_insert_list = []
+    for key_idx in np.flatnonzero(remaining_array[:, 0] != 0):
+        (facility_line_to_write, crop_id_to_write) = key_list[key_idx]
+        facility_id_to_write = facility_list[location_name_list.index(facility_line_to_write.split('_')[0])]
+        line_to_write = int(facility_line_to_write.split('_')[1])
+        [expected_plant_sites_to_write, expected_whole_grams_to_write, expected_loose_grams_to_write] = remaining_array[key_idx].tolist()
+        if expected_plant_sites_to_write.is_integer():
+            expected_plant_sites_to_write = int(expected_plant_sites_to_write)
+        all_tuple_to_insert_list += [(allocation_date, facility_id_to_write, line_to_write, crop_id_to_write, expected_plant_sites_to_write, expected_whole_grams_to_write, expected_loose_grams_to_write, facility_line_to_write)]
 
-            tuple_to_insert = line_tuple + (crop_id_to_write, expected_plant_sites_to_write, expected_whole_grams_to_write, expected_loose_grams_to_write,facility_line_to_write)
-            if expected_plant_sites_to_write != 0:
-                all_tuple_to_insert_list += [tuple_to_insert]
     return all_tuple_to_insert_list
 
 
@@ -2194,7 +2457,9 @@ def allocateToNextDay(new_expected_ps_dict):
     
     # output: output_dict = input dictionary with all remaining to be harvested tomorrow moved to the following harvest day
     # output_dict[harvest_date][facility_line][crop_id] = total_plant_sites
-    
+
+    # note: rebuilds the whole dictionary, use HarvestHorizon.advance when stepping through many harvest days
+
     output_dict = {}
     date_tomorrow = list(new_expected_ps_dict.keys())[0]
     date_after_tomorrow = list(new_expected_ps_dict.keys())[1]
@@ -2237,10 +2502,121 @@ def allocateToNextDay(new_expected_ps_dict):
         date_next_value_dictionary = new_expected_ps_dict[date_next]
         output_dict[date_next] = date_next_value_dictionary
         next_date_idx += 1
-        
+
     return output_dict
 
 
+class HarvestHorizon:
+
+    # goal: rolling horizon of expected plant sites that advances one harvest day at a time without rebuilding the dictionary
+    #       (day by day alternative to allocateToNextDay)
+
+    # input: dictionary of expected plant sites
+    # new_expected_ps_dict[harvest_date][facility_line][crop_id] = total_plant_sites
+
+    # state:
+    #   key_list: (facility_line, crop_id) keys in order of first appearance, key_idx_dict maps each key to its array index
+    #   date_deque: harvest dates in dictionary order
+    #   ps_deque: one numpy array of plant sites per harvest date, indexed by key_idx_dict
+    #   scheduled_deque: one boolean array per harvest date, True where the (facility_line, crop_id) is in the dictionary
+
+    # output: nested dictionary views of the horizon (dayDict, toDict)
+    # dayDict()[facility_line][crop_id] = total_plant_sites
+
+    def __init__(self, new_expected_ps_dict):
+
+        self.key_list = []
+        self.key_idx_dict = {}
+        is_integer = True
+        for harvest_date in new_expected_ps_dict.keys():
+            for facility_line in new_expected_ps_dict[harvest_date].keys():
+                for crop_id in new_expected_ps_dict[harvest_date][facility_line].keys():
+                    if (facility_line, crop_id) not in self.key_idx_dict:
+                        self.key_idx_dict[(facility_line, crop_id)] = len(self.key_list)
+                        self.key_list += [(facility_line, crop_id)]
+                    if not isinstance(new_expected_ps_dict[harvest_date][facility_line][crop_id], (int, np.integer)):
+                        is_integer = False
+        self.dtype = np.int64 if is_integer else np.float64
+
+        self.date_deque = deque()
+        self.ps_deque = deque()
+        self.scheduled_deque = deque()
+        for harvest_date in new_expected_ps_dict.keys():
+            ps_array = np.zeros(len(self.key_list), dtype = self.dtype)
+            scheduled_array = np.zeros(len(self.key_list), dtype = bool)
+            for facility_line in new_expected_ps_dict[harvest_date].keys():
+                for crop_id in new_expected_ps_dict[harvest_date][facility_line].keys():
+                    key_idx = self.key_idx_dict[(facility_line, crop_id)]
+                    ps_array[key_idx] = new_expected_ps_dict[harvest_date][facility_line][crop_id]
+                    scheduled_array[key_idx] = True
+            self.date_deque.append(harvest_date)
+            self.ps_deque.append(ps_array)
+            self.scheduled_deque.append(scheduled_array)
+
+    def __len__(self):
+        return len(self.date_deque)
+
+    def currentDate(self):
+        # output: harvest date at the front of the horizon
+        return self.date_deque[0]
+
+    def advance(self):
+
+        # goal: move remaining plant sites of the first harvest date to the next harvest date and drop the first date
+        #       O(lines x crops), the rest of the horizon is untouched
+
+        # output: harvest date that was dropped
+
+        if len(self.date_deque) < 2:
+            raise ValueError('HarvestHorizon needs at least two harvest dates to advance')
+
+        harvest_date = self.date_deque.popleft()
+        ps_array = self.ps_deque.popleft()
+        scheduled_array = self.scheduled_deque.popleft()
+        self.ps_deque[0] += ps_array
+        self.scheduled_deque[0] |= scheduled_array
+
+        return harvest_date
+
+    def plantSites(self, facility_line, crop_id, day_idx = 0):
+        # output: plant sites for the facility line and crop on the harvest date at day_idx (0 if not scheduled)
+        key_idx = self.key_idx_dict.get((facility_line, crop_id))
+        if key_idx is None:
+            return 0
+        return self.ps_deque[day_idx][key_idx].item()
+
+    def allocate(self, facility_line, crop_id, plant_sites, day_idx = 0):
+        # goal: subtract allocated plant sites from the facility line and crop on the harvest date at day_idx
+        key_idx = self.key_idx_dict[(facility_line, crop_id)]
+        self.ps_deque[day_idx][key_idx] -= plant_sites
+
+    def dayDict(self, day_idx = 0):
+
+        # output: nested dictionary view of one harvest date
+        # output_dict[facility_line][crop_id] = total_plant_sites
+
+        output_dict = {}
+        ps_array = self.ps_deque[day_idx]
+        for key_idx in np.flatnonzero(self.scheduled_deque[day_idx]):
+            (facility_line, crop_id) = self.key_list[key_idx]
+            if facility_line not in output_dict:
+                output_dict[facility_line] = {}
+            output_dict[facility_line][crop_id] = ps_array[key_idx].item()
+
+        return output_dict
+
+    def toDict(self):
+
+        # output: nested dictionary view of the whole horizon (same layout as the input dictionary)
+        # output_dict[harvest_date][facility_line][crop_id] = total_plant_sites
+
+        output_dict = {}
+        for day_idx in range(len(self.date_deque)):
+            output_dict[self.date_deque[day_idx]] = self.dayDict(day_idx)
+
+        return output_dict
+
+
 def liveOrderCheck(expected_ps_dict, lsd_date_list):
     
     # goal: add dictionary keys to expected_ps_dict if there are live orders to allocate
@@ -2253,56 +2629,35 @@ def liveOrderCheck(expected_ps_dict, lsd_date_list):
     # new2_expected_ps_dict[harvest_date][facility_line][crop_id] = total_plant_sites
     
 
-    # clean dictionary keys to contain only dates and not datetimes
-    expected_ps_datetime_list = list(expected_ps_dict.keys())
-    #expected_ps_val_list = list(expected_ps_dict.values())
-    expected_ps_date_list = []
-    #new_expected_ps_dict = {}
-    new_expected_ps_dict = expected_ps_dict
-    for d in range(len(expected_ps_datetime_list)):
-        expected_ps_datetime = expected_ps_datetime_list[d]
-        #expected_ps_value = expected_ps_val_list[d]
-        expected_ps_date = expected_ps_datetime.date()
+    # existing harvest dates in dictionary order and as a set for membership checks
+    expected_ps_date_list = list(expected_ps_dict.keys())
+    expected_ps_date_set = set(expected_ps_date_list)
 
-        expected_ps_date_list += [expected_ps_datetime]
-        #new_expected_ps_dict[expected_ps_datetime] = expected_ps_value
-    #print(new_expected_ps_dict.keys())
+    # create sorted list of missing dates in the harvest where there are live orders
 
-    # create list of missing dates in the harvest where there are live orders
-
-    missing_date_list = []
+    missing_date_set = set()
 
     for lsd_order_date in lsd_date_list:
-        lsd_order_date_dt = datetime.combine(lsd_order_date, datetime.min.time()) 
-        if lsd_order_date_dt not in expected_ps_date_list and lsd_order_date_dt not in missing_date_list: 
-            missing_date_list += [lsd_order_date_dt]
+        lsd_order_date_dt = datetime.combine(lsd_order_date, datetime.min.time())
+        if lsd_order_date_dt not in expected_ps_date_set:
+            missing_date_set.add(lsd_order_date_dt)
+
+    missing_date_list = sorted(missing_date_set)
 
     # create new dictionary that includes missing dates as keys with empty values
+    # single merge: each missing date is inserted before the first existing date after it
     new2_expected_ps_dict = {}
-    new_expected_ps_date_list = expected_ps_date_list
-
-    for missing_date in missing_date_list:
-
-        if len(new_expected_ps_date_list) > 0:
-            i = 0
-            while i < len(new_expected_ps_date_list):
-                date_key = new_expected_ps_date_list[i]
-                i += 1
-                date_key_val = new_expected_ps_dict[date_key]
-                if date_key < missing_date:
-                    new2_expected_ps_dict[date_key] = date_key_val
-                    new_expected_ps_date_list = [d for d in new_expected_ps_date_list if d != date_key]
-                    i = 0
-                else:
-                    new2_expected_ps_dict[missing_date] = {}
-        else:
-            new2_expected_ps_dict[missing_date] = {}
+    missing_idx = 0
 
-    # add any remaining dates to the new dictionary
-    for i in range(len(new_expected_ps_date_list)):
-        key = new_expected_ps_date_list[i]
-        value = new_expected_ps_dict[new_expected_ps_date_list[i]]
-        new2_expected_ps_dict[new_expected_ps_date_list[i]] = new_expected_ps_dict[new_expected_ps_date_list[i]]
+    for date_key in expected_ps_date_list:
+        while missing_idx < len(missing_date_list) and missing_date_list[missing_idx] < date_key:
+            new2_expected_ps_dict[missing_date_list[missing_idx]] = {}
+            missing_idx += 1
+        new2_expected_ps_dict[date_key] = expected_ps_dict[date_key]
+
+    # add any remaining missing dates after the last harvest date
+    for missing_date in missing_date_list[missing_idx:]:
+        new2_expected_ps_dict[missing_date] = {}
 
     return new2_expected_ps_dict
 
@@ -2590,6 +2945,311 @@ def yearOverYearAverage(source_dict,facility_line,crop_id,harvest_date):
 
 
 
+class DimensionCache:
+
+    # goal: local snapshot of slow changing dimensions so startup reads a file instead of re-pulling the warehouse
+    #       a dimension is re-pulled only when its snapshot is older than the TTL or its row count/checksum changed
+
+    # input:
+    # cnxn_cursor: open pyodbc cursor
+    # cache_dir: directory holding one .npz file per dimension (created if missing)
+    # ttl_hours: age in hours after which a snapshot is re-pulled regardless of the checksum
+
+    # state: one .npz per dimension, read without pickle (allow_pickle = False), containing
+    #   col_0 ... col_n: column arrays (typed when the column has one python type, otherwise a unicode array of JSON values
+    #                    with dates, datetimes, and decimals tagged, see jsonValue)
+    #   json_columns: indices of the JSON columns
+    #   load_timestamp: unix time of the pull
+    #   row_count, checksum: result of the validation query at pull time
+    #   sql: query the snapshot was pulled with (a changed query forces a re-pull)
+
+    # output: rows(...) returns the dimension as a list of row tuples, the same rows cnxn_cursor.fetchone() would give
+
+    def __init__(self, cnxn_cursor, cache_dir = None, ttl_hours = 12):
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dimension_cache')
+        self.cnxn_cursor = cnxn_cursor
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_hours * 3600
+        os.makedirs(self.cache_dir, exist_ok = True)
+
+    def path(self, table_name):
+        return os.path.join(self.cache_dir, table_name + '.npz')
+
+    @staticmethod
+    def jsonValue(value):
+
+        # output: JSON serializable form of a dimension value (types without a JSON form are tagged by name)
+
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, datetime):
+            return {'datetime': value.isoformat()}
+        if isinstance(value, date):
+            return {'date': value.isoformat()}
+        if isinstance(value, decimal.Decimal):
+            return {'decimal': str(value)}
+        raise TypeError('DimensionCache cannot store ' + type(value).__name__ + ' values')
+
+    @staticmethod
+    def pythonValue(json_dict):
+
+        # output: dimension value of a tagged JSON value (json.loads object_hook)
+
+        if 'datetime' in json_dict:
+            return datetime.fromisoformat(json_dict['datetime'])
+        if 'date' in json_dict:
+            return date.fromisoformat(json_dict['date'])
+        if 'decimal' in json_dict:
+            return decimal.Decimal(json_dict['decimal'])
+        return json_dict
+
+    def validation(self, table_name, validation_sql = None):
+
+        # output: (row count, checksum) of the dimension in the warehouse, one cheap aggregate round trip
+
+        if validation_sql is None:
+            validation_sql = "SELECT COUNT_BIG(*), CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM " + table_name
+        self.cnxn_cursor.execute(validation_sql)
+        row = self.cnxn_cursor.fetchone()
+        row_count = int(row[0])
+        checksum = 0
+        if row[1] is not None:
+            checksum = int(row[1])
+        return (row_count, checksum)
+
+    def rows(self, table_name, sql, validation_sql = None, refresh = 0):
+
+        # goal: return the rows of sql from the snapshot if it is still valid, otherwise pull and store a new snapshot
+
+        # input:
+        # table_name: dimension name, also the snapshot file name
+        # sql: query that pulls the dimension
+        # validation_sql: query returning (row count, checksum), defaults to COUNT_BIG/CHECKSUM_AGG over table_name
+        # refresh: 1 to re-pull regardless of the snapshot
+
+        [row_count, checksum] = self.validation(table_name, validation_sql)
+        cache_path = self.path(table_name)
+
+        if refresh == 0 and os.path.exists(cache_path):
+            with np.load(cache_path, allow_pickle = False) as snapshot:
+                # snapshots written before the JSON columns (object arrays, no json_columns) are re-pulled
+                is_valid = ('json_columns' in snapshot.files
+                            and str(snapshot['sql']) == sql
+                            and time.time() - float(snapshot['load_timestamp']) < self.ttl_seconds
+                            and int(snapshot['row_count']) == row_count
+                            and int(snapshot['checksum']) == checksum)
+                if is_valid:
+                    column_count = int(snapshot['column_count'])
+                    json_column_set = set(snapshot['json_columns'].tolist())
+                    column_LoL = list()
+                    for col_idx in range(column_count):
+                        column_list = snapshot['col_' + str(col_idx)].tolist()
+                        if col_idx in json_column_set:
+                            column_list = [json.loads(val, object_hook = self.pythonValue) for val in column_list]
+                        column_LoL += [column_list]
+                    return list(zip(*column_LoL))
+
+        self.cnxn_cursor.execute(sql)
+        column_count = len(self.cnxn_cursor.description)
+        row_list = [tuple(row) for row in self.cnxn_cursor.fetchall()]
+
+        column_dict = {}
+        json_column_list = []
+        for col_idx in range(column_count):
+            column_list = [row[col_idx] for row in row_list]
+            type_set = set(type(val) for val in column_list)
+            column_array = None
+            if len(type_set) == 1 and type_set.pop() in (int, float, str, bool):
+                column_array = np.array(column_list)
+            # mixed types, None, dates, and ints beyond int64 are stored as JSON text (no object arrays, no pickle)
+            if column_array is None or column_array.dtype == object:
+                try:
+                    column_array = np.array([json.dumps(self.jsonValue(val)) for val in column_list], dtype = str)
+                except TypeError as error:
+                    print('DimensionCache: ' + table_name + ' not cached, ' + str(error))
+                    return row_list
+                json_column_list += [col_idx]
+            column_dict['col_' + str(col_idx)] = column_array
+
+        # write to a temporary file and swap it in so a concurrent reader never sees a partial snapshot
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'wb') as cache_file:
+            np.savez(cache_file, sql = np.array(sql), load_timestamp = np.array(time.time()), row_count = np.array(row_count),
+                     checksum = np.array(checksum), column_count = np.array(column_count),
+                     json_columns = np.array(json_column_list, dtype = np.int64), **column_dict)
+        os.replace(tmp_path, cache_path)
+
+        return row_list
+
+    def invalidate(self, table_name):
+        # goal: drop the snapshot of a dimension so the next rows(...) call re-pulls it
+        if os.path.exists(self.path(table_name)):
+            os.remove(self.path(table_name))
+
+
+
+
+# fact tables exported by ParquetSink: (column, type) in the INSERT order of the baseline table
+# types: 'int', 'float', 'date', 'datetime'; the pending tables share the schema of their baseline table
+fact_schema_dict = {
+    'CustomerInventoryAllocation_Facts': [('CustomerInventoryAllocationID', 'int'), ('AllocationDate', 'date'), ('FacilityID', 'int'),
+                                          ('ProductID', 'int'), ('EnjoyByDate', 'date'), ('CustomerID', 'int'), ('StartOfDayQty', 'float'),
+                                          ('AllocatedQty', 'float'), ('EndOfDayQty', 'float'), ('Tier', 'int'), ('LoadDate', 'datetime'),
+                                          ('ToDate', 'datetime'), ('IsActive', 'int')],
+    'CustomerHarvestAllocation_Facts': [('CustomerHarvestAllocationID', 'int'), ('DemandAllocationDate', 'date'), ('DemandDate', 'date'),
+                                        ('HarvestFacilityID', 'int'), ('DemandFacilityID', 'int'), ('CropID', 'int'), ('ProductID', 'int'),
+                                        ('CustomerID', 'int'), ('ForecastedGPPS', 'float'), ('AllocatedPlantSites', 'float'),
+                                        ('AllocatedGrams', 'float'), ('AllocatedQty', 'float'), ('FullPackout', 'int'), ('Tier', 'int'),
+                                        ('LoadDate', 'datetime'), ('ToDate', 'datetime'), ('IsActive', 'int')],
+    'CustomerShortDemand_Facts': [('CustomerShortDemandID', 'int'), ('DemandDate', 'date'), ('DemandAllocationDate', 'date'),
+                                  ('FacilityID', 'int'), ('ProductID', 'int'), ('CustomerID', 'int'), ('ShortDemandQty', 'float'),
+                                  ('LoadDate', 'datetime'), ('ToDate', 'datetime'), ('IsActive', 'int')],
+    # StopSell_Facts repeats the facility ID in a tenth column that StopSellPending_Facts does not have, it is not exported
+    'StopSell_Facts': [('StopSellID', 'int'), ('StopSellDate', 'date'), ('FacilityID', 'int'), ('ProductID', 'int'), ('EnjoyByDate', 'date'),
+                       ('StopSellQty', 'float'), ('LoadDate', 'datetime'), ('ToDate', 'datetime'), ('IsActive', 'int')],
+    'HarvestForecast_Facts': [('HarvestForecastID', 'int'), ('HarvestDate', 'date'), ('FacilityID', 'int'), ('FacilityLineID', 'int'),
+                              ('CropID', 'int'), ('ExpectedPlantSites', 'int'), ('ExpectedWholeGrams', 'float'), ('ExpectedLooseGrams', 'float'),
+                              ('ExpectedClamshells', 'int'), ('Expected12Pack', 'int'), ('WholeSpatialPrecision', 'int'),
+                              ('LooseSpatialPrecision', 'int'), ('AvgHeadweight', 'float'), ('PlantSitesPerClam', 'float'),
+                              ('LooseGramsPerPlantSite', 'float'), ('OptimizedTrailLengthAvgHeadweight', 'int'),
+                              ('OptimizedTrailLengthPSPC', 'int'), ('LoadDate', 'datetime'), ('ToDate', 'datetime'), ('IsActive', 'int')],
+    'OrderForecast_Facts': [('OrderForecastID', 'int'), ('OrderDate', 'date'), ('FacilityID', 'int'), ('CustomersID', 'int'), ('ItemID', 'int'),
+                            ('ExpectedOrderQty', 'int'), ('StdExpectedOrderQty', 'float'), ('LiveSalesOrderQty', 'int'),
+                            ('OrderAllocationDate', 'date'), ('LoadDate', 'datetime'), ('ToDate', 'datetime'), ('IsActive', 'int')]}
+
+
+
+def factColumnValue(value, column_type):
+
+    # goal: convert one written value (python, numpy, or pyodbc type) to the python type of its Parquet column
+
+    if value is None:
+        return None
+    if column_type == 'int':
+        return int(value)
+    if column_type == 'float':
+        return float(value)
+    if column_type == 'date':
+        if isinstance(value, datetime):
+            return value.date()
+        return value
+    return value
+
+
+
+class ParquetSink:
+
+    # goal: write the rows of each fact table write as a partitioned Parquet dataset next to the SQL insert
+    #       the rows come from the in-memory tuples the writers insert, no table is read back from the database
+
+    # input:
+    # root_dir: dataset root directory (created if missing)
+    # load_date: run load date of the partition (defaults to the time the sink is created, one partition per run)
+
+    # state: one part file per write call
+    #   root_dir/<table>/RunLoadDate=<YYYY-mm-dd_HHMMSS>/AllocationTier=<tier>/IsPending=<0|1>/part-<sequence>.parquet
+    #   tables without a tier (forecasts) are written to AllocationTier=0
+    #   the partition keys are named apart from the LoadDate and Tier columns so a hive-partitioned read keeps both
+
+    # output: write(...) returns the path of the part file (None when there are no rows)
+    #         rollback(part_sequence) deletes the part files of the run written after part_sequence (resumed runs)
+    # pyarrow is imported on the first write so jobs without a Parquet export do not need it
+
+    def __init__(self, root_dir, load_date = None):
+        if load_date is None:
+            load_date = datetime.now()
+        self.root_dir = root_dir
+        self.load_date = load_date
+        self.load_date_str = load_date.strftime('%Y-%m-%d_%H%M%S')
+        self.lock = threading.Lock()
+        os.makedirs(self.root_dir, exist_ok = True)
+
+        # a sink reopened on the load date of an earlier run continues its part sequence
+        self.part_sequence = max([self.partSequence(file_name) for (dir_path, file_name) in self.runFiles() if file_name.startswith('part-')], default = 0)
+
+    def runFiles(self):
+        # (directory, file name) of every file of this run in the dataset
+        run_file_list = []
+        for table_name in fact_schema_dict:
+            run_dir = os.path.join(self.root_dir, table_name, 'RunLoadDate=' + self.load_date_str)
+            for (dir_path, dir_name_list, file_name_list) in os.walk(run_dir):
+                run_file_list += [(dir_path, file_name) for file_name in file_name_list]
+        return run_file_list
+
+    @staticmethod
+    def partSequence(file_name):
+        return int(file_name[len('part-'):].split('.')[0])
+
+    def partitionDir(self, table_name, tier = 0, is_pending = 0):
+        return os.path.join(self.root_dir, table_name, 'RunLoadDate=' + self.load_date_str, 'AllocationTier=' + str(int(tier)), 'IsPending=' + str(int(is_pending)))
+
+    def table(self, table_name, row_list):
+
+        # goal: column arrays of the rows typed by fact_schema_dict
+
+        import pyarrow as pa
+
+        schema_list = fact_schema_dict[table_name]
+        column_array_list = []
+        for (col_idx, (column_name, column_type)) in enumerate(schema_list):
+            column_list = [factColumnValue(row[col_idx], column_type) for row in row_list]
+            arrow_type = {'int': pa.int64(), 'float': pa.float64(), 'date': pa.date32(), 'datetime': pa.timestamp('us')}[column_type]
+            column_array_list += [pa.array(column_list, type = arrow_type)]
+        return pa.Table.from_arrays(column_array_list, names = [column_name for (column_name, column_type) in schema_list])
+
+    def write(self, table_name, row_list, tier = 0, is_pending = 0):
+
+        # goal: write one part file of a fact table partition
+
+        # input:
+        # table_name: baseline fact table name in fact_schema_dict (pending writes use the baseline name with is_pending = 1)
+        # row_list: tuples in the INSERT order of the table (extra trailing values are dropped)
+        # tier: tier count of the rows
+        # is_pending: 1 for rows of the Pending table, 0 for the baseline table
+
+        if len(row_list) == 0:
+            return None
+
+        import pyarrow.parquet as pq
+
+        arrow_table = self.table(table_name, row_list)
+        partition_dir = self.partitionDir(table_name, tier, is_pending)
+        os.makedirs(partition_dir, exist_ok = True)
+        with self.lock:
+            self.part_sequence += 1
+            part_name = 'part-' + str(self.part_sequence).zfill(5) + '.parquet'
+        part_path = os.path.join(partition_dir, part_name)
+
+        # write to a hidden temporary file and swap it in so a reader of the dataset never sees a partial part file
+        tmp_path = os.path.join(partition_dir, '.' + part_name + '.tmp')
+        pq.write_table(arrow_table, tmp_path)
+        os.replace(tmp_path, part_path)
+
+        return part_path
+
+    def rollback(self, part_sequence):
+
+        # goal: drop the part files of this run written after a checkpoint, the next write continues the sequence from there
+
+        # input:
+        # part_sequence: part_sequence of the sink when the checkpoint was recorded
+
+        # output: number of part files deleted (temporary files of interrupted writes included)
+
+        deleted_count = 0
+        with self.lock:
+            for (dir_path, file_name) in self.runFiles():
+                is_tmp = file_name.startswith('.part-') and file_name.endswith('.tmp')
+                is_late_part = file_name.startswith('part-') and self.partSequence(file_name) > part_sequence
+                if is_tmp or is_late_part:
+                    os.remove(os.path.join(dir_path, file_name))
+                    deleted_count += 1
+            self.part_sequence = part_sequence
+        return deleted_count
+
+
+
 
 #print('functions loaded')
 
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Gotham Greens Job Launcher
+
+# Forecasting + Production Planning
+#
+# One command line entry point per scheduled job:
+#   python GothamJobs.py order-forecast
+#   python GothamJobs.py harvest-forecast
+#   python GothamJobs.py facility-line-dim
+#   python GothamJobs.py customer-allocations [job arguments]
+#   python GothamJobs.py run-diff <run A> <run B> [diff arguments]
+#
+# --import-profile runs only the import statements of the job script (not the job) in a child interpreter
+# with python -X importtime and reports import time per top-level module, slowest first
+#
+# only the standard library is imported here; each job imports numpy/pyodbc/etc. itself when its
+# script reaches the stage that needs them
+
+import argparse
+import ast
+import os
+import re
+import runpy
+import subprocess
+import sys
+
+# job name: script in this folder
+job_script_dict = {'order-forecast': 'FPP_OrderForecast_Facts_NewLoad_G_TST.py',
+                   'harvest-forecast': 'FPP_HarvestForecast_Facts_Initialization_G_TST.py',
+                   'facility-line-dim': 'FacilityLine_Dim.py',
+                   'customer-allocations': 'CustomerAllocations_DEV.py',
+                   'run-diff': 'RunDiff.py'}
+
+job_dir = os.path.dirname(os.path.abspath(__file__))
+
+# modules a job runs without (the Parquet export); a missing module outside this set fails the import profile
+optional_module_set = {'pyarrow'}
+
+# python -X importtime stderr line: "import time:  self [us] | cumulative | imported package"
+importtime_pattern = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+
+def scriptPath(job_name):
+    return os.path.join(job_dir, job_script_dict[job_name])
+
+
+def runJob(job_name, job_args = None):
+
+#     goal: run a job script in this interpreter as if it were launched directly
+
+#     input: job name from job_script_dict, optional list of arguments passed on to the script
+
+#     output: global namespace of the finished script (dictionary)
+
+    script_path = scriptPath(job_name)
+    if job_args is None:
+        job_args = []
+
+    # the scripts read config.yml from sys.path[0] and their own arguments from sys.argv
+    saved_argv = sys.argv
+    saved_path = list(sys.path)
+    sys.argv = [script_path] + list(job_args)
+    sys.path.insert(0, job_dir)
+    try:
+        return runpy.run_path(script_path, run_name = '__main__')
+    finally:
+        sys.argv = saved_argv
+        sys.path[:] = saved_path
+
+
+def scriptImports(job_name):
+
+#     goal: import statements a job script runs outside of its functions and classes
+
+#     input: job name from job_script_dict
+
+#     output: list of import statements (source strings) in script order, imports inside the cells' if blocks included
+
+    with open(scriptPath(job_name), 'r') as script_file:
+        script_tree = ast.parse(script_file.read())
+
+    import_list = []
+
+    def visit(node):
+        for child in ast.iter_child_nodes(node):
+            # imports inside functions and classes only run when they are called
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)):
+                continue
+            if isinstance(child, (ast.Import, ast.ImportFrom)):
+                import_str = ast.unparse(child)
+                if import_str not in import_list:
+                    import_list.append(import_str)
+                continue
+            visit(child)
+
+    visit(script_tree)
+    return import_list
+
+
+def profileImports(job_name, top_count = 25):
+
+#     goal: run the import statements of a job in a child interpreter with -X importtime and report import time per module
+#           the job itself does not run, so no database is read or written
+
+#     input: job name from job_script_dict, number of modules to report
+
+#     output: list of (module, self microseconds, cumulative microseconds) for top-level imports sorted by cumulative time,
+#             return code of the child interpreter
+
+    # optional modules that are not installed are skipped (and listed on stderr), as the job would skip the stage that needs them;
+    # any other import error stops the child interpreter with its traceback and a non-zero return code
+    import_code = ''
+    for import_str in scriptImports(job_name):
+        import_node = ast.parse(import_str).body[0]
+        if isinstance(import_node, ast.ImportFrom):
+            module_name_list = [import_node.module or '']
+        else:
+            module_name_list = [alias.name for alias in import_node.names]
+        if all(module_name.split('.')[0] in optional_module_set for module_name in module_name_list):
+            import_code += ('try:\n    ' + import_str + '\nexcept ImportError:\n'
+                            '    import sys\n    sys.stderr.write(' + repr('skipped optional import: ' + import_str + '\n') + ')\n')
+        else:
+            import_code += import_str + '\n'
+
+    # the scripts import GothamFunctions from their own folder
+    command = [sys.executable, '-X', 'importtime', '-c', import_code]
+    process = subprocess.Popen(command, stderr = subprocess.PIPE, universal_newlines = True, cwd = job_dir)
+
+    import_time_list = []
+    for line in process.stderr:
+        match = importtime_pattern.match(line)
+        if match is None:
+            # other output on stderr passes through (except the importtime header)
+            if not line.startswith('import time:'):
+                sys.stderr.write(line)
+            continue
+        (self_us, cumulative_us, indent, module_name) = match.groups()
+        # top-level imports only, nested imports are included in their parent's cumulative time
+        if len(indent) <= 1:
+            import_time_list += [(module_name, int(self_us), int(cumulative_us))]
+    return_code = process.wait()
+
+    import_time_list.sort(key = lambda x: x[2], reverse = True)
+
+    total_us = sum(x[2] for x in import_time_list)
+    print('import profile: ' + job_name + ' ' + str(round(total_us / 1e6, 3)) + ' s in ' + str(len(import_time_list)) + ' top-level imports')
+    print('{:>12} {:>12}  {}'.format('self [ms]', 'cumul [ms]', 'module'))
+    for (module_name, self_us, cumulative_us) in import_time_list[:top_count]:
+        print('{:>12.1f} {:>12.1f}  {}'.format(self_us / 1e3, cumulative_us / 1e3, module_name))
+
+    return (import_time_list, return_code)
+
+
+def orderForecast(job_args = None):
+    return runJob('order-forecast', job_args)
+
+
+def harvestForecast(job_args = None):
+    return runJob('harvest-forecast', job_args)
+
+
+def facilityLineDim(job_args = None):
+    return runJob('facility-line-dim', job_args)
+
+
+def customerAllocations(job_args = None):
+    return runJob('customer-allocations', job_args)
+
+
+def runDiff(job_args = None):
+    return runJob('run-diff', job_args)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Gotham Greens forecasting and allocation jobs')
+    parser.add_argument('job', choices = sorted(job_script_dict.keys()), help = 'job to run')
+    parser.add_argument('--import-profile', action = 'store_true', help = 'report import time per module of the job imports (python -X importtime), without running the job')
+    parser.add_argument('--import-profile-top', type = int, default = 25, help = 'number of modules in the import profile report')
+    (args, job_args) = parser.parse_known_args(argv)
+
+    if args.import_profile:
+        (import_time_list, return_code) = profileImports(args.job, args.import_profile_top)
+        return return_code
+
+    runJob(args.job, job_args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
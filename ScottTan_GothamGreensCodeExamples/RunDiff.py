@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Gotham Greens Run Diff
+
+# Forecasting + Production Planning
+#
+# Compares the fact table outputs of two runs, e.g. before and after an allocation engine change:
+#   python RunDiff.py sql:2026-10-18 sql:2026-10-19
+#   python RunDiff.py sql:2026-10-19T06:00..2026-10-19T07:30 sql:active
+#   python RunDiff.py 2026-10-19_061502 2026-10-19_074410 --parquet-dir exports
+#   python RunDiff.py sql:2026-10-19 latest --parquet-dir exports --tables CustomerShortDemand_Facts
+#
+# a run is one of
+#   sql:<YYYY-mm-dd>   rows loaded into the *_Facts (and *Pending_Facts) tables on that day, active and superseded
+#                      (IsActive = 0), so every run of that day
+#   sql:<from>..<to>   rows with <from> <= LoadDate < <to> (ISO timestamps, e.g. 2026-10-19T06:00), one run of a day with several
+#   sql:active         current rows (IsActive = 1), i.e. the last run that replaced each table
+#   sql:active,<YYYY-mm-dd> or sql:active,<from>..<to>   both filters
+#   <RunLoadDate>      RunLoadDate partition of a Parquet export (--parquet-dir, see GothamFunctions.ParquetSink)
+#   latest             most recent RunLoadDate partition of each table in the Parquet export
+#
+# rows are joined on the natural key of each table (date, greenhouse, product, customer, enjoy-by, tier, is_pending),
+# quantities are summed per key, and the row, quantity, and short demand deltas are reported per table
+# the join is vectorized with numpy (one sort of the stacked key columns of both runs)
+#
+# exit code 1 when the runs differ, so the diff can gate turning on a faster engine
+
+import argparse
+import datetime as DT
+import os
+import socket
+import sys
+
+import numpy as np
+import yaml
+
+import GothamFunctions
+
+# natural key columns and compared quantity columns per fact table (IsPending is always part of the key)
+diff_spec_dict = {
+    'CustomerInventoryAllocation_Facts': (['AllocationDate', 'FacilityID', 'ProductID', 'CustomerID', 'EnjoyByDate', 'Tier'],
+                                          ['AllocatedQty', 'StartOfDayQty', 'EndOfDayQty']),
+    'CustomerHarvestAllocation_Facts': (['DemandAllocationDate', 'DemandDate', 'HarvestFacilityID', 'DemandFacilityID', 'CropID', 'ProductID', 'CustomerID', 'Tier'],
+                                        ['AllocatedQty', 'AllocatedGrams', 'AllocatedPlantSites']),
+    'CustomerShortDemand_Facts': (['DemandAllocationDate', 'DemandDate', 'FacilityID', 'ProductID', 'CustomerID'],
+                                  ['ShortDemandQty']),
+    'StopSell_Facts': (['StopSellDate', 'FacilityID', 'ProductID', 'EnjoyByDate'],
+                       ['StopSellQty']),
+    'HarvestForecast_Facts': (['HarvestDate', 'FacilityID', 'FacilityLineID', 'CropID'],
+                              ['ExpectedPlantSites', 'ExpectedLooseGrams', 'ExpectedClamshells']),
+    'OrderForecast_Facts': (['OrderDate', 'FacilityID', 'CustomersID', 'ItemID'],
+                            ['ExpectedOrderQty'])}
+
+# tables written to a Pending table as well (<table>Pending_Facts)
+pending_table_set = {'CustomerInventoryAllocation_Facts', 'CustomerHarvestAllocation_Facts', 'CustomerShortDemand_Facts', 'StopSell_Facts'}
+
+sql_fetch_size = 100000
+
+
+def connectionString():
+    HOSTNAME = socket.gethostname()
+
+    if HOSTNAME == 'hostname':
+        CONNECTIONSTRING = """Driver={ODBC Driver 17 for SQL Server};
+                                Server=127.0.0.1,1443;
+                                Database=databasename;
+                                trusted_connection=yes""" # use windows auth on DB01
+    else:
+        with open(os.path.join(sys.path[0], "config.yml"), 'r') as ymlfile:
+            cfg = yaml.load(ymlfile, Loader=yaml.SafeLoader)
+    #    uid = cfg['databasename']['uid']
+        uid = 'sa'
+        pwd = cfg['databasename']['pwd'][:-3]
+        CONNECTIONSTRING = """Driver={ODBC Driver 17 for SQL Server};
+                                Server=hostname\\MSSQLSERVER1;
+                                Database=databasename;
+                                UID=%s;
+                                PWD=%s;""" % (uid, pwd) # use config.yml on local machine
+    return CONNECTIONSTRING
+
+
+def columnArray(value_list, column_type):
+
+#     goal: numpy array of one fact column, missing values as NaT/NaN
+
+    if column_type == 'date':
+        return np.array([GothamFunctions.factColumnValue(value, 'date') for value in value_list], dtype = 'datetime64[D]')
+    if column_type == 'datetime':
+        return np.array(value_list, dtype = 'datetime64[us]')
+    return np.array([np.nan if value is None else value for value in value_list], dtype = np.float64)
+
+
+def sqlRunFilter(run_filter):
+
+#     goal: WHERE clause of the rows a sql: run selects
+
+#     input: run filter after 'sql:' (<YYYY-mm-dd>, <from>..<to>, active, or active,<YYYY-mm-dd>/active,<from>..<to>)
+
+#     output: (WHERE clause with ? parameters, parameter list)
+
+    condition_list = []
+    parameter_list = []
+    for part in run_filter.split(','):
+        try:
+            if part == 'active':
+                condition_list += ['IsActive = 1']
+            elif '..' in part:
+                (from_str, to_str) = part.split('..', 1)
+                condition_list += ['LoadDate >= ?', 'LoadDate < ?']
+                parameter_list += [DT.datetime.fromisoformat(from_str), DT.datetime.fromisoformat(to_str)]
+            else:
+                # whole day as a LoadDate range (instead of CONVERT(Date, LoadDate), so an index on LoadDate is used)
+                load_date = DT.datetime.strptime(part, '%Y-%m-%d')
+                condition_list += ['LoadDate >= ?', 'LoadDate < ?']
+                parameter_list += [load_date, load_date + DT.timedelta(days = 1)]
+        except ValueError:
+            raise ValueError('run sql:' + run_filter + ' is not sql:<YYYY-mm-dd>, sql:<from>..<to>, or sql:active[,<YYYY-mm-dd>|,<from>..<to>]')
+    return (' AND '.join(condition_list), parameter_list)
+
+
+def readSqlRun(cnxn_cursor, table_name, run_filter, column_name_list):
+
+#     goal: read the rows of a run from a fact table and its pending table
+
+#     input: open pyodbc cursor, fact table name, run filter after 'sql:' (see sqlRunFilter), columns to return
+
+#     output: dictionary column name: numpy array, including IsPending
+
+    schema_list = GothamFunctions.fact_schema_dict[table_name]
+    column_idx_dict = dict((column_name, col_idx) for (col_idx, (column_name, column_type)) in enumerate(schema_list))
+    column_type_dict = dict(schema_list)
+
+    source_list = [(table_name, 0)]
+    if table_name in pending_table_set:
+        source_list += [(table_name.replace('_Facts', 'Pending_Facts'), 1)]
+
+    (where_sql, parameter_list) = sqlRunFilter(run_filter)
+
+    value_LoL = [[] for column_name in column_name_list]
+    is_pending_list = []
+    for (source_table_name, is_pending) in source_list:
+        # columns are read by position in the INSERT order of fact_schema_dict
+        sql = "SELECT * FROM " + source_table_name + " WHERE " + where_sql
+        cnxn_cursor.execute(sql, *parameter_list)
+        row_list = cnxn_cursor.fetchmany(sql_fetch_size)
+        while len(row_list) > 0:
+            for (col_idx, column_name) in enumerate(column_name_list):
+                schema_idx = column_idx_dict[column_name]
+                value_LoL[col_idx] += [row[schema_idx] for row in row_list]
+            is_pending_list += [is_pending] * len(row_list)
+            row_list = cnxn_cursor.fetchmany(sql_fetch_size)
+
+    column_dict = {}
+    for (col_idx, column_name) in enumerate(column_name_list):
+        column_dict[column_name] = columnArray(value_LoL[col_idx], column_type_dict[column_name])
+    column_dict['IsPending'] = np.array(is_pending_list, dtype = np.float64)
+    return column_dict
+
+
+def parquetRunLoadDates(parquet_dir, table_name):
+    table_dir = os.path.join(parquet_dir, table_name)
+    if not os.path.isdir(table_dir):
+        return []
+    return sorted(name.split('=', 1)[1] for name in os.listdir(table_dir) if name.startswith('RunLoadDate='))
+
+
+def readParquetRun(parquet_dir, table_name, run_load_date, column_name_list):
+
+#     goal: read the rows of a run from the Parquet export of a fact table
+
+#     input: export root directory, fact table name, RunLoadDate partition value or 'latest', columns to return
+
+#     output: dictionary column name: numpy array, including IsPending (empty arrays if the run has no partition)
+
+    import pyarrow.dataset as ds
+
+    if run_load_date == 'latest':
+        run_load_date_list = parquetRunLoadDates(parquet_dir, table_name)
+        run_load_date = None
+        if len(run_load_date_list) > 0:
+            run_load_date = run_load_date_list[-1]
+
+    column_type_dict = dict(GothamFunctions.fact_schema_dict[table_name])
+    run_dir = os.path.join(parquet_dir, table_name, 'RunLoadDate=' + str(run_load_date))
+    if run_load_date is None or not os.path.isdir(run_dir):
+        column_dict = dict((column_name, columnArray([], column_type_dict[column_name])) for column_name in column_name_list)
+        column_dict['IsPending'] = np.array([], dtype = np.float64)
+        return column_dict
+
+    arrow_table = ds.dataset(run_dir, format = 'parquet', partitioning = 'hive').to_table(columns = column_name_list + ['IsPending'])
+
+    column_dict = {}
+    for column_name in column_name_list + ['IsPending']:
+        column_array = arrow_table.column(column_name).to_numpy()
+        if column_type_dict.get(column_name) == 'date':
+            column_dict[column_name] = column_array.astype('datetime64[D]')
+        else:
+            column_dict[column_name] = column_array.astype(np.float64)
+    return column_dict
+
+
+def keyMatrix(column_dict, key_name_list):
+
+#     goal: stack the key columns into one int64 matrix (dates as days since 1970, missing values as the int64 minimum)
+
+    key_column_list = []
+    for key_name in key_name_list:
+        column_array = column_dict[key_name]
+        if np.issubdtype(column_array.dtype, np.datetime64):
+            key_column_list += [column_array.astype('datetime64[D]').astype(np.int64)]
+        else:
+            key_column_list += [np.where(np.isnan(column_array), np.iinfo(np.int64).min, np.round(column_array)).astype(np.int64)]
+    return np.stack(key_column_list, axis = 1).reshape(-1, len(key_name_list))
+
+
+def keyString(key_row, key_name_list, table_name):
+    column_type_dict = dict(GothamFunctions.fact_schema_dict[table_name])
+    key_str_list = []
+    for (key_name, key_value) in zip(key_name_list, key_row):
+        if key_value == np.iinfo(np.int64).min:
+            key_str_list += [key_name + '=NULL']
+        elif column_type_dict.get(key_name) == 'date':
+            key_str_list += [key_name + '=' + str(np.datetime64(int(key_value), 'D'))]
+        else:
+            key_str_list += [key_name + '=' + str(key_value)]
+    return ' '.join(key_str_list)
+
+
+def diffTable(table_name, column_dict_a, column_dict_b, tolerance = 1e-6, top_count = 10):
+
+#     goal: join two runs of a fact table on its natural key and report row and quantity deltas
+
+#     input: fact table name, column dictionaries of run A and run B (readSqlRun/readParquetRun), absolute tolerance
+#            for quantity differences, number of differing keys to print
+
+#     output: dictionary with row counts, key counts, and per quantity totals and deltas; is_different is True if
+#             any key is missing from one run or differs in row count or quantity
+
+    (key_name_list, metric_name_list) = diff_spec_dict[table_name]
+    key_name_list = key_name_list + ['IsPending']
+
+    key_matrix_a = keyMatrix(column_dict_a, key_name_list)
+    key_matrix_b = keyMatrix(column_dict_b, key_name_list)
+    row_count_a = key_matrix_a.shape[0]
+    row_count_b = key_matrix_b.shape[0]
+
+    # one sort of both runs: group index per row, rows of the same key in A and B share a group
+    (unique_key_matrix, group_idx_array) = np.unique(np.concatenate([key_matrix_a, key_matrix_b]), axis = 0, return_inverse = True)
+    group_idx_array = group_idx_array.reshape(-1)
+    group_count = unique_key_matrix.shape[0]
+    group_idx_a = group_idx_array[:row_count_a]
+    group_idx_b = group_idx_array[row_count_a:]
+
+    key_row_count_a = np.bincount(group_idx_a, minlength = group_count)
+    key_row_count_b = np.bincount(group_idx_b, minlength = group_count)
+    is_in_a = key_row_count_a > 0
+    is_in_b = key_row_count_b > 0
+
+    is_key_different = (key_row_count_a != key_row_count_b)
+    key_delta_size = np.zeros(group_count)
+    metric_dict = {}
+    for metric_name in metric_name_list:
+        metric_sum_a = np.bincount(group_idx_a, weights = np.nan_to_num(column_dict_a[metric_name]), minlength = group_count)
+        metric_sum_b = np.bincount(group_idx_b, weights = np.nan_to_num(column_dict_b[metric_name]), minlength = group_count)
+        metric_delta = metric_sum_b - metric_sum_a
+        is_key_different |= np.abs(metric_delta) > tolerance
+        key_delta_size = np.maximum(key_delta_size, np.abs(metric_delta))
+        metric_dict[metric_name] = {'total_a': float(metric_sum_a.sum()),
+                                    'total_b': float(metric_sum_b.sum()),
+                                    'delta': float(metric_delta.sum()),
+                                    'max_key_delta': float(np.abs(metric_delta).max()) if group_count > 0 else 0.0,
+                                    'key_delta_array': metric_delta}
+
+    diff_dict = {'table_name': table_name,
+                 'row_count_a': row_count_a,
+                 'row_count_b': row_count_b,
+                 'key_count': group_count,
+                 'key_count_only_a': int(np.count_nonzero(is_in_a & ~is_in_b)),
+                 'key_count_only_b': int(np.count_nonzero(is_in_b & ~is_in_a)),
+                 'key_count_changed': int(np.count_nonzero(is_key_different & is_in_a & is_in_b)),
+                 'metric_dict': metric_dict,
+                 'is_different': bool(is_key_different.any())}
+
+    print(table_name + ': ' + ('DIFFERENT' if diff_dict['is_different'] else 'same'))
+    print('  rows: A ' + str(row_count_a) + '  B ' + str(row_count_b) + '  delta ' + str(row_count_b - row_count_a))
+    print('  keys: ' + str(group_count) + ' total, ' + str(diff_dict['key_count_only_a']) + ' only in A, ' + str(diff_dict['key_count_only_b'])
+          + ' only in B, ' + str(diff_dict['key_count_changed']) + ' changed')
+    for metric_name in metric_name_list:
+        metric = metric_dict[metric_name]
+        print('  {}: A {:.3f}  B {:.3f}  delta {:.3f}  max key delta {:.3f}'.format(metric_name, metric['total_a'], metric['total_b'], metric['delta'], metric['max_key_delta']))
+
+    # largest differences first
+    different_idx_array = np.flatnonzero(is_key_different)
+    different_idx_array = different_idx_array[np.argsort(-key_delta_size[different_idx_array], kind = 'stable')]
+    for group_idx in different_idx_array[:top_count]:
+        delta_str = ' '.join(metric_name + ' ' + '{:+.3f}'.format(metric_dict[metric_name]['key_delta_array'][group_idx]) for metric_name in metric_name_list)
+        print('    ' + keyString(unique_key_matrix[group_idx], key_name_list, table_name)
+              + '  rows ' + str(key_row_count_a[group_idx]) + '->' + str(key_row_count_b[group_idx]) + '  ' + delta_str)
+
+    return diff_dict
+
+
+def readRun(run_spec, table_name, column_name_list, parquet_dir, cnxn_cursor):
+    if run_spec.startswith('sql:'):
+        return readSqlRun(cnxn_cursor, table_name, run_spec[len('sql:'):], column_name_list)
+    if parquet_dir is None:
+        raise ValueError('run ' + run_spec + ' is a Parquet run, --parquet-dir is required')
+    return readParquetRun(parquet_dir, table_name, run_spec, column_name_list)
+
+
+def diffRuns(run_a, run_b, table_name_list = None, parquet_dir = None, parquet_dir_b = None, tolerance = 1e-6, top_count = 10):
+
+#     goal: diff two runs over the fact tables
+
+#     input: run specs of A and B (sql:<filter>, <RunLoadDate>, or latest), tables to compare (default all in diff_spec_dict),
+#            Parquet export root of A and of B (B defaults to A), tolerance and number of printed keys per table
+
+#     output: list of diffTable dictionaries
+
+    if table_name_list is None:
+        table_name_list = list(diff_spec_dict.keys())
+    if parquet_dir_b is None:
+        parquet_dir_b = parquet_dir
+
+    cnxn = None
+    cnxn_cursor = None
+    if run_a.startswith('sql:') or run_b.startswith('sql:'):
+        import pyodbc
+        cnxn = pyodbc.connect(connectionString())
+        cnxn_cursor = cnxn.cursor()
+
+    diff_dict_list = []
+    try:
+        for table_name in table_name_list:
+            (key_name_list, metric_name_list) = diff_spec_dict[table_name]
+            column_name_list = key_name_list + metric_name_list
+            column_dict_a = readRun(run_a, table_name, column_name_list, parquet_dir, cnxn_cursor)
+            column_dict_b = readRun(run_b, table_name, column_name_list, parquet_dir_b, cnxn_cursor)
+            diff_dict_list += [diffTable(table_name, column_dict_a, column_dict_b, tolerance, top_count)]
+    finally:
+        if cnxn is not None:
+            cnxn_cursor.close()
+            cnxn.close()
+
+    # short demand is the customer facing result of the allocations
+    for diff_dict in diff_dict_list:
+        if diff_dict['table_name'] == 'CustomerShortDemand_Facts':
+            print('short demand delta (B - A): {:.3f}'.format(diff_dict['metric_dict']['ShortDemandQty']['delta']))
+
+    return diff_dict_list
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Gotham Greens run to run diff of the fact table outputs')
+    run_help = ('sql:<YYYY-mm-dd> (all rows loaded that day, including superseded IsActive = 0 rows), sql:<from>..<to> (LoadDate range), '
+                'sql:active (IsActive = 1 rows, optionally ,<YYYY-mm-dd> or ,<from>..<to>), a RunLoadDate of the Parquet export, or latest')
+    parser.add_argument('run_a', help = 'run A: ' + run_help)
+    parser.add_argument('run_b', help = 'run B: ' + run_help)
+    parser.add_argument('--parquet-dir', default = None, help = 'Parquet export root of run A (and of run B unless --parquet-dir-b is set)')
+    parser.add_argument('--parquet-dir-b', default = None, help = 'Parquet export root of run B')
+    parser.add_argument('--tables', nargs = '+', choices = list(diff_spec_dict.keys()), default = None, help = 'fact tables to compare (default all)')
+    parser.add_argument('--tolerance', type = float, default = 1e-6, help = 'absolute quantity difference per key that counts as equal')
+    parser.add_argument('--top', type = int, default = 10, help = 'number of differing keys printed per table')
+    args = parser.parse_args(argv)
+
+    diff_dict_list = diffRuns(args.run_a, args.run_b, args.tables, args.parquet_dir, args.parquet_dir_b, args.tolerance, args.top)
+
+    if any(diff_dict['is_different'] for diff_dict in diff_dict_list):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())